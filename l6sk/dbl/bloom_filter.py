@@ -0,0 +1,58 @@
+""" bloom_filter.py
+A plain Bloom filter over str keys. Used by segment files to tell "this segment definitely has no records for
+session X" w/o reading it. Fixed size, no deletes, serializes to/from bytes as is (the bit array is the format).
+"""
+
+import hashlib
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ Constants
+# k = 7 is optimal at ~10 bits per key, which gives ~1% false positives. Going over that many keys just raises the
+# false positive rate, nothing breaks.
+DEFAULT_NUM_HASHES = 7
+
+
+class BloomFilter:
+    """ num_bytes * 8 bits, num_hashes bit positions per key. Positions come from one blake2b digest per key, split in
+    two 64 bit halves for double hashing (h1 + i * h2). """
+
+    def __init__(self, num_bytes: int, num_hashes: int = DEFAULT_NUM_HASHES, bits: bytes = None):
+        super().__init__()
+
+        assert num_bytes > 0
+
+        self._num_bits = num_bytes * 8
+        self._num_hashes = num_hashes
+
+        if bits is None:
+            self._bits = bytearray(num_bytes)
+        else:
+            assert len(bits) == num_bytes
+            self._bits = bytearray(bits)
+
+    @property
+    def num_bytes(self) -> int:
+        return len(self._bits)
+
+    def _positions(self, key: str):
+
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+
+        return [(h1 + i * h2) % self._num_bits for i in range(self._num_hashes)]
+
+    def add(self, key: str):
+
+        for pos in self._positions(key):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, key: str) -> bool:
+        """ False means key was never added. True means it probably was. """
+
+        bits = self._bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._bits)
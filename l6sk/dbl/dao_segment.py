@@ -0,0 +1,306 @@
+""" dao_segment.py
+This module provides an implementation of the l6sk Database Layer on append-only segment files, no sqlite.
+Each log group is a directory of segment files (see segment_lgrp.py). Meant for pure append-and-scan workloads,
+serves the same DBL_API log record ops as the sqlite DAOs, so dbl_service_thread_entry can run either one. (except
+the ones off what sqlite log groups keep at ingest: histograms, session diffs, templates. Those get a 501)
+Old segments can be compacted into column oriented archive files (see segment_archive.py) by a background thread.
+"""
+
+import os
+import sys
+import time
+import threading
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ
+from l6sk.dbl.dbl_api import DBL_API, DBL_FAIL_CAUSE, LGR_APPEND_ARGS, LGR_QUERY, get_lgrp_opts, is_valid_lgrp_name
+from l6sk.dbl.dbl_api import LGR_MULTI_QUERY, LGR_EXPORT, LGR_FIELDS, LgrQueryError, get_srv_ts_usec
+from l6sk.dbl.segment_lgrp import SegmentLogGroup
+from l6sk.dbl.lgr_export import LgrExport, iter_no_chunks
+from l6sk.dbl.lgr_multi_query import LgrpQueryMerge
+
+from l6sk import log_util as log
+
+
+class SegmentDAO:
+    """ l6sk DAO interface backed by append-only segment files. """
+
+    def __init__(self,
+                 dirname: str,
+                 lgrp_opts: dict = None,
+                 segment_size: int = 64 * 1024 * 1024,
+                 sync_appends: bool = True,
+                 index_every: int = 128,
+                 bloom_bytes: int = 4096,
+                 archive_after: float = None,
+                 archive_interval: float = 600.0,
+                 archive_chunk_rows: int = 8192,
+                 export_chunk_rows: int = 1000,
+                 export_max_pending: int = 4,
+                 export_stall_timeout: float = 60.0):
+        super().__init__()
+
+        log.info("Initializing segment file DAO ...")
+
+        # log group <name> lives in <dirname>/lgrp_<name>/
+        self._dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+
+        # segment_size, sync_appends, index_every, bloom_bytes are the defaults for every log group (see
+        # SegmentLogGroup). lgrp_opts can override them per log group (see dbl_api.get_lgrp_opts()). Options that
+        # dont mean anything to segment files (ie the sqlite msg compression ones) are ignored.
+        self._lgrp_opts = lgrp_opts
+        self._segment_size = segment_size
+        self._sync_appends = sync_appends
+        self._index_every = index_every
+        self._bloom_bytes = bloom_bytes
+
+        # lgrp name -> SegmentLogGroup. opened on first use. Reads are served on the DBL worker, a scan is just
+        # a walk over mmap()ed files. There are no connections to pool or reconnect.
+        self._lgrps = {}
+
+        # exports read export_chunk_rows records at a time, upto export_max_pending encoded chunks wait for the client.
+        # (see lgr_export.py)
+        self._export_chunk_rows = export_chunk_rows
+        self._export_max_pending = export_max_pending
+        self._export_stall_timeout = export_stall_timeout
+
+        # ******************** archiving
+        # every archive_interval seconds a background thread compacts the sealed segments whose records are all
+        # older than archive_after seconds into archive files. (archive_chunk_rows rows per column chunk)
+        # None means never. Can be set per log group too. (lgrp_opts 'archive_after')
+        self._archive_after = archive_after
+        self._archive_interval = archive_interval
+        self._archive_chunk_rows = archive_chunk_rows
+
+        archive_enabled = (archive_after is not None) or any('archive_after' in opts
+                                                             for opts in (lgrp_opts or {}).values())
+        if archive_enabled:
+            t = threading.Thread(target=self._archive_thread_entry, name="dbl_segment_archive_thread")
+            t.daemon = True
+            t.start()
+
+        log.dbg("SegmentDAO is initialized.")
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ========================================================================================== top level request entry
+    def serve_req(self, req: DBL_REQ):
+        """ Serve the DB request contained in req, and set the result or cause of failure on it when done. """
+
+        # NOTE: reminder that if either one of <req.fail_cause, req.succ_data> is not None, req to be treated as done.
+        try:
+            result = self._decode_and_exec_req(req)
+            req.succ_data = result
+        except NotImplementedError as ex:
+            req.fail_cause = DBL_FAIL_CAUSE(http_err_code=501,
+                                            user_msg=str(ex),
+                                            dbg_info_string=f"SegmentDAO: {req.op}")
+        except LgrQueryError as ex:
+            req.fail_cause = DBL_FAIL_CAUSE(http_err_code=400,
+                                            user_msg=str(ex),
+                                            dbg_info_string=str(ex))
+        except Exception as ex:
+            req.fail_cause = DBL_FAIL_CAUSE(http_err_code=500,
+                                            user_msg='Internal Server Error',
+                                            dbg_info_string=str(ex))
+
+    def _decode_and_exec_req(self, req: DBL_REQ):
+
+        if req.op in {DBL_API.HEALTH_CHK_1}:
+            return self.health_check_v1()
+
+        if req.op in {DBL_API.HEALTH_CHK_2}:
+            return self.health_check_v2()
+
+        if req.op in {DBL_API.HEALTH_CHK_3}:
+            return self.health_check_v3()
+
+        if req.op in {DBL_API.APPEND_LGRS, DBL_API.APPEND_LGRS_DURABLE}:
+            return self.append_lgrs(req.data)
+
+        if req.op in {DBL_API.QUERY_LGRS}:
+            return self.query_lgrs(req.data)
+
+        if req.op in {DBL_API.QUERY_MULTI_LGRS}:
+            return self.query_multi_lgrs(req.data)
+
+        if req.op in {DBL_API.EXPORT_LGRS}:
+            return self.export_lgrs(req.data)
+
+        # no full text index here, never anything to do.
+        if req.op in {DBL_API.INDEX_FTS}:
+            return {'indexed': 0, 'backlog': 0}
+
+        # these are off what the sqlite log groups keep at ingest (rollups, session summaries, templates). Segments
+        # only have the records. 501, the request is fine, this server's storage cant do it.
+        if req.op in {DBL_API.HISTOGRAM_LGRS, DBL_API.DIFF_SESSIONS, DBL_API.TOP_TEMPLATES}:
+            raise NotImplementedError(f"Not supported w/ the segment file storage: {req.op}")
+
+        raise NotImplementedError(f"DBL op not supported by SegmentDAO: {req.op}")
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ====================================================================================================== Log Records
+    def _get_lgrp_dirname(self, lgrp: str) -> str:
+        return os.path.join(self._dirname, f"lgrp_{lgrp}")
+
+    def _get_lgrp(self, lgrp: str, create: bool = True) -> SegmentLogGroup:
+        """ Return the SegmentLogGroup for the given log group name, open (or create) its directory on first use.
+        create False (reads): None if there is no directory. """
+
+        lgrp_store = self._lgrps.get(lgrp)
+
+        if lgrp_store is None:
+            # log group names become directory names.
+            if not is_valid_lgrp_name(lgrp):
+                raise ValueError(f"Invalid log group name: {lgrp}")
+
+            if (not create) and (not os.path.isdir(self._get_lgrp_dirname(lgrp))):
+                return None
+
+            opts = get_lgrp_opts(self._lgrp_opts, lgrp)
+            lgrp_store = SegmentLogGroup(lgrp,
+                                         self._get_lgrp_dirname(lgrp),
+                                         segment_size=opts.get('segment_size', self._segment_size),
+                                         sync_appends=opts.get('sync_appends', self._sync_appends),
+                                         index_every=opts.get('index_every', self._index_every),
+                                         bloom_bytes=opts.get('bloom_bytes', self._bloom_bytes),
+                                         archive_chunk_rows=self._archive_chunk_rows)
+            self._lgrps[lgrp] = lgrp_store
+
+        return lgrp_store
+
+    def append_lgrs(self, args: LGR_APPEND_ARGS) -> int:
+        # segments dont record args.journal_seq. A journal replay after a crash re-appends the entries that were
+        # applied but not yet marked applied in the journal, ie the last few ms worth. (see ingest_journal.py)
+        return self._get_lgrp(args.lgrp).append_lgrs(args.lgrs)
+
+    def query_lgrs(self, query: LGR_QUERY) -> dict:
+
+        # reads dont create log groups.
+        lgrp_store = self._get_lgrp(query.lgrp, create=False)
+        if lgrp_store is None:
+            return {'fields': LGR_FIELDS, 'lgrs': [], 'stats': {}}
+
+        return lgrp_store.query_lgrs(query)
+
+    def _get_lgrp_names(self) -> list:
+        """ Every log group there is, open or only on disk so far. Sorted. """
+
+        names = set(self._lgrps)
+        for fname in os.listdir(self._dirname):
+            if fname.startswith("lgrp_") and is_valid_lgrp_name(fname[len("lgrp_"):]):
+                names.add(fname[len("lgrp_"):])
+
+        return sorted(names)
+
+    def query_multi_lgrs(self, mquery: LGR_MULTI_QUERY) -> dict:
+        """ The log groups one after the other, on the DBL worker. A scan here is a walk over mmap()ed files, theres
+        no connection to hand another thread. The early stop still saves the groups after the first full page most of
+        their scan. """
+
+        lgrps = self._get_lgrp_names() if mquery.lgrps is None else list(mquery.lgrps)
+        merge = LgrpQueryMerge(mquery, lgrps, LGR_FIELDS)
+
+        for lgrp in lgrps:
+            merge.run_lgrp(lgrp, self.query_lgrs)
+
+        return merge.get_result()
+
+    def export_lgrs(self, args: LGR_EXPORT) -> LgrExport:
+        """ Start an export. The segments are picked here, on the DBL worker, and read on the export thread. The export
+        stops at the records there were when it started. """
+
+        lgrp_store = self._get_lgrp(args.query.lgrp, create=False)
+        if lgrp_store is None:
+            chunks = iter_no_chunks()
+        else:
+            chunks = lgrp_store.iter_lgrs(args.query, chunk_size=self._export_chunk_rows)
+
+        return LgrExport(LGR_FIELDS, lambda: chunks, fmt=args.fmt, gzip=args.gzip,
+                         max_pending=self._export_max_pending, stall_timeout=self._export_stall_timeout)
+
+    def archive_lgrps(self) -> int:
+        """ Archive the old enough segments of every open log group. Return how many segments were archived. """
+
+        num_archived = 0
+
+        for lgrp, lgrp_store in list(self._lgrps.items()):
+            archive_after = get_lgrp_opts(self._lgrp_opts, lgrp).get('archive_after', self._archive_after)
+            if archive_after is None:
+                continue
+
+            num_archived += lgrp_store.archive_segments(get_srv_ts_usec() - int(archive_after * 1000000))
+
+        return num_archived
+
+    def _archive_thread_entry(self):
+
+        log.info(f"SegmentDAO archive thread started. Interval: {self._archive_interval} seconds")
+
+        while True:
+            time.sleep(self._archive_interval)
+
+            # never let this thread die. a failed run (disk full, ...) might work next time.
+            try:
+                start_time = time.perf_counter()
+                num_archived = self.archive_lgrps()
+                if num_archived:
+                    log.dbg(f"Archived {num_archived} segments in {(time.perf_counter() - start_time):.1f} seconds")
+            except Exception as ex:
+                log.err(f"Failed to archive segments: {ex}")
+
+    def close(self):
+        """ Unmap and close every segment file. Only really needed by tests, the DAO normally lives as long as the
+        process. """
+
+        for lgrp_store in self._lgrps.values():
+            lgrp_store.close()
+
+        self._lgrps = {}
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ============================================================================================ Health Check Services
+    def health_check_v1(self) -> str:
+        """ Return a non empty string indicating healthy communication to the DAO. """
+
+        return "DBL health check: OK"
+
+    def _get_hchk_filename(self) -> str:
+        return os.path.join(self._dirname, "hchk_sentinel")
+
+    def health_check_v2(self) -> dict:
+        """ Timed listing of the data directory. There are no tables here, thats the read every log group open is. """
+
+        start_time = time.perf_counter()
+        os.listdir(self._dirname)
+
+        return {'hchk': "DBL health check v2: OK", 'dao_exec_ms': (time.perf_counter() - start_time) * 1000}
+
+    def health_check_v3(self) -> dict:
+        """ Timed write, fsync() and delete of a sentinel file in the data directory. """
+
+        start_time = time.perf_counter()
+        hchk_filename = self._get_hchk_filename()
+
+        fd = os.open(hchk_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, str(get_srv_ts_usec()).encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.remove(hchk_filename)
+
+        return {'hchk': "DBL health check v3: OK", 'dao_exec_ms': (time.perf_counter() - start_time) * 1000}
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================================
+def main():
+    pass
+
+
+if '__main__' == __name__:
+    main()
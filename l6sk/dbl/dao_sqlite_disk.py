@@ -10,7 +10,16 @@ import errno
 import threading
 
 from l6sk.dbl.dbl_dispatch import DBL_REQ
-from l6sk.dbl.dbl_api import DBL_API
+from l6sk.dbl.dbl_api import DBL_API, DBL_READ_OPS, DBL_FAIL_CAUSE, LGR_APPEND_ARGS, LGR_QUERY, get_lgrp_opts
+from l6sk.dbl.dbl_api import LGR_HISTOGRAM, LGR_EXPORT, LGR_SESSION_DIFF, LGR_TEMPLATE_TOP, is_valid_lgrp_name
+from l6sk.dbl.dbl_api import LGR_MULTI_QUERY, LgrQueryError, get_srv_ts_usec
+from l6sk.dbl.sqlite_lgrp import SqliteLogGroup, SQLITE_LGR_FIELDS, get_no_lgrp_result
+from l6sk.dbl.lgr_query_cache import LgrQueryCache
+from l6sk.dbl.lgr_export import LgrExport, iter_no_chunks
+from l6sk.dbl.lgr_multi_query import LgrpQueryMerge
+from l6sk.dbl.sqlite_read_pool import SqliteReadPool, open_read_conn
+from l6sk.dbl.sqlite_archive import LgrpArchive, find_archives, archive_lgrp, query_tiers, iter_tiers, list_hot_lgrps
+from l6sk.dbl.sqlite_maint import WalCheckpointer, incremental_vacuum_step, hchk_read, hchk_write
 
 from l6sk.crypt_util import get_auth_kdf
 
@@ -18,12 +27,36 @@ from l6sk import knobman as km
 from l6sk import log_util as log
 
 
+def _get_lrid_range_archives(archives: list, lrid_range: tuple) -> list:
+    """ The archives that can have records in lrid_range. (a query cache delta is usually none of them) """
+
+    if (lrid_range is None) or (lrid_range[0] is None):
+        return archives
+
+    return [arc for arc in archives if arc.max_lrid > lrid_range[0]]
+
+
 class DAO_SQLITE:
     """ Sqlite implementation of the l6sk DAO interface. """
 
     # This class should take its knobs as constructor args for consistency and ease of testing.
     # if knobman is used it should be in some sort of module level lazy init function. Not inside this class.
-    def __init__(self, db_filename: str):
+    def __init__(self,
+                 db_filename: str,
+                 lgrp_dirname: str = None,
+                 lgrp_opts: dict = None,
+                 num_readers: int = 2,
+                 archive_after: float = None,
+                 archive_partition: float = 24 * 3600.0,
+                 archive_interval: float = 600.0,
+                 checkpoint_interval: float = 1.0,
+                 wal_max_bytes: int = 64 * 1024 * 1024,
+                 vacuum_step_pages: int = 128,
+                 query_cache_bytes: int = None,
+                 query_cache_max_delta: int = 10000,
+                 export_chunk_rows: int = 1000,
+                 export_max_pending: int = 4,
+                 export_stall_timeout: float = 60.0):
         super().__init__()
 
         log.info("Initializing sqlite DAO")
@@ -38,6 +71,27 @@ class DAO_SQLITE:
         # lifecycle management. Altho its probably fine for long enof to use for dev.
         self._db_filename = db_filename
 
+        # each log group is a separate db file in this directory. defaults to next to the main db file.
+        if lgrp_dirname is None:
+            lgrp_dirname = os.path.dirname(os.path.abspath(db_filename))
+
+        self._lgrp_dirname = lgrp_dirname
+
+        # per log group options (SqliteLogGroup kwargs). see dbl_api.get_lgrp_opts()
+        self._lgrp_opts = lgrp_opts
+
+        # query results, upto query_cache_bytes of them. None means no cache. (see lgr_query_cache.py) Shared by the
+        # DBL worker and the reader threads.
+        self._query_cache = None
+        if query_cache_bytes:
+            self._query_cache = LgrQueryCache(max_bytes=query_cache_bytes, max_delta=query_cache_max_delta)
+
+        # exports read export_chunk_rows records at a time, upto export_max_pending encoded chunks wait for the client.
+        # (see lgr_export.py)
+        self._export_chunk_rows = export_chunk_rows
+        self._export_max_pending = export_max_pending
+        self._export_stall_timeout = export_stall_timeout
+
         # In an old version of this we tried to assert that connection can be opened here even tho we dont want to
         # open just yet. And if fails refuse to init. This is bad idea. You dont want to be that hard to init.
         # dont reach for os._exit() every time there is a network error.
@@ -45,6 +99,47 @@ class DAO_SQLITE:
         # conn management bits and buffers.
         self._curr_conn = None
 
+        # lgrp name -> SqliteLogGroup. log group files are opened on first use.
+        self._lgrps = {}
+
+        # Log group dbs are in WAL mode. The connections above are the writers and are only used by the DBL worker.
+        # Read ops (DBL_READ_OPS) go to a pool of reader threads w/ their own read-only connections. So a slow
+        # dashboard query doesnt hold up the inserts queued behind it. WAL gives each read a consistent snapshot
+        # while ingest goes on. 0 readers means do everything on the DBL worker.
+        # Threads are started lazily, DAO is created on the DBL worker thread and we dont want threads at import time.
+        self._num_readers = num_readers
+        self._read_pool = None
+
+        # ******************** hot/cold tiering
+        # every archive_interval seconds a background thread moves each log group's partitions (archive_partition
+        # seconds of srv_ts) that are older than archive_after seconds out to read-only archive dbs. Queries fan out
+        # to the archives that overlap them. (see sqlite_archive.py) archive_after None means keep it all hot.
+        # lgrp name -> [LgrpArchive, ...] sorted by partition. loaded on first use. The archive thread adds to it.
+        self._archive_after = archive_after
+        self._archive_partition = archive_partition
+        self._archive_interval = archive_interval
+        self._archives = {}
+        self._archives_lock = threading.Lock()
+
+        if archive_after is not None:
+            t = threading.Thread(target=self._archive_thread_entry, name="dbl_sqlite_archive_thread")
+            t.daemon = True
+            t.start()
+
+        # ******************** maintenance (see sqlite_maint.py)
+        # The DBL worker calls run_maintenance() between requests and when its idle. (dbl_service_thread_entry)
+        # Writers dont checkpoint on their own, the log groups written to get a WalCheckpointer run every
+        # checkpoint_interval seconds, or as soon as the worker is idle. WALs over wal_max_bytes get reset/truncated.
+        # checkpoint_interval None means leave it to sqlite's automatic checkpoints.
+        # Idle time also goes to incremental_vacuum, vacuum_step_pages pages at a time.
+        self._checkpoint_interval = checkpoint_interval
+        self._wal_max_bytes = wal_max_bytes
+        self._vacuum_step_pages = vacuum_step_pages
+        self._checkpointers = {}
+        self._next_checkpoint = time.monotonic() + (checkpoint_interval or 0)
+        self._lgrps_written = set()
+        self._lgrps_to_vacuum = []
+
         log.dbg("Sqlite DAO init complete.")
 
     # ==================================================================================================================
@@ -92,42 +187,451 @@ class DAO_SQLITE:
     # ==================================================================================================================
     # ========================================================================================== top level request entry
     # ==================================================================================================================
-    def process_req(self, req: DBL_REQ):
-        """ Process the DB request contained in req, and set the result or cause of failure on it also. """
+    def serve_req(self, req: DBL_REQ):
+        """ Serve the DB request contained in req, and set the result or cause of failure on it when done. """
 
+        # NOTE: reminder that if either one of <req.fail_cause, req.succ_data> is not None, req to be treated as done.
         try:
-            result = dao.prcoess_req(next_req)
-            next_req.succ_data = result
+            # read ops are finished by a reader thread. not done yet when this returns, thats fine.
+            if (req.op in DBL_READ_OPS) and self._num_readers > 0:
+                self._submit_read_req(req)
+                return
+
+            result = self._decode_and_exec_req(req)
+            req.succ_data = result
             # Done, could return here.
         # maybe extra except clauses to catch specific errors and set corresponding msgs and http codes.
+        except LgrQueryError as ex:
+            req.fail_cause = DBL_FAIL_CAUSE(http_err_code=400,
+                                            user_msg=str(ex),
+                                            dbg_info_string=str(ex))
         except Exception as ex:
-            next_req.fail_cause = DBL_REQ_FAIL_CAUSE(http_err_code=500,
-                                                     user_msg='Internal Server Error',
-                                                     dbg_data=str(ex))
+            req.fail_cause = DBL_FAIL_CAUSE(http_err_code=500,
+                                            user_msg='Internal Server Error',
+                                            dbg_info_string=str(ex))
 
-    def _process_req(self, req: DBL_REQ):
+    def _decode_and_exec_req(self, req: DBL_REQ):
 
         # request args: <req.op, req.data>
         # result: <req.fail_cause, req.succ_data> if either is not None, request is to be treated as finished
 
         if req.op in {DBL_API.HEALTH_CHK_1}:
-            pass
-        elif req.op in {DBL_API.HEALTH_CHK_2}:
-            pass
-        elif req.op in {DBL_API.HEALTH_CHK_3}:
-            pass
+            return self.health_check_v1()
+
+        if req.op in {DBL_API.HEALTH_CHK_2}:
+            return self.health_check_v2()
+
+        if req.op in {DBL_API.HEALTH_CHK_3}:
+            return self.health_check_v3()
+
+        if req.op in {DBL_API.APPEND_LGRS, DBL_API.APPEND_LGRS_DURABLE}:
+            return self.append_lgrs(req.data)
+
+        if req.op in {DBL_API.QUERY_LGRS}:
+            return self.query_lgrs(req.data)
+
+        if req.op in {DBL_API.QUERY_MULTI_LGRS}:
+            return self.query_multi_lgrs(req.data)
+
+        if req.op in {DBL_API.INDEX_FTS}:
+            return self.index_fts(req.data)
+
+        if req.op in {DBL_API.HISTOGRAM_LGRS}:
+            return self.histogram_lgrs(req.data)
+
+        if req.op in {DBL_API.EXPORT_LGRS}:
+            return self.export_lgrs(req.data)
+
+        if req.op in {DBL_API.DIFF_SESSIONS}:
+            return self.diff_sessions(req.data)
+
+        if req.op in {DBL_API.TOP_TEMPLATES}:
+            return self.top_templates(req.data)
+
+        raise NotImplementedError(f"DBL op not supported by DAO_SQLITE: {req.op}")
+
+    def _submit_read_req(self, req: DBL_REQ):
+        """ Hand a read op over to the reader pool. Anything that needs the writer (ie opening a log group's db
+        the first time its seen) is done here, on the DBL worker, before handing it over. """
+
+        if self._read_pool is None:
+            self._read_pool = SqliteReadPool(num_readers=self._num_readers)
+
+        if req.op in {DBL_API.QUERY_LGRS}:
+            query_work = self._get_query_work(req.data.lgrp)
+            query = req.data
+
+            def work(get_conn):
+                return query_work(query, get_conn)
+
+            self._read_pool.submit(req, work)
+            return
+
+        if req.op in {DBL_API.QUERY_MULTI_LGRS}:
+            # a work item per log group, so they run on as many readers as there are. Nothing waits on them, the
+            # group that finishes last sets req's result.
+            mquery = req.data
+            lgrps = self._get_multi_query_lgrps(mquery)
+            merge = LgrpQueryMerge(mquery, lgrps, SQLITE_LGR_FIELDS)
+
+            if not lgrps:
+                req.succ_data = merge.get_result()
+                return
+
+            # every log group is opened before any of them is submitted, a group that cant be fails req right here.
+            query_works = [(lgrp, self._get_query_work(lgrp)) for lgrp in lgrps]
+
+            for lgrp, query_work in query_works:
+
+                def work(get_conn, lgrp=lgrp, query_work=query_work):
+                    if merge.run_lgrp(lgrp, lambda query: query_work(query, get_conn)):
+                        merge.set_result(req)
+
+                self._read_pool.submit(DBL_REQ(op=DBL_API.QUERY_LGRS), work)
+            return
+
+        if req.op in {DBL_API.HISTOGRAM_LGRS}:
+            lgrp_store = self._get_lgrp(req.data.lgrp, create=False)
+            if lgrp_store is None:
+                req.succ_data = get_no_lgrp_result(req.data)
+                return
+
+            lgrp_filename = self._get_lgrp_filename(req.data.lgrp)
+            hist = req.data
+
+            def work(get_conn):
+                return lgrp_store.histogram_lgrs(hist, conn=get_conn(lgrp_filename, on_open=lgrp_store.prepare_conn))
+
+            self._read_pool.submit(req, work)
+            return
+
+        if req.op in {DBL_API.DIFF_SESSIONS}:
+            lgrp_store = self._get_lgrp(req.data.lgrp, create=False)
+            if lgrp_store is None:
+                req.succ_data = get_no_lgrp_result(req.data)
+                return
+
+            lgrp_filename = self._get_lgrp_filename(req.data.lgrp)
+            diff = req.data
+
+            def work(get_conn):
+                return lgrp_store.diff_sessions(diff, conn=get_conn(lgrp_filename, on_open=lgrp_store.prepare_conn))
+
+            self._read_pool.submit(req, work)
+            return
+
+        if req.op in {DBL_API.TOP_TEMPLATES}:
+            lgrp_store = self._get_lgrp(req.data.lgrp, create=False)
+            if lgrp_store is None:
+                req.succ_data = get_no_lgrp_result(req.data)
+                return
+
+            lgrp_filename = self._get_lgrp_filename(req.data.lgrp)
+            top = req.data
+
+            def work(get_conn):
+                return lgrp_store.top_templates(top, conn=get_conn(lgrp_filename, on_open=lgrp_store.prepare_conn))
+
+            self._read_pool.submit(req, work)
+            return
+
+        # a read op that has no reader side implementation, serve it here.
+        req.succ_data = self._decode_and_exec_req(req)
 
     # ==================================================================================================================
     # =============================================================================================== API: Health Checks
     # ==================================================================================================================
-    def health_check_v1(self):
-        pass
+    def health_check_v1(self) -> str:
+        """ Return a non empty string indicating healthy communication to the DAO. """
+
+        return "DBL health check: OK"
+
+    def _get_hchk_connection(self) -> sqlite3.Connection:
+
+        conn = self._get_db_connection()
+        if conn is None:
+            raise RuntimeError(f"No db connection to: {self._db_filename}")
+
+        return conn
+
+    def health_check_v2(self) -> dict:
+        """ Timed read on the main db file. """
+
+        return {'hchk': "DBL health check v2: OK", 'dao_exec_ms': hchk_read(self._get_hchk_connection())}
+
+    def health_check_v3(self) -> dict:
+        """ Timed write and delete of a row in a sentinel table in the main db file. """
+
+        return {'hchk': "DBL health check v3: OK", 'dao_exec_ms': hchk_write(self._get_hchk_connection())}
+
+    # ==================================================================================================================
+    # ====================================================================================================== Log Records
+    # ==================================================================================================================
+    def _get_lgrp_filename(self, lgrp: str) -> str:
+        return os.path.join(self._lgrp_dirname, f"lgrp_{lgrp}.db")
+
+    def _get_lgrp(self, lgrp: str, create: bool = True) -> SqliteLogGroup:
+        """ Return the SqliteLogGroup for the given log group name, open (or create) its db file on first use.
+        create False (reads): None if there is no db file. """
+
+        lgrp_store = self._lgrps.get(lgrp)
+
+        if lgrp_store is None:
+            # log group names become file names. dont let them be anything but plain names.
+            if not is_valid_lgrp_name(lgrp):
+                raise ValueError(f"Invalid log group name: {lgrp}")
+
+            lgrp_filename = self._get_lgrp_filename(lgrp)
+            if (not create) and (not os.path.exists(lgrp_filename)):
+                return None
+            conn = sqlite3.connect(lgrp_filename, isolation_level=None)
+
+            # only takes on a new db (before the first table). An existing one would need a VACUUM to switch.
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+
+            # WAL is persistent, its a property of the db file. but its cheap to assert it on every open.
+            conn.execute("PRAGMA journal_mode = WAL;")
+            lgrp_store = SqliteLogGroup(lgrp, conn, **get_lgrp_opts(self._lgrp_opts, lgrp))
+            self._lgrps[lgrp] = lgrp_store
+
+            if self._checkpoint_interval is not None:
+                conn.execute("PRAGMA wal_autocheckpoint = 0;")
+                self._checkpointers[lgrp] = WalCheckpointer(conn, lgrp_filename, self._wal_max_bytes)
+
+        return lgrp_store
+
+    def append_lgrs(self, args: LGR_APPEND_ARGS) -> int:
+        lgrp_store = self._get_lgrp(args.lgrp)
+        self._lgrps_written.add(args.lgrp)
+        return lgrp_store.append_lgrs(args.lgrs, journal_seq=args.journal_seq)
+
+    def query_lgrs(self, query: LGR_QUERY) -> dict:
+
+        lgrp_store = self._get_lgrp(query.lgrp, create=False)
+        if lgrp_store is None:
+            return get_no_lgrp_result(query)
+
+        archives = self._get_archives(query.lgrp)
+
+        def run_query(lrid_range):
+            return query_tiers(query, lambda query: lgrp_store.query_lgrs(query, lrid_range=lrid_range),
+                               _get_lrid_range_archives(archives, lrid_range),
+                               lambda arc, query: arc.store.query_lgrs(query, lrid_range=lrid_range))
+
+        return self._cached_query(lgrp_store, query, run_query)
+
+    def _get_query_work(self, lgrp: str):
+        """ A query_work(query, get_conn) that runs query on lgrp (hot db and archives, thru the query cache) off a
+        reader's connections. Call it on the DBL worker, opening a log group needs the writer. """
+
+        lgrp_store = self._get_lgrp(lgrp, create=False)
+        if lgrp_store is None:
+            return lambda query, get_conn: get_no_lgrp_result(query)
+
+        lgrp_filename = self._get_lgrp_filename(lgrp)
+        archives = self._get_archives(lgrp)
+
+        def query_work(query, get_conn):
+
+            def run_query(lrid_range):
+
+                def hot_query(query):
+                    return lgrp_store.query_lgrs(query, lrid_range=lrid_range,
+                                                 conn=get_conn(lgrp_filename, on_open=lgrp_store.prepare_conn))
+
+                def arc_query(arc, query):
+                    return arc.store.query_lgrs(query, lrid_range=lrid_range,
+                                                conn=get_conn(arc.filename, on_open=arc.store.prepare_conn))
+
+                return query_tiers(query, hot_query, _get_lrid_range_archives(archives, lrid_range), arc_query)
+
+            return self._cached_query(lgrp_store, query, run_query)
+
+        return query_work
+
+    def query_multi_lgrs(self, mquery: LGR_MULTI_QUERY) -> dict:
+        """ W/o a reader pool, the log groups one after the other. """
+
+        lgrps = self._get_multi_query_lgrps(mquery)
+        merge = LgrpQueryMerge(mquery, lgrps, SQLITE_LGR_FIELDS)
+
+        for lgrp in lgrps:
+            merge.run_lgrp(lgrp, self.query_lgrs)
+
+        return merge.get_result()
+
+    def _get_multi_query_lgrps(self, mquery: LGR_MULTI_QUERY) -> list:
+        """ mquery's log groups, every one there is a db file of if it doesnt name them. (not just the open ones) """
+
+        if mquery.lgrps is not None:
+            return list(mquery.lgrps)
+
+        return [lgrp for lgrp in list_hot_lgrps(self._lgrp_dirname) if is_valid_lgrp_name(lgrp)]
+
+    def _cached_query(self, lgrp_store: SqliteLogGroup, query: LGR_QUERY, run_query) -> dict:
+        """ run_query(lrid_range) thru the query cache, if there is one. (see LgrQueryCache.query_lgrs()) """
+
+        if self._query_cache is None:
+            return run_query(None)
+
+        return self._query_cache.query_lgrs(query, lgrp_store.get_cache_mark(query), run_query,
+                                            lgrp_store.get_changed_lrids)
+
+    def histogram_lgrs(self, hist: LGR_HISTOGRAM) -> dict:
+        """ Rollups stay in the hot db when records are archived, no need to look at the archives. """
+        lgrp_store = self._get_lgrp(hist.lgrp, create=False)
+        return get_no_lgrp_result(hist) if lgrp_store is None else lgrp_store.histogram_lgrs(hist)
+
+    def diff_sessions(self, diff: LGR_SESSION_DIFF) -> dict:
+        """ Session summaries stay in the hot db when records are archived too. """
+        lgrp_store = self._get_lgrp(diff.lgrp, create=False)
+        return get_no_lgrp_result(diff) if lgrp_store is None else lgrp_store.diff_sessions(diff)
+
+    def top_templates(self, top: LGR_TEMPLATE_TOP) -> dict:
+        """ So do the template counts. """
+        lgrp_store = self._get_lgrp(top.lgrp, create=False)
+        return get_no_lgrp_result(top) if lgrp_store is None else lgrp_store.top_templates(top)
+
+    def export_lgrs(self, args: LGR_EXPORT) -> LgrExport:
+        """ Start an export. The export thread has read-only connections of its own to the hot db and the archives
+        (closed when its done), the hot db's read is one WAL snapshot for the whole export. """
+
+        query = args.query
+        lgrp_store = self._get_lgrp(query.lgrp, create=False)
+        if lgrp_store is None:
+            return LgrExport(SQLITE_LGR_FIELDS, iter_no_chunks, fmt=args.fmt, gzip=args.gzip)
+
+        lgrp_filename = self._get_lgrp_filename(query.lgrp)
+        chunk_size = self._export_chunk_rows
+
+        def iter_chunks():
+            conns = []
+
+            def iter_store(db_filename, store):
+                conn = open_read_conn(db_filename)
+                conns.append(conn)
+                store.prepare_conn(conn)
+                return store.iter_lgrs(query, conn=conn, chunk_size=chunk_size)
+
+            try:
+                yield from iter_tiers(query, lambda: iter_store(lgrp_filename, lgrp_store),
+                                      lambda: self._get_archives(query.lgrp),
+                                      lambda arc: iter_store(arc.filename, arc.store), chunk_size)
+            finally:
+                for conn in conns:
+                    conn.close()
+
+        return LgrExport(SQLITE_LGR_FIELDS, iter_chunks, fmt=args.fmt, gzip=args.gzip,
+                         max_pending=self._export_max_pending, stall_timeout=self._export_stall_timeout)
+
+    def index_fts(self, lgrp: str = None) -> dict:
+        """ One batch of full text indexing for lgrp, for every open log group if None. Totals of what they returned.
+        Archives are indexed whole when they are made, only hot dbs ever have a backlog. """
+
+        lgrps = list(self._lgrps) if lgrp is None else [lgrp]
+        totals = {'indexed': 0, 'backlog': 0}
+
+        for name in lgrps:
+            lgrp_store = self._get_lgrp(name, create=False)
+            if lgrp_store is None:
+                continue
+
+            res = lgrp_store.index_fts()
+            if res['indexed']:
+                self._lgrps_written.add(name)
+
+            for key, val in res.items():
+                totals[key] += val
+
+        return totals
+
+    # ==================================================================================================================
+    # ================================================================================================ Hot/cold tiering
+    # ==================================================================================================================
+    def _get_archives(self, lgrp: str) -> list:
+        """ lgrp's archives, sorted by partition. A copy, the archive thread might add to it any time. """
+
+        with self._archives_lock:
+            if lgrp not in self._archives:
+                self._archives[lgrp] = find_archives(self._lgrp_dirname, lgrp)
+
+            return list(self._archives[lgrp])
+
+    def _add_archive(self, lgrp: str, arc: LgrpArchive):
+
+        with self._archives_lock:
+            self._archives[lgrp] = sorted(self._archives[lgrp] + [arc], key=lambda arc: (arc.p_start, arc.max_lrid))
+
+    def archive_lgrps(self) -> int:
+        """ Move old partitions of every log group in lgrp_dirname (opened by this DAO yet or not) to archive dbs.
+        Return how many archives were created. """
+
+        archive_before = get_srv_ts_usec() - int(self._archive_after * 1000000)
+        partition_usec = int(self._archive_partition * 1000000)
+        num_archived = 0
+
+        for lgrp in list_hot_lgrps(self._lgrp_dirname):
+            if not is_valid_lgrp_name(lgrp):
+                continue
+
+            num_archived += archive_lgrp(self._lgrp_dirname, lgrp, self._get_archives(lgrp), archive_before,
+                                         partition_usec, lambda arc, lgrp=lgrp: self._add_archive(lgrp, arc))
+
+        return num_archived
+
+    def _archive_thread_entry(self):
+
+        log.info(f"DAO_SQLITE archive thread started. Interval: {self._archive_interval} seconds")
+
+        while True:
+            time.sleep(self._archive_interval)
+
+            # never let this thread die. a failed run (disk full, busy db, ...) might work next time.
+            try:
+                start_time = time.perf_counter()
+                num_archived = self.archive_lgrps()
+                if num_archived:
+                    log.dbg(f"Archived {num_archived} partitions in {(time.perf_counter() - start_time):.1f} seconds")
+            except Exception as ex:
+                log.err(f"Failed to archive log groups: {ex}")
+
+    # ==================================================================================================================
+    # ===================================================================================================== Maintenance
+    # ==================================================================================================================
+    def run_maintenance(self, idle: bool) -> bool:
+        """ Called by the DBL worker after every request (idle False) and when the queues have been empty for a while
+        (idle True). Runs the checkpoints that are due, and when idle, a step of incremental vacuum. Each call is a
+        small amount of work, the next request waits on it. Return True if there is more idle work to do. """
+
+        now = time.monotonic()
+
+        if self._lgrps_written and (idle or (now >= self._next_checkpoint)):
+            for lgrp in self._lgrps_written:
+                checkpointer = self._checkpointers.get(lgrp)
+                if checkpointer is not None:
+                    checkpointer.checkpoint()
+
+            self._lgrps_written = set()
+            self._next_checkpoint = now + (self._checkpoint_interval or 0)
+
+        if not idle:
+            return False
+
+        # one log group per call. A log group stays on the list until it has no free pages left.
+        if not self._lgrps_to_vacuum:
+            self._lgrps_to_vacuum = list(self._lgrps)
+            return False
+
+        lgrp = self._lgrps_to_vacuum[0]
+        if incremental_vacuum_step(self._lgrps[lgrp].conn, self._vacuum_step_pages) < self._vacuum_step_pages:
+            self._lgrps_to_vacuum.pop(0)
+
+        return bool(self._lgrps_to_vacuum)
 
-    def health_check_v2(self):
-        pass
+    def get_maint_stats(self) -> dict:
+        """ lgrp -> checkpoint counts. (see WalCheckpointer.counts) """
 
-    def health_check_v3(self):
-        pass
+        return {lgrp: dict(checkpointer.counts) for lgrp, checkpointer in self._checkpointers.items()}
 
     # ==================================================================================================================
     # ==================================================================================== API: GET_USERS (TODO replace)
@@ -1,6 +1,7 @@
 """ dao_sqlite.py
 This module provides implementation of the l6sk Database Layer using a in-memory sqlite instance.
-Everything is ephemeral here.
+Everything is ephemeral here, unless snapshots are turned on. Then log groups are periodically copied to disk
+and restored from there on the next start. (data loss is bounded by the snapshot interval)
 """
 
 import os
@@ -8,10 +9,18 @@ import sys
 import time
 import sqlite3
 import errno
+import queue
 import threading
 
 from l6sk.dbl.dbl_dispatch import DBL_REQ
-from l6sk.dbl.dbl_api import DBL_API, DBL_FAIL_CAUSE
+from l6sk.dbl.dbl_api import DBL_API, DBL_FAIL_CAUSE, LGR_APPEND_ARGS, LGR_QUERY, get_lgrp_opts, is_valid_lgrp_name
+from l6sk.dbl.dbl_api import LGR_HISTOGRAM, LGR_EXPORT, LGR_SESSION_DIFF, LGR_TEMPLATE_TOP, LGR_MULTI_QUERY
+from l6sk.dbl.dbl_api import LgrQueryError
+from l6sk.dbl.sqlite_lgrp import SqliteLogGroup, SQLITE_LGR_FIELDS, get_no_lgrp_result
+from l6sk.dbl.lgr_query_cache import LgrQueryCache
+from l6sk.dbl.lgr_export import LgrExport, iter_no_chunks
+from l6sk.dbl.lgr_multi_query import LgrpQueryMerge
+from l6sk.dbl.sqlite_maint import hchk_read, hchk_write
 
 from l6sk.crypt_util import get_auth_kdf
 
@@ -22,7 +31,15 @@ from l6sk import log_util as log
 class MemSqliteDAO:
     """ l6sk DAO interface backed by in-mem sqlite3. """
 
-    def __init__(self):
+    def __init__(self,
+                 lgrp_opts: dict = None,
+                 snapshot_dirname: str = None,
+                 snapshot_interval: float = 60.0,
+                 query_cache_bytes: int = None,
+                 query_cache_max_delta: int = 10000,
+                 export_chunk_rows: int = 1000,
+                 export_max_pending: int = 4,
+                 export_stall_timeout: float = 60.0):
         super().__init__()
 
         log.info("Initializing memory sqlite DAO ...")
@@ -36,6 +53,56 @@ class MemSqliteDAO:
         # before our queries if we didnt ask for it.
         self._db_conn = sqlite3.connect(":memory:", isolation_level=None)
 
+        # each log group is a separate memory db. lgrp name -> SqliteLogGroup. created on first use.
+        self._lgrps = {}
+
+        # per log group options (SqliteLogGroup kwargs). see dbl_api.get_lgrp_opts()
+        self._lgrp_opts = lgrp_opts
+
+        # query results, upto query_cache_bytes of them. None means no cache. (see lgr_query_cache.py)
+        self._query_cache = None
+        if query_cache_bytes:
+            self._query_cache = LgrQueryCache(max_bytes=query_cache_bytes, max_delta=query_cache_max_delta)
+
+        # exports read export_chunk_rows records at a time, upto export_max_pending encoded chunks wait for the client.
+        # (see lgr_export.py)
+        self._export_chunk_rows = export_chunk_rows
+        self._export_max_pending = export_max_pending
+        self._export_stall_timeout = export_stall_timeout
+
+        # ******************** snapshots
+        # if snapshot_dirname is set, every snapshot_interval seconds each log group's memory db is copied to
+        # <snapshot_dirname>/lgrp_<name>.snap.db. The copy is a serialize() of the db, taken by the DBL worker between
+        # requests (run_maintenance(), one log group per call) so its never in the middle of an append. The snapshot
+        # thread writes it out. (the online backup API cant be used on a memory db under steady ingest: every commit
+        # to the source restarts it, a copy that takes longer than the gap between appends never finishes)
+        self._snapshot_dirname = snapshot_dirname
+        self._snapshot_interval = snapshot_interval
+
+        # set by the snapshot thread when its time for a snapshot. Then the DBL worker takes a copy of each log group
+        # in _snapshot_todo, hands it over on _snapshot_q, (lgrp, data) and a (None, journal seq) once its done w/ all
+        # of them.
+        self._snapshot_due = threading.Event()
+        self._snapshot_todo = None
+        self._snapshot_q = queue.Queue()
+
+        # ingest journal seqs (see ingest_journal.py). The highest one applied, the one it was at when the current
+        # snapshot round started, and the one the last complete round had. Entries upto that one are on disk, the
+        # journal can let go of them. (get_durable_journal_seq())
+        self._max_journal_seq = None
+        self._snapshot_round_seq = None
+        self._durable_journal_seq = None
+
+        if snapshot_dirname:
+            os.makedirs(snapshot_dirname, exist_ok=True)
+
+            # warm restore before serving anything. DAO is created by the DBL worker before it enters its loop.
+            self._restore_snapshots()
+
+            t = threading.Thread(target=self._snapshot_thread_entry, name="dbl_mem_snapshot_thread")
+            t.daemon = True
+            t.start()
+
         log.dbg("MemSqliteDAO is initialized.")
 
     # ==================================================================================================================
@@ -57,6 +124,10 @@ class MemSqliteDAO:
             # "... mainthread.schedule_soon ..."(lambda: event.set())
             # Done, could return here.
         # maybe extra except clauses to catch specific errors and set corresponding msgs and http codes.
+        except LgrQueryError as ex:
+            req.fail_cause = DBL_FAIL_CAUSE(http_err_code=400,
+                                            user_msg=str(ex),
+                                            dbg_info_string=str(ex))
         except Exception as ex:
             req.fail_cause = DBL_FAIL_CAUSE(http_err_code=500,
                                             user_msg='Internal Server Error',
@@ -76,10 +147,259 @@ class MemSqliteDAO:
         if req.op in {DBL_API.HEALTH_CHK_3}:
             return self.health_check_v3()
 
+        if req.op in {DBL_API.APPEND_LGRS, DBL_API.APPEND_LGRS_DURABLE}:
+            return self.append_lgrs(req.data)
+
+        if req.op in {DBL_API.QUERY_LGRS}:
+            return self.query_lgrs(req.data)
+
+        if req.op in {DBL_API.QUERY_MULTI_LGRS}:
+            return self.query_multi_lgrs(req.data)
+
+        if req.op in {DBL_API.INDEX_FTS}:
+            return self.index_fts(req.data)
+
+        if req.op in {DBL_API.HISTOGRAM_LGRS}:
+            return self.histogram_lgrs(req.data)
+
+        if req.op in {DBL_API.EXPORT_LGRS}:
+            return self.export_lgrs(req.data)
+
+        if req.op in {DBL_API.DIFF_SESSIONS}:
+            return self.diff_sessions(req.data)
+
+        if req.op in {DBL_API.TOP_TEMPLATES}:
+            return self.top_templates(req.data)
+
+        raise NotImplementedError(f"DBL op not supported by MemSqliteDAO: {req.op}")
+
     # ==================================================================================================================
+    # ==================================================================================================================
+    # ====================================================================================================== Log Records
+    def _get_lgrp(self, lgrp: str, create: bool = True) -> SqliteLogGroup:
+        """ Return the SqliteLogGroup for the given log group name, create its memory db if this is the first use.
+        create False (reads): None if there is none. """
+
+        lgrp_store = self._lgrps.get(lgrp)
+
+        if lgrp_store is None:
+            if not is_valid_lgrp_name(lgrp):
+                raise ValueError(f"Invalid log group name: {lgrp}")
+
+            if not create:
+                return None
+
+            lgrp_store = self._open_lgrp(lgrp, self._mk_mem_conn())
+
+        return lgrp_store
+
+    def _mk_mem_conn(self) -> sqlite3.Connection:
+
+        # The snapshot thread reads log group dbs through the same connection the DBL worker writes to.
+        # sqlite is built serialized (sqlite3.threadsafety == 3) so sharing the connection is fine.
+        return sqlite3.connect(":memory:", isolation_level=None, check_same_thread=False)
+
+    def _open_lgrp(self, lgrp: str, conn: sqlite3.Connection) -> SqliteLogGroup:
+
+        lgrp_store = SqliteLogGroup(lgrp, conn, **get_lgrp_opts(self._lgrp_opts, lgrp))
+        self._lgrps[lgrp] = lgrp_store
+
+        return lgrp_store
+
+    def append_lgrs(self, args: LGR_APPEND_ARGS) -> int:
+
+        num_appended = self._get_lgrp(args.lgrp).append_lgrs(args.lgrs, journal_seq=args.journal_seq)
+
+        if args.journal_seq is not None:
+            self._max_journal_seq = max(args.journal_seq, self._max_journal_seq or 0)
+
+        return num_appended
+
+    def query_lgrs(self, query: LGR_QUERY) -> dict:
+
+        lgrp_store = self._get_lgrp(query.lgrp, create=False)
+        if lgrp_store is None:
+            return get_no_lgrp_result(query)
+
+        if self._query_cache is None:
+            return lgrp_store.query_lgrs(query)
+
+        return self._query_cache.query_lgrs(query, lgrp_store.get_cache_mark(query),
+                                            lambda lrid_range: lgrp_store.query_lgrs(query, lrid_range=lrid_range),
+                                            lgrp_store.get_changed_lrids)
+
+    def query_multi_lgrs(self, mquery: LGR_MULTI_QUERY) -> dict:
+        """ The log groups one after the other, theres the one connection per group anyway. The early stop still
+        saves the groups after the first full page most of their query. """
+
+        lgrps = sorted(self._lgrps) if mquery.lgrps is None else list(mquery.lgrps)
+        merge = LgrpQueryMerge(mquery, lgrps, SQLITE_LGR_FIELDS)
+
+        for lgrp in lgrps:
+            merge.run_lgrp(lgrp, self.query_lgrs)
+
+        return merge.get_result()
+
+    def histogram_lgrs(self, hist: LGR_HISTOGRAM) -> dict:
+        lgrp_store = self._get_lgrp(hist.lgrp, create=False)
+        return get_no_lgrp_result(hist) if lgrp_store is None else lgrp_store.histogram_lgrs(hist)
+
+    def diff_sessions(self, diff: LGR_SESSION_DIFF) -> dict:
+        lgrp_store = self._get_lgrp(diff.lgrp, create=False)
+        return get_no_lgrp_result(diff) if lgrp_store is None else lgrp_store.diff_sessions(diff)
+
+    def top_templates(self, top: LGR_TEMPLATE_TOP) -> dict:
+        lgrp_store = self._get_lgrp(top.lgrp, create=False)
+        return get_no_lgrp_result(top) if lgrp_store is None else lgrp_store.top_templates(top)
+
+    def export_lgrs(self, args: LGR_EXPORT) -> LgrExport:
+        """ Start an export. A memory db has the one connection, the export thread reads thru the DBL worker's (sqlite
+        serializes the calls, neither waits on the other for longer than a step). Theres no WAL snapshot to read from,
+        the export stops at the records there were when it started instead. (lrid upto max_lrid) Repeat counts can be
+        newer than that. """
+
+        lgrp_store = self._get_lgrp(args.query.lgrp, create=False)
+        if lgrp_store is None:
+            return LgrExport(SQLITE_LGR_FIELDS, iter_no_chunks, fmt=args.fmt, gzip=args.gzip)
+
+        lrid_range = (None, lgrp_store.max_lrid)
+
+        return LgrExport(SQLITE_LGR_FIELDS,
+                         lambda: lgrp_store.iter_lgrs(args.query, lrid_range=lrid_range,
+                                                      chunk_size=self._export_chunk_rows),
+                         fmt=args.fmt, gzip=args.gzip, max_pending=self._export_max_pending,
+                         stall_timeout=self._export_stall_timeout)
+
+    def index_fts(self, lgrp: str = None) -> dict:
+        """ One batch of full text indexing for lgrp, for every log group if None. Totals of what they returned. """
+
+        lgrp_stores = list(self._lgrps.values()) if lgrp is None else [self._get_lgrp(lgrp, create=False)]
+        totals = {'indexed': 0, 'backlog': 0}
+
+        for lgrp_store in filter(None, lgrp_stores):
+            for key, val in lgrp_store.index_fts().items():
+                totals[key] += val
+
+        return totals
+
     # ==================================================================================================================
     # ==================================================================================================================
+    # ============================================================================================ Snapshot and restore
+    def _get_snapshot_filename(self, lgrp: str) -> str:
+        return os.path.join(self._snapshot_dirname, f"lgrp_{lgrp}.snap.db")
+
+    def _restore_snapshots(self):
+        """ Load every log group snapshot found in the snapshot dir into memory. """
+
+        for fname in sorted(os.listdir(self._snapshot_dirname)):
+            if not (fname.startswith("lgrp_") and fname.endswith(".snap.db")):
+                continue
+
+            lgrp = fname[len("lgrp_"):-len(".snap.db")]
+            if not is_valid_lgrp_name(lgrp):
+                continue
+
+            start_time = time.perf_counter()
+            conn = self._mk_mem_conn()
+
+            snap_conn = sqlite3.connect(self._get_snapshot_filename(lgrp))
+            try:
+                snap_conn.backup(conn)
+            finally:
+                snap_conn.close()
+
+            self._open_lgrp(lgrp, conn)
+            log.info(f"Restored log group: {lgrp} from snapshot in {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+    def _write_snapshot(self, lgrp: str, data: bytes):
+        """ Write a serialize()d log group db as its snapshot. To a tmp file first, then renamed over the previous
+        one, so there is always a complete snapshot on disk even if the process dies mid way. """
+
+        snap_filename = self._get_snapshot_filename(lgrp)
+        tmp_filename = snap_filename + ".tmp"
+
+        with open(tmp_filename, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_filename, snap_filename)
 
+    def snapshot_lgrps(self):
+        """ Snapshot every log group to disk, right here. Only when nothing else is using the DAO, ie on the DBL worker
+        or in tests. The snapshot thread goes thru run_maintenance() instead. """
+
+        journal_seq = self._max_journal_seq
+
+        for lgrp, lgrp_store in list(self._lgrps.items()):
+            self._write_snapshot(lgrp, lgrp_store.conn.serialize())
+
+        self._durable_journal_seq = journal_seq
+
+    def get_durable_journal_seq(self) -> int:
+        """ The ingest journal seq upto which every applied entry is in a snapshot on disk. None if there is none yet
+        (no snapshots, or none since the start). Applied is only in memory here, the journal keeps its files until
+        this covers them. Any thread. """
+
+        return self._durable_journal_seq
+
+    def run_maintenance(self, idle: bool) -> bool:
+        """ Called by the DBL worker after every request and when the queues have been empty for a while. If a
+        snapshot is due, copies the next log group's db for the snapshot thread, once its done writing the last one.
+        A serialize() is a memcpy of the db, the next request waits on that much. Never has more to do right away,
+        the snapshot thread's writes set the pace. (returns False) """
+
+        if self._snapshot_todo is None:
+            if not self._snapshot_due.is_set():
+                return False
+
+            self._snapshot_due.clear()
+            self._snapshot_todo = sorted(self._lgrps)
+            self._snapshot_round_seq = self._max_journal_seq
+
+        # snapshot thread is still writing the last one. upto 2 copies of a db in memory, not all of them.
+        if not self._snapshot_q.empty():
+            return False
+
+        # the end of the round, w/ the journal seq it covers.
+        if not self._snapshot_todo:
+            self._snapshot_todo = None
+            self._snapshot_q.put((None, self._snapshot_round_seq))
+            return False
+
+        lgrp = self._snapshot_todo.pop(0)
+        self._snapshot_q.put((lgrp, self._lgrps[lgrp].conn.serialize()))
+
+        return False
+
+    def _snapshot_thread_entry(self):
+
+        log.info(f"MemSqliteDAO snapshot thread started. Interval: {self._snapshot_interval} seconds")
+
+        while True:
+            time.sleep(self._snapshot_interval)
+
+            start_time = time.perf_counter()
+            self._snapshot_due.set()
+            num_failed = 0
+
+            while True:
+                lgrp, data = self._snapshot_q.get()
+                if lgrp is None:
+                    break
+
+                # never let this thread die. a failed snapshot (disk full, ...) might work next time.
+                try:
+                    self._write_snapshot(lgrp, data)
+                except Exception as ex:
+                    log.err(f"Failed to snapshot log group: {lgrp}: {ex}")
+                    num_failed += 1
+
+            # a round w/ a log group missing doesnt cover anything.
+            if not num_failed:
+                if data is not None:
+                    self._durable_journal_seq = data
+                log.dbg(f"Log group snapshots done in {(time.perf_counter() - start_time) * 1000:.1f} ms")
 
     # ==================================================================================================================
     # ==================================================================================================================
@@ -91,11 +411,15 @@ class MemSqliteDAO:
 
         return "DBL health check: OK"
 
-    def health_check_v2(self):
-        pass
+    def health_check_v2(self) -> dict:
+        """ Timed read on the DAO's own memory db. """
+
+        return {'hchk': "DBL health check v2: OK", 'dao_exec_ms': hchk_read(self._db_conn)}
+
+    def health_check_v3(self) -> dict:
+        """ Timed write and delete of a row in a sentinel table, in the DAO's own memory db. """
 
-    def health_check_v3(self):
-        pass
+        return {'hchk': "DBL health check v3: OK", 'dao_exec_ms': hchk_write(self._db_conn)}
 
 
 # ======================================================================================================================
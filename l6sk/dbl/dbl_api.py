@@ -5,6 +5,7 @@ DBL API. Expose the functionality provided by the l6sk DB Layer.
 """
 
 import os
+import time
 import threading
 import queue
 from dataclasses import dataclass
@@ -32,10 +33,51 @@ class DBL_API(enum.Enum):
     # Get a user record. Could be used to grant login, display user info, ...
     DESCRIBE_USER = 30
 
+    # ******************** Log records
+    # Append a batch of log records to a log group. data: LGR_APPEND_ARGS, succ_data: number of records appended.
+    APPEND_LGRS = 100
+
+    # Same as APPEND_LGRS, but succ_data is only set once the records are durable (sync_level 2). If the dispatcher
+    # has an ingest journal, that is once they are fsync()ed in the journal, they get applied to the DAO right after.
+    # W/o a journal the DAO serves it like APPEND_LGRS. (durable for the disk DAOs, not for the memory one)
+    APPEND_LGRS_DURABLE = 101
+
+    # Read back log records from a log group. data: LGR_QUERY, succ_data: dict w/ 'fields' and 'lgrs' (list of tuples)
+    QUERY_LGRS = 110
+
+    # Same, across log groups. (see lgr_multi_query.py) data: LGR_MULTI_QUERY, succ_data: dict w/ 'fields' and 'lgrs',
+    # the rows of every log group merged in srv_ts order, each w/ the name of its log group last.
+    QUERY_MULTI_LGRS = 111
+
+    # Catch up on full text indexing (log groups w/ lgrp_opts 'fts'). One batch per log group. Meant to be queued at
+    # LOW priority, over and over. (see dbl_dispatch.dbl_ticker_thread_entry) data: log group name, None means every
+    # log group the DAO has open. succ_data: dict w/ 'indexed' (records indexed) and 'backlog' (records still not)
+    INDEX_FTS = 120
+
+    # Count of records per time bucket and level (and subsystem) off the log group's rollups, never the records
+    # themselves. (sqlite DAOs, lgrp_opts 'rollups') data: LGR_HISTOGRAM, succ_data: dict w/ 'fields' and 'buckets'
+    # (list of tuples, see LGR_HISTOGRAM_FIELDS)
+    HISTOGRAM_LGRS = 130
+
+    # Start an export of every record a query matches. data: LGR_EXPORT, succ_data: an LgrExport (see lgr_export.py)
+    # thats already running on a thread of its own, the caller takes the encoded chunks off it. Served on the DBL
+    # worker, starting one is quick. The export itself doesnt go thru the DBL worker.
+    EXPORT_LGRS = 140
+
+    # Compare two sessions of a log group off their summaries, never the records themselves. (sqlite DAOs, lgrp_opts
+    # 'session_summaries') data: LGR_SESSION_DIFF, succ_data: dict w/ 'a' and 'b' (the summaries, None for a session
+    # the log group has none of), 'lvls', 'files', 'msgs' (lists of tuples) and their 'fields'
+    DIFF_SESSIONS = 150
+
+    # Most frequent msg templates of a log group in a time range, off the per hour counts kept at ingest. (sqlite DAOs,
+    # lgrp_opts 'templates') data: LGR_TEMPLATE_TOP, succ_data: dict w/ 'fields', 'templates' (list of tuples, see
+    # LGR_TEMPLATE_TOP_FIELDS) and 'total', the records w/ a msg in the range.
+    TOP_TEMPLATES = 160
 
     # ******************** Health checks
     # Health Check v1 is just for the DAO object to ACK health. Wont leave process. v2 reads db, v3 writes db
-    # TODO acutally define v2 and v3.
+    # (writes and deletes a row in a sentinel table, or a sentinel file for DAOs w/o tables). v1 succ_data is a string,
+    # v2 and v3 succ_data: dict w/ 'hchk' (the same kind of string) and 'dao_exec_ms', how long the read/write took.
     HEALTH_CHK_1 = 500
     HEALTH_CHK_2 = 501
     HEALTH_CHK_3 = 502
@@ -43,6 +85,18 @@ class DBL_API(enum.Enum):
     def __str__(self):
         return super().__str__()[8:]  # chopping i.e. "DBL_API.CREATE_USER", to "CREATE_USER"
 
+
+# Operations that only read. DAOs that have separate read connections (ie disk sqlite w/ a reader pool) can serve
+# these off the DBL worker thread, everything else (anything that writes) stays on the DBL worker.
+DBL_READ_OPS = frozenset({
+    DBL_API.DESCRIBE_USER,
+    DBL_API.QUERY_LGRS,
+    DBL_API.QUERY_MULTI_LGRS,
+    DBL_API.HISTOGRAM_LGRS,
+    DBL_API.DIFF_SESSIONS,
+    DBL_API.TOP_TEMPLATES,
+})
+
 # This interface is a listing of the methods every dao must implement.
 # Every DAO would subclass this and then have to implement all of its abstractmethods
 # class DAOL6SK(ABC):
@@ -51,6 +105,321 @@ class DBL_API(enum.Enum):
 #     def health_check_v1(self):
 #         """ . """
 
+# ======================================================================================================================
+# ======================================================================================================================
+# =========================================================================================================== Log Record
+
+# log levels are stored as small ints, not as text. Leaves room in between in case we ever want a TRCE or NOTE level.
+# the text form ('DBUG', 'INFO', ...) is what the clients send and what they get back.
+LGR_LVL_CODES = {
+    "DBUG": 10,
+    "INFO": 20,
+    "WARN": 30,
+    "ERRR": 40,
+    "CRIT": 50,
+}
+
+LGR_LVL_NAMES = {code: name for name, code in LGR_LVL_CODES.items()}
+
+
+def ts_to_usec(ts: float) -> int:
+    """ Convert a unix timestamp in (possibly fractional) seconds to integer micro seconds. None stays None. """
+
+    if ts is None:
+        return None
+
+    return int(round(float(ts) * 1000000))
+
+
+def get_srv_ts_usec() -> int:
+    """ Return the current unix time in integer micro seconds. This is what srv_ts gets set to on arrival. """
+
+    return time.time_ns() // 1000
+
+
+@dataclass(frozen=False)
+class LOG_RECORD:
+    """ A LOG_RECORD fully describes/tracks a single log message, and is generated for each log message.
+    This is how the web layer hands log records to DBL. All timestamps are unix time in integer micro seconds. """
+
+    # client_ts: client timestamp. generated by client SDK at the time log msg was issued. could be None.
+    client_ts: int = None
+
+    # server timestamp, generated by the l6sk server upon reception. used for trim/rotate/discard/...
+    # must not be null in the database. If None here, the DAO will set it.
+    srv_ts: int = None
+
+    # 'DBUG', 'INFO', 'WARN', 'ERRR', 'CRIT' or None (None is useful for fifo_2_l6sk)
+    lvl: str = None
+
+    # optional. A subsystem name. None means no subsystem/main/generic.
+    subsys: str = None
+
+    # optional. everytime a client logger is init()ed, a new random session id will be created.
+    session_id: str = None
+
+    # caller information
+    lineno: int = None
+    filename: str = None
+    funcname: str = None
+
+    # process info
+    pname: str = None
+    pid: int = None
+
+    # thread info
+    tname: str = None
+    tid: int = None
+
+    # the log msg itself.
+    msg: str = None
+
+    # set by the server if the record went through ingest sampling (see lgr_sampler.py). The probability it was kept
+    # with, so it stands for 1 / sample_rate records. None means it wasnt sampled. (same as 1.0)
+    sample_rate: float = None
+
+
+# Column order of the log record rows handed back to DBL users (QUERY_LGRS succ_data['lgrs'] tuples).
+LGR_FIELDS = ('lrid', 'srv_ts', 'client_ts', 'lvl', 'subsys', 'session_id', 'lineno', 'filename', 'funcname', 'pname',
+              'pid', 'tname', 'tid', 'msg')
+
+# Log groups that collapse repeated records at ingest (sqlite DAOs, lgrp_opts 'repeat_window') return these after
+# LGR_FIELDS. repeat_count: how many identical records (same session, lvl, filename, lineno and msg, back to back)
+# the row stands for, 1 if it wasnt repeated. last_srv_ts: srv_ts of the last of them. (srv_ts is the first's)
+LGR_REPEAT_FIELDS = ('repeat_count', 'last_srv_ts')
+
+# Sqlite DAOs also return the sample_rate of each row after those, 1.0 for rows that werent sampled. A row stands for
+# repeat_count / sample_rate records.
+LGR_SAMPLE_FIELDS = ('sample_rate', )
+
+# and the id of the template of each row's msg (see lgr_templates.py), None for records w/o one. (no msg, or appended
+# before the log group had templates)
+LGR_TEMPLATE_FIELDS = ('template_id', )
+
+
+def get_lgrp_opts(lgrp_opts: dict, lgrp: str) -> dict:
+    """ lgrp_opts maps log group names to dicts of per log group options, ie {"*": {...}, "noisy_svc": {...}}.
+    The "*" entry applies to every log group, a log group's own entry overrides it key by key. ("*" can never be
+    a log group name). Returns the merged options for lgrp. lgrp_opts can be None. """
+
+    if not lgrp_opts:
+        return {}
+
+    merged = dict(lgrp_opts.get("*", {}))
+    merged.update(lgrp_opts.get(lgrp, {}))
+
+    return merged
+
+
+def is_valid_lgrp_name(lgrp: str) -> bool:
+    """ Log group names end up in file names (disk DAO), so DAOs refuse anything that is not plain alphanumeric + '_'
+    and starting with a letter. Length limits and the rest of the policy is upto the web layer (see SL__LGRP_... knobs)
+    """
+
+    if (not isinstance(lgrp, str)) or (not lgrp):
+        return False
+
+    if not lgrp[0].isascii() or not lgrp[0].isalpha():
+        return False
+
+    return all((ch.isascii() and ch.isalnum()) or ch == '_' for ch in lgrp)
+
+
+@dataclass(frozen=True)
+class LGR_APPEND_ARGS:
+    """ Args for DBL_API.APPEND_LGRS. Append the given list of LOG_RECORDs to the log group named lgrp.
+    journal_seq is set by the ingest journal on the appends it applies (see ingest_journal.py). DAOs that can, use it
+    to skip appends they already have when the journal is replayed. """
+
+    lgrp: str
+    lgrs: typing.List[LOG_RECORD]
+    journal_seq: int = None
+
+
+@dataclass(frozen=True)
+class LGR_QUERY:
+    """ Args for DBL_API.QUERY_LGRS. All filters are optional, None means dont filter on that.
+    srv_ts and client_ts bounds are inclusive and in micro seconds. session_id and subsys are exact matches.
+    lvl_min is a level name ('WARN' means WARN, ERRR and CRIT), lvls a set of level names, a record has to match
+    both. Records w/o a level dont match either.
+    Results come back in (srv_ts, lrid) order. after is a keyset cursor, the (srv_ts, lrid) of the last record of the
+    previous page, only records past it are returned. (see get_next_page_after())
+    msg_match is a full text search on msg, in sqlite FTS5 query syntax: tokens (ANDed), "a phrase", prefix*, OR, NOT.
+    Only for log groups that have a full text index (sqlite DAOs, lgrp_opts 'fts'), ValueError on the rest.
+    msg_regex, filename_regex: python re patterns, re.search()ed. ValueError for patterns that are too long, dont
+    compile or look like they could backtrack for ever. (see lgr_regex.py)
+    template_id: records whose msg has that template. (sqlite DAOs, lgrp_opts 'templates', see TOP_TEMPLATES) """
+
+    lgrp: str
+    srv_ts_min: int = None
+    srv_ts_max: int = None
+    session_id: str = None
+    subsys: str = None
+    lvl_min: str = None
+    limit: int = 100
+    lvls: typing.FrozenSet[str] = None
+    client_ts_min: int = None
+    client_ts_max: int = None
+    after: typing.Tuple[int, int] = None
+    msg_match: str = None
+    msg_regex: str = None
+    filename_regex: str = None
+    template_id: int = None
+
+
+def get_query_lvl_codes(query: LGR_QUERY) -> tuple:
+    """ The level codes query (or an LGR_HISTOGRAM) matches, lvls and lvl_min together, sorted. None if it doesnt
+    filter on level. """
+
+    if (query.lvls is None) and (query.lvl_min is None):
+        return None
+
+    codes = LGR_LVL_CODES.values() if query.lvls is None else [LGR_LVL_CODES[lvl] for lvl in query.lvls]
+    if query.lvl_min is not None:
+        codes = [code for code in codes if code >= LGR_LVL_CODES[query.lvl_min]]
+
+    return tuple(sorted(set(codes)))
+
+
+def get_query_srv_ts_min(query: LGR_QUERY) -> int:
+    """ The lowest srv_ts query can match, srv_ts_min or the cursor's, whichever is higher. None if unbounded. """
+
+    if query.after is None:
+        return query.srv_ts_min
+
+    if query.srv_ts_min is None:
+        return query.after[0]
+
+    return max(query.srv_ts_min, query.after[0])
+
+
+def is_after_cursor(query: LGR_QUERY, srv_ts: int, lrid: int) -> bool:
+    """ True if a record w/ this srv_ts and lrid is past query's cursor. (or query has none) """
+
+    return (query.after is None) or ((srv_ts, lrid) > tuple(query.after))
+
+
+def is_client_ts_match(query: LGR_QUERY, client_ts) -> bool:
+    """ True if client_ts is within query's client_ts bounds. W/ a bound set, records w/o a client_ts (or one that
+    isnt an int) dont match. """
+
+    if (query.client_ts_min is None) and (query.client_ts_max is None):
+        return True
+
+    if not isinstance(client_ts, int):
+        return False
+
+    return ((query.client_ts_min is None) or (client_ts >= query.client_ts_min)) and \
+        ((query.client_ts_max is None) or (client_ts <= query.client_ts_max))
+
+
+def get_next_page_after(query: LGR_QUERY, lgrs: list):
+    """ The cursor (LGR_QUERY.after) for the page after lgrs, QUERY_LGRS' result rows for query. None if that was
+    the last page. Every DAO's result rows start w/ lrid, srv_ts. """
+
+    if len(lgrs) < query.limit or not lgrs:
+        return None
+
+    return (lgrs[-1][1], lgrs[-1][0])
+
+
+@dataclass(frozen=True)
+class LGR_MULTI_QUERY:
+    """ Args for DBL_API.QUERY_MULTI_LGRS. query's filters and limit apply to every log group in lgrps, its lgrp and
+    after are ignored. lgrps None means every log group the DAO has. Results come back in (srv_ts, lgrp, lrid) order,
+    after is a keyset cursor, the (srv_ts, lgrp, lrid) of the last record of the previous page.
+    (see get_next_multi_page_after()) """
+
+    query: LGR_QUERY
+    lgrps: typing.Tuple[str, ...] = None
+    after: typing.Tuple[int, str, int] = None
+
+
+def get_next_multi_page_after(mquery: LGR_MULTI_QUERY, lgrs: list):
+    """ The cursor (LGR_MULTI_QUERY.after) for the page after lgrs, QUERY_MULTI_LGRS' result rows for mquery. None if
+    that was the last page. """
+
+    if len(lgrs) < mquery.query.limit or not lgrs:
+        return None
+
+    return (lgrs[-1][1], lgrs[-1][-1], lgrs[-1][0])
+
+
+# Column order of HISTOGRAM_LGRS succ_data['buckets'] tuples. bucket_ts: start of the bucket, unix time in micro
+# seconds. subsys is None unless LGR_HISTOGRAM.by_subsys. count: records appended (repeats each count), est_count:
+# count re-weighted for ingest sampling, ie what count would have been w/o it.
+LGR_HISTOGRAM_FIELDS = ('bucket_ts', 'lvl', 'subsys', 'count', 'est_count')
+
+
+@dataclass(frozen=True)
+class LGR_HISTOGRAM:
+    """ Args for DBL_API.HISTOGRAM_LGRS. bucket_sec is the bucket size, a multiple of 60. Buckets are aligned to the
+    epoch, the ones from the bucket srv_ts_min is in upto the one srv_ts_max is in are returned, empty ones are left
+    out. lvls, lvl_min, subsys filter the same as LGR_QUERY's. by_subsys: a count per subsystem, not one for all. """
+
+    lgrp: str
+    srv_ts_min: int = None
+    srv_ts_max: int = None
+    bucket_sec: int = 60
+    lvl_min: str = None
+    lvls: typing.FrozenSet[str] = None
+    subsys: str = None
+    by_subsys: bool = False
+
+
+# Column order of the DIFF_SESSIONS succ_data lists. count_a, count_b: records of the session a, b. Msgs are counted
+# approximately, a msg's true count is in [count - err, count]. A msg one session has no counter for is at most the
+# lowest count it has, ie count = err = that. (0, 0 if it has counters to spare) filename_regex, msg_regex: for an
+# LGR_QUERY w/ the session_id that gets the records behind the row.
+LGR_SESSION_DIFF_FIELDS = {
+    'lvls': ('lvl', 'count_a', 'count_b'),
+    'files': ('filename', 'count_a', 'count_b', 'filename_regex'),
+    'msgs': ('msg', 'count_a', 'err_a', 'count_b', 'err_b', 'msg_regex'),
+}
+
+
+@dataclass(frozen=True)
+class LGR_SESSION_DIFF:
+    """ Args for DBL_API.DIFF_SESSIONS. session_a is the one compared against, ie an earlier run, session_b ie the
+    latest one. top: most files and msgs returned, the ones whose counts differ the most. (levels are all there) """
+
+    lgrp: str
+    session_a: str
+    session_b: str
+    top: int = 20
+
+
+# Column order of TOP_TEMPLATES succ_data['templates'] tuples. Templates are counted approximately, per hour, the
+# most frequent ones of each hour are kept. count: the records counted for it. count_min, count_max: its true count is
+# in between. (count_max adds what it could have had in the hours it wasnt counted in)
+LGR_TEMPLATE_TOP_FIELDS = ('template_id', 'template', 'count', 'count_min', 'count_max')
+
+
+@dataclass(frozen=True)
+class LGR_TEMPLATE_TOP:
+    """ Args for DBL_API.TOP_TEMPLATES. The hours from the one srv_ts_min is in upto the one srv_ts_max is in, the
+    limit templates w/ the highest counts. """
+
+    lgrp: str
+    srv_ts_min: int = None
+    srv_ts_max: int = None
+    limit: int = 20
+
+
+# formats an export can be encoded in. ndjson: a JSON object per record per line. csv: a header row w/ the field names.
+LGR_EXPORT_FORMATS = ('ndjson', 'csv')
+
+
+@dataclass(frozen=True)
+class LGR_EXPORT:
+    """ Args for DBL_API.EXPORT_LGRS. query's filters, its limit None means every match. fmt: one of
+    LGR_EXPORT_FORMATS. gzip: the encoded chunks are gzip compressed, together they are one gzip stream. """
+
+    query: LGR_QUERY
+    fmt: str = 'ndjson'
+    gzip: bool = False
+
+
 # ======================================================================================================================
 # ======================================================================================================================
 @dataclass(frozen=True)
@@ -76,11 +445,16 @@ class DBL_FAIL_CAUSE:
     call stack none of which can be garbage collected as long as this pointer lives.
     """
 
-    http_err_code = None
+    http_err_code: int = None
     user_msg: str = None
     dbg_info_string: str = None
 
 
+class LgrQueryError(ValueError):
+    """ A read op the DAO cant run for reasons that are the client's, ie a malformed msg_match, or a msg_match on a
+    log group w/o a full text index. DAOs fail these w/ a 400, the message is ok to send back. """
+
+
 # ======================================================================================================================
 # ======================================================================================================================
 def main():
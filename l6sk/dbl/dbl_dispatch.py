@@ -67,6 +67,11 @@ class DBL_REQ:
     succ_data: typing.Any = None
     fail_cause: typing.Any = None
 
+    # time.monotonic() when put_req() queued it and when get_next_req() handed it to the DBL worker. Their difference
+    # is how long it waited in the queues. (health checks report it)
+    enqueue_ts: float = None
+    dequeue_ts: float = None
+
     # each request gets a random uuid.
     # uuid: str = field(default_factory=lambda: crypt_util.get_uuid_generator().get_l6sk_uuid_b64())
 
@@ -151,9 +156,16 @@ class DBL_REQUEST_DISPATCH:
     A PQueue could leade to starvation of even the NORMAL p values.
     We can also add a "starvation queue" called ultra_low_q or starv_q and set its p value to 0. This guy would only
     be serviced if others are empty, otherwise starve.
+
+    ********** Ingest journal. If the dispatcher has one (see ingest_journal.py) DBL_API.APPEND_LGRS_DURABLE requests
+    dont go to the queues. The journal thread makes them durable in groups, acks them and queues the APPEND_LGRS
+    requests that apply them to the DAO. The DBL worker replays the journal before serving anything.
+
+    ********** Live tail. If the dispatcher has an LgrHub (see lgr_hub.py) the DBL worker publishes the records of
+    every append the DAO served to it, for /api/lgr/tail.
     """
 
-    def __init__(self):
+    def __init__(self, journal=None, lgr_hub=None):
         super().__init__()
 
         # multiple queues for different priorities
@@ -161,6 +173,34 @@ class DBL_REQUEST_DISPATCH:
         self._q_norm = queue.Queue()
         self._q_hi = queue.Queue()
 
+        # requests handed to the DBL worker so far. Only the DBL worker writes it, anyone can read it.
+        self._num_dispatched = 0
+
+        # IngestJournal or None.
+        self._journal = journal
+        if journal is not None:
+            journal.start(self.put_req)
+
+        # LgrHub or None.
+        self._lgr_hub = lgr_hub
+
+    @property
+    def journal(self):
+        return self._journal
+
+    @property
+    def lgr_hub(self):
+        return self._lgr_hub
+
+    @property
+    def num_dispatched(self) -> int:
+        return self._num_dispatched
+
+    def get_queue_depths(self) -> dict:
+        """ Return the number of requests waiting in each queue. ie {'hi': 0, 'norm': 12, 'lo': 3} """
+
+        return {'hi': self._q_hi.qsize(), 'norm': self._q_norm.qsize(), 'lo': self._q_lo.qsize()}
+
     # dbg util method
     def _get_queue_name(self, q: queue.Queue) -> str:
         " Given one of this dipatcher's queues return a string telling humans which queue it was. (ie the lo, hi, ...)"
@@ -185,6 +225,10 @@ class DBL_REQUEST_DISPATCH:
 
         # log.info(f"put_req called. DBL_REQ: {req}")
 
+        if (self._journal is not None) and (req.op == DBL_API.APPEND_LGRS_DURABLE):
+            self._journal.put_req(req)
+            return
+
         # default to normal priority. but it should be set properly already.
         dest_q = self._q_norm
 
@@ -195,6 +239,7 @@ class DBL_REQUEST_DISPATCH:
             dest_q = self._q_lo
 
         # now deal with put no wait.
+        req.enqueue_ts = time.monotonic()
         try:
             dest_q.put_nowait(req)
         except Exception as ex:
@@ -269,6 +314,8 @@ class DBL_REQUEST_DISPATCH:
 
             try:
                 next_req = chosen_q.get_nowait()
+                next_req.dequeue_ts = time.monotonic()
+                self._num_dispatched += 1
             except queue.Empty:
                 pass
 
@@ -279,8 +326,12 @@ class DBL_REQUEST_DISPATCH:
 # ======================================================================================================================
 # ======================================================================================================================
 # ============================================================================================ DBL Service worker thread
+# appends the DAO serves. (APPEND_LGRS_DURABLE too, w/o an ingest journal it goes to the DAO as is)
+_APPEND_OPS = frozenset({DBL_API.APPEND_LGRS, DBL_API.APPEND_LGRS_DURABLE})
+
+
 # **************************************** Process a single DBL request.
-def process_dbl_req(dao, next_req: DBL_REQ):
+def process_dbl_req(dao, next_req: DBL_REQ, lgr_hub=None):
 
     # careful not to crash this thread. we need this thread in inf loop to keep serving requests,
     # even if 1 or 100 request fail miserably. ie db was out 5 minutes
@@ -289,6 +340,55 @@ def process_dbl_req(dao, next_req: DBL_REQ):
     except:
         pass
 
+    # committed, live tails get them. (0 appended is a journal entry the DAO already had)
+    if (lgr_hub is not None) and (next_req.op in _APPEND_OPS) and next_req.succ_data:
+        try:
+            lgr_hub.publish(next_req.data.lgrp, next_req.data.lgrs)
+        except Exception as ex:
+            log.err(f"Failed to publish appended records to live tails: {ex}")
+
+
+# **************************************** DAO housekeeping between requests.
+def process_dbl_maint(dao, idle: bool) -> bool:
+    """ Give the DAO a chance to do its housekeeping (checkpoints, vacuum, ...) on the DBL worker, if it has any.
+    idle: the queues have been empty for a while. Return True if the DAO has more idle work, ie dont sleep yet. """
+
+    run_maintenance = getattr(dao, 'run_maintenance', None)
+    if run_maintenance is None:
+        return False
+
+    # same as process_dbl_req, this thread doesnt die over a failed checkpoint.
+    try:
+        return run_maintenance(idle)
+    except Exception:
+        return False
+
+
+# **************************************** background DBL work
+def dbl_ticker_thread_entry(req_dispatch: DBL_REQUEST_DISPATCH, make_req, interval: float, again=None):
+    """ Entry point for a thread that keeps the DBL worker busy w/ some background op (ie DBL_API.INDEX_FTS),
+    forever. make_req() makes the request, usually a LOW priority one. One at a time, the next one is queued interval
+    seconds after the last one was served. Or right away if again(served request) says so, ie there is a backlog.
+    W/ LOW priority that means the op gets the DBL worker whenever nothing else wants it, and its LOW share when the
+    queues are congested. """
+
+    log.info(f"DBL ticker thread started. Interval: {interval} seconds")
+
+    while True:
+        req = make_req()
+        req_dispatch.put_req(req)
+
+        # same sleep wait as any other DBL user. (see DBL_REQUEST_DISPATCH)
+        while (req.succ_data is None) and (req.fail_cause is None):
+            time.sleep(0.01)
+
+        if req.fail_cause is not None:
+            log.warn(f"Background DBL request failed: {req}")
+        elif (again is not None) and again(req):
+            continue
+
+        time.sleep(interval)
+
 
 # **************************************** entry point for DBL worker thread.
 def dbl_service_thread_entry(dao_maker_callable, req_dispatch: DBL_REQUEST_DISPATCH):
@@ -326,6 +426,10 @@ def dbl_service_thread_entry(dao_maker_callable, req_dispatch: DBL_REQUEST_DISPA
 
     dao = dao_maker_callable()
 
+    # whatever the ingest journal acked last run but the DAO didnt get, goes in before any new request.
+    if req_dispatch.journal is not None:
+        req_dispatch.journal.replay(dao)
+
     log.info("DBL dispacth entering service loop ...")
 
     # DBL thread never leaves this loop, careful exceptions must not break this loop, otherwise DBL is gone,
@@ -355,14 +459,18 @@ def dbl_service_thread_entry(dao_maker_callable, req_dispatch: DBL_REQUEST_DISPA
         if next_req:
             # we got a request. Reset idle counter
             idle_counter = 0
-            process_dbl_req(dao=dao, next_req=next_req)
+            process_dbl_req(dao=dao, next_req=next_req, lgr_hub=req_dispatch.lgr_hub)
+            process_dbl_maint(dao=dao, idle=False)
 
         else:
             # we hit empty, inc idle counter, see if it exceeds threshold.
             idle_counter += 1
 
             if idle_counter > idle_counter_threshold:
-                time.sleep(sleep_timeout)
+                # idle, a good time for the DAO's housekeeping. Its done in small steps, the next request only ever
+                # waits on one. No sleeping while there is more of it.
+                if not process_dbl_maint(dao=dao, idle=True):
+                    time.sleep(sleep_timeout)
                 idle_counter -= 1  # dont let idle_counter to go to +inf.
         # Done, loop and process the next one.
 
@@ -0,0 +1,64 @@
+""" heavy_hitters.py
+Top-k counting in bounded space, Space-Saving (Metwally et al., "Efficient Computation of Frequent and Top-k Elements
+in Data Streams"). Upto capacity counters, <item: [count, err]>. An item that has a counter is counted. A new item
+takes a free counter, or once they are all taken the one w/ the lowest count (min), and starts at min + its weight w/
+err = min. So:
+  - an item's true count is in [count - err, count].
+  - every item w/ a true count over total / capacity has a counter.
+  - an item w/o a counter has a true count of at most the lowest count. (0 if not all counters are taken)
+Counters are plain dicts so callers can keep them wherever they like, ie rows in a table loaded for the update.
+"""
+
+import heapq
+
+
+def space_saving_add(counters: dict, weights: dict, capacity: int) -> set:
+    """ Count weights (<item: weight>, ie a batch counted up w/ a Counter) into counters (<item: [count, err]>, changed
+    in place). Return the items that lost their counter. Items have to be orderable, ties on count go to the
+    smallest item. """
+
+    evicted = set()
+
+    # built the first time a counter has to be taken over. entries go stale when their item's count changes or it
+    # loses its counter, checked when they get to the top.
+    heap = None
+
+    for item, weight in weights.items():
+        counter = counters.get(item)
+        if counter is not None:
+            counter[0] += weight
+            continue
+
+        if len(counters) < capacity:
+            counters[item] = [weight, 0]
+            continue
+
+        if heap is None:
+            heap = [(count, key) for key, (count, _) in counters.items()]
+            heapq.heapify(heap)
+
+        while True:
+            min_count, min_item = heap[0]
+            min_counter = counters.get(min_item)
+            if (min_counter is not None) and (min_counter[0] == min_count):
+                break
+
+            heapq.heappop(heap)
+            if min_counter is not None:
+                heapq.heappush(heap, (min_counter[0], min_item))
+
+        heapq.heapreplace(heap, (min_count + weight, item))
+        del counters[min_item]
+        evicted.add(min_item)
+        counters[item] = [min_count + weight, min_count]
+
+    return evicted - counters.keys()
+
+
+def get_min_count(counters: dict, capacity: int) -> int:
+    """ Most an item w/o a counter could have been counted. """
+
+    if len(counters) < capacity:
+        return 0
+
+    return min(count for count, _ in counters.values())
@@ -0,0 +1,420 @@
+""" ingest_journal.py
+Append-only ingest journal in front of the DAO for sync_level 2 appends (DBL_API.APPEND_LGRS_DURABLE).
+
+Waiting on the DAO to make every sync_level 2 request durable (a sqlite commit or a segment msync() per request) means
+one fsync per request, on the DBL worker, w/ every other request queued up behind it. The journal takes that off the
+DBL worker: durable appends are handed to the journal thread instead of the DBL queues. It writes everything that came
+in since its last round to the journal file and fsync()s once for the whole group, then acks them (succ_data) and
+queues a plain APPEND_LGRS for each one, which the DBL worker applies to the DAO whenever it gets to it.
+
+Every entry has a seq. A journal file is deleted once all of its entries are durable in the DAO. Whatever is left at
+start up is replayed into the DAO by the DBL worker before it serves anything else (see dbl_service_thread_entry). The
+sqlite DAOs record the last seq they have per log group in the same transaction as the rows, so replay skips what they
+already got. The segment DAO doesnt, a crash may get it the last few ms of applied entries twice.
+
+For the disk DAOs durable is applied. A DAO that only has them in memory reports the seq upto which they are on disk
+(get_durable_journal_seq(), the memory DAO's last complete snapshot) and files, the replayed ones too, are kept
+until that covers them. W/o snapshots thats never, dont run the journal in front of such a DAO. (see server_init)
+"""
+
+import os
+import sys
+import time
+import json
+import queue
+import struct
+import zlib
+import threading
+import tempfile
+import dataclasses
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ, DBL_REQ_PRIORITY
+from l6sk.dbl.dbl_api import DBL_API, DBL_FAIL_CAUSE, LOG_RECORD, LGR_APPEND_ARGS, LGR_LVL_CODES, is_valid_lgrp_name
+from l6sk.dbl.dbl_api import get_srv_ts_usec
+
+from l6sk import log_util as log
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ========================================================================================================= File format
+# A journal file is just entries back to back: <body len, crc32 of body, seq> header + body. body is JSON:
+# [lgrp, [[LOG_RECORD field values], ...]] (field values in _LGR_ATTRS order)
+# A crash in the middle of a write leaves a short or corrupt last entry. Reading stops there, that group was never
+# acked.
+_ENTRY_HDR = struct.Struct("<IIQ")
+
+_JNL_PREFIX = "jnl_"
+_JNL_SUFFIX = ".l6jnl"
+
+_LGR_ATTRS = tuple(fld.name for fld in dataclasses.fields(LOG_RECORD))
+
+# how long the journal thread blocks on an empty queue before it goes looking for applied entries.
+_IDLE_WAIT = 0.05
+
+
+def _get_journal_filename(dirname: str, first_seq: int) -> str:
+    return os.path.join(dirname, f"{_JNL_PREFIX}{first_seq:020d}{_JNL_SUFFIX}")
+
+
+def _list_journal_files(dirname: str) -> list:
+    """ Journal files in dirname, oldest first. """
+
+    return [os.path.join(dirname, fname) for fname in sorted(os.listdir(dirname))
+            if fname.startswith(_JNL_PREFIX) and fname.endswith(_JNL_SUFFIX)]
+
+
+def _fsync_dir(dirname: str):
+    """ Make file creates/deletes in dirname durable. """
+
+    dir_fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def _encode_entry(seq: int, args: LGR_APPEND_ARGS) -> bytes:
+    """ Return the journal entry for args. ValueError/TypeError if args isnt something the DAO would take. """
+
+    if not is_valid_lgrp_name(args.lgrp):
+        raise ValueError(f"Invalid log group name: {args.lgrp}")
+
+    lgrs = []
+    for lgr in args.lgrs:
+        if (lgr.lvl is not None) and (lgr.lvl not in LGR_LVL_CODES):
+            raise ValueError(f"Invalid log level: {lgr.lvl}")
+
+        lgrs.append([getattr(lgr, attr) for attr in _LGR_ATTRS])
+
+    body = json.dumps([args.lgrp, lgrs], separators=(',', ':')).encode('utf-8')
+
+    return _ENTRY_HDR.pack(len(body), zlib.crc32(body), seq) + body
+
+
+def _read_entries(filename: str):
+    """ Yield (seq, LGR_APPEND_ARGS) for every complete entry in the journal file. """
+
+    with open(filename, 'rb') as f:
+        data = f.read()
+
+    offset = 0
+    while offset + _ENTRY_HDR.size <= len(data):
+        body_len, crc, seq = _ENTRY_HDR.unpack_from(data, offset)
+        body = data[offset + _ENTRY_HDR.size:offset + _ENTRY_HDR.size + body_len]
+
+        if (len(body) < body_len) or (zlib.crc32(body) != crc):
+            break
+
+        lgrp, lgrs = json.loads(body)
+        yield seq, LGR_APPEND_ARGS(lgrp, [LOG_RECORD(*vals) for vals in lgrs], journal_seq=seq)
+
+        offset += _ENTRY_HDR.size + body_len
+
+    if offset < len(data):
+        log.warn(f"Ignoring {len(data) - offset} bytes of unfinished entries at the end of journal file: {filename}")
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================= IngestJournal
+class IngestJournal:
+    """ Group committed ingest journal. The dispatcher hands it the APPEND_LGRS_DURABLE requests (see
+    DBL_REQUEST_DISPATCH), start() it w/ a put_req callable that queues the apply requests for the DBL worker. """
+
+    def __init__(self, dirname: str, group_commit_delay: float = 0.0, file_size: int = 16 * 1024 * 1024):
+        super().__init__()
+
+        self._dirname = dirname
+        os.makedirs(dirname, exist_ok=True)
+
+        # the journal thread takes whatever is queued when it wakes up as one group, one write() + fsync() for all of
+        # them. Requests that come in during the fsync make up the next group. group_commit_delay seconds of extra
+        # wait after the first request of a group make bigger groups, at the cost of latency.
+        self._group_commit_delay = group_commit_delay
+
+        # start a new journal file once the current one is this many bytes.
+        self._file_size = file_size
+
+        self._q = queue.Queue()
+        self._put_req = None
+
+        # files left from the last run, replay() applies and deletes them.
+        self._replay_filenames = _list_journal_files(dirname)
+
+        # seqs must keep going up across runs, the sqlite DAOs skip anything at or below what they have. Even after
+        # replay() deleted every file, or if someone wiped the journal directory. So a run starts at the current
+        # time in micro seconds, unless the last run got further than that. (a file is named after its first seq)
+        self._next_seq = get_srv_ts_usec()
+        for filename in self._replay_filenames:
+            self._next_seq = max(self._next_seq,
+                                 int(os.path.basename(filename)[len(_JNL_PREFIX):-len(_JNL_SUFFIX)]) + 1)
+            for seq, _ in _read_entries(filename):
+                self._next_seq = max(self._next_seq, seq + 1)
+
+        # journal files of this run, oldest first: [filename, last seq in it]. The last one is being written to.
+        self._files = []
+        self._file = None
+
+        # seq -> the APPEND_LGRS request that applies it, until the DBL worker is done w/ it.
+        self._unapplied = {}
+
+        # entries the DAO refused. Their file is kept, replay() tries again at the next start.
+        self._failed_seqs = set()
+
+        # set by replay(), nothing is applied before that. The DAO's get_durable_journal_seq(), None if it has none
+        # (applied is durable). And the files replay() applied but the DAO doesnt have durable yet: [filename, last seq]
+        self._get_durable_seq = None
+        self._replayed_files = []
+
+    def start(self, put_req):
+        """ Open a new journal file and start the journal thread. put_req(req) queues apply requests. """
+
+        self._put_req = put_req
+        self._open_file()
+
+        t = threading.Thread(target=self._journal_thread_entry, name="dbl_ingest_journal_thread")
+        t.daemon = True
+        t.start()
+
+    def put_req(self, req: DBL_REQ):
+        """ Queue an APPEND_LGRS_DURABLE request. Its done (succ_data or fail_cause) once its in the journal. """
+
+        self._q.put_nowait(req)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ============================================================================================ journal thread side
+    def _open_file(self):
+
+        filename = _get_journal_filename(self._dirname, self._next_seq)
+        self._file = open(filename, 'ab')
+        self._files.append([filename, None])
+        _fsync_dir(self._dirname)
+
+    def _journal_thread_entry(self):
+
+        log.info(f"Ingest journal thread started. Journal directory: {self._dirname}")
+
+        while True:
+            # never let this thread die. Requests of a failed group are failed, the next group might work.
+            try:
+                self._commit_group()
+                self._collect_applied()
+            except Exception as ex:
+                log.err(f"Ingest journal error: {ex}")
+
+    def _commit_group(self) -> int:
+        """ Write, fsync and ack the queued requests. Return the group size. """
+
+        try:
+            reqs = [self._q.get(timeout=_IDLE_WAIT)]
+        except queue.Empty:
+            return 0
+
+        if self._group_commit_delay > 0:
+            time.sleep(self._group_commit_delay)
+
+        while True:
+            try:
+                reqs.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+
+        # srv_ts is set here, so a replay gets the same srv_ts as the ack did.
+        srv_ts = get_srv_ts_usec()
+        entries = []
+
+        for req in reqs:
+            try:
+                for lgr in req.data.lgrs:
+                    if lgr.srv_ts is None:
+                        lgr.srv_ts = srv_ts
+
+                entries.append((req, self._next_seq, _encode_entry(self._next_seq, req.data)))
+                self._next_seq += 1
+            except (ValueError, TypeError, AttributeError) as ex:
+                req.fail_cause = DBL_FAIL_CAUSE(http_err_code=400, user_msg='Bad Request', dbg_info_string=str(ex))
+
+        if not entries:
+            return len(reqs)
+
+        offset = self._file.tell()
+        try:
+            self._file.write(b"".join(frame for _, _, frame in entries))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception as ex:
+            # none of the group is acked, dont leave a partial group in the file for replay to pick up.
+            self._file.truncate(offset)
+            self._file.seek(offset)
+            for req, _, _ in entries:
+                req.fail_cause = DBL_FAIL_CAUSE(http_err_code=500, user_msg='Internal Server Error',
+                                                dbg_info_string=str(ex))
+            raise
+
+        self._files[-1][1] = entries[-1][1]
+
+        # one priority for all applies. The DBL queues are FIFO, so entries get applied in seq order.
+        for req, seq, _ in entries:
+            apply_req = DBL_REQ(op=DBL_API.APPEND_LGRS, priority=DBL_REQ_PRIORITY.NORMAL,
+                                data=LGR_APPEND_ARGS(req.data.lgrp, req.data.lgrs, journal_seq=seq))
+            self._unapplied[seq] = apply_req
+            self._put_req(apply_req)
+            req.succ_data = len(req.data.lgrs)
+
+        if self._file.tell() >= self._file_size:
+            self._file.close()
+            self._open_file()
+
+        return len(reqs)
+
+    def _collect_applied(self):
+        """ Forget the entries the DBL worker is done w/, delete the journal files that have nothing left to apply. """
+
+        for seq, apply_req in list(self._unapplied.items()):
+            if apply_req.succ_data is not None:
+                del self._unapplied[seq]
+            elif apply_req.fail_cause is not None:
+                log.err(f"Failed to apply ingest journal entry: {seq}, kept for replay. {apply_req.fail_cause}")
+                del self._unapplied[seq]
+                self._failed_seqs.add(seq)
+
+        min_needed_seq = min(min(self._unapplied, default=self._next_seq),
+                             min(self._failed_seqs, default=self._next_seq))
+
+        # applied, but maybe only in memory.
+        if self._get_durable_seq is not None:
+            durable_seq = self._get_durable_seq()
+            min_needed_seq = min(min_needed_seq, durable_seq + 1 if durable_seq is not None else 0)
+
+        num_deleted = 0
+        while self._replayed_files and (self._replayed_files[0][1] < min_needed_seq):
+            os.remove(self._replayed_files.pop(0)[0])
+            num_deleted += 1
+
+        while (len(self._files) > 1) and (self._files[0][1] < min_needed_seq):
+            os.remove(self._files.pop(0)[0])
+            num_deleted += 1
+
+        if num_deleted:
+            _fsync_dir(self._dirname)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ===================================================================================================== replay side
+    def replay(self, dao) -> int:
+        """ Apply the journal files left from the last run to dao, then delete them, or leave that to the journal
+        thread if dao only has them in memory. Runs on the DBL worker, before it serves anything else. Return the
+        number of entries applied. """
+
+        get_durable_seq = getattr(dao, 'get_durable_journal_seq', None)
+        replayed_files = []
+        num_applied = 0
+
+        for filename in self._replay_filenames:
+            last_seq = 0
+
+            for seq, args in _read_entries(filename):
+                req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=args)
+                dao.serve_req(req)
+                last_seq = seq
+
+                # it didnt make it twice. dont hold up the start up (or keep the file forever) for it.
+                if req.fail_cause is not None:
+                    log.err(f"Dropping ingest journal entry: {seq}, failed to apply it on replay. {req.fail_cause}")
+                    continue
+
+                num_applied += 1
+
+            if get_durable_seq is None:
+                os.remove(filename)
+            else:
+                replayed_files.append([filename, last_seq])
+
+        if self._replay_filenames:
+            _fsync_dir(self._dirname)
+            log.info(f"Replayed {num_applied} entries from {len(self._replay_filenames)} ingest journal files.")
+
+        self._replay_filenames = []
+
+        # the journal thread takes it from here.
+        self._replayed_files = replayed_files
+        self._get_durable_seq = get_durable_seq
+
+        return num_applied
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================================
+def _dbg_bench_group_commit(num_clients: int = 32, num_reqs: int = 200):
+    """ sync_level 2 latency, num_clients threads each doing num_reqs durable appends (one record each) back to back.
+    w/ the journal (group commit, apply later) vs. the DAO doing it (disk sqlite, a commit per request). """
+
+    from l6sk.dbl.dbl_dispatch import DBL_REQUEST_DISPATCH, process_dbl_req
+    from l6sk.dbl.dao_sqlite_disk import DAO_SQLITE
+
+    def run(journal_kwargs):
+        tmp_dirname = tempfile.mkdtemp(prefix="l6sk_bench_jnl_")
+        dao = DAO_SQLITE(os.path.join(tmp_dirname, 'l6sk.db'), num_readers=0)
+        journal = IngestJournal(os.path.join(tmp_dirname, 'jnl'), **journal_kwargs) if journal_kwargs else None
+        dispatch = DBL_REQUEST_DISPATCH(journal=journal)
+        latencies = []
+        stop = []
+
+        def dbl_worker():
+            while not stop:
+                req = dispatch.get_next_req()
+                if req is None:
+                    time.sleep(0.0005)
+                    continue
+                process_dbl_req(dao, req)
+
+        def client(client_id):
+            for i in range(num_reqs):
+                lgrs = [LOG_RECORD(lvl='INFO', msg=f"client {client_id} msg {i}")]
+                req = DBL_REQ(op=DBL_API.APPEND_LGRS_DURABLE, data=LGR_APPEND_ARGS('bench', lgrs))
+                start_time = time.perf_counter()
+                dispatch.put_req(req)
+                while (req.succ_data is None) and (req.fail_cause is None):
+                    time.sleep(0.0002)
+                latencies.append(time.perf_counter() - start_time)
+
+        worker = threading.Thread(target=dbl_worker, daemon=True)
+        worker.start()
+
+        start_time = time.perf_counter()
+        clients = [threading.Thread(target=client, args=(client_id, )) for client_id in range(num_clients)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+        elapsed = time.perf_counter() - start_time
+
+        stop.append(True)
+        worker.join()
+
+        latencies.sort()
+        return (len(latencies) / elapsed, latencies[len(latencies) // 2] * 1000,
+                latencies[len(latencies) * 99 // 100] * 1000)
+
+    # dispatch log.dbg()s every request (w/ an inspect.stack() each), that would be all this measures.
+    log_dbg = log.dbg
+    log.dbg = lambda msg: None
+
+    print(f"sync_level 2 appends, {num_clients} clients x {num_reqs} requests:")
+    for name, journal_kwargs in [("dao commit per request", None),
+                                 ("journal, delay 0", {"group_commit_delay": 0.0}),
+                                 ("journal, delay 2ms", {"group_commit_delay": 0.002})]:
+        reqs_per_sec, p50, p99 = run(journal_kwargs)
+        print(f"  {name:<24} {reqs_per_sec:>8.0f} req/s   p50: {p50:6.2f} ms   p99: {p99:6.2f} ms")
+
+    log.dbg = log_dbg
+
+
+def main():
+    _dbg_bench_group_commit()
+
+
+if '__main__' == __name__:
+    main()
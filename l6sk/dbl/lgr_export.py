@@ -0,0 +1,269 @@
+""" lgr_export.py
+Streaming exports. A query's result is a list in memory (QUERY_LGRS), fine for a page, not for a million records.
+An export is every record a query matches, read a chunk at a time off one statement (SqliteLogGroup.iter_lgrs(), on
+a db in WAL mode that is one read snapshot) and encoded (NDJSON or CSV, optionally gzip) on a thread of its own. The
+encoded chunks are handed to the web layer thru a queue of upto max_pending of them, and it writes and flush()es them
+as they come. When the client reads slower than the db does, the queue fills up and the export thread waits, so
+memory is what max_pending chunks take, for any size of result.
+Nothing of it runs on the DBL worker, ingest goes on. (a WAL reader doesnt wait on the writer, or the writer on it)
+
+An export stuck on a client that stopped reading (but didnt close the connection) holds its snapshot, and w/ it the
+WAL checkpoints. After stall_timeout seconds of that its given up on.
+
+get_chunk() and cancel() from any thread, the web layer's is the IOLoop.
+"""
+
+import io
+import csv
+import json
+import time
+import zlib
+import queue
+import threading
+
+from l6sk.dbl.dbl_api import LGR_EXPORT_FORMATS
+
+from l6sk import log_util as log
+
+# seconds the export thread waits on a full queue before it checks on cancel() again.
+_PUT_POLL = 0.1
+
+# Content-Type of each format.
+EXPORT_CONTENT_TYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv; charset=utf-8'}
+
+
+def _encode_ndjson(fields: tuple, rows: list) -> bytes:
+    return "".join(json.dumps(dict(zip(fields, row))) + "\n" for row in rows).encode()
+
+
+def _encode_csv(fields: tuple, rows: list) -> bytes:
+    buf = io.StringIO()
+    csv.writer(buf).writerows(rows)
+    return buf.getvalue().encode()
+
+
+def _encode_header(fmt: str, fields: tuple) -> bytes:
+    return _encode_csv(fields, [fields]) if fmt == 'csv' else b''
+
+
+_ENCODERS = {'ndjson': _encode_ndjson, 'csv': _encode_csv}
+
+
+def iter_no_chunks():
+    """ iter_chunks of an export w/ no rows, ie of a log group that doesnt exist. """
+    yield from ()
+
+
+class LgrExport:
+    """ One export, started on a thread of its own right away.
+    fields: names of the row values, in order. iter_chunks(): returns a generator of lists of rows, its run (and
+    closed) on the export thread. ie lambda: lgrp_store.iter_lgrs(query, ...). fmt: one of LGR_EXPORT_FORMATS.
+    gzip: chunks are compressed, one gzip stream all together, each chunk flushed so it can be decoded as it comes.
+    max_pending: encoded chunks that can wait for the reader. stall_timeout: seconds the reader can leave a full queue
+    alone, after that the export is cancelled, w/ an error. None means wait for ever. """
+
+    def __init__(self, fields: tuple, iter_chunks, fmt: str = 'ndjson', gzip: bool = False, max_pending: int = 4,
+                 stall_timeout: float = 60.0, name: str = "dbl_export_thread"):
+        super().__init__()
+
+        if fmt not in LGR_EXPORT_FORMATS:
+            raise ValueError(f"unknown export format: {fmt}")
+
+        self.fields = fields
+        self.fmt = fmt
+        self.gzip = gzip
+        self._stall_timeout = stall_timeout
+
+        # encoded chunks, None after the last one.
+        self._pending = queue.Queue(max_pending)
+        self._cancelled = False
+        self._finished = False
+        self._exited = False
+
+        # set (str) if the export failed. whatever was handed out before that is all there is.
+        self.error = None
+
+        self.num_rows = 0
+        self.num_bytes = 0
+
+        t = threading.Thread(target=self._export_thread_entry, args=(iter_chunks,), name=name)
+        t.daemon = True
+        t.start()
+
+    def get_chunk(self) -> bytes:
+        """ The next encoded chunk, b'' if there is none yet, None once everything was handed out (or it failed, see
+        error). Doesnt wait. """
+
+        if self._finished:
+            return None
+
+        try:
+            data = self._pending.get_nowait()
+        except queue.Empty:
+            # the thread is gone w/o queueing its None, it was cancelled. (ie the reader stalled)
+            if self._exited:
+                self._finished = True
+                return None
+            return b''
+
+        if data is None:
+            self._finished = True
+
+        return data
+
+    def cancel(self):
+        """ Stop the export, ie the client is gone. The export thread closes its statements and exits. Ok to call more
+        than once, or after its done. """
+
+        self._cancelled = True
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # =============================================================================================== export thread side
+    def _put(self, data) -> bool:
+        """ Queue data once there is room. False if the export was cancelled meanwhile, or the reader stalled. """
+
+        deadline = None if self._stall_timeout is None else time.monotonic() + self._stall_timeout
+
+        while not self._cancelled:
+            try:
+                self._pending.put(data, timeout=_PUT_POLL)
+                return True
+            except queue.Full:
+                pass
+
+            if (deadline is not None) and (time.monotonic() > deadline):
+                self.error = f"reader stalled for over {self._stall_timeout} s"
+                self._cancelled = True
+
+        return False
+
+    def _export_thread_entry(self, iter_chunks):
+
+        chunks = None
+        compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if self.gzip else None
+        encode = _ENCODERS[self.fmt]
+
+        # this thread doesnt get to die w/ an exception, and the reader always gets its None. (unless its gone)
+        try:
+            data = _encode_header(self.fmt, self.fields)
+            chunks = iter_chunks()
+
+            for rows in chunks:
+                data += encode(self.fields, rows)
+                if compressor is not None:
+                    data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+                if not self._put(data):
+                    return
+
+                self.num_rows += len(rows)
+                self.num_bytes += len(data)
+                data = b''
+
+            if compressor is not None:
+                data = compressor.compress(data) + compressor.flush()
+
+            if data and self._put(data):
+                self.num_bytes += len(data)
+        except Exception as ex:
+            log.warn(f"Export failed: {ex}")
+            self.error = str(ex)
+        finally:
+            try:
+                if chunks is not None:
+                    chunks.close()
+            finally:
+                self._put(None)
+                self._exited = True
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_bench_export(num_lgrs: int = 200 * 1000, batch_size: int = 100):
+    """ A disk DAO log group w/ num_lgrs records. Exports all of them as NDJSON, the whole result as a list (what a
+    QUERY_LGRS w/o a limit would be) vs an LgrExport read as it comes. Prints time and peak python memory of each.
+    Then appends batch_size record batches on the DBL worker (this thread) while an export runs, vs w/o one. """
+
+    import shutil  # pylint: disable=import-outside-toplevel
+    import tempfile  # pylint: disable=import-outside-toplevel
+    import tracemalloc  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dbl_api import LOG_RECORD, LGR_QUERY, LGR_EXPORT  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dbl_api import LGR_APPEND_ARGS  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dao_sqlite_disk import DAO_SQLITE  # pylint: disable=import-outside-toplevel
+
+    def mk_lgrs(first_idx, count):
+        return [LOG_RECORD(srv_ts=1604852083000000 + idx * 1000, lvl=['DBUG', 'INFO', 'WARN', 'ERRR'][idx % 4],
+                           session_id=f"sess_{idx % 1000}", filename='server_init.py', lineno=idx % 300,
+                           msg=f"request {idx} served in {idx % 97} ms")
+                for idx in range(first_idx, first_idx + count)]
+
+    def read_all(export):
+        num_bytes = 0
+        while True:
+            chunk = export.get_chunk()
+            if chunk is None:
+                return num_bytes
+            if not chunk:
+                time.sleep(0.001)
+            num_bytes += len(chunk)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        dao = DAO_SQLITE(f"{tmp_dir}/l6sk.db", num_readers=0)
+        for first_idx in range(0, num_lgrs, 10000):
+            dao.append_lgrs(LGR_APPEND_ARGS('bench', mk_lgrs(first_idx, 10000)))
+        query = LGR_QUERY(lgrp='bench', limit=None)
+
+        def as_list():
+            res = dao.query_lgrs(query)
+            return len(_encode_ndjson(res['fields'], res['lgrs']))
+
+        def as_export():
+            return read_all(dao.export_lgrs(LGR_EXPORT(query)))
+
+        print(f"Export of {num_lgrs:,} records, {as_export() / 1024 / 1024:.1f} MB of NDJSON:")
+        for name, run in [('as one list', as_list), ('LgrExport', as_export)]:
+            start_time = time.perf_counter()
+            run()
+            run_t = time.perf_counter() - start_time
+
+            # (separately, tracemalloc slows it down a lot)
+            tracemalloc.start()
+            run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            print(f"  {name:12}: {run_t:.2f} s, peak {peak / 1024 / 1024:.1f} MB")
+
+        def append_batches(num_batches, first_idx):
+            times = []
+            for batch_idx in range(num_batches):
+                start_time = time.perf_counter()
+                dao.append_lgrs(LGR_APPEND_ARGS('bench', mk_lgrs(first_idx + batch_idx * batch_size, batch_size)))
+                times.append(time.perf_counter() - start_time)
+            times.sort()
+            return times[len(times) // 2] * 1000, times[int(len(times) * 0.99)] * 1000
+
+        idle_p50, idle_p99 = append_batches(500, num_lgrs)
+
+        # an export w/ a reader that keeps up, on a thread of its own.
+        export = dao.export_lgrs(LGR_EXPORT(query))
+        reader = threading.Thread(target=read_all, args=(export,))
+        reader.start()
+        busy_p50, busy_p99 = append_batches(500, num_lgrs + 500 * batch_size)
+        reader.join()
+
+        print(f"  appends of {batch_size}: w/o an export p50 {idle_p50:.2f} ms p99 {idle_p99:.2f} ms, during one "
+              f"p50 {busy_p50:.2f} ms p99 {busy_p99:.2f} ms ({export.num_rows:,} records exported)")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def main():
+    _dbg_bench_export()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,283 @@
+""" lgr_hub.py
+Live tail. Dashboards that poll /api/lgr/query for new records cost the DBL worker a query each, every poll, whether
+there is anything new or not. A thousand of them polling once a second is a thousand queries a second. LgrHub is an
+in-process pub/sub instead: the DBL worker publishes every batch it appended (after the DAO committed it) and the hub
+hands the records to whoever is tailing that log group. Tailing costs the DBL worker nothing, zero or a thousand
+tails. (a publish to a log group nobody tails is one dict lookup)
+
+Fan out is on the IOLoop, where the tail handlers are. publish() only schedules it (call_soon, thread safe), the DBL
+worker doesnt wait on any subscriber. Each record is JSON encoded once per batch, no matter how many subscribers
+get it. Every subscriber has a bounded buffer, one that falls behind by more than its buffer (ie a client that doesnt
+read fast enough, its TCP window is full and its flush() doesnt return) is dropped, not waited for. It can reconnect
+and catch up w/ /api/lgr/query.
+
+The records are the LOG_RECORDs as they were appended, not rows read back. No lrid, and records a log group
+collapses as repeats (lgrp_opts 'repeat_window') show up one by one.
+
+subscribe(), unsubscribe(), wait() and get_stats() are IOLoop thread only. publish() from any thread.
+"""
+
+import json
+import time
+import asyncio
+import collections
+
+from l6sk.dbl.dbl_api import LOG_RECORD, LGR_QUERY, LGR_FIELDS, LGR_LVL_CODES, get_query_lvl_codes
+
+from l6sk import log_util as log
+
+# fields of tailed records, in the order they are sent. LGR_FIELDS w/o lrid, appends dont have one.
+TAIL_FIELDS = LGR_FIELDS[1:]
+
+
+class TailSubscriber:
+    """ One tail. query: the filters, only lgrp, lvls, lvl_min, session_id and subsys are looked at. """
+
+    __slots__ = ('query', 'lvl_codes', 'filter_key', 'max_buffer', 'buffer', 'event', 'dropped', 'closed', 'num_sent')
+
+    def __init__(self, query: LGR_QUERY, max_buffer: int):
+        self.query = query
+        self.lvl_codes = get_query_lvl_codes(query)
+        self.filter_key = (self.lvl_codes, query.session_id, query.subsys)
+        self.max_buffer = max_buffer
+
+        # <srv_ts, JSON encoded record>, not sent yet.
+        self.buffer = collections.deque()
+
+        # set when there is something for wait() to return, or the subscriber is done.
+        self.event = asyncio.Event()
+
+        # dropped: fell behind by more than max_buffer records. closed: unsubscribed.
+        self.dropped = False
+        self.closed = False
+
+        self.num_sent = 0
+
+    def is_match(self, lgr: LOG_RECORD) -> bool:
+
+        query = self.query
+
+        if (self.lvl_codes is not None) and (LGR_LVL_CODES.get(lgr.lvl) not in self.lvl_codes):
+            return False
+
+        if (query.session_id is not None) and (lgr.session_id != query.session_id):
+            return False
+
+        return (query.subsys is None) or (lgr.subsys == query.subsys)
+
+
+class LgrHub:
+    """ call_soon: schedules a callable on the IOLoop, from any thread. (IOLoop.add_callback)
+    max_buffer: records a subscriber can fall behind by before its dropped.
+    max_subscribers: subscribe() refuses more than this many at once. """
+
+    def __init__(self, call_soon, max_buffer: int = 1000, max_subscribers: int = 1000):
+        super().__init__()
+
+        self._call_soon = call_soon
+        self._max_buffer = max_buffer
+        self._max_subscribers = max_subscribers
+
+        # <lgrp: set of TailSubscriber>. Only the IOLoop changes it, publish() only checks if a log group has any.
+        self._lgrp_subs = {}
+        self._num_subs = 0
+
+        self.num_published = 0
+        self.num_fanned_out = 0
+        self.num_dropped = 0
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ================================================================================================== any thread side
+    def has_subscribers(self, lgrp: str) -> bool:
+        return bool(self._lgrp_subs.get(lgrp))
+
+    def publish(self, lgrp: str, lgrs: list):
+        """ lgrs were just appended to lgrp. Hand them to lgrp's subscribers, if it has any. Doesnt wait for that.
+        lgrs must not change after this. """
+
+        if not self.has_subscribers(lgrp):
+            return
+
+        self.num_published += len(lgrs)
+        self._call_soon(self._fan_out, lgrp, lgrs)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ====================================================================================================== IOLoop side
+    def subscribe(self, query: LGR_QUERY, max_buffer: int = None) -> TailSubscriber:
+        """ Start tailing query.lgrp. None if there are max_subscribers already. """
+
+        if self._num_subs >= self._max_subscribers:
+            return None
+
+        sub = TailSubscriber(query, max_buffer or self._max_buffer)
+
+        # a new set, not an add. publish() may be looking at the old one from the DBL worker.
+        self._lgrp_subs[query.lgrp] = self._lgrp_subs.get(query.lgrp, frozenset()) | {sub}
+        self._num_subs += 1
+
+        return sub
+
+    def unsubscribe(self, sub: TailSubscriber):
+        """ Stop sub. Wakes up whoever is in wait() on it. Ok to call more than once. """
+
+        if sub.closed:
+            return
+
+        sub.closed = True
+        sub.event.set()
+
+        subs = self._lgrp_subs.get(sub.query.lgrp, frozenset()) - {sub}
+        if subs:
+            self._lgrp_subs[sub.query.lgrp] = subs
+        else:
+            self._lgrp_subs.pop(sub.query.lgrp, None)
+
+        self._num_subs -= 1
+
+    async def wait(self, sub: TailSubscriber, timeout: float) -> list:
+        """ Wait upto timeout seconds for records. Return <srv_ts, JSON encoded record> for every record sub has
+        gotten since the last call, [] if there was none (or sub is done, see sub.dropped/closed) """
+
+        if not sub.buffer and not sub.closed:
+            # a timer that sets the event, not wait_for(). thats a task per call, w/ a thousand tails it adds up.
+            sub.event.clear()
+            timer = asyncio.get_running_loop().call_later(timeout, sub.event.set)
+            await sub.event.wait()
+            timer.cancel()
+
+        items = list(sub.buffer)
+        sub.buffer.clear()
+        sub.num_sent += len(items)
+
+        return items
+
+    def _fan_out(self, lgrp: str, lgrs: list):
+
+        subs = self._lgrp_subs.get(lgrp)
+        if not subs:
+            return
+
+        # encoded once, shared by every subscriber that gets the record. Matched once per distinct filter, most tails
+        # of a log group have the same few filters (or none).
+        encoded = [None] * len(lgrs)
+        filter_matches = {}
+
+        for sub in subs:
+            matches = filter_matches.get(sub.filter_key)
+            if matches is None:
+                matches = [idx for idx, lgr in enumerate(lgrs) if sub.is_match(lgr)]
+                filter_matches[sub.filter_key] = matches
+
+            if not matches:
+                continue
+
+            if len(sub.buffer) + len(matches) > sub.max_buffer:
+                log.warn(f"Tail of log group: {lgrp} fell behind by over {sub.max_buffer} records. Dropped.")
+                sub.dropped = True
+                self.num_dropped += 1
+                self.unsubscribe(sub)
+                continue
+
+            for idx in matches:
+                if encoded[idx] is None:
+                    lgr = lgrs[idx]
+                    encoded[idx] = (lgr.srv_ts, json.dumps([getattr(lgr, field) for field in TAIL_FIELDS]))
+                sub.buffer.append(encoded[idx])
+
+            sub.event.set()
+            self.num_fanned_out += len(matches)
+
+    def get_stats(self) -> dict:
+        return {'subscribers': self._num_subs, 'lgrps': {lgrp: len(subs) for lgrp, subs in self._lgrp_subs.items()},
+                'published': self.num_published, 'fanned_out': self.num_fanned_out, 'dropped': self.num_dropped}
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_bench_tail_vs_poll(num_tails: int = 1000, duration: float = 5.0, batch_rate: int = 50, batch_size: int = 20,
+                            flush_interval: float = 0.1):
+    """ num_tails dashboards following one log group that gets batch_rate batches of batch_size records a second.
+    Polling: each one runs a query (page of 100 records past its cursor) once a second, on a memory sqlite log group.
+    Tailing: an LgrHub on an asyncio loop, tails take what they got every flush_interval seconds at most, like the tail
+    handler does. Prints what each costs the DBL worker, and the loop, per second. """
+
+    import threading  # pylint: disable=import-outside-toplevel
+    import sqlite3  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.sqlite_lgrp import SqliteLogGroup  # pylint: disable=import-outside-toplevel
+
+    def mk_batch(batch_idx):
+        return [LOG_RECORD(srv_ts=1604852083000000 + (batch_idx * batch_size + idx) * 1000, lvl='INFO',
+                           session_id=f"sess_{idx % 7}", msg=f"request {batch_idx}/{idx} served in 3 ms")
+                for idx in range(batch_size)]
+
+    num_batches = int(duration * batch_rate)
+
+    # polling. the batches are appended first, then each tail polls the second's worth of them.
+    lgrp = SqliteLogGroup('bench', sqlite3.connect(":memory:", isolation_level=None))
+    for batch_idx in range(num_batches):
+        lgrp.append_lgrs(mk_batch(batch_idx))
+
+    start_time = time.perf_counter()
+    for second in range(int(duration)):
+        srv_ts_min = 1604852083000000 + second * batch_rate * batch_size * 1000
+        for _ in range(num_tails):
+            lgrp.query_lgrs(LGR_QUERY(lgrp='bench', srv_ts_min=srv_ts_min, limit=100))
+    poll_t = (time.perf_counter() - start_time) / duration
+
+    # tailing. the DBL worker is a thread that publishes batch_rate batches a second.
+    async def run_tails():
+        loop = asyncio.get_running_loop()
+        hub = LgrHub(loop.call_soon_threadsafe, max_buffer=10000, max_subscribers=num_tails)
+        subs = [hub.subscribe(LGR_QUERY(lgrp='bench')) for _ in range(num_tails)]
+        num_received = [0]
+
+        async def tail(sub):
+            while not sub.closed:
+                items = await hub.wait(sub, 1.0)
+                num_received[0] += len(items)
+                await asyncio.sleep(flush_interval)
+
+        tasks = [asyncio.ensure_future(tail(sub)) for sub in subs]
+
+        batches = [mk_batch(batch_idx) for batch_idx in range(num_batches)]
+        publish_t = [0.0]
+
+        def dbl_worker():
+            for batch in batches:
+                start = time.thread_time()
+                hub.publish('bench', batch)
+                publish_t[0] += time.thread_time() - start
+                time.sleep(1 / batch_rate)
+
+        start = time.process_time()
+        worker = threading.Thread(target=dbl_worker)
+        worker.start()
+        while worker.is_alive():
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)
+        loop_t = time.process_time() - start - publish_t[0]
+
+        for sub in subs:
+            hub.unsubscribe(sub)
+        await asyncio.gather(*tasks)
+
+        return publish_t[0], loop_t, num_received[0], hub.get_stats()
+
+    publish_t, loop_t, num_received, stats = asyncio.run(run_tails())
+
+    print(f"{num_tails} dashboards, {batch_rate * batch_size} records/s for {duration:.0f} s:")
+    print(f"  polling 1/s:  {num_tails} queries/s, DBL worker busy {poll_t * 1000:.0f} ms/s")
+    print(f"  LgrHub tails: 0 queries/s, DBL worker busy {publish_t / duration * 1000:.2f} ms/s publishing, "
+          f"loop busy {loop_t / duration * 1000:.0f} ms/s fanning out {num_received / duration:,.0f} records/s "
+          f"(w/o the HTTP writes, dropped: {stats['dropped']})")
+
+
+def main():
+    _dbg_bench_tail_vs_poll()
+
+
+if '__main__' == __name__:
+    main()
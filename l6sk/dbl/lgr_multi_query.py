@@ -0,0 +1,211 @@
+""" lgr_multi_query.py
+Queries across log groups. (DBL_API.QUERY_MULTI_LGRS) The query runs on each log group on its own, the usual way
+(tiers, result cache and all), for a page of upto limit records. The pages are k-way merged w/ a heap in
+(srv_ts, lgrp, lrid) order, the first limit rows of that are the result. DAOs that can run the groups at the same time
+(disk DAO, a reader thread each) take about what the slowest group does, not the sum of them.
+
+Early stop: once a group has a full page, no record after its last srv_ts can make the merged page. Groups that start
+after that only look upto there (srv_ts_max), ie a group that has nothing that early costs an index probe, not a page.
+Groups that start after one failed arent run at all.
+
+The cursor of a merged page is <srv_ts, lgrp, lrid> of its last record. For each group thats an LGR_QUERY.after: the
+groups that sort before lgrp only have records after srv_ts left, lgrp the ones after (srv_ts, lrid), the groups after
+it the ones from srv_ts on.
+"""
+
+import heapq
+import itertools
+import threading
+import dataclasses
+
+from l6sk.dbl.dbl_api import LGR_QUERY, LGR_MULTI_QUERY, DBL_FAIL_CAUSE, LgrQueryError
+
+# sqlite INTEGER max, no lrid is over it.
+_LRID_MAX = 2**63 - 1
+
+
+def _with_lgrp(lgrs: list, lgrp: str):
+
+    return (row + (lgrp, ) for row in lgrs)
+
+
+class LgrpQueryMerge:
+    """ One QUERY_MULTI_LGRS. The DAO calls run_lgrp() for every lgrp in lgrps, the one that says it was the last
+    calls set_result(req). Thread safe, the groups can run on any threads. fields: the fields of the DAO's result
+    rows. """
+
+    def __init__(self, mquery: LGR_MULTI_QUERY, lgrps: list, fields: tuple):
+        super().__init__()
+
+        self._mquery = mquery
+        self._fields = fields
+        self._lock = threading.Lock()
+
+        # <lgrp: result rows> of the groups that are done.
+        self._pages = {}
+        self._num_pending = len(lgrps)
+        self._failure = None
+
+        # the lowest last srv_ts of a full page so far.
+        self._srv_ts_bound = None
+
+    def get_lgrp_query(self, lgrp: str) -> LGR_QUERY:
+        """ The query to run on lgrp, None if there is no point anymore. (another group failed) """
+
+        query = self._mquery.query
+
+        with self._lock:
+            if self._failure is not None:
+                return None
+            srv_ts_bound = self._srv_ts_bound
+
+        after = None
+        if self._mquery.after is not None:
+            srv_ts, after_lgrp, lrid = self._mquery.after
+            if lgrp < after_lgrp:
+                after = (srv_ts, _LRID_MAX)
+            elif lgrp == after_lgrp:
+                after = (srv_ts, lrid)
+            else:
+                after = (srv_ts, 0)
+
+        srv_ts_max = query.srv_ts_max
+        if (srv_ts_bound is not None) and ((srv_ts_max is None) or (srv_ts_bound < srv_ts_max)):
+            srv_ts_max = srv_ts_bound
+
+        return dataclasses.replace(query, lgrp=lgrp, after=after, srv_ts_max=srv_ts_max)
+
+    def run_lgrp(self, lgrp: str, query_fn) -> bool:
+        """ Run lgrp's query w/ query_fn(query), which returns what QUERY_LGRS would, and keep its page. True if lgrp
+        was the last group. """
+
+        query = self.get_lgrp_query(lgrp)
+        lgrs = None
+
+        try:
+            if query is not None:
+                lgrs = query_fn(query)['lgrs']
+        except Exception as ex:
+            # a fresh exception, not ex. (no traceback to keep alive) one of the query's own stays a 400.
+            failure_type = LgrQueryError if isinstance(ex, LgrQueryError) else RuntimeError
+            with self._lock:
+                if self._failure is None:
+                    self._failure = failure_type(f"log group: {lgrp}: {ex}")
+
+        limit = self._mquery.query.limit
+
+        with self._lock:
+            if lgrs is not None:
+                self._pages[lgrp] = lgrs
+
+                if (limit is not None) and (len(lgrs) >= limit):
+                    if (self._srv_ts_bound is None) or (lgrs[-1][1] < self._srv_ts_bound):
+                        self._srv_ts_bound = lgrs[-1][1]
+
+            self._num_pending -= 1
+            return self._num_pending == 0
+
+    def get_result(self) -> dict:
+        """ The merged page, a dict w/ 'fields' (the DAO's fields, then 'lgrp') and 'lgrs'. RuntimeError if a group
+        failed, LgrQueryError if it was the query's fault. """
+
+        if self._failure is not None:
+            raise self._failure
+
+        # rows come in (srv_ts, lrid) order per group. (lrid and srv_ts are always the first two) heapq.merge() only
+        # takes rows off a group's page as it needs them, the rest of the pages are never looked at.
+        merged = heapq.merge(*[_with_lgrp(lgrs, lgrp) for lgrp, lgrs in sorted(self._pages.items())],
+                             key=lambda row: (row[1], row[-1], row[0]))
+        lgrs = list(itertools.islice(merged, self._mquery.query.limit))
+
+        return {'fields': self._fields + ('lgrp', ), 'lgrs': lgrs}
+
+    def set_result(self, req):
+        """ Finish req (a DBL_REQ) w/ get_result(), or the failure. Same as the DBL worker would. """
+
+        try:
+            req.succ_data = self.get_result()
+        except LgrQueryError as ex:
+            req.fail_cause = DBL_FAIL_CAUSE(http_err_code=400,
+                                            user_msg=str(ex),
+                                            dbg_info_string=str(ex))
+        except Exception as ex:
+            req.fail_cause = DBL_FAIL_CAUSE(http_err_code=500,
+                                            user_msg='Internal Server Error',
+                                            dbg_info_string=str(ex))
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_bench_multi_query(num_lgrps: int = 8, num_lgrs: int = 100 * 1000, num_queries: int = 20):
+    """ num_lgrps disk DAO log groups w/ num_lgrs records each. A page of a query that has to look at a lot of records
+    per match (client_ts filter, no index) across all of them: the groups one after the other (no readers) vs on a
+    reader each. Then the same w/ the groups one after another in time, where the first group's page is all it takes.
+    The sum of the groups' own queries (what a merge w/o the early stop costs) vs the multi query. """
+
+    import shutil  # pylint: disable=import-outside-toplevel
+    import tempfile  # pylint: disable=import-outside-toplevel
+    import time  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dbl_api import LOG_RECORD, LGR_APPEND_ARGS, DBL_API  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dbl_dispatch import DBL_REQ  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dao_sqlite_disk import DAO_SQLITE  # pylint: disable=import-outside-toplevel
+
+    base_ts = 1604852083000000
+
+    # 1 in 1000 records has a client_ts the query matches.
+    def mk_lgrs(lgrp_idx, first_idx, count, spread):
+        # spread: the groups take turns, ie every group has records all over the time range.
+        ts_idxs = [idx * num_lgrps + lgrp_idx if spread else lgrp_idx * num_lgrs + idx
+                   for idx in range(first_idx, first_idx + count)]
+        return [LOG_RECORD(srv_ts=base_ts + ts_idx * 1000, client_ts=2 if idx % 1000 == 0 else 1, lvl='INFO',
+                           filename='server_init.py', lineno=idx % 300, msg=f"request {idx} served in {idx % 97} ms")
+                for idx, ts_idx in zip(range(first_idx, first_idx + count), ts_idxs)]
+
+    def timed(run):
+        start_time = time.perf_counter()
+        for _ in range(num_queries):
+            run()
+        return (time.perf_counter() - start_time) / num_queries * 1000
+
+    def serve(dao, req):
+        dao.serve_req(req)
+        while (req.succ_data is None) and (req.fail_cause is None):
+            time.sleep(0.0001)
+        assert req.fail_cause is None, req.fail_cause
+        return req.succ_data
+
+    query = LGR_QUERY(lgrp=None, limit=50, client_ts_min=2)
+    mquery = LGR_MULTI_QUERY(query=query)
+    lgrps = [f"bench_{lgrp_idx}" for lgrp_idx in range(num_lgrps)]
+
+    for spread in (True, False):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            dao = DAO_SQLITE(f"{tmp_dir}/l6sk.db", num_readers=0)
+            for lgrp_idx, lgrp in enumerate(lgrps):
+                for first_idx in range(0, num_lgrs, 10000):
+                    dao.append_lgrs(LGR_APPEND_ARGS(lgrp, mk_lgrs(lgrp_idx, first_idx, 10000, spread)))
+            readers_dao = DAO_SQLITE(f"{tmp_dir}/l6sk.db", num_readers=num_lgrps)
+
+            # reader connections are opened on the first query.
+            serve(readers_dao, DBL_REQ(op=DBL_API.QUERY_MULTI_LGRS, data=mquery))
+
+            sum_ms = timed(lambda: [dao.query_lgrs(dataclasses.replace(query, lgrp=lgrp)) for lgrp in lgrps])
+            serial_ms = timed(lambda: dao.query_multi_lgrs(mquery))
+            readers_ms = timed(lambda: serve(readers_dao, DBL_REQ(op=DBL_API.QUERY_MULTI_LGRS, data=mquery)))
+
+            print(f"{num_lgrps} log groups of {num_lgrs:,} records, "
+                  f"{'interleaved in time' if spread else 'one after another in time'}, page of {query.limit}:")
+            print(f"  sum of per group queries: {sum_ms:.1f} ms, multi query w/o readers: {serial_ms:.1f} ms, "
+                  f"on {num_lgrps} readers: {readers_ms:.1f} ms")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+def main():
+    _dbg_bench_multi_query()
+
+
+if '__main__' == __name__:
+    main()
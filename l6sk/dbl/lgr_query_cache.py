@@ -0,0 +1,246 @@
+""" lgr_query_cache.py
+Query result cache for the sqlite DAOs. (a look aside buffer in DAO terms)
+
+Dashboards and readers run the same queries over and over, most of them over time ranges where nothing will ever
+change again. Records are append only, lrids only go up. So a result computed when the log group's highest lrid was
+max_lrid is still the right answer for the records upto max_lrid, for ever. Entries are tagged w/ that mark:
+  - the log group is still at the mark: the cached result is the answer, no SQL at all.
+  - a few records were appended since: only those are queried (lrid past the mark, see SqliteLogGroup.query_lgrs()
+    lrid_range) and merged into the cached result. A query over last week costs what the delta does, ie nothing
+    matches and its a short rowid walk.
+  - a lot was appended since (over max_delta records): the query is run again, like a miss.
+Rows can change in place in one case, a repeat run (lgrp_opts 'repeat_window') getting more repeats updates its row.
+The log group counts those (row_gen) and remembers which rows they were, an entry that has one of them is dropped.
+Archiving moves records, it doesnt change them, entries stay good.
+
+Keys are the query w/ its filters normalized (levels as codes, srv_ts_min and the cursor as one lower bound) so
+lvl_min=WARN and lvl=WARN,ERRR,CRIT share an entry. LRU eviction, bounded by the (estimated) bytes of the cached rows.
+Thread safe, reader threads use it at the same time.
+"""
+
+import sys
+import heapq
+import itertools
+import threading
+import collections
+
+from l6sk.dbl.dbl_api import LGR_QUERY, get_query_lvl_codes, get_query_srv_ts_min
+
+# an entry can take upto this share of the cache. (one full history query shouldnt flush everything else)
+_MAX_ENTRY_SHARE = 8
+
+
+class _CacheEntry:
+
+    __slots__ = ('fields', 'lgrs', 'max_lrid', 'row_gen', 'num_bytes')
+
+    def __init__(self, fields: tuple, lgrs: list, max_lrid: int, row_gen: int, num_bytes: int = None):
+        self.fields = fields
+        self.lgrs = lgrs
+        self.max_lrid = max_lrid
+        self.row_gen = row_gen
+        self.num_bytes = _get_num_bytes(lgrs) if num_bytes is None else num_bytes
+
+
+def _get_num_bytes(lgrs: list) -> int:
+    """ About what lgrs (list of row tuples) takes in memory. Shared values (small ints, None, interned strs) are
+    counted every time, so its on the high side. """
+
+    return sys.getsizeof(lgrs) + sum(sys.getsizeof(row) + sum(map(sys.getsizeof, row)) for row in lgrs)
+
+
+def get_cache_key(query: LGR_QUERY) -> tuple:
+
+    return (query.lgrp, get_query_srv_ts_min(query), query.srv_ts_max, query.session_id, query.subsys,
+            get_query_lvl_codes(query), query.limit, query.client_ts_min, query.client_ts_max,
+            None if query.after is None else tuple(query.after), query.msg_match, query.msg_regex, query.filename_regex,
+            query.template_id)
+
+
+def _merge_lgrs(lgrs_a: list, lgrs_b: list, limit: int) -> list:
+    """ Merge two (srv_ts, lrid) ordered lists of rows, keep limit. """
+
+    return list(itertools.islice(heapq.merge(lgrs_a, lgrs_b, key=lambda row: (row[1], row[0])), limit))
+
+
+class LgrQueryCache:
+    """ max_bytes: cached rows are evicted (least recently used first) to stay under this many bytes.
+    max_delta: a cached result is topped up w/ the records appended since, if there are upto this many. Over that,
+    the query is run again. """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, max_delta: int = 10000):
+        super().__init__()
+
+        self._max_bytes = max_bytes
+        self._max_delta = max_delta
+        self._lock = threading.Lock()
+
+        # <cache key: _CacheEntry> in LRU order.
+        self._entries = collections.OrderedDict()
+        self._num_bytes = 0
+
+        self.num_hits = 0
+        self.num_delta_hits = 0
+        self.num_misses = 0
+        self.num_uncached = 0
+        self.num_evicted = 0
+
+    def query_lgrs(self, query: LGR_QUERY, mark: tuple, run_query, get_changed_lrids) -> dict:
+        """ query's result, from the cache if it can be. Same format as SqliteLogGroup.query_lgrs()'
+        mark: <max_lrid, row_gen> of the log group right now (SqliteLogGroup.get_cache_mark()), None means dont cache.
+        run_query(lrid_range): runs query on the records in lrid_range (see SqliteLogGroup.query_lgrs())
+        get_changed_lrids(row_gen): the log group's SqliteLogGroup.get_changed_lrids() """
+
+        if mark is None:
+            with self._lock:
+                self.num_uncached += 1
+            return run_query(None)
+
+        max_lrid, row_gen = mark
+        key = get_cache_key(query)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+
+        if (entry is not None) and (entry.row_gen != row_gen):
+            changed_lrids = get_changed_lrids(entry.row_gen)
+            if (changed_lrids is None) or any(row[0] in changed_lrids for row in entry.lgrs):
+                entry = None
+
+        # (an entry can be past the mark, a reader thread that got the mark just before an append)
+        if (entry is not None) and (entry.max_lrid >= max_lrid):
+            with self._lock:
+                self.num_hits += 1
+            return {'fields': entry.fields, 'lgrs': list(entry.lgrs)}
+
+        if (entry is not None) and (max_lrid - entry.max_lrid <= self._max_delta):
+            res = run_query((entry.max_lrid, max_lrid))
+            with self._lock:
+                self.num_delta_hits += 1
+
+            # sizing the rows costs more than the delta query. only the new ones are, the rest is pro rata.
+            lgrs = entry.lgrs
+            num_bytes = entry.num_bytes
+            if res['lgrs']:
+                lgrs = _merge_lgrs(entry.lgrs, res['lgrs'], query.limit)
+                num_bytes += _get_num_bytes(res['lgrs'])
+                num_bytes = num_bytes * len(lgrs) // (len(entry.lgrs) + len(res['lgrs']))
+
+            entry = _CacheEntry(res['fields'], lgrs, max_lrid, row_gen, num_bytes)
+        else:
+            res = run_query((None, max_lrid))
+            with self._lock:
+                self.num_misses += 1
+
+            entry = _CacheEntry(res['fields'], res['lgrs'], max_lrid, row_gen)
+
+        self._put(key, entry)
+
+        return {'fields': entry.fields, 'lgrs': list(entry.lgrs)}
+
+    def _put(self, key: tuple, entry: _CacheEntry):
+
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self._num_bytes -= old_entry.num_bytes
+
+            if entry.num_bytes > self._max_bytes // _MAX_ENTRY_SHARE:
+                return
+
+            self._entries[key] = entry
+            self._num_bytes += entry.num_bytes
+
+            while self._num_bytes > self._max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._num_bytes -= evicted.num_bytes
+                self.num_evicted += 1
+
+    def get_stats(self) -> dict:
+
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._num_bytes, 'hits': self.num_hits,
+                    'delta_hits': self.num_delta_hits, 'misses': self.num_misses, 'uncached': self.num_uncached,
+                    'evicted': self.num_evicted}
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_bench_query_cache(num_lgrs: int = 500 * 1000, num_queries: int = 200, batch_size: int = 100):
+    """ A memory sqlite log group w/ num_lgrs records (a day of them), a batch of batch_size appended before every
+    query. Dashboard like queries, run num_queries times each, w/o and w/ the cache:
+      - history: ERRRs of an hour from yesterday morning, ie nothing past the mark ever matches.
+      - head: WARN+ records of the last hour, ie every query overlaps the records appended since the last one.
+      - session: one session's records, the whole day. """
+
+    import time  # pylint: disable=import-outside-toplevel
+    import sqlite3  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dbl_api import LOG_RECORD  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.sqlite_lgrp import SqliteLogGroup  # pylint: disable=import-outside-toplevel
+
+    base_ts = 1604852083000000
+    step = 24 * 3600 * 1000 * 1000 // num_lgrs
+
+    def mk_lgrs(first_idx, count):
+        return [LOG_RECORD(srv_ts=base_ts + idx * step, lvl=['DBUG', 'INFO', 'INFO', 'WARN', 'ERRR'][idx % 5],
+                           session_id=f"sess_{idx % 1000}", msg=f"request {idx} served in {idx % 97} ms")
+                for idx in range(first_idx, first_idx + count)]
+
+    queries = {
+        'history': LGR_QUERY(lgrp='bench', srv_ts_min=base_ts + 8 * 3600 * 1000 * 1000,
+                             srv_ts_max=base_ts + 9 * 3600 * 1000 * 1000, lvl_min='ERRR', limit=1000),
+        'head': LGR_QUERY(lgrp='bench', srv_ts_min=base_ts + 23 * 3600 * 1000 * 1000, lvl_min='WARN', limit=100),
+        'session': LGR_QUERY(lgrp='bench', session_id='sess_42', limit=1000),
+    }
+
+    lgrp = SqliteLogGroup('bench', sqlite3.connect(":memory:", isolation_level=None))
+    for first_idx in range(0, num_lgrs, 10000):
+        lgrp.append_lgrs(mk_lgrs(first_idx, 10000))
+    next_idx = num_lgrs
+
+    print(f"{num_lgrs:,} records, {batch_size} appended before each query, {num_queries} queries each:")
+    for name, query in queries.items():
+        cache = LgrQueryCache()
+        uncached_t = 0.0
+        cached_t = 0.0
+
+        for _ in range(num_queries):
+            lgrp.append_lgrs(mk_lgrs(next_idx, batch_size))
+            next_idx += batch_size
+
+            start = time.perf_counter()
+            res = lgrp.query_lgrs(query)
+            uncached_t += time.perf_counter() - start
+
+            start = time.perf_counter()
+            cached_res = cache.query_lgrs(query, lgrp.get_cache_mark(query),
+                                          lambda lrid_range, query=query: lgrp.query_lgrs(query, lrid_range=lrid_range),
+                                          lgrp.get_changed_lrids)
+            cached_t += time.perf_counter() - start
+
+            assert cached_res == res
+
+        stats = cache.get_stats()
+        print(f"  {name:8}: uncached {uncached_t / num_queries * 1000:.2f} ms/query, cached "
+              f"{cached_t / num_queries * 1000:.3f} ms/query ({len(res['lgrs'])} rows, "
+              f"{stats['delta_hits']} delta hits)")
+
+    # w/o appends in between, every query after the first is a hit.
+    cache = LgrQueryCache()
+    query = queries['history']
+    start = time.perf_counter()
+    for _ in range(num_queries):
+        cache.query_lgrs(query, lgrp.get_cache_mark(query),
+                         lambda lrid_range: lgrp.query_lgrs(query, lrid_range=lrid_range), lgrp.get_changed_lrids)
+    print(f"  history, no appends: cached {(time.perf_counter() - start) / num_queries * 1000:.3f} ms/query "
+          f"({cache.get_stats()['hits']} hits)")
+
+def main():
+    _dbg_bench_query_cache()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,260 @@
+""" lgr_regex.py
+Regex filters on msg and filename. (LGR_QUERY msg_regex, filename_regex)
+
+Sqlite has the REGEXP operator but no function behind it, X REGEXP Y calls a user function regexp(Y, X).
+register_regexp() adds one to a connection, backed by a PatternCache. A query's pattern is the same for every row it
+looks at, so its compiled once and every row after that is a dict hit. (re.search(pattern, ...) per row goes thru
+re's own cache each time, shared w/ everything else in the process and keyed on type and flags as well)
+
+Python's re backtracks, and it cant be interrupted. sqlite's progress handler (regex_deadline()) only runs between
+VM instructions, between regexp() calls, never in one. So each call is bounded by the pattern checks (check_regex()),
+before a pattern gets anywhere near a row:
+- length, and it compiles.
+- no quantified group w/ a quantifier or an alternation in it, ie (a+)+ (a+b?)+ (a|aa)+ (.*a){12}. Thats where
+  exponential backtracking comes from.
+- the rest is polynomial, a search() can take upto about len(value) ** (variable quantifiers + 1) steps. .*.*.*x takes
+  a minute on a 1000 char msg. So a pattern only ever searches the first so many chars of a value, as many as keep
+  that under REGEX_STEP_BUDGET steps. (BoundedRegex) A plain word, all of any msg. timeout.*refused, the first 10k
+  chars. Patterns that would get less than REGEX_MIN_VALUE_LEN chars are refused.
+A call takes a few tens of ms at most, the deadline takes care of the query as a whole.
+"""
+
+import re
+import time
+import functools
+import sqlite3
+import contextlib
+import collections
+
+from l6sk.dbl.dbl_api import LGR_QUERY
+
+# default max pattern length, in chars.
+REGEX_MAX_LEN = 256
+
+# sqlite VM instructions between deadline checks.
+_PROGRESS_N = 10000
+
+# upper bound on the backtracking steps of one search(), see BoundedRegex. (tens of ms of re)
+REGEX_STEP_BUDGET = 10**8
+
+# patterns that cant search at least this many chars of a value w/in the budget are refused.
+REGEX_MIN_VALUE_LEN = 64
+
+# the most chars of a value any pattern searches.
+_REGEX_MAX_VALUE_LEN = 10**8
+
+try:
+    from re import _parser as _sre_parse  # python 3.11+
+    from re import _constants as _sre_const
+except ImportError:
+    import sre_parse as _sre_parse
+    import sre_constants as _sre_const
+
+_REPEAT_OPS = frozenset(getattr(_sre_const, name) for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+                        if hasattr(_sre_const, name))
+_ATOMIC_GROUP = getattr(_sre_const, 'ATOMIC_GROUP', None)
+
+
+def _get_subpatterns(op, av) -> list:
+    """ The parsed subpatterns of one (non repeat) node: its alternatives (BRANCH, conditional group), or a list w/
+    its one subpattern (group, lookaround), or none. """
+
+    if op is _sre_const.BRANCH:
+        return av[1]
+
+    if op is _sre_const.SUBPATTERN:
+        return [av[-1]]
+
+    if op in (_sre_const.ASSERT, _sre_const.ASSERT_NOT):
+        return [av[1]]
+
+    if op is _sre_const.GROUPREF_EXISTS:
+        return [av[1]] + ([av[2]] if av[2] is not None else [])
+
+    if (_ATOMIC_GROUP is not None) and (op is _ATOMIC_GROUP):
+        return [av]
+
+    return []
+
+
+def _has_nested_repeat(parsed, in_repeat: bool = False) -> bool:
+    """ True if a repeat (max > 1) in parsed has a repeat or an alternation in it. """
+
+    for op, av in parsed:
+        if op in _REPEAT_OPS:
+            if in_repeat or _has_nested_repeat(av[2], av[1] > 1):
+                return True
+        elif (op is _sre_const.BRANCH) and in_repeat:
+            return True
+        elif any(_has_nested_repeat(sub, in_repeat) for sub in _get_subpatterns(op, av)):
+            return True
+
+    return False
+
+
+def _get_search_steps(parsed, value_len: int) -> int:
+    """ Upper bound on the ways parsed can match at one position of a value_len chars value. W/o nested repeats (see
+    _has_nested_repeat()) a repeat can take upto value_len + 1 different lengths, alternatives add up. """
+
+    steps = 1
+    for op, av in parsed:
+        if op in _REPEAT_OPS:
+            steps *= (min(av[1] - av[0], value_len) + 1) * _get_search_steps(av[2], value_len)
+        else:
+            subs = _get_subpatterns(op, av)
+            if subs:
+                steps *= sum(_get_search_steps(sub, value_len) for sub in subs)
+
+    return steps
+
+
+def _get_max_value_len(parsed) -> int:
+    """ The most chars of a value parsed can search w/in REGEX_STEP_BUDGET. (a search() tries every position) """
+
+    lo, hi = 0, _REGEX_MAX_VALUE_LEN
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if mid * _get_search_steps(parsed, mid) <= REGEX_STEP_BUDGET:
+            lo = mid
+        else:
+            hi = mid - 1
+
+    return lo
+
+
+class BoundedRegex:
+    """ A compiled pattern that only searches the first max_value_len chars of a value. A match has to be in there,
+    $ matches at its end. """
+
+    def __init__(self, compiled: re.Pattern, max_value_len: int):
+        super().__init__()
+
+        self.compiled = compiled
+        self.max_value_len = max_value_len
+
+    def search(self, value: str):
+        return self.compiled.search(value, 0, self.max_value_len)
+
+
+class PatternCache:
+    """ pattern -> BoundedRegex, the max_size most recently used ones. Not thread safe, one per connection. """
+
+    def __init__(self, max_size: int = 64):
+        super().__init__()
+
+        self._max_size = max_size
+
+        # <pattern: BoundedRegex> in LRU order.
+        self._patterns = collections.OrderedDict()
+
+        self.num_compiled = 0
+
+    def get(self, pattern: str) -> BoundedRegex:
+
+        compiled = self._patterns.get(pattern)
+
+        if compiled is None:
+            compiled = check_regex(pattern, max_len=None)
+            self.num_compiled += 1
+            self._patterns[pattern] = compiled
+            if len(self._patterns) > self._max_size:
+                self._patterns.popitem(last=False)
+        else:
+            self._patterns.move_to_end(pattern)
+
+        return compiled
+
+
+@functools.lru_cache(maxsize=256)
+def _check_regex(pattern: str) -> BoundedRegex:
+
+    try:
+        compiled = re.compile(pattern)
+        parsed = _sre_parse.parse(pattern)
+    except re.error as ex:
+        raise ValueError(f"invalid regex: {pattern!r} ({ex})") from ex
+
+    if _has_nested_repeat(parsed):
+        raise ValueError(f"regex has a quantified group w/ a quantifier or | in it: {pattern!r}")
+
+    max_value_len = _get_max_value_len(parsed)
+    if max_value_len < REGEX_MIN_VALUE_LEN:
+        raise ValueError(f"regex has too many quantifiers: {pattern!r}")
+
+    return BoundedRegex(compiled, max_value_len)
+
+
+def check_regex(pattern: str, max_len: int = REGEX_MAX_LEN) -> BoundedRegex:
+    """ Return pattern compiled and bounded. ValueError if its over max_len chars (None means any length), doesnt
+    compile, has nested quantifiers or too many of them. (see the module doc) """
+
+    if (max_len is not None) and (len(pattern) > max_len):
+        raise ValueError(f"regex is {len(pattern)} chars, max is {max_len}")
+
+    return _check_regex(pattern)
+
+
+def get_literal_regex(val: str, whole: bool = True, max_len: int = REGEX_MAX_LEN) -> str:
+    """ A regex that matches val as is, from the start (and to the end if whole). If that is over max_len chars, one
+    that matches the start of val, as much of it as fits. """
+
+    while True:
+        pattern = "^" + re.escape(val) + ("$" if whole else "")
+        if len(pattern) <= max_len:
+            return pattern
+
+        val = val[:len(val) * 3 // 4]
+        whole = False
+
+
+def register_regexp(conn: sqlite3.Connection, cache: PatternCache = None) -> PatternCache:
+    """ Add the REGEXP operator to conn. NULL values dont match. Return the connection's PatternCache. """
+
+    if cache is None:
+        cache = PatternCache()
+
+    def regexp(pattern, value):
+        if value is None:
+            return False
+        return cache.get(pattern).search(value) is not None
+
+    conn.create_function("regexp", 2, regexp, deterministic=True)
+
+    return cache
+
+
+@contextlib.contextmanager
+def regex_deadline(conn: sqlite3.Connection, timeout: float):
+    """ Interrupt whatever conn runs in the block once its been timeout seconds. TimeoutError if it did. None timeout
+    means no deadline. """
+
+    if timeout is None:
+        yield
+        return
+
+    deadline = time.monotonic() + timeout
+    conn.set_progress_handler(lambda: time.monotonic() > deadline, _PROGRESS_N)
+
+    try:
+        yield
+    except sqlite3.OperationalError as ex:
+        if time.monotonic() <= deadline:
+            raise
+        raise TimeoutError(f"regex query took over {timeout} s") from ex
+    finally:
+        conn.set_progress_handler(None, _PROGRESS_N)
+
+
+def get_query_regexes(query: LGR_QUERY, max_len: int = REGEX_MAX_LEN) -> dict:
+    """ <field: BoundedRegex> for the regex filters of query, checked. Empty if it has none. """
+
+    regexes = {}
+
+    if query.msg_regex is not None:
+        regexes['msg'] = check_regex(query.msg_regex, max_len)
+
+    if query.filename_regex is not None:
+        regexes['filename'] = check_regex(query.filename_regex, max_len)
+
+    return regexes
+
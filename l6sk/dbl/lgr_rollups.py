@@ -0,0 +1,228 @@
+""" lgr_rollups.py
+Time bucket rollups of a sqlite log group (SqliteLogGroup rollups). Record counts per (bucket, lvl, subsys), for minute
+and hour buckets, kept up to date by append_lgrs() in the same transaction as the records. Histograms read these,
+never log_record, so they cost what the number of buckets does. A day of minutes is 1440 rows per level. lvl is 0 for
+records w/o a level and subsys is '' for records w/o one, or for every record if the group doesnt roll up per
+subsystem. (a primary key cant have NULLs that compare equal) Rollups stay in the hot db when records are archived,
+histograms cover archived time too.
+"""
+
+import time
+import random
+import sqlite3
+
+from l6sk.dbl.dbl_api import LOG_RECORD, LGR_LVL_CODES, LGR_LVL_NAMES, LGR_HISTOGRAM, LGR_HISTOGRAM_FIELDS
+from l6sk.dbl.dbl_api import get_query_lvl_codes
+
+from l6sk import log_util as log
+
+_ROLLUP_SCHEMA_SCRIPT = """
+CREATE TABLE IF NOT EXISTS lgr_rollup(
+    -- 60 or 3600
+    bucket_sec INTEGER NOT NULL,
+    -- start of the bucket, unix time in micro seconds
+    bucket_ts INTEGER NOT NULL,
+    lvl INTEGER NOT NULL,
+    subsys TEXT NOT NULL,
+    -- records appended, repeats collapsed into another row each count. est_count weighs each by 1 / sample_rate.
+    count INTEGER NOT NULL,
+    est_count REAL NOT NULL,
+    PRIMARY KEY (bucket_sec, bucket_ts, lvl, subsys)
+) WITHOUT ROWID;
+"""
+
+_ROLLUP_MINUTE_USEC = 60 * 1000000
+_ROLLUP_HOUR_USEC = 3600 * 1000000
+
+_UPSERT_ROLLUP_SQL = """
+INSERT INTO lgr_rollup(bucket_sec, bucket_ts, lvl, subsys, count, est_count) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT(bucket_sec, bucket_ts, lvl, subsys) DO UPDATE SET count = count + excluded.count,
+                                                              est_count = est_count + excluded.est_count;
+"""
+
+# rollups for the records already there when a group gets them. A repeat run counts in the bucket of its first record.
+_BACKFILL_ROLLUP_SQL = """
+INSERT INTO lgr_rollup(bucket_sec, bucket_ts, lvl, subsys, count, est_count)
+SELECT {bucket_sec}, srv_ts - srv_ts % {bucket_usec}, coalesce(lvl, 0), {subsys}, sum(coalesce(repeat_count, 1)),
+       sum(coalesce(repeat_count, 1) / coalesce(sample_rate, 1.0))
+FROM log_record GROUP BY 2, 3, 4;
+"""
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# =============================================================================================================== upkeep
+def ensure_rollups(conn: sqlite3.Connection, lgrp: str, by_subsys: bool):
+    """ Create the rollup table if conn's db doesnt have one yet, and roll up the records already there. (ie a group
+    that just got rollups, or was made before they were a thing) One transaction. """
+
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'lgr_rollup';").fetchone() is not None:
+        return
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN IMMEDIATE;")
+
+    try:
+        cursor.execute(_ROLLUP_SCHEMA_SCRIPT)
+
+        subsys = "coalesce(subsys, '')" if by_subsys else "''"
+        for bucket_usec in (_ROLLUP_MINUTE_USEC, _ROLLUP_HOUR_USEC):
+            cursor.execute(_BACKFILL_ROLLUP_SQL.format(bucket_sec=bucket_usec // 1000000, bucket_usec=bucket_usec,
+                                                       subsys=subsys))
+
+        num_rollups = cursor.execute("SELECT count(*) FROM lgr_rollup;").fetchone()[0]
+        cursor.execute("COMMIT;")
+    except Exception:
+        cursor.execute("ROLLBACK;")
+        raise
+
+    if num_rollups:
+        log.info(f"Rolled up the existing records of log group: {lgrp} into {num_rollups} buckets")
+
+
+def update_rollups(cursor: sqlite3.Cursor, lgrs: list, by_subsys: bool, minute_retention_usec: int,
+                   pruned_hour: int) -> int:
+    """ Count lgrs into the rollups, inside append_lgrs()' transaction. Counted up in python first, a batch is one
+    upsert per (bucket, lvl, subsys) it touches, not one per record. Minute rollups past minute_retention_usec (None
+    means keep them) are deleted the first time a batch gets to a new hour, pruned_hour is the hour they were last
+    pruned at. Return what it is now. """
+
+    minutes = {}
+    for lgr in lgrs:
+        sample_rate = lgr.sample_rate
+        key = (lgr.srv_ts - lgr.srv_ts % _ROLLUP_MINUTE_USEC,
+               0 if lgr.lvl is None else LGR_LVL_CODES[lgr.lvl],
+               (lgr.subsys or '') if by_subsys else '')
+
+        counts = minutes.get(key)
+        if counts is None:
+            counts = minutes[key] = [0, 0.0]
+        counts[0] += 1
+        counts[1] += 1.0 if (sample_rate is None) or (sample_rate >= 1.0) else 1.0 / sample_rate
+
+    hours = {}
+    for (minute_ts, lvl, subsys), (count, est_count) in minutes.items():
+        counts = hours.setdefault((minute_ts - minute_ts % _ROLLUP_HOUR_USEC, lvl, subsys), [0, 0.0])
+        counts[0] += count
+        counts[1] += est_count
+
+    cursor.executemany(_UPSERT_ROLLUP_SQL, [(60, ) + key + tuple(counts) for key, counts in minutes.items()] +
+                       [(3600, ) + key + tuple(counts) for key, counts in hours.items()])
+
+    if minute_retention_usec is None:
+        return pruned_hour
+
+    hour = max(lgr.srv_ts for lgr in lgrs) // _ROLLUP_HOUR_USEC
+    if (pruned_hour is None) or (hour > pruned_hour):
+        cursor.execute("DELETE FROM lgr_rollup WHERE bucket_sec = 60 AND bucket_ts < ?;",
+                       (hour * _ROLLUP_HOUR_USEC - minute_retention_usec, ))
+        pruned_hour = hour
+
+    return pruned_hour
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ================================================================================================================ query
+def query_histogram(conn: sqlite3.Connection, hist: LGR_HISTOGRAM) -> dict:
+    """ Record counts per bucket and level (and subsys) in hist's time range, off conn's rollups. Result is a dict w/
+    'fields' (LGR_HISTOGRAM_FIELDS) and 'buckets', a list of tuples in bucket_ts, lvl (, subsys) order. Buckets that
+    are a multiple of an hour are summed up from hour rollups, the rest from minute ones. hist.bucket_sec has to be a
+    multiple of 60. """
+
+    bucket_usec = hist.bucket_sec * 1000000
+    where_clauses = ["bucket_sec = ?"]
+    params = [bucket_usec, 3600 if hist.bucket_sec % 3600 == 0 else 60]
+
+    # from the start of the bucket srv_ts_min is in.
+    if hist.srv_ts_min is not None:
+        where_clauses.append("bucket_ts >= ?")
+        params.append(hist.srv_ts_min - hist.srv_ts_min % bucket_usec)
+
+    if hist.srv_ts_max is not None:
+        where_clauses.append("bucket_ts <= ?")
+        params.append(hist.srv_ts_max)
+
+    lvl_codes = get_query_lvl_codes(hist)
+    if lvl_codes is not None:
+        where_clauses.append(f"lvl IN ({', '.join('?' * len(lvl_codes))})")
+        params.extend(lvl_codes)
+
+    if hist.subsys is not None:
+        where_clauses.append("subsys = ?")
+        params.append(hist.subsys)
+
+    group_by = "bucket, lvl, subsys" if hist.by_subsys else "bucket, lvl"
+    sql = (f"SELECT bucket_ts - bucket_ts % ? AS bucket, lvl, {'subsys' if hist.by_subsys else 'NULL'}, "
+           f"sum(count), sum(est_count) FROM lgr_rollup WHERE {' AND '.join(where_clauses)} "
+           f"GROUP BY {group_by} ORDER BY {group_by};")
+
+    buckets = [(bucket_ts, LGR_LVL_NAMES.get(lvl), subsys or None, count, est_count)
+               for bucket_ts, lvl, subsys, count, est_count in conn.execute(sql, params)]
+
+    return {'fields': LGR_HISTOGRAM_FIELDS, 'buckets': buckets}
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_bench_rollups(num_records=1000 * 1000, batch_size=500, num_runs=10):
+    """ A day's worth of records (num_records spread over 24h). Ingest rate w/ rollups off vs on. Then the per level
+    histogram of the last 24h, per minute and per hour: GROUP BY over log_record (what it would be w/o rollups) vs
+    histogram_lgrs(). """
+
+    from l6sk.dbl.sqlite_lgrp import SqliteLogGroup, get_db_size_bytes  # pylint: disable=import-outside-toplevel
+
+    print(f"Benchmarking rollups w/ {num_records:,} records over 24h ...")
+
+    rnd = random.Random(1655)
+    day_usec = 24 * 3600 * 1000000
+    base_ts = int(time.time() * 1000000) - day_usec
+    lvls = ['DBUG'] * 60 + ['INFO'] * 30 + ['WARN'] * 7 + ['ERRR'] * 3
+    lgrs = [LOG_RECORD(srv_ts=base_ts + i * day_usec // num_records, lvl=rnd.choice(lvls),
+                       session_id=f"sess_{rnd.randrange(50)}", msg=f"GET /api/items/{i} 200")
+            for i in range(num_records)]
+
+    print(f"{'rollups':12}{'records/s':>12}{'db bytes per row':>18}")
+    lgrps = {}
+    for rollups in (False, True):
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('bench', conn, rollups=rollups)
+
+        start_time = time.perf_counter()
+        for batch_start in range(0, num_records, batch_size):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + batch_size])
+        insert_t = time.perf_counter() - start_time
+
+        print(f"{str(rollups):12}{num_records / insert_t:>12,.0f}{get_db_size_bytes(conn) / num_records:>18.1f}")
+        lgrps[rollups] = lgrp
+
+    lgrp = lgrps[True]
+    group_by_sql = ("SELECT srv_ts - srv_ts % ? AS bucket, lvl, count(*) FROM log_record WHERE srv_ts >= ? "
+                    "GROUP BY bucket, lvl ORDER BY bucket, lvl;")
+
+    print(f"{'histogram':24}{'buckets':>10}{'GROUP BY (ms)':>16}{'rollups (ms)':>16}")
+    for name, bucket_sec in (('per minute, 24h', 60), ('per hour, 24h', 3600)):
+        start_time = time.perf_counter()
+        for _ in range(num_runs):
+            group_by_rows = lgrp.conn.execute(group_by_sql, (bucket_sec * 1000000, base_ts)).fetchall()
+        group_by_t = (time.perf_counter() - start_time) / num_runs
+
+        start_time = time.perf_counter()
+        for _ in range(num_runs):
+            buckets = lgrp.histogram_lgrs(LGR_HISTOGRAM(lgrp='bench', srv_ts_min=base_ts, bucket_sec=bucket_sec))
+        rollup_t = (time.perf_counter() - start_time) / num_runs
+
+        assert [row[2] for row in group_by_rows] == [row[3] for row in buckets['buckets']]
+        print(f"{name:24}{len(group_by_rows):>10,}{group_by_t * 1000:>16.3f}{rollup_t * 1000:>16.3f}")
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================================
+def main():
+    _dbg_bench_rollups()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,288 @@
+""" lgr_sampler.py
+Ingest sampling. When the DBL worker cant keep up, the dispatch queues grow and so does the time a record waits in
+them, w/o bound. LgrSampler sits in front of put_req() and drops records before they get queued, the least important
+ones first:
+- ERRR and CRIT (keep_lvl_min and up) are always kept.
+- the other levels each have a keep ratio. They go down when the queues hold more than target_queue_delay seconds
+  worth of requests (queue depth / DBL worker throughput), DBUG first, then INFO, then WARN. And back up, the other way
+  around, once the queues are drained.
+- each session has a token bucket (session_rate records/s, upto session_burst). While a level ratio is below 1.0, a
+  session keeps about session_rate records/s of that level on top of what the ratio lets thru, so one chatty client
+  cant take the whole budget from the quiet ones. Sessions dont lose anything while all ratios are at 1.0.
+Kept records get sample_rate set, the probability they were kept with. Sqlite DAOs store it, a row stands for
+1 / sample_rate records when counting. (the segment DAO doesnt store it)
+
+Not thread safe. The web layer calls it from the ioloop thread.
+"""
+
+import time
+import random
+import collections
+
+from l6sk.dbl.dbl_api import LOG_RECORD, LGR_LVL_CODES
+
+from l6sk import log_util as log
+
+# levels that can be sampled, in the order they are given up. Records w/o a level are sampled like INFO.
+_SAMPLED_LVLS = ('DBUG', 'INFO', 'WARN')
+
+
+class _SessionBucket:
+
+    __slots__ = ('tokens', 'last_ts', 'win_start', 'win_count', 'rate')
+
+    def __init__(self, tokens: float, now: float):
+        self.tokens = tokens
+        self.last_ts = now
+
+        # records seen in the current 1 second window, and the rate of the last one.
+        self.win_start = now
+        self.win_count = 0
+        self.rate = 0.0
+
+
+class LgrSampler:
+    """ dispatch: the DBL_REQUEST_DISPATCH records are headed to, for its queue depths and throughput.
+    target_queue_delay: seconds. Level ratios go down while the queues hold more than this, and back up when they
+    hold less than a quarter of it.
+    adjust_interval: seconds between ratio adjustments. Each one halves (or grows by 1/4) one level's ratio.
+    min_keep_ratio: level ratios dont go below this. Something from every level still makes it.
+    session_rate, session_burst: per session token bucket. None session_rate turns session buckets off.
+    max_sessions: buckets are kept for this many of the most recent sessions.
+    keep_lvl_min: this level and up are never sampled. """
+
+    def __init__(self,
+                 dispatch,
+                 target_queue_delay: float = 0.5,
+                 adjust_interval: float = 0.25,
+                 min_keep_ratio: float = 0.01,
+                 session_rate: float = 500.0,
+                 session_burst: float = 2000.0,
+                 max_sessions: int = 4096,
+                 keep_lvl_min: str = 'ERRR',
+                 rnd: random.Random = None,
+                 clock=time.monotonic):
+        super().__init__()
+
+        self._dispatch = dispatch
+        self._target_queue_delay = target_queue_delay
+        self._adjust_interval = adjust_interval
+        self._min_keep_ratio = min_keep_ratio
+        self._session_rate = session_rate
+        self._session_burst = session_burst
+        self._max_sessions = max_sessions
+        self._keep_lvl_code = LGR_LVL_CODES[keep_lvl_min]
+        self._rnd = rnd or random.Random()
+        self._clock = clock
+
+        self._keep_ratios = {lvl: 1.0 for lvl in _SAMPLED_LVLS}
+
+        # <session_id: _SessionBucket> in LRU order.
+        self._buckets = collections.OrderedDict()
+
+        # throughput is measured over each adjust_interval.
+        self._next_adjust = clock() + adjust_interval
+        self._last_adjust = clock()
+        self._last_num_dispatched = dispatch.num_dispatched
+        self._queue_delay = 0.0
+
+        self._num_seen = 0
+        self._num_kept = 0
+
+    def get_keep_ratios(self) -> dict:
+        return dict(self._keep_ratios)
+
+    def get_stats(self) -> dict:
+        return {'seen': self._num_seen, 'kept': self._num_kept, 'queue_delay': self._queue_delay,
+                'keep_ratios': self.get_keep_ratios()}
+
+    def sample(self, lgrs: list) -> list:
+        """ Return the records of lgrs to keep, w/ their sample_rate set. """
+
+        now = self._clock()
+        if now >= self._next_adjust:
+            self._adjust(now)
+
+        kept = []
+        for lgr in lgrs:
+            ratio, sample_rate = self._get_sample_rate(lgr, now)
+
+            if (sample_rate >= 1.0) or (self._rnd.random() < sample_rate):
+                lgr.sample_rate = sample_rate if sample_rate < 1.0 else None
+                kept.append(lgr)
+
+                # the ratio would have kept ratio / sample_rate of these anyway, only the rest is on the session.
+                bucket = self._buckets.get(lgr.session_id)
+                if (bucket is not None) and (sample_rate > ratio):
+                    bucket.tokens = max(0.0, bucket.tokens - (1.0 - ratio / sample_rate))
+
+        self._num_seen += len(lgrs)
+        self._num_kept += len(kept)
+
+        return kept
+
+    def _get_sample_rate(self, lgr: LOG_RECORD, now: float) -> tuple:
+        """ Return (level ratio, probability to keep lgr w/). """
+
+        lvl_code = LGR_LVL_CODES.get(lgr.lvl)
+
+        # unknown levels are the DAO's to refuse, not ours to drop.
+        if (lgr.lvl is not None) and ((lvl_code is None) or (lvl_code >= self._keep_lvl_code)):
+            return 1.0, 1.0
+
+        ratio = self._keep_ratios[lgr.lvl or 'INFO']
+
+        # nothing backed up for this level, no reason to look at sessions either.
+        if (ratio >= 1.0) or (self._session_rate is None) or (lgr.session_id is None):
+            return ratio, ratio
+
+        bucket = self._get_bucket(lgr.session_id, now)
+        if bucket.tokens >= 1.0:
+            return ratio, 1.0
+
+        # out of tokens. session_rate worth of what it sends, on average, on top of the ratio.
+        return ratio, min(1.0, ratio + self._session_rate / max(bucket.rate, bucket.win_count, 1))
+
+    def _get_bucket(self, session_id: str, now: float) -> _SessionBucket:
+
+        bucket = self._buckets.get(session_id)
+
+        if bucket is None:
+            bucket = _SessionBucket(self._session_burst, now)
+            self._buckets[session_id] = bucket
+            if len(self._buckets) > self._max_sessions:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(session_id)
+            bucket.tokens = min(self._session_burst, bucket.tokens + (now - bucket.last_ts) * self._session_rate)
+            bucket.last_ts = now
+
+        if now - bucket.win_start >= 1.0:
+            bucket.rate = bucket.win_count / (now - bucket.win_start)
+            bucket.win_start = now
+            bucket.win_count = 0
+
+        bucket.win_count += 1
+
+        return bucket
+
+    def _adjust(self, now: float):
+        """ Move one level's keep ratio, depending on how long the queues would take to drain. """
+
+        num_dispatched = self._dispatch.num_dispatched
+        throughput = (num_dispatched - self._last_num_dispatched) / max(now - self._last_adjust, 1e-6)
+        queue_depth = sum(self._dispatch.get_queue_depths().values())
+
+        # nothing got served, no way to tell how fast it would go. if there is a queue, its slow.
+        if queue_depth == 0:
+            self._queue_delay = 0.0
+        elif throughput > 0:
+            self._queue_delay = queue_depth / throughput
+        else:
+            self._queue_delay = float('inf')
+
+        self._last_num_dispatched = num_dispatched
+        self._last_adjust = now
+        self._next_adjust = now + self._adjust_interval
+
+        if self._queue_delay > self._target_queue_delay:
+            for lvl in _SAMPLED_LVLS:
+                if self._keep_ratios[lvl] > self._min_keep_ratio:
+                    self._keep_ratios[lvl] = max(self._min_keep_ratio, self._keep_ratios[lvl] / 2)
+                    log.dbg(f"Queue delay: {self._queue_delay:.3f} s. {lvl} keep ratio down to: "
+                            f"{self._keep_ratios[lvl]:.3f}")
+                    return
+
+        elif self._queue_delay < self._target_queue_delay / 4:
+            for lvl in reversed(_SAMPLED_LVLS):
+                if self._keep_ratios[lvl] < 1.0:
+                    self._keep_ratios[lvl] = min(1.0, self._keep_ratios[lvl] * 1.25)
+                    return
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_bench_overload(duration: float = 30.0, tick: float = 0.01, capacity: int = 400, overload: float = 3.0,
+                        batch_size: int = 10, num_sessions: int = 20):
+    """ Simulated time, tick seconds per step. The DBL worker gets thru capacity records per tick. Clients send
+    overload times that, for the middle third of duration, and half of capacity otherwise, in requests of batch_size
+    records. One of the sessions is a chatty one, half of all records. Levels: 70% DBUG, 20% INFO, 7% WARN, 3% ERRR.
+    Compares no sampling (queue grows, records wait) to LgrSampler, and checks how close the sample_rate weighted
+    counts get to the real ones. """
+
+    from l6sk.dbl.dbl_dispatch import DBL_REQUEST_DISPATCH, DBL_REQ  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dbl_api import DBL_API, LGR_APPEND_ARGS  # pylint: disable=import-outside-toplevel
+
+    lvls = ['DBUG'] * 70 + ['INFO'] * 20 + ['WARN'] * 7 + ['ERRR'] * 3
+
+    def run(sampling: bool):
+        rnd = random.Random(1655)
+        sim_time = [0.0]
+        dispatch = DBL_REQUEST_DISPATCH()
+        sampler = LgrSampler(dispatch, rnd=random.Random(7), clock=lambda: sim_time[0]) if sampling else None
+
+        sent = collections.Counter()
+        stored = collections.Counter()
+        weighted = collections.Counter()
+        waits = []
+        budget = 0
+
+        for step in range(int(duration / tick)):
+            sim_time[0] = step * tick
+            in_overload = duration / 3 <= sim_time[0] < duration * 2 / 3
+            num_reqs = int(capacity / batch_size * (overload if in_overload else 0.5))
+
+            for _ in range(num_reqs):
+                session_id = 'chatty' if rnd.random() < 0.5 else f"sess_{rnd.randrange(num_sessions)}"
+                lgrs = [LOG_RECORD(lvl=rnd.choice(lvls), session_id=session_id, msg='x') for _ in range(batch_size)]
+                for lgr in lgrs:
+                    sent[lgr.lvl] += 1
+
+                if sampler is not None:
+                    lgrs = sampler.sample(lgrs)
+                    if not lgrs:
+                        continue
+
+                req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS('bench', lgrs))
+                req.succ_data = sim_time[0]  # abusing it for the enqueue time.
+                dispatch.put_req(req)
+
+            budget += capacity
+            while budget > 0:
+                req = dispatch.get_next_req()
+                if req is None:
+                    budget = 0
+                    break
+                budget -= len(req.data.lgrs)
+                waits.append(sim_time[0] - req.succ_data)
+                for lgr in req.data.lgrs:
+                    stored[lgr.lvl] += 1
+                    weighted[lgr.lvl] += 1 / (lgr.sample_rate or 1.0)
+
+        waits.sort()
+        num_left = sum(dispatch.get_queue_depths().values())
+        return sent, stored, weighted, waits[len(waits) * 99 // 100], waits[-1], num_left
+
+    # dispatch logs every request at dbg. Thats all this would measure.
+    dbg = log.dbg
+    log.dbg = lambda *args, **kwargs: None
+    try:
+        print(f"{duration:.0f}s simulated, DBL worker does {capacity / tick:.0f} records/s, clients send "
+              f"{overload:.0f}x that for {duration / 3:.0f}s, {batch_size} records per request:")
+        for name, sampling in [("no sampling", False), ("LgrSampler", True)]:
+            sent, stored, weighted, p99_wait, max_wait, left = run(sampling)
+            print(f"  {name}: queue wait p99: {p99_wait:.2f} s  max: {max_wait:.2f} s  still queued at the end: {left}")
+            for lvl in ('DBUG', 'INFO', 'WARN', 'ERRR'):
+                print(f"    {lvl}  sent: {sent[lvl]:>7}  stored: {stored[lvl]:>7} ({stored[lvl] / sent[lvl]:6.1%})  "
+                      f"weighted count error: {(weighted[lvl] - sent[lvl]) / sent[lvl]:+6.2%}")
+    finally:
+        log.dbg = dbg
+
+
+def main():
+    _dbg_bench_overload()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,63 @@
+""" lgr_templates.py
+Log msg templates. Most msgs are a format string w/ a few values filled in: "took 12 ms", "took 340 ms", ... The
+template is the msg w/ the values masked, "took <num> ms". Masked in this order, so the digits of a UUID arent taken
+for numbers: quoted strings ('...' or "...", an apostrophe inside a word doesnt start one) <str>, UUIDs <uuid>, hex
+(0x..., or 8+ hex digits w/ both digits and letters in them) <hex>, numbers (digit runs, w/ any . or : between them,
+ie 3.5 10.0.0.1 12:30:05) <num>. Only the first TEMPLATE_MSG_LEN chars of a msg are looked at.
+
+A template's id is a hash of its text, 63 bits so its a positive sqlite INTEGER. The same template gets the same id
+in every log group and every db (archives too) w/o a lookup table to keep in sync. It takes billions of templates in
+a log group for two of them to be likely to share an id.
+"""
+
+import re
+import hashlib
+import functools
+
+# chars of a msg its template is made of.
+TEMPLATE_MSG_LEN = 1000
+
+# msgs (their first TEMPLATE_MSG_LEN chars) whose template is remembered. Most records are one of a few msgs.
+_CACHE_SIZE = 4096
+
+_QUOTED_RE = re.compile(r"\"[^\"\n]*\"|(?<!\w)'[^'\n]*'(?!\w)")
+_UUID_RE = re.compile(r"\b[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\b")
+_HEX_RE = re.compile(r"\b(?:0[xX][0-9a-fA-F]+|(?=[0-9a-fA-F]{8})(?=[0-9a-fA-F]*[0-9])(?=[0-9a-fA-F]*[a-fA-F])"
+                     r"[0-9a-fA-F]{8,})\b")
+_NUM_RE = re.compile(r"\d+(?:[.:]\d+)*")
+
+
+def get_template(msg: str) -> str:
+    """ msg w/ its values masked. A pass is skipped for a msg w/o the char its matches all have, a str in check is a
+    lot cheaper than a regex scan that finds nothing. """
+
+    if ('"' in msg) or ("'" in msg):
+        msg = _QUOTED_RE.sub("<str>", msg)
+
+    if '-' in msg:
+        msg = _UUID_RE.sub("<uuid>", msg)
+
+    msg = _HEX_RE.sub("<hex>", msg)
+
+    return _NUM_RE.sub("<num>", msg)
+
+
+def get_template_id(template: str) -> int:
+
+    digest = hashlib.blake2b(template.encode('utf-8', 'surrogatepass'), digest_size=8).digest()
+
+    return int.from_bytes(digest, 'big') >> 1
+
+
+@functools.lru_cache(maxsize=_CACHE_SIZE)
+def _get_msg_template(msg: str) -> tuple:
+
+    template = get_template(msg)
+
+    return get_template_id(template), template
+
+
+def get_msg_template(msg) -> tuple:
+    """ <template id, template> of msg. Anything thats not a str is templated as str(msg). """
+
+    return _get_msg_template(str(msg)[:TEMPLATE_MSG_LEN])
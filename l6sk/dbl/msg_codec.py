@@ -0,0 +1,195 @@
+""" msg_codec.py
+Compression for log msg bodies. Log msgs are short and repetitive, too short for zlib to find much to work with
+one msg at a time. So we train a preset dictionary (zlib zdict) from a sample of a log group's recent msgs and compress
+each msg against it. Dictionaries are versioned by whoever stores them, every compressed msg must be stored along with
+the version of the dictionary it was compressed with.
+
+This module has no notion of log groups or databases. Its just the codec + the dictionary trainer.
+"""
+
+import time
+import zlib
+import random
+import collections
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ Constants
+# Raw deflate (negative wbits), no zlib header or adler32, that would be 6 bytes on every msg. The version stored next
+# to each msg is what tells us how to decode it anyway.
+# An 8 KB window (and so at most an 8 KB dictionary). Setting up a compressor with a zdict is not free, its about
+# the size of the window. We prime one compressor per dictionary and copy() it for every msg. With a 32 KB window
+# a copy costs ~3 times as much and log msgs hardly ever gain anything from the bigger dict.
+_WBITS = -13
+_MAX_ZDICT_SIZE = 1 << 13
+
+# memLevel 4 is about the sweet spot for copy() cost, the compression ratio on short msgs is barely affected.
+_MEM_LEVEL = 4
+
+# word n-grams upto this many words are dictionary candidates.
+_MAX_NGRAM_WORDS = 4
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ====================================================================================================== Dict training
+def train_zdict(samples: list, zdict_size: int = _MAX_ZDICT_SIZE) -> bytes:
+    """ Build a zlib preset dictionary from a list of sample msgs (str). Returns at most zdict_size bytes.
+
+    This is a simple frequency based trainer. Count word n-grams (1 to _MAX_NGRAM_WORDS words, including the
+    separating space) over the samples, score each by how many bytes it would save (count * len), and fill the dict
+    w/ the best ones. zlib favors matches closer to the data, so the best scoring strings go at the end. """
+
+    zdict_size = min(zdict_size, _MAX_ZDICT_SIZE)
+    ngram_counts = collections.Counter()
+
+    for sample in samples:
+        words = sample.split(' ')
+        num_words = len(words)
+
+        for ngram_len in range(1, _MAX_NGRAM_WORDS + 1):
+            for start_idx in range(0, num_words - ngram_len + 1):
+                ngram_counts[' '.join(words[start_idx:start_idx + ngram_len])] += 1
+
+    # anything seen only once in the sample, is not going to be worth the space. 3 bytes is the shortest deflate match.
+    candidates = [(count * len(ngram), ngram) for ngram, count in ngram_counts.items() if count > 1 and len(ngram) > 3]
+    candidates.sort(reverse=True)
+
+    chosen = []
+    chosen_size = 0
+
+    for _, ngram in candidates:
+        ngram_bytes = ngram.encode('utf-8')
+
+        # if a longer chosen string already contains this one, it adds nothing.
+        if any(ngram_bytes in prev for prev in chosen):
+            continue
+
+        if chosen_size + len(ngram_bytes) + 1 > zdict_size:
+            continue
+
+        chosen.append(ngram_bytes)
+        chosen_size += len(ngram_bytes) + 1
+
+    # best last
+    chosen.reverse()
+
+    return b' '.join(chosen)
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ================================================================================================================ Codec
+class MsgZDictCodec:
+    """ Compress/decompress log msgs against a set of versioned preset dictionaries.
+    Not thread safe, each DB connection owner (ie SqliteLogGroup) should have its own. """
+
+    def __init__(self, compress_level: int = 6):
+        super().__init__()
+
+        self._compress_level = compress_level
+
+        # dict version -> zdict bytes
+        self._zdicts = {}
+
+        # dict version -> compressor primed w/ that zdict. copy() these, never use them directly.
+        self._primed_compressors = {}
+
+    def add_zdict(self, dver: int, zdict: bytes):
+        self._zdicts[dver] = zdict
+
+    def has_zdict(self, dver: int) -> bool:
+        return dver in self._zdicts
+
+    def compress(self, msg: str, dver: int) -> bytes:
+        """ Compress msg w/ the dictionary of version dver. Returns None if compression doesnt make it smaller,
+        in which case the caller should store msg as is. """
+
+        if msg is None:
+            return None
+
+        primed = self._primed_compressors.get(dver)
+
+        if primed is None:
+            primed = zlib.compressobj(self._compress_level, zlib.DEFLATED, _WBITS, _MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                      self._zdicts[dver])
+            self._primed_compressors[dver] = primed
+
+        msg_bytes = msg.encode('utf-8')
+        compressor = primed.copy()
+        compressed = compressor.compress(msg_bytes) + compressor.flush()
+
+        if len(compressed) >= len(msg_bytes):
+            return None
+
+        return compressed
+
+    def decompress(self, compressed: bytes, dver: int) -> str:
+        """ Inverse of compress(). KeyError if there is no dictionary w/ version dver. """
+
+        decompressor = zlib.decompressobj(_WBITS, self._zdicts[dver])
+        msg_bytes = decompressor.decompress(compressed) + decompressor.flush()
+
+        return msg_bytes.decode('utf-8')
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_mk_sample_msgs(count: int, seed=1655) -> list:
+    """ Repetitive, log looking msgs. A handful of shapes, w/ ids, numbers, paths in them. """
+
+    rnd = random.Random(seed)
+
+    shapes = [
+        lambda: f"GET /api/lgr/new 200 took {rnd.random() * 20:.2f} ms client=10.0.0.{rnd.randint(1, 254)}",
+        lambda: f"DBL request served op=APPEND_LGRS lgrp=default batch_size={rnd.randint(1, 512)} queue=norm_q",
+        lambda: f"session {rnd.getrandbits(96):024x} connected from worker {rnd.randint(1, 16)}",
+        lambda: f"Failed to open db connection. Exception: unable to open database file lgrp_{rnd.randint(1, 9)}.db",
+        lambda: f"cache miss for key user:{rnd.randint(1, 100000)}, falling back to sqlite, retry {rnd.randint(0, 3)}",
+    ]
+
+    return [rnd.choice(shapes)() for _ in range(count)]
+
+
+def _dbg_bench_codec(num_msgs=50 * 1000):
+
+    msgs = _dbg_mk_sample_msgs(num_msgs)
+    raw_size = sum(len(m.encode('utf-8')) for m in msgs)
+
+    start_time = time.perf_counter()
+    zdict = train_zdict(msgs[:2000])
+    train_t = time.perf_counter() - start_time
+
+    codec = MsgZDictCodec()
+    codec.add_zdict(1, zdict)
+
+    start_time = time.perf_counter()
+    compressed = [codec.compress(m, 1) for m in msgs]
+    compress_t = time.perf_counter() - start_time
+
+    zdict_size = sum(len(c) if c is not None else len(m.encode('utf-8')) for c, m in zip(compressed, msgs))
+    plain_zlib_size = sum(len(zlib.compress(m.encode('utf-8'), 6)) for m in msgs)
+
+    start_time = time.perf_counter()
+    for c in compressed:
+        if c is not None:
+            codec.decompress(c, 1)
+    decompress_t = time.perf_counter() - start_time
+
+    print(f"zdict: {len(zdict):,} bytes, trained in {train_t * 1000:.1f} ms")
+    print(f"raw msg bytes: {raw_size:,}  zlib per msg: {plain_zlib_size:,}  zdict per msg: {zdict_size:,} "
+          f"({zdict_size / raw_size:.1%} of raw)")
+    print(f"compress: {compress_t / num_msgs * 1000000:.2f} us/msg  decompress: "
+          f"{decompress_t / num_msgs * 1000000:.2f} us/msg")
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================================
+def main():
+    _dbg_bench_codec()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,370 @@
+""" segment_archive.py
+Column oriented archive files for cold log records. The segment DAO compacts sealed segments that are old enough
+into one of these, and then drops the segment. Cold data is queried rarely but is most of the disk, so here we
+trade write cost for size: rows are split in chunks, and every field of a chunk is stored as its own zlib compressed
+column chunk. Columns of similar values next to each other (timestamps, session ids, file names, ...) compress a lot
+better than rows do.
+
+Every chunk has zone maps (min/max) for srv_ts, lvl and lineno. A query skips chunks the zone maps rule out, and for
+the rest decompresses the columns its predicates need first. Other columns are only decompressed if some rows match.
+
+Layout: magic, column chunks and the source segment's bloom filter back to back, a JSON directory (chunks, zone
+maps, where each column chunk is), then a fixed size footer pointing at the directory.
+Archive files are written once, to a tmp file that is renamed into place, and never modified.
+"""
+
+import os
+import sys
+import mmap
+import json
+import zlib
+import struct
+import array
+import itertools
+
+from l6sk.dbl.dbl_api import LGR_QUERY, LGR_FIELDS, LGR_LVL_CODES, LGR_LVL_NAMES
+from l6sk.dbl.dbl_api import get_query_lvl_codes, get_query_srv_ts_min, is_after_cursor, is_client_ts_match
+from l6sk.dbl.bloom_filter import BloomFilter
+from l6sk.dbl.lgr_regex import get_query_regexes
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ Constants
+_ARC_MAGIC = b"L6SKARC1"
+
+# directory offset, directory len, crc32 of directory, magic
+_ARC_FOOTER = struct.Struct("<QII8s")
+
+_ARC_VERSION = 1
+
+# int columns. lvl is stored as its code. The rest are str columns.
+_INT_COLS = frozenset({'lrid', 'srv_ts', 'client_ts', 'lvl', 'lineno', 'pid', 'tid'})
+
+# stored as differences from the previous value. these grow slowly from row to row, the deltas are tiny and repetitive.
+_DELTA_COLS = frozenset({'lrid', 'srv_ts', 'client_ts'})
+
+# zone mapped columns
+_ZONE_MAP_COLS = ('srv_ts', 'lvl', 'lineno')
+
+# column chunk encodings. first byte of a column chunk, the rest is zlib compressed.
+_ENC_INT = b'I'  # presence bytes + int64 array
+_ENC_DELTA = b'D'  # presence bytes + int64 array of deltas
+_ENC_STR = b'S'  # uint32 lengths (_NULL_LEN for None) + utf-8 bytes
+_ENC_JSON = b'J'  # json list. int columns w/ values that are not int64 (ints kept as str, see segment_lgrp.py)
+
+_NULL_LEN = 0xFFFFFFFF
+_INT64_MIN = -(2**63)
+_INT64_MAX = 2**63 - 1
+
+_LVL_COL_IDX = LGR_FIELDS.index('lvl')
+
+
+def _to_le_bytes(arr: array.array) -> bytes:
+
+    if sys.byteorder != 'little':
+        arr = array.array(arr.typecode, arr)
+        arr.byteswap()
+
+    return arr.tobytes()
+
+
+def _from_le_bytes(typecode: str, buf: bytes) -> array.array:
+
+    arr = array.array(typecode)
+    arr.frombytes(buf)
+
+    if sys.byteorder != 'little':
+        arr.byteswap()
+
+    return arr
+
+
+def _is_int64(val) -> bool:
+    return isinstance(val, int) and _INT64_MIN <= val <= _INT64_MAX
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ========================================================================================================= Column codec
+def _encode_col(col: str, vals: list) -> bytes:
+
+    if col in _INT_COLS:
+        if not all(val is None or _is_int64(val) for val in vals):
+            return _ENC_JSON + zlib.compress(json.dumps(vals).encode('utf-8'))
+
+        presence = bytes(0 if val is None else 1 for val in vals)
+        ints = [0 if val is None else val for val in vals]
+        enc = _ENC_INT
+
+        if col in _DELTA_COLS:
+            deltas = [ints[0]] + [ints[idx] - ints[idx - 1] for idx in range(1, len(ints))]
+            if all(_INT64_MIN <= delta <= _INT64_MAX for delta in deltas):
+                ints = deltas
+                enc = _ENC_DELTA
+
+        return enc + zlib.compress(presence + _to_le_bytes(array.array('q', ints)))
+
+    str_bytes = [None if val is None else str(val).encode('utf-8') for val in vals]
+    lens = array.array('I', (_NULL_LEN if sb is None else len(sb) for sb in str_bytes))
+
+    return _ENC_STR + zlib.compress(_to_le_bytes(lens) + b''.join(sb for sb in str_bytes if sb))
+
+
+def _decode_col(blob: bytes, num_rows: int, idxs: list = None) -> list:
+    """ Values of the column chunk at row idxs (all rows if None). Decompressing is the same either way, but turning
+    bytes into python objects is most of the cost of a str column, so thats only done for the rows asked for. """
+
+    enc = blob[:1]
+    payload = zlib.decompress(blob[1:])
+
+    if enc == _ENC_JSON:
+        vals = json.loads(payload)
+        return vals if idxs is None else [vals[idx] for idx in idxs]
+
+    if enc in (_ENC_INT, _ENC_DELTA):
+        presence = payload[:num_rows]
+        ints = _from_le_bytes('q', payload[num_rows:])
+        vals = list(itertools.accumulate(ints)) if enc == _ENC_DELTA else ints.tolist()
+
+        if not all(presence):
+            vals = [val if present else None for val, present in zip(vals, presence)]
+
+        return vals if idxs is None else [vals[idx] for idx in idxs]
+
+    lens = _from_le_bytes('I', payload[:num_rows * 4])
+    str_area = payload[num_rows * 4:]
+
+    # None is _NULL_LEN long but takes no bytes.
+    ends = list(itertools.accumulate(0 if str_len == _NULL_LEN else str_len for str_len in lens))
+
+    if idxs is None:
+        idxs = range(num_rows)
+
+    return [
+        None if lens[idx] == _NULL_LEN else str(str_area[ends[idx] - lens[idx]:ends[idx]], 'utf-8') for idx in idxs
+    ]
+
+
+def _zone_map(vals: list):
+    """ [min, max] of the non None int values, None if there are none. """
+
+    ints = [val for val in vals if _is_int64(val)]
+
+    if not ints:
+        return None
+
+    return [min(ints), max(ints)]
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# =============================================================================================================== Writer
+def write_archive(filename: str, rows: list, bloom_bits: bytes, ts_sorted: bool, chunk_rows: int = 8192):
+    """ Write rows (LGR_FIELDS ordered tuples, as a query returns them, in lrid order) as an archive file.
+    bloom_bits is the source segment's bloom filter, so session/subsys queries can still skip the whole file.
+    Writes to filename + '.tmp', fsyncs, and renames it into place. """
+
+    assert rows
+
+    tmp_filename = filename + ".tmp"
+    directory = {
+        'version': _ARC_VERSION,
+        'rows': len(rows),
+        'first_lrid': rows[0][0],
+        'last_lrid': rows[-1][0],
+        'min_srv_ts': min(row[1] for row in rows),
+        'max_srv_ts': max(row[1] for row in rows),
+        'ts_sorted': ts_sorted,
+        'chunks': [],
+    }
+
+    with open(tmp_filename, 'wb') as arc_file:
+        arc_file.write(_ARC_MAGIC)
+        pos = len(_ARC_MAGIC)
+
+        for chunk_start in range(0, len(rows), chunk_rows):
+            chunk = rows[chunk_start:chunk_start + chunk_rows]
+            chunk_dir = {'rows': len(chunk), 'cols': {}}
+
+            for col_idx, col in enumerate(LGR_FIELDS):
+                vals = [row[col_idx] for row in chunk]
+
+                if col == 'lvl':
+                    vals = [LGR_LVL_CODES.get(val) for val in vals]
+
+                if col in _ZONE_MAP_COLS:
+                    chunk_dir[col] = _zone_map(vals)
+
+                blob = _encode_col(col, vals)
+                arc_file.write(blob)
+                chunk_dir['cols'][col] = [pos, len(blob)]
+                pos += len(blob)
+
+            directory['chunks'].append(chunk_dir)
+
+        arc_file.write(bloom_bits)
+        directory['bloom'] = [pos, len(bloom_bits)]
+        pos += len(bloom_bits)
+
+        dir_bytes = json.dumps(directory, separators=(',', ':')).encode('utf-8')
+        arc_file.write(dir_bytes)
+        arc_file.write(_ARC_FOOTER.pack(pos, len(dir_bytes), zlib.crc32(dir_bytes), _ARC_MAGIC))
+
+        arc_file.flush()
+        os.fsync(arc_file.fileno())
+
+    os.replace(tmp_filename, filename)
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# =============================================================================================================== Reader
+class ArchiveFile:
+    """ Read side of an archive file. Has the same read interface the segment DAO uses on its segments (lrid and
+    srv_ts range, ts_sorted, blocks, might_match(), iter_rows()) so a query treats both the same. Here a block is a
+    chunk. Thread safe, its read-only. """
+
+    def __init__(self, filename: str):
+        super().__init__()
+
+        self.filename = filename
+        self.sealed = True
+
+        with open(filename, 'rb') as arc_file:
+            self.mm = mmap.mmap(arc_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        dir_pos, dir_len, dir_crc, magic = _ARC_FOOTER.unpack_from(self.mm, len(self.mm) - _ARC_FOOTER.size)
+        dir_bytes = self.mm[dir_pos:dir_pos + dir_len]
+
+        if magic != _ARC_MAGIC or self.mm[:len(_ARC_MAGIC)] != _ARC_MAGIC or zlib.crc32(dir_bytes) != dir_crc:
+            raise ValueError(f"Not a valid archive file: {filename}")
+
+        directory = json.loads(dir_bytes)
+
+        self.record_count = directory['rows']
+        self.first_lrid = directory['first_lrid']
+        self.last_lrid = directory['last_lrid']
+        self.min_srv_ts = directory['min_srv_ts']
+        self.max_srv_ts = directory['max_srv_ts']
+        self.ts_sorted = directory['ts_sorted']
+        self.blocks = directory['chunks']
+
+        bloom_pos, bloom_len = directory['bloom']
+        self.bloom = BloomFilter(bloom_len, bits=self.mm[bloom_pos:bloom_pos + bloom_len])
+
+    def get_file_size(self) -> int:
+        return len(self.mm)
+
+    def might_match(self, session_id, subsys) -> bool:
+
+        keys = []
+        if session_id is not None:
+            keys.append(f"s:{session_id}")
+        if subsys is not None:
+            keys.append(f"u:{subsys}")
+
+        return all(self.bloom.might_contain(key) for key in keys)
+
+    def _read_col(self, chunk: dict, col: str, idxs: list = None) -> list:
+
+        pos, blob_len = chunk['cols'][col]
+        return _decode_col(self.mm[pos:pos + blob_len], chunk['rows'], idxs)
+
+    def iter_rows(self, query: LGR_QUERY, stats: dict):
+        """ Yield rows (LGR_FIELDS order) in lrid order matching the query's filters. Chunks the zone maps rule out
+        are skipped. stats['blocks_scanned'] is incremented for every chunk that is decompressed (at least partly)
+        If the archive is ts_sorted, the caller wont take more than query.limit rows, we dont decode more either.
+        (limit None: every match) """
+
+        lo = get_query_srv_ts_min(query)
+        hi = query.srv_ts_max
+        lvl_codes = get_query_lvl_codes(query)
+        check_client_ts = (query.client_ts_min is not None) or (query.client_ts_max is not None)
+        regexes = get_query_regexes(query)
+        remaining = query.limit
+
+        for chunk in self.blocks:
+            ts_zone = chunk['srv_ts']
+            lvl_zone = chunk['lvl']
+
+            if hi is not None and ts_zone[0] > hi:
+                if self.ts_sorted:
+                    return
+                continue
+
+            if lo is not None and ts_zone[1] < lo:
+                continue
+
+            if lvl_codes is not None and (lvl_zone is None or
+                                          not any(lvl_zone[0] <= code <= lvl_zone[1] for code in lvl_codes)):
+                continue
+
+            stats['blocks_scanned'] += 1
+
+            # predicate columns first, the rest only if something matched.
+            cols = {}
+            idxs = range(chunk['rows'])
+
+            if lo is not None or hi is not None:
+                cols['srv_ts'] = self._read_col(chunk, 'srv_ts')
+                ts_lo = lo if lo is not None else _INT64_MIN
+                ts_hi = hi if hi is not None else _INT64_MAX
+                idxs = [idx for idx in idxs if ts_lo <= cols['srv_ts'][idx] <= ts_hi]
+
+            # w/ a cursor lo is set, srv_ts is already read.
+            if query.after is not None and idxs:
+                cols['lrid'] = self._read_col(chunk, 'lrid')
+                idxs = [idx for idx in idxs if is_after_cursor(query, cols['srv_ts'][idx], cols['lrid'][idx])]
+
+            for col, want in (('lvl', lvl_codes), ('session_id', query.session_id), ('subsys', query.subsys)):
+                if want is None or not idxs:
+                    continue
+
+                cols[col] = self._read_col(chunk, col)
+                col_vals = cols[col]
+
+                if col == 'lvl':
+                    idxs = [idx for idx in idxs if col_vals[idx] in want]
+                else:
+                    idxs = [idx for idx in idxs if col_vals[idx] == want]
+
+            if check_client_ts and idxs:
+                cols['client_ts'] = self._read_col(chunk, 'client_ts')
+                idxs = [idx for idx in idxs if is_client_ts_match(query, cols['client_ts'][idx])]
+
+            # regexes last, only the msgs/filenames of rows that got past the rest are searched.
+            for col, compiled in regexes.items():
+                if not idxs:
+                    break
+
+                cols[col] = self._read_col(chunk, col)
+                col_vals = cols[col]
+                idxs = [idx for idx in idxs if col_vals[idx] is not None and compiled.search(col_vals[idx])]
+
+            if not idxs:
+                continue
+
+            # limit None (ie exports) takes everything.
+            if self.ts_sorted and remaining is not None:
+                idxs = list(idxs[:remaining])
+                remaining -= len(idxs)
+
+            col_vals = []
+            for col in LGR_FIELDS:
+                if col in cols:
+                    col_vals.append([cols[col][idx] for idx in idxs])
+                else:
+                    col_vals.append(self._read_col(chunk, col, idxs))
+
+            col_vals[_LVL_COL_IDX] = [LGR_LVL_NAMES.get(code) for code in col_vals[_LVL_COL_IDX]]
+
+            yield from zip(*col_vals)
+
+            if self.ts_sorted and remaining is not None and remaining <= 0:
+                return
+
+    def close(self):
+
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
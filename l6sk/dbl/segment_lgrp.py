@@ -0,0 +1,1118 @@
+""" segment_lgrp.py
+Append-only segment file storage for a single log group. The segment DAO holds one SegmentLogGroup per log group,
+just like the sqlite DAOs hold SqliteLogGroups. For plain append-and-scan workloads we dont need sqlite's B-tree,
+page cache or journal. Records are written once, in lrid order, and never updated. A read is a scan over the
+segments that could have matching records.
+
+Layout, a log group is a directory of segment files, seg_<first lrid>.l6seg:
+  - every segment file is exactly segment_size bytes. Its created at that size (sparse, ftruncate) and mmap()ed.
+  - records are appended to the active (last) segment as frames: <body len, crc32 of body> + body.
+    a body len of 0 is the end of data (fresh file is all zeros).
+  - when the next frame doesnt fit, the segment is sealed: a footer (lrid range, srv_ts range, record count, ...) is
+    written in the last _FOOTER.size bytes, and the segment is re-mapped read-only. A new segment is started.
+  - on open, sealed segments are recognized by their footer. The one w/o a footer is the active segment, its frames
+    are walked and crc checked to find where the data ends. A torn write at the end (crash mid append) is cut off.
+  - sealed segments whose records are all old enough can be compacted into column oriented archive files,
+    arc_<first lrid>.l6arc (see segment_archive.py), which replace them. Queries read both the same way.
+"""
+
+import os
+import sys
+import time
+import mmap
+import heapq
+import itertools
+import operator
+import zlib
+import struct
+import random
+import threading
+import collections
+
+from l6sk.dbl.dbl_api import LOG_RECORD, LGR_QUERY, LGR_FIELDS, LGR_LVL_CODES, LGR_LVL_NAMES, get_srv_ts_usec
+from l6sk.dbl.dbl_api import get_query_lvl_codes, get_query_srv_ts_min, is_client_ts_match, LgrQueryError
+from l6sk.dbl.bloom_filter import BloomFilter
+from l6sk.dbl.segment_archive import ArchiveFile, write_archive
+from l6sk.dbl.lgr_regex import get_query_regexes
+
+from l6sk import log_util as log
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================== Record format
+# frame header: body len, crc32(body)
+_FRAME_HDR = struct.Struct("<II")
+
+# body is a fixed size header and then the str fields' bytes back to back. The header has every int field and the
+# length of every str field, so decoding a record is one unpack_from() and a few slices.
+#   lrid, srv_ts, lvl code (0 for None), presence bitmap, ints-as-str bitmap,
+#   client_ts, lineno, pid, tid, (0 if not present)
+#   len of subsys, session_id, filename, funcname, pname, tname, msg (utf-8 bytes)
+# Ints that dont fit int64 (or are not ints) are kept as str, just like the sqlite DAOs do. Their bytes go after msg
+# and the int slot holds their length.
+_BODY_HDR = struct.Struct("<qqBHB" + "qqqq" + "HHHHHHI")
+_SRV_TS_OFFSET = 8
+_LVL_OFFSET = 16
+
+_OPT_INT_FIELDS = ('client_ts', 'lineno', 'pid', 'tid')
+_OPT_STR_FIELDS = ('subsys', 'session_id', 'filename', 'funcname', 'pname', 'tname', 'msg')
+_OPT_FIELDS = _OPT_INT_FIELDS + _OPT_STR_FIELDS
+_ALL_PRESENT = (1 << len(_OPT_FIELDS)) - 1
+
+_INT64 = struct.Struct("<q")
+
+_INT64_MIN = -(2**63)
+_INT64_MAX = 2**63 - 1
+
+# _decode_body() works on a list of: the header's int values, the decoded strs, then lrid, srv_ts, lvl name. This
+# picks the LGR_FIELDS ordered row out of it.
+_DECODE_FIELDS = _OPT_FIELDS + ('lrid', 'srv_ts', 'lvl')
+_pick_row = operator.itemgetter(*(_DECODE_FIELDS.index(field) for field in LGR_FIELDS))
+
+# session_id/subsys filters are checked on the raw bytes, w/o decoding the record. positions of their lengths in the
+# body header, and their bits in the presence bitmap.
+_SUBSYS_LEN_IDX = 9 + _OPT_STR_FIELDS.index('subsys')
+_SESSION_ID_LEN_IDX = 9 + _OPT_STR_FIELDS.index('session_id')
+_SUBSYS_BIT = 1 << _OPT_FIELDS.index('subsys')
+_SESSION_ID_BIT = 1 << _OPT_FIELDS.index('session_id')
+assert _OPT_STR_FIELDS[:2] == ('subsys', 'session_id')
+
+_LRID_IDX = LGR_FIELDS.index('lrid')
+_SRV_TS_IDX = LGR_FIELDS.index('srv_ts')
+_CLIENT_TS_IDX = LGR_FIELDS.index('client_ts')
+_SESSION_ID_IDX = LGR_FIELDS.index('session_id')
+_SUBSYS_IDX = LGR_FIELDS.index('subsys')
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================= Segment footer
+# A sealed segment has a trailer right after its data and a footer in its last _FOOTER.size bytes.
+# trailer: the sparse index, <offset, min srv_ts, max srv_ts> of every block of index_every records, then the bloom
+# filter's bits.
+# footer: magic, flags, first lrid, last lrid, min srv_ts, max srv_ts, record count, data len, index_every,
+# number of blocks, bloom filter bytes, crc32 of everything before it.
+_SEG_MAGIC = b"L6SKSEG2"
+_FOOTER = struct.Struct("<8sIqqqqIIIIII")
+_INDEX_ENTRY = struct.Struct("<Iqq")
+
+# segments sealed before the sparse index and bloom filters. (no trailer) Those get theirs rebuilt at open.
+_SEG_MAGIC_V1 = b"L6SKSEG1"
+_FOOTER_V1 = struct.Struct("<8sIqqqqIII")
+
+# all records in the segment are in srv_ts order (as well as lrid order). Usually the case, srv_ts is set by the
+# server per batch. Clients are allowed to send their own srv_ts tho.
+_FOOTER_FLAG_TS_SORTED = 1
+
+_SEG_FILENAME_PREFIX = "seg_"
+_SEG_FILENAME_SUFFIX = ".l6seg"
+
+_ARC_FILENAME_PREFIX = "arc_"
+_ARC_FILENAME_SUFFIX = ".l6arc"
+
+
+def _bloom_keys(session_id, subsys) -> list:
+    """ The bloom filter keys of a record. One filter per segment holds both fields, so they get a prefix. """
+
+    keys = []
+
+    if session_id is not None:
+        keys.append(f"s:{session_id}")
+
+    if subsys is not None:
+        keys.append(f"u:{subsys}")
+
+    return keys
+
+
+def _encode_int(val):
+    """ <int64 or None, str or None> for an optional int field. """
+
+    try:
+        int_val = int(val)
+    except (TypeError, ValueError):
+        return None, str(val)
+
+    if (int_val < _INT64_MIN) or (int_val > _INT64_MAX):
+        return None, str(val)
+
+    return int_val, None
+
+
+def _encode_record(lgr: LOG_RECORD, lrid: int) -> bytes:
+    """ Encode lgr as a frame (header + body). lgr.srv_ts must be set. """
+
+    lvl_code = 0
+    if lgr.lvl is not None:
+        lvl_code = LGR_LVL_CODES[lgr.lvl]  # KeyError on unknown level, refuse the batch.
+
+    present = 0
+    ints_as_str = 0
+    ints = []
+    strs = []
+    extra_strs = []
+
+    for bit, field in enumerate(_OPT_INT_FIELDS):
+        val = getattr(lgr, field)
+        if val is None:
+            ints.append(0)
+            continue
+
+        present |= 1 << bit
+        int_val, str_val = _encode_int(val)
+
+        if str_val is None:
+            ints.append(int_val)
+        else:
+            ints_as_str |= 1 << bit
+            str_bytes = str_val.encode('utf-8')
+            ints.append(len(str_bytes))
+            extra_strs.append(str_bytes)
+
+    for bit, field in enumerate(_OPT_STR_FIELDS, start=len(_OPT_INT_FIELDS)):
+        val = getattr(lgr, field)
+        if val is None:
+            strs.append(b'')
+            continue
+
+        present |= 1 << bit
+        strs.append(str(val).encode('utf-8'))
+
+    # struct.error if caller metadata is longer than 64 KB. (or msg longer than 4 GB)
+    body = b''.join([_BODY_HDR.pack(lrid, lgr.srv_ts, lvl_code, present, ints_as_str, *ints, *map(len, strs))] +
+                    strs + extra_strs)
+
+    return _FRAME_HDR.pack(len(body), zlib.crc32(body)) + body
+
+
+def _decode_body(body: bytes) -> tuple:
+    """ Decode a record body into a tuple in LGR_FIELDS order. """
+
+    hdr = _BODY_HDR.unpack_from(body)
+    str_lens = hdr[9:]
+    pos = _BODY_HDR.size
+    vals = list(hdr[5:9])
+
+    # caller metadata and msgs are almost always ascii. then one decode() of the whole str area, and byte offsets
+    # are char offsets. otherwise decode them one by one.
+    str_area_len = sum(str_lens)
+    str_area = str(body[pos:pos + str_area_len], 'utf-8')
+
+    if len(str_area) == str_area_len:
+        str_pos = 0
+        for str_len in str_lens:
+            vals.append(str_area[str_pos:str_pos + str_len])
+            str_pos += str_len
+    else:
+        str_pos = pos
+        for str_len in str_lens:
+            vals.append(str(body[str_pos:str_pos + str_len], 'utf-8'))
+            str_pos += str_len
+
+    pos += str_area_len
+
+    ints_as_str = hdr[4]
+    if ints_as_str:
+        for bit in range(len(_OPT_INT_FIELDS)):
+            if ints_as_str & (1 << bit):
+                str_len = vals[bit]
+                vals[bit] = str(body[pos:pos + str_len], 'utf-8')
+                pos += str_len
+
+    present = hdr[3]
+    if present != _ALL_PRESENT:
+        for bit in range(len(_OPT_FIELDS)):
+            if not present & (1 << bit):
+                vals[bit] = None
+
+    vals.append(hdr[0])
+    vals.append(hdr[1])
+    vals.append(LGR_LVL_NAMES.get(hdr[2]))
+
+    return _pick_row(vals)
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================= Segment
+class _Segment:
+    """ One segment file and its mmap, plus its sparse index and bloom filter (in memory for every segment, and in
+    the trailer of sealed ones). Sealed segments are mapped read-only. """
+
+    def __init__(self, filename: str, first_lrid: int, index_every: int, bloom_bytes: int):
+        super().__init__()
+
+        self.filename = filename
+        self.first_lrid = first_lrid
+        self.last_lrid = first_lrid - 1
+        self.min_srv_ts = None
+        self.max_srv_ts = None
+        self.record_count = 0
+        self.data_len = 0
+        self.ts_sorted = True
+        self.sealed = False
+
+        # sparse index. one [offset, min srv_ts, max srv_ts] per block of index_every records. srv_ts range per block
+        # (not just the first ts) so it works for segments that are not ts sorted too.
+        self.index_every = index_every
+        self.blocks = []
+
+        # bloom filter over the segment's session ids and subsystems.
+        self.bloom = BloomFilter(bloom_bytes)
+
+        # bloom keys already added. only kept for the active segment, saves hashing the same session id over and over.
+        self._bloom_keys_seen = set()
+
+        self.fd = None
+        self.mm = None
+
+    def note_record(self, lrid: int, srv_ts: int, offset: int, session_id, subsys):
+        """ Book keeping for a record just written at offset. """
+
+        if self.max_srv_ts is not None and srv_ts < self.max_srv_ts:
+            self.ts_sorted = False
+
+        if self.min_srv_ts is None or srv_ts < self.min_srv_ts:
+            self.min_srv_ts = srv_ts
+
+        if self.max_srv_ts is None or srv_ts > self.max_srv_ts:
+            self.max_srv_ts = srv_ts
+
+        if self.record_count % self.index_every == 0:
+            self.blocks.append([offset, srv_ts, srv_ts])
+        else:
+            block = self.blocks[-1]
+            if srv_ts < block[1]:
+                block[1] = srv_ts
+            if srv_ts > block[2]:
+                block[2] = srv_ts
+
+        for key in _bloom_keys(session_id, subsys):
+            if key not in self._bloom_keys_seen:
+                self._bloom_keys_seen.add(key)
+                self.bloom.add(key)
+
+        self.last_lrid = lrid
+        self.record_count += 1
+
+    def mark_sealed(self):
+
+        self.sealed = True
+        self._bloom_keys_seen = None
+
+    def get_free_space(self) -> int:
+        """ Bytes left for frames, after making room for the trailer and footer. (assumes the next record starts a new
+        block, good enough) """
+
+        trailer_len = (len(self.blocks) + 1) * _INDEX_ENTRY.size + self.bloom.num_bytes
+
+        return len(self.mm) - _FOOTER.size - trailer_len - self.data_len
+
+    def trailer_and_footer_bytes(self) -> tuple:
+
+        bloom_bits = self.bloom.to_bytes()
+        trailer = b''.join([_INDEX_ENTRY.pack(*block) for block in self.blocks] + [bloom_bits])
+
+        flags = _FOOTER_FLAG_TS_SORTED if self.ts_sorted else 0
+        min_srv_ts = self.min_srv_ts if self.min_srv_ts is not None else 0
+        max_srv_ts = self.max_srv_ts if self.max_srv_ts is not None else -1
+
+        footer_wo_crc = _FOOTER.pack(_SEG_MAGIC, flags, self.first_lrid, self.last_lrid, min_srv_ts, max_srv_ts,
+                                     self.record_count, self.data_len, self.index_every, len(self.blocks),
+                                     len(bloom_bits), 0)[:-4]
+
+        return trailer, footer_wo_crc + struct.pack("<I", zlib.crc32(footer_wo_crc))
+
+    def load_footer(self) -> bool:
+        """ If the segment has a valid footer, load it (and the trailer) and return True. """
+
+        footer_start = len(self.mm) - _FOOTER.size
+        (magic, flags, first_lrid, last_lrid, min_srv_ts, max_srv_ts, record_count, data_len, index_every, num_blocks,
+         bloom_len, crc) = _FOOTER.unpack_from(self.mm, footer_start)
+
+        if magic != _SEG_MAGIC or crc != zlib.crc32(self.mm[footer_start:len(self.mm) - 4]):
+            return self._load_footer_v1()
+
+        self.first_lrid = first_lrid
+        self.last_lrid = last_lrid
+        self.record_count = record_count
+        self.data_len = data_len
+        self.ts_sorted = bool(flags & _FOOTER_FLAG_TS_SORTED)
+        self.min_srv_ts = min_srv_ts if record_count else None
+        self.max_srv_ts = max_srv_ts if record_count else None
+
+        self.index_every = index_every
+        self.blocks = [
+            list(_INDEX_ENTRY.unpack_from(self.mm, data_len + idx * _INDEX_ENTRY.size)) for idx in range(num_blocks)
+        ]
+
+        bloom_start = data_len + num_blocks * _INDEX_ENTRY.size
+        self.bloom = BloomFilter(bloom_len, bits=self.mm[bloom_start:bloom_start + bloom_len])
+        self.mark_sealed()
+
+        return True
+
+    def _load_footer_v1(self) -> bool:
+        """ Sealed w/o a trailer. Take the data len from the footer, and rebuild the index and bloom filter. """
+
+        footer_start = len(self.mm) - _FOOTER_V1.size
+        magic, _, _, _, _, _, _, data_len, crc = _FOOTER_V1.unpack_from(self.mm, footer_start)
+
+        if magic != _SEG_MAGIC_V1 or crc != zlib.crc32(self.mm[footer_start:len(self.mm) - 4]):
+            return False
+
+        self._walk_frames(data_len)
+        self.mark_sealed()
+
+        return True
+
+    def _walk_frames(self, end: int) -> int:
+        """ Go over the frames in [0, end) w/ crc checks, re-doing the book keeping for each. Stop at the first
+        empty or bad one. Return where the valid data ends. """
+
+        pos = 0
+
+        while pos + _FRAME_HDR.size <= end:
+            body_len, crc = _FRAME_HDR.unpack_from(self.mm, pos)
+            body_start = pos + _FRAME_HDR.size
+
+            if body_len == 0 or body_start + body_len > end:
+                break
+
+            body = self.mm[body_start:body_start + body_len]
+            if zlib.crc32(body) != crc:
+                break
+
+            row = _decode_body(body)
+            self.note_record(row[_LRID_IDX], row[_SRV_TS_IDX], pos, row[_SESSION_ID_IDX], row[_SUBSYS_IDX])
+            pos = body_start + body_len
+
+        self.data_len = pos
+
+        return pos
+
+    def recover(self):
+        """ Walk the frames of an unsealed segment, find the end of valid data. Anything after it (a torn write)
+        is zeroed so the next append starts from a clean end of data marker. """
+
+        capacity = len(self.mm) - _FOOTER.size
+        pos = self._walk_frames(capacity)
+
+        # zero whatever is left of a partial frame. upto the next page boundary is plenty, a frame header can only
+        # be followed by its own body, and we stopped at the first bad one.
+        torn_end = min(capacity, pos + mmap.PAGESIZE)
+        if any(self.mm[pos:torn_end]):
+            log.warn(f"Segment: {self.filename} has a torn write after {pos} bytes, dropping it.")
+            self.mm[pos:capacity] = bytes(capacity - pos)
+
+    def might_match(self, session_id, subsys) -> bool:
+        """ False if the bloom filter says the segment has no records w/ this session id or subsys. """
+
+        return all(self.bloom.might_contain(key) for key in _bloom_keys(session_id, subsys))
+
+    def iter_rows(self, query: LGR_QUERY, stats: dict):
+        """ Yield decoded rows (LGR_FIELDS order) in lrid order that match the query's filters (its limit is up to the
+        caller). Blocks whose srv_ts range doesnt overlap [srv_ts_min, srv_ts_max] are skipped, if the segment is
+        ts_sorted we stop at the first block (and record) past srv_ts_max. Only matching records get decoded. (client_ts
+        and regexes are checked on the decoded row)
+        stats['blocks_scanned'] is incremented for every block read. """
+
+        mm = self.mm
+        frame_hdr_size = _FRAME_HDR.size
+        unpack_hdr = _FRAME_HDR.unpack_from
+        unpack_ts = _INT64.unpack_from
+        lo = get_query_srv_ts_min(query)
+        lo = lo if lo is not None else _INT64_MIN
+        hi = query.srv_ts_max if query.srv_ts_max is not None else _INT64_MAX
+        lvl_codes = get_query_lvl_codes(query)
+        after_lrid = query.after[1] if query.after is not None else None
+        check_client_ts = (query.client_ts_min is not None) or (query.client_ts_max is not None)
+        regex_checks = [(LGR_FIELDS.index(field), compiled) for field, compiled in get_query_regexes(query).items()]
+        ts_sorted = self.ts_sorted
+        num_blocks = len(self.blocks)
+        unpack_body_hdr = _BODY_HDR.unpack_from
+        want_subsys = query.subsys.encode('utf-8') if query.subsys is not None else None
+        want_session_id = query.session_id.encode('utf-8') if query.session_id is not None else None
+
+        for block_idx in range(num_blocks):
+            block_start, block_min_ts, block_max_ts = self.blocks[block_idx]
+
+            if block_max_ts < lo:
+                continue
+
+            if block_min_ts > hi:
+                if ts_sorted:
+                    return
+                continue
+
+            stats['blocks_scanned'] += 1
+
+            pos = block_start
+            end = self.blocks[block_idx + 1][0] if block_idx + 1 < num_blocks else self.data_len
+
+            while pos < end:
+                body_len = unpack_hdr(mm, pos)[0]
+                body_start = pos + frame_hdr_size
+                srv_ts = unpack_ts(mm, body_start + _SRV_TS_OFFSET)[0]
+                pos = body_start + body_len
+
+                if lo <= srv_ts <= hi:
+                    # no level is code 0, never in lvl_codes.
+                    if (lvl_codes is not None) and (mm[body_start + _LVL_OFFSET] not in lvl_codes):
+                        continue
+
+                    # lo is the cursor's srv_ts or past it. its records up to the cursor's lrid were on the last page.
+                    if (after_lrid is not None) and (srv_ts == lo) and (unpack_ts(mm, body_start)[0] <= after_lrid):
+                        continue
+
+                    if (want_subsys is not None) or (want_session_id is not None):
+                        # strs start right after the header, subsys first then session_id.
+                        hdr = unpack_body_hdr(mm, body_start)
+                        subsys_start = body_start + _BODY_HDR.size
+                        session_id_start = subsys_start + hdr[_SUBSYS_LEN_IDX]
+
+                        if want_subsys is not None:
+                            if not (hdr[3] & _SUBSYS_BIT) or mm[subsys_start:session_id_start] != want_subsys:
+                                continue
+
+                        if want_session_id is not None:
+                            session_id_end = session_id_start + hdr[_SESSION_ID_LEN_IDX]
+                            if not (hdr[3] & _SESSION_ID_BIT) or mm[session_id_start:session_id_end] != want_session_id:
+                                continue
+
+                    row = _decode_body(mm[body_start:pos])
+                    if check_client_ts and not is_client_ts_match(query, row[_CLIENT_TS_IDX]):
+                        continue
+
+                    if regex_checks and not all(row[idx] is not None and compiled.search(row[idx])
+                                                for idx, compiled in regex_checks):
+                        continue
+
+                    yield row
+                elif ts_sorted and srv_ts > hi:
+                    return
+
+    def close(self):
+
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ===================================================================================================== SegmentLogGroup
+class SegmentLogGroup:
+    """ One log group, stored as append-only segment files in dirname (created if needed).
+
+    segment_size: size of each segment file in bytes. A single record must fit in one segment.
+    sync_appends: msync() the appended pages before append_lgrs() returns. Off means an append is done once its in
+    the page cache, like sqlite w/ synchronous=OFF. (a crash of the process loses nothing, a crash of the OS might)
+    index_every: sparse index granularity. a block is this many records, the smallest unit a query can skip.
+    bloom_bytes: size of each segment's bloom filter (session ids, subsystems). ~10 bits per distinct value for 1%
+    false positives, the 4 KB default is good for ~3000 sessions + subsystems per segment.
+    archive_chunk_rows: rows per chunk in archive files. (see archive_segments()) The zone maps are per chunk.
+    """
+
+    def __init__(self,
+                 lgrp: str,
+                 dirname: str,
+                 segment_size: int = 64 * 1024 * 1024,
+                 sync_appends: bool = True,
+                 index_every: int = 128,
+                 bloom_bytes: int = 4096,
+                 archive_chunk_rows: int = 8192):
+        super().__init__()
+
+        # mmap offsets must be page aligned, and we flush by page.
+        assert segment_size % mmap.PAGESIZE == 0
+        assert segment_size > _FOOTER.size + bloom_bytes
+        assert index_every > 0
+
+        self._lgrp = lgrp
+        self._dirname = dirname
+        self._segment_size = segment_size
+        self._sync_appends = sync_appends
+        self._index_every = index_every
+        self._bloom_bytes = bloom_bytes
+        self._archive_chunk_rows = archive_chunk_rows
+
+        # all segments, in lrid order. the last one is the active one, every other one is sealed.
+        # and the archive files, in lrid order. all of them are older (lower lrids) than any segment.
+        self._segments = []
+        self._archives = []
+        self._next_lrid = 1
+
+        # archive_segments() runs on its own thread. It holds this while it swaps a segment for its archive, queries
+        # and _start_segment() hold it to look at/change the lists. Appends and queries are on the same thread (the
+        # DBL worker) and dont need it among themselves.
+        self._lock = threading.Lock()
+
+        # totals over every query since open. see get_scan_stats()
+        self._scan_stats = collections.Counter()
+
+        os.makedirs(dirname, exist_ok=True)
+        self._open_segments()
+
+    @property
+    def lgrp(self) -> str:
+        return self._lgrp
+
+    def get_num_segments(self) -> int:
+        return len(self._segments)
+
+    def get_num_archives(self) -> int:
+        return len(self._archives)
+
+    def get_scan_stats(self) -> dict:
+        """ Query scan stats (same keys as a query result's 'stats') summed over every query since open. """
+
+        return dict(self._scan_stats)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ================================================================================================ segment lifecycle
+    def _get_segment_filename(self, first_lrid: int) -> str:
+        return os.path.join(self._dirname, f"{_SEG_FILENAME_PREFIX}{first_lrid:020d}{_SEG_FILENAME_SUFFIX}")
+
+    def _get_archive_filename(self, first_lrid: int) -> str:
+        return os.path.join(self._dirname, f"{_ARC_FILENAME_PREFIX}{first_lrid:020d}{_ARC_FILENAME_SUFFIX}")
+
+    def _mk_segment(self, filename: str, first_lrid: int) -> _Segment:
+        return _Segment(filename, first_lrid, index_every=self._index_every, bloom_bytes=self._bloom_bytes)
+
+    def _open_segments(self):
+
+        fnames = sorted(os.listdir(self._dirname))
+
+        for fname in fnames:
+            if fname.startswith(_ARC_FILENAME_PREFIX) and fname.endswith(_ARC_FILENAME_SUFFIX + ".tmp"):
+                # archive_segments() didnt get to finish this one. The segment is still there.
+                os.remove(os.path.join(self._dirname, fname))
+            elif fname.startswith(_ARC_FILENAME_PREFIX) and fname.endswith(_ARC_FILENAME_SUFFIX):
+                arc = ArchiveFile(os.path.join(self._dirname, fname))
+                self._archives.append(arc)
+                self._next_lrid = max(self._next_lrid, arc.last_lrid + 1)
+
+        archived_lrids = {arc.first_lrid for arc in self._archives}
+
+        for fname in fnames:
+            if not (fname.startswith(_SEG_FILENAME_PREFIX) and fname.endswith(_SEG_FILENAME_SUFFIX)):
+                continue
+
+            first_lrid = int(fname[len(_SEG_FILENAME_PREFIX):-len(_SEG_FILENAME_SUFFIX)])
+
+            if first_lrid in archived_lrids:
+                # archived, but crashed before the segment was deleted. The archive is complete, its renamed into
+                # place only after its fsync()ed.
+                log.warn(f"Segment: {fname} is already archived, deleting it.")
+                os.remove(os.path.join(self._dirname, fname))
+                continue
+
+            seg = self._mk_segment(os.path.join(self._dirname, fname), first_lrid)
+
+            seg.fd = os.open(seg.filename, os.O_RDWR)
+            seg.mm = mmap.mmap(seg.fd, 0)
+
+            if seg.load_footer():
+                self._remap_read_only(seg)
+            else:
+                # only the last segment can be unsealed. (a crash after a segment is full but before its sealed
+                # leaves a full unsealed one w/o a successor, that one is the last too)
+                seg.recover()
+
+            self._segments.append(seg)
+            self._next_lrid = max(self._next_lrid, seg.last_lrid + 1)
+
+        # an unsealed segment that isnt the last one should not exist, but if it does seal it and move on.
+        for seg in self._segments[:-1]:
+            if not seg.sealed:
+                self._seal(seg)
+
+        if not self._segments or self._segments[-1].sealed:
+            self._start_segment()
+
+    def _start_segment(self):
+
+        seg = self._mk_segment(self._get_segment_filename(self._next_lrid), self._next_lrid)
+
+        seg.fd = os.open(seg.filename, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+        os.ftruncate(seg.fd, self._segment_size)
+        seg.mm = mmap.mmap(seg.fd, self._segment_size)
+
+        with self._lock:
+            self._segments.append(seg)
+
+    def _seal(self, seg: _Segment):
+
+        trailer, footer = seg.trailer_and_footer_bytes()
+
+        # a segment sealed at open (unsealed, not the last one) might not have room for a trailer. it keeps working
+        # w/o one, the index is rebuilt on every open.
+        if seg.data_len + len(trailer) <= len(seg.mm) - _FOOTER.size:
+            seg.mm[seg.data_len:seg.data_len + len(trailer)] = trailer
+            seg.mm[len(seg.mm) - _FOOTER.size:] = footer
+
+        seg.mm.flush()
+        seg.mark_sealed()
+
+        self._remap_read_only(seg)
+
+    def _remap_read_only(self, seg: _Segment):
+        """ Sealed segments are never written again. Map them read-only, and let go of the fd. """
+
+        # the writable map isnt close()d, an export (see iter_lgrs()) might still be reading it. It goes once the last
+        # reference to it does.
+        seg.mm = mmap.mmap(seg.fd, 0, access=mmap.ACCESS_READ)
+        os.close(seg.fd)
+        seg.fd = None
+
+    def close(self):
+
+        for seg in self._archives + self._segments:
+            seg.close()
+
+        self._segments = []
+        self._archives = []
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ======================================================================================================== archiving
+    def archive_segments(self, archive_before: int) -> int:
+        """ Compact every sealed segment whose records are all older than archive_before (srv_ts, micro seconds) into
+        an archive file, and delete the segment. Return how many segments were archived.
+        Meant to run on a background thread, while the DBL worker keeps appending and querying. Sealed segments are
+        never written again, so reading one here is safe. A query that already has the segment in hand keeps reading
+        it, its mmap is closed when the last reference is gone. (unlinking a mapped file is fine) """
+
+        with self._lock:
+            to_archive = [
+                seg for seg in self._segments[:-1]
+                if seg.sealed and seg.record_count and seg.max_srv_ts < archive_before
+            ]
+
+        for seg in to_archive:
+            rows = list(seg.iter_rows(LGR_QUERY(lgrp=self._lgrp), collections.Counter()))
+            arc_filename = self._get_archive_filename(seg.first_lrid)
+
+            write_archive(arc_filename, rows, seg.bloom.to_bytes(), seg.ts_sorted, chunk_rows=self._archive_chunk_rows)
+            arc = ArchiveFile(arc_filename)
+
+            with self._lock:
+                self._archives = sorted(self._archives + [arc], key=lambda arc: arc.first_lrid)
+                self._segments = [other for other in self._segments if other is not seg]
+
+            os.remove(seg.filename)
+            log.dbg(f"Segment: {seg.filename} archived. {len(seg.mm):,} -> {arc.get_file_size():,} bytes")
+
+        return len(to_archive)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # =========================================================================================================== append
+    def append_lgrs(self, lgrs: list) -> int:
+        """ Append the given LOG_RECORDs. Set srv_ts on the ones that dont have one. Return the number of records
+        appended. Every record is encoded before anything is written, so a bad record refuses the whole batch.
+        A crash in the middle of the write might leave the first part of a batch in. """
+
+        srv_ts = get_srv_ts_usec()
+
+        # what an empty segment has room for.
+        capacity = self._segment_size - _FOOTER.size - _INDEX_ENTRY.size - self._bloom_bytes
+
+        frames = []
+        for idx, lgr in enumerate(lgrs):
+            if lgr.srv_ts is None:
+                lgr.srv_ts = srv_ts
+
+            frame = _encode_record(lgr, self._next_lrid + idx)
+            if len(frame) > capacity:
+                raise ValueError(f"Log record too large for segment: {len(frame)} bytes")
+
+            frames.append((frame, lgr))
+
+        seg = self._segments[-1]
+        flush_start = seg.data_len
+
+        for frame, lgr in frames:
+
+            if len(frame) > seg.get_free_space():
+                self._flush(seg, flush_start)
+                self._seal(seg)
+                self._start_segment()
+                seg = self._segments[-1]
+                flush_start = 0
+
+            offset = seg.data_len
+            seg.mm[offset:offset + len(frame)] = frame
+            seg.data_len += len(frame)
+            seg.note_record(self._next_lrid, lgr.srv_ts, offset, lgr.session_id, lgr.subsys)
+            self._next_lrid += 1
+
+        self._flush(seg, flush_start)
+
+        return len(frames)
+
+    def _flush(self, seg: _Segment, start: int):
+
+        if not self._sync_appends or seg.data_len <= start:
+            return
+
+        page_start = start - (start % mmap.PAGESIZE)
+        seg.mm.flush(page_start, seg.data_len - page_start)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ============================================================================================================ query
+    def query_lgrs(self, query: LGR_QUERY) -> dict:
+        """ Same contract as SqliteLogGroup.query_lgrs(), rows in (srv_ts, lrid) order. Plus 'stats', how much of the
+        log group the query had to read:
+            segments, blocks: how many there are (w/ records in them). archives count as segments, and their chunks
+            as blocks.
+            archives: how many of the segments are archive files
+            segments_skipped_ts: skipped, srv_ts range of the segment doesnt overlap the query
+            segments_skipped_bloom: skipped, bloom filter says no such session/subsys in the segment
+            blocks_scanned, blocks_skipped: blocks read, and not read (for whatever reason)
+
+        Segments are pruned by srv_ts range and bloom filter w/o touching their data. The rest are scanned in min
+        srv_ts order, and we stop as soon as the next segment cant have anything that beats what we have. Inside a
+        segment the sparse index skips blocks outside the srv_ts range, in an archive the zone maps skip chunks. """
+
+        if query.msg_match is not None:
+            raise LgrQueryError(f"Log group: {self._lgrp} has no full text index. (segment DAO)")
+
+        if query.template_id is not None:
+            raise LgrQueryError(f"Log group: {self._lgrp} has no msg templates. (segment DAO)")
+
+        lo = get_query_srv_ts_min(query)
+        hi = query.srv_ts_max
+
+        stats = collections.Counter(segments=0, archives=0, blocks=0, segments_skipped_ts=0,
+                                    segments_skipped_bloom=0, blocks_scanned=0)
+        candidates = []
+
+        with self._lock:
+            tiers = self._archives + self._segments
+
+        for seg in tiers:
+            if not seg.record_count:
+                continue
+
+            stats['segments'] += 1
+            stats['blocks'] += len(seg.blocks)
+
+            if isinstance(seg, ArchiveFile):
+                stats['archives'] += 1
+
+            if (lo is not None and seg.max_srv_ts < lo) or (hi is not None and seg.min_srv_ts > hi):
+                stats['segments_skipped_ts'] += 1
+            elif not seg.might_match(query.session_id, query.subsys):
+                stats['segments_skipped_bloom'] += 1
+            else:
+                candidates.append(seg)
+
+        candidates.sort(key=lambda seg: seg.min_srv_ts)
+
+        sort_key = lambda row: (row[1], row[0])
+        best = []
+
+        for seg in candidates:
+            if len(best) >= query.limit and seg.min_srv_ts > best[-1][1]:
+                break
+
+            rows = seg.iter_rows(query, stats)
+
+            if not seg.ts_sorted:
+                best = heapq.nsmallest(query.limit, best + list(rows), key=sort_key)
+                continue
+
+            # in a ts sorted segment, the first limit matches are the segment's best. And if the whole segment sorts
+            # after what we have (the usual case, segments dont overlap) they just go at the end.
+            if best and (seg.min_srv_ts, seg.first_lrid) <= sort_key(best[-1]):
+                best = heapq.nsmallest(query.limit, best + list(itertools.islice(rows, query.limit)), key=sort_key)
+            else:
+                best.extend(itertools.islice(rows, query.limit - len(best)))
+
+        stats['blocks_skipped'] = stats['blocks'] - stats['blocks_scanned']
+        self._scan_stats.update(stats)
+
+        return {'fields': LGR_FIELDS, 'lgrs': best, 'stats': dict(stats)}
+
+    def iter_lgrs(self, query: LGR_QUERY, chunk_size: int = 1000):
+        """ query_lgrs() for results too big to have in memory at once, ie exports. Returns a generator of lists of
+        upto chunk_size rows (LGR_FIELDS order), in (srv_ts, lrid) order. query.limit None means every match.
+        Call it on the DBL worker, the generator can be run on any thread: it yields the records there were when this
+        was called, appends that come in meanwhile arent seen. (and dont wait on it) Segments that arent ts_sorted
+        are sorted in memory, one at a time. """
+
+        if query.msg_match is not None:
+            raise LgrQueryError(f"Log group: {self._lgrp} has no full text index. (segment DAO)")
+
+        if query.template_id is not None:
+            raise LgrQueryError(f"Log group: {self._lgrp} has no msg templates. (segment DAO)")
+
+        # segments archived meanwhile keep their mmap as long as we hold them. the active one can only grow, past
+        # max_lrid.
+        with self._lock:
+            tiers = [(seg, seg.ts_sorted) for seg in self._archives + self._segments if seg.record_count]
+        max_lrid = self._next_lrid - 1
+
+        return self._iter_chunks(query, tiers, max_lrid, chunk_size)
+
+    def _iter_chunks(self, query: LGR_QUERY, tiers: list, max_lrid: int, chunk_size: int):
+
+        stats = collections.Counter()
+        lo = get_query_srv_ts_min(query)
+        hi = query.srv_ts_max
+        streams = []
+
+        for seg, ts_sorted in tiers:
+            if (lo is not None and seg.max_srv_ts < lo) or (hi is not None and seg.min_srv_ts > hi):
+                continue
+            if not seg.might_match(query.session_id, query.subsys):
+                continue
+
+            rows = (row for row in seg.iter_rows(query, stats) if row[_LRID_IDX] <= max_lrid)
+            streams.append(rows if ts_sorted else iter(sorted(rows, key=lambda row: (row[1], row[0]))))
+
+        rows = heapq.merge(*streams, key=lambda row: (row[1], row[0]))
+        if query.limit is not None:
+            rows = itertools.islice(rows, query.limit)
+
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_bench_ingest_scan(num_records=200 * 1000, batch_size=500, num_range_scans=200):
+    """ Side by side: segment files vs a sqlite log group on disk (WAL, like the disk DAO). Both w/ durable appends
+    (sqlite default synchronous=FULL vs msync) and both w/o. Prints ingest rate, full scan and range scan times. """
+
+    import shutil  # pylint: disable=import-outside-toplevel
+    import sqlite3  # pylint: disable=import-outside-toplevel
+    import tempfile  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.sqlite_lgrp import SqliteLogGroup  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.msg_codec import _dbg_mk_sample_msgs  # pylint: disable=import-outside-toplevel
+
+    print(f"Benchmarking segment files vs sqlite w/ {num_records:,} records in batches of {batch_size} ...")
+
+    rnd = random.Random(1655)
+    base_ts = int(time.time() * 1000000)
+    msgs = _dbg_mk_sample_msgs(num_records)
+    lvls = list(LGR_LVL_CODES)
+
+    # ~ 10k records per second of server time
+    def mk_lgrs():
+        return [
+            LOG_RECORD(srv_ts=base_ts + i * 100, client_ts=base_ts + i * 100 - 50, lvl=rnd.choice(lvls),
+                       session_id='AZxV89HW_SvGbZsyFDkDP6q0', lineno=rnd.randint(1, 2000), filename='server_init.py',
+                       funcname='webapp_init', pid=4242, pname='MainProcess', tid=140212345678912, tname='MainThread',
+                       msg=msgs[i]) for i in range(num_records)
+        ]
+
+    scan_starts = [base_ts + int(rnd.random() * (num_records - 10000) * 100) for _ in range(num_range_scans)]
+
+    def run(lgrp, dir_size):
+
+        lgrs = mk_lgrs()
+
+        start_time = time.perf_counter()
+        for batch_start in range(0, num_records, batch_size):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + batch_size])
+        ingest_t = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        full = lgrp.query_lgrs(LGR_QUERY(lgrp='bench', limit=num_records))
+        full_scan_t = time.perf_counter() - start_time
+        assert len(full['lgrs']) == num_records
+
+        # 1 second worth of records (~10k) at random spots, only the first 100 come back.
+        start_time = time.perf_counter()
+        for st in scan_starts:
+            lgrp.query_lgrs(LGR_QUERY(lgrp='bench', srv_ts_min=st, srv_ts_max=st + 1000000))
+        range_scan_t = (time.perf_counter() - start_time) / num_range_scans
+
+        return num_records / ingest_t, full_scan_t * 1000, range_scan_t * 1000, dir_size() / num_records
+
+    def dir_size_fn(dirname):
+        # segment files are sparse, count what is actually allocated.
+        return lambda: sum(os.stat(os.path.join(dirname, f)).st_blocks * 512 for f in os.listdir(dirname))
+
+    results = {}
+    for durable in (True, False):
+        tmp_dirname = tempfile.mkdtemp(prefix="l6sk_seg_bench_")
+        try:
+            conn = sqlite3.connect(os.path.join(tmp_dirname, "lgrp_bench.db"), isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL;")
+            if not durable:
+                conn.execute("PRAGMA synchronous = OFF;")
+            results[('sqlite', durable)] = run(SqliteLogGroup('bench', conn), dir_size_fn(tmp_dirname))
+            conn.close()
+
+            seg_dirname = os.path.join(tmp_dirname, "lgrp_bench")
+            seg_lgrp = SegmentLogGroup('bench', seg_dirname, segment_size=16 * 1024 * 1024, sync_appends=durable)
+            results[('segment', durable)] = run(seg_lgrp, dir_size_fn(seg_dirname))
+            seg_lgrp.close()
+        finally:
+            shutil.rmtree(tmp_dirname)
+
+    cols = [('sqlite', True), ('segment', True), ('sqlite', False), ('segment', False)]
+    print(f"{'':28}" + "".join(f"{name + (' sync' if durable else ' nosync'):>18}" for name, durable in cols))
+    for idx, label, fmt in ((0, 'inserts per second', ',.0f'), (1, 'full scan (ms)', '.1f'),
+                            (2, 'range scan, limit 100 (ms)', '.3f'), (3, 'disk bytes per row', '.1f')):
+        print(f"{label:28}" + "".join(f"{results[col][idx]:>18{fmt}}" for col in cols))
+
+
+def _dbg_bench_session_lookup(num_records=400 * 1000, num_sessions=200, num_lookups=50):
+    """ Find all records of one session. Sessions come and go, each one's records are in one stretch of the log
+    group, like client processes that run for a while. Prints lookup time and how much of the log group was read. """
+
+    import shutil  # pylint: disable=import-outside-toplevel
+    import sqlite3  # pylint: disable=import-outside-toplevel
+    import tempfile  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.sqlite_lgrp import SqliteLogGroup  # pylint: disable=import-outside-toplevel
+
+    print(f"Benchmarking session lookups w/ {num_records:,} records, {num_sessions} sessions ...")
+
+    rnd = random.Random(1655)
+    base_ts = int(time.time() * 1000000)
+    sessions = [f"sess_{rnd.getrandbits(96):024x}" for _ in range(num_sessions)]
+
+    def mk_lgrs():
+        return [
+            LOG_RECORD(srv_ts=base_ts + i * 100, lvl='INFO', session_id=sessions[i * num_sessions // num_records],
+                       lineno=rnd.randint(1, 2000), filename='server_init.py', msg=f"hello world {i}")
+            for i in range(num_records)
+        ]
+
+    lookups = [rnd.choice(sessions) for _ in range(num_lookups)]
+    tmp_dirname = tempfile.mkdtemp(prefix="l6sk_seg_bench_")
+
+    try:
+        conn = sqlite3.connect(os.path.join(tmp_dirname, "lgrp_bench.db"), isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        sqlite_lgrp = SqliteLogGroup('bench', conn)
+        seg_lgrp = SegmentLogGroup('bench', os.path.join(tmp_dirname, "lgrp_bench"), segment_size=4 * 1024 * 1024,
+                                   sync_appends=False)
+
+        for lgrp in (sqlite_lgrp, seg_lgrp):
+            lgrs = mk_lgrs()
+            for batch_start in range(0, num_records, 500):
+                lgrp.append_lgrs(lgrs[batch_start:batch_start + 500])
+
+        results = {}
+        for name, lgrp in (('sqlite', sqlite_lgrp), ('segment', seg_lgrp)):
+            start_time = time.perf_counter()
+            for session_id in lookups:
+                res = lgrp.query_lgrs(LGR_QUERY(lgrp='bench', session_id=session_id, limit=num_records))
+                assert len(res['lgrs']) == num_records // num_sessions
+            results[name] = (time.perf_counter() - start_time) / num_lookups * 1000
+
+        stats = seg_lgrp.get_scan_stats()
+        seg_lgrp.close()
+        conn.close()
+    finally:
+        shutil.rmtree(tmp_dirname)
+
+    print(f"sqlite (session_id_ref, srv_ts) index: {results['sqlite']:.2f} ms per lookup")
+    print(f"segments: {results['segment']:.2f} ms per lookup. per lookup: "
+          f"{stats['segments_skipped_bloom'] / num_lookups:.1f} of {stats['segments'] / num_lookups:.0f} segments "
+          f"skipped by bloom filter, {stats['blocks_scanned'] / num_lookups:.1f} of "
+          f"{stats['blocks'] / num_lookups:.0f} blocks read")
+
+
+def _dbg_bench_archive(num_records=400 * 1000, num_queries=50):
+    """ Same records as segments and then archived. Prints disk bytes per row, archiving rate, and query times for
+    a full scan, a 1 second range, rare levels (CRIT is ~1 in 500 records, found by the zone maps), and a session. """
+
+    import shutil  # pylint: disable=import-outside-toplevel
+    import tempfile  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.msg_codec import _dbg_mk_sample_msgs  # pylint: disable=import-outside-toplevel
+
+    print(f"Benchmarking segments vs archive files w/ {num_records:,} records ...")
+
+    rnd = random.Random(1655)
+    base_ts = int(time.time() * 1000000) - 7 * 24 * 3600 * 1000000
+    msgs = _dbg_mk_sample_msgs(num_records)
+    sessions = [f"sess_{rnd.getrandbits(96):024x}" for _ in range(200)]
+
+    # CRITs come in bursts, a few per 100k records.
+    lvls = [rnd.choice(['DBUG', 'INFO', 'INFO', 'INFO', 'WARN', 'ERRR']) for _ in range(num_records)]
+    for burst_start in rnd.sample(range(num_records - 200), num_records // 100000 * 4):
+        for idx in range(burst_start, burst_start + 200, 10):
+            lvls[idx] = 'CRIT'
+
+    lgrs = [
+        LOG_RECORD(srv_ts=base_ts + i * 100, client_ts=base_ts + i * 100 - 50, lvl=lvls[i],
+                   session_id=sessions[i * len(sessions) // num_records], lineno=rnd.randint(1, 2000),
+                   filename='server_init.py', funcname='webapp_init', pid=4242, pname='MainProcess',
+                   tid=140212345678912, tname='MainThread', msg=msgs[i]) for i in range(num_records)
+    ]
+
+    scan_starts = [base_ts + int(rnd.random() * (num_records - 10000) * 100) for _ in range(num_queries)]
+    queries = {
+        'full scan': [LGR_QUERY(lgrp='bench', limit=num_records)],
+        '1 sec range, limit 100': [
+            LGR_QUERY(lgrp='bench', srv_ts_min=st, srv_ts_max=st + 1000000) for st in scan_starts
+        ],
+        'lvl_min CRIT': [LGR_QUERY(lgrp='bench', lvl_min='CRIT', limit=num_records)],
+        'session': [LGR_QUERY(lgrp='bench', session_id=rnd.choice(sessions), limit=num_records) for _ in range(10)],
+    }
+
+    tmp_dirname = tempfile.mkdtemp(prefix="l6sk_seg_bench_")
+    try:
+        lgrp = SegmentLogGroup('bench', tmp_dirname, segment_size=4 * 1024 * 1024, sync_appends=False)
+        for batch_start in range(0, num_records, 500):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + 500])
+
+        def run():
+            sizes = [os.stat(os.path.join(tmp_dirname, f)).st_blocks * 512 for f in os.listdir(tmp_dirname)]
+            times = {}
+            for name, query_list in queries.items():
+                start_time = time.perf_counter()
+                for query in query_list:
+                    lgrp.query_lgrs(query)
+                times[name] = (time.perf_counter() - start_time) / len(query_list) * 1000
+            return sum(sizes) / num_records, times
+
+        seg_results = run()
+
+        start_time = time.perf_counter()
+        num_archived = lgrp.archive_segments(get_srv_ts_usec())
+        archive_t = time.perf_counter() - start_time
+
+        stats_before = lgrp.get_scan_stats()
+        arc_results = run()
+        stats = collections.Counter(lgrp.get_scan_stats())
+        stats.subtract(stats_before)
+        lgrp.close()
+    finally:
+        shutil.rmtree(tmp_dirname)
+
+    print(f"archived {num_archived} segments, {num_records / archive_t:,.0f} records per second")
+    print(f"{'':28}{'segments':>14}{'archives':>14}")
+    print(f"{'disk bytes per row':28}{seg_results[0]:>14.1f}{arc_results[0]:>14.1f}")
+    for name in queries:
+        print(f"{name + ' (ms)':28}{seg_results[1][name]:>14.2f}{arc_results[1][name]:>14.2f}")
+    print(f"archive chunks decompressed: {stats['blocks_scanned']:,} of {stats['blocks']:,} over all queries")
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================================
+def main():
+    _dbg_bench_ingest_scan()
+    _dbg_bench_session_lookup()
+    _dbg_bench_archive()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,394 @@
+""" sqlite_archive.py
+Hot/cold tiering for the disk DAO. A log group's db (lgrp_<name>.db) is the hot tier, it takes every insert. Once
+all of a time partition (srv_ts range, ie a day) is older than the archive age, its records are moved out to an
+archive db of their own:
+    lgrp_<name>.arc_<partition start>_<partition end>_<max lrid>.db
+Archive dbs have the same schema. Their msgs are all compressed (w/ a dictionary trained on the archive itself), they
+are VACUUMed, and then never written again (file mode is read-only). The hot db stays small (freed pages are reused
+by new inserts) and history is still there.
+
+Queries go to the hot db and to every archive whose partition overlaps the query's srv_ts range. Results are merged
+in (srv_ts, lrid) order. lrids are kept when records move, so a record that is briefly in both tiers (a move is in
+progress) comes back once.
+
+Moving a partition: copy to <archive>.tmp (one transaction, inside sqlite), compress (and full text index, if the
+hot db has one) and vacuum the copy, rename it into place, then delete the copied records from the hot db in small
+batches. A crash before the rename leaves a .tmp to clean up, a crash after it leaves records in both tiers, the
+delete is re-done on the next run.
+"""
+
+import os
+import sys
+import time
+import stat
+import heapq
+import pathlib
+import itertools
+import sqlite3
+
+from l6sk.dbl.dbl_api import LGR_QUERY, LGR_APPEND_ARGS, get_query_srv_ts_min
+from l6sk.dbl.sqlite_lgrp import SqliteLogGroup, SQLITE_LGR_FIELDS, LGRP_SCHEMA_VERSION
+from l6sk.dbl.sqlite_lgrp import copy_lgrs_to_attached, delete_lgrs, has_fts_index
+
+from l6sk import log_util as log
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ Constants
+# log group names cant have '.' in them, so this never shows up in a hot db's file name.
+_ARC_INFIX = ".arc_"
+_ARC_SUFFIX = ".db"
+_TMP_SUFFIX = ".tmp"
+
+# how long the archiving connection waits on the hot db's writer (the DBL worker) before giving up on a batch.
+_HOT_DB_TIMEOUT = 30.0
+
+
+def get_hot_filename(dirname: str, lgrp: str) -> str:
+    return os.path.join(dirname, f"lgrp_{lgrp}.db")
+
+
+def get_archive_filename(dirname: str, lgrp: str, p_start: int, p_end: int, max_lrid: int) -> str:
+    return os.path.join(dirname, f"lgrp_{lgrp}{_ARC_INFIX}{p_start:020d}_{p_end:020d}_{max_lrid:020d}{_ARC_SUFFIX}")
+
+
+def list_hot_lgrps(dirname: str) -> list:
+    """ Names of the log groups that have a hot db in dirname. """
+
+    return sorted(fname[len("lgrp_"):-len(".db")] for fname in os.listdir(dirname)
+                  if fname.startswith("lgrp_") and fname.endswith(".db") and '.' not in fname[:-len(".db")])
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ========================================================================================================= LgrpArchive
+class LgrpArchive:
+    """ One archive db. store is a SqliteLogGroup on a read-only connection to it. That connection may be used from
+    any thread (the db never changes), reader threads can also open their own w/ store.prepare_conn(). """
+
+    def __init__(self, filename: str, lgrp: str, p_start: int, p_end: int, max_lrid: int):
+        super().__init__()
+
+        self.filename = filename
+        self.p_start = p_start
+        self.p_end = p_end
+        self.max_lrid = max_lrid
+
+        db_uri = pathlib.Path(filename).resolve().as_uri() + "?mode=ro"
+        conn = sqlite3.connect(db_uri, uri=True, isolation_level=None, check_same_thread=False)
+        self.store = SqliteLogGroup(lgrp, conn, read_only=True)
+
+    def overlaps(self, srv_ts_min, srv_ts_max) -> bool:
+        """ Could the archive have records in [srv_ts_min, srv_ts_max]? (None means unbounded) """
+
+        if (srv_ts_min is not None) and (self.p_end <= srv_ts_min):
+            return False
+
+        if (srv_ts_max is not None) and (self.p_start > srv_ts_max):
+            return False
+
+        return True
+
+    def close(self):
+        self.store.conn.close()
+
+
+def find_archives(dirname: str, lgrp: str) -> list:
+    """ Open lgrp's archive dbs in dirname, sorted by partition start. Leftover .tmp files are deleted. """
+
+    prefix = f"lgrp_{lgrp}{_ARC_INFIX}"
+    archives = []
+
+    for fname in os.listdir(dirname):
+        if not fname.startswith(prefix):
+            continue
+
+        if fname.endswith(_TMP_SUFFIX):
+            log.warn(f"Deleting unfinished log group archive: {fname}")
+            os.remove(os.path.join(dirname, fname))
+            continue
+
+        # sqlite's journal files, ie a -journal left from a crash while writing the .tmp
+        if not fname.endswith(_ARC_SUFFIX):
+            continue
+
+        p_start, p_end, max_lrid = (int(part) for part in fname[len(prefix):-len(_ARC_SUFFIX)].split('_'))
+        archives.append(LgrpArchive(os.path.join(dirname, fname), lgrp, p_start, p_end, max_lrid))
+
+    archives.sort(key=lambda arc: (arc.p_start, arc.max_lrid))
+
+    return archives
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ archiving
+def _archive_partition(hot_conn: sqlite3.Connection, dirname: str, lgrp: str, p_start: int, p_end: int,
+                       add_archive) -> bool:
+    """ Move the records in [p_start, p_end) out of the hot db (hot_conn) into a new archive db. The new LgrpArchive
+    is handed to add_archive() before anything is deleted from the hot db, so queries never miss a record.
+    Return False if there was nothing to move. """
+
+    tmp_filename = get_archive_filename(dirname, lgrp, p_start, p_end, 0) + _TMP_SUFFIX
+
+    if os.path.exists(tmp_filename):
+        os.remove(tmp_filename)
+
+    # create the schema, then copy inside sqlite.
+    arc_conn = sqlite3.connect(tmp_filename, isolation_level=None)
+    SqliteLogGroup(lgrp, arc_conn, rollups=False, session_summaries=False, templates=False)
+    arc_conn.close()
+
+    hot_conn.execute("ATTACH DATABASE ? AS arc;", (tmp_filename, ))
+    try:
+        max_lrid = copy_lgrs_to_attached(hot_conn, 'arc', p_start, p_end)
+    finally:
+        hot_conn.execute("DETACH DATABASE arc;")
+
+    if max_lrid is None:
+        os.remove(tmp_filename)
+        return False
+
+    arc_conn = sqlite3.connect(tmp_filename, isolation_level=None)
+    try:
+        arc_store = SqliteLogGroup(lgrp, arc_conn, rollups=False, session_summaries=False, templates=False)
+        num_compressed = arc_store.compress_msgs()
+
+        # archives of a log group w/ a full text index get one of their own, whole. (the hot one might be behind)
+        if has_fts_index(hot_conn):
+            arc_store.rebuild_fts()
+
+        arc_conn.execute("VACUUM;")
+    finally:
+        arc_conn.close()
+
+    arc_filename = get_archive_filename(dirname, lgrp, p_start, p_end, max_lrid)
+    os.chmod(tmp_filename, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    os.replace(tmp_filename, arc_filename)
+
+    add_archive(LgrpArchive(arc_filename, lgrp, p_start, p_end, max_lrid))
+
+    num_deleted = delete_lgrs(hot_conn, p_start, p_end, max_lrid)
+    log.dbg(f"Archived {num_deleted} records ({num_compressed} msgs compressed) to: {arc_filename}")
+
+    return True
+
+
+def archive_lgrp(dirname: str, lgrp: str, archives: list, archive_before: int, partition_usec: int,
+                 add_archive) -> int:
+    """ Move every partition (srv_ts ranges of partition_usec, aligned to the epoch) that ends at or before
+    archive_before out of lgrp's hot db. archives are lgrp's current archives, deletes they didnt get to finish are
+    finished first. New archives are handed to add_archive(arc) as soon as they are in place. Return how many there
+    were. Uses its own connection to the hot db, meant to run on a thread of its own while the DBL worker keeps
+    writing. """
+
+    hot_conn = sqlite3.connect(get_hot_filename(dirname, lgrp), isolation_level=None, timeout=_HOT_DB_TIMEOUT)
+    num_archived = 0
+
+    try:
+        # the copy assumes both dbs are the current schema. The DAO migrates a hot db the first time it opens it.
+        if hot_conn.execute("PRAGMA user_version;").fetchone()[0] != LGRP_SCHEMA_VERSION:
+            log.dbg(f"Not archiving log group: {lgrp}, its db is not at the current schema version yet.")
+            return num_archived
+
+        for arc in archives:
+            num_deleted = delete_lgrs(hot_conn, arc.p_start, arc.p_end, arc.max_lrid)
+            if num_deleted:
+                log.warn(f"Deleted {num_deleted} already archived records from log group: {lgrp}")
+
+        while True:
+            min_srv_ts = hot_conn.execute("SELECT min(srv_ts) FROM log_record;").fetchone()[0]
+            if min_srv_ts is None:
+                break
+
+            p_start = min_srv_ts - (min_srv_ts % partition_usec)
+            p_end = p_start + partition_usec
+
+            if p_end > archive_before:
+                break
+
+            if _archive_partition(hot_conn, dirname, lgrp, p_start, p_end, add_archive):
+                num_archived += 1
+    finally:
+        hot_conn.close()
+
+    return num_archived
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================== queries
+def _merge_lgrs(lgrs_a: list, lgrs_b: list, limit: int) -> list:
+    """ Merge two (srv_ts, lrid) ordered lists of rows, drop duplicates (same record from two tiers), keep limit.
+    (None means all) """
+
+    result = []
+    last_lrid = None
+
+    for row in heapq.merge(lgrs_a, lgrs_b, key=lambda row: (row[1], row[0])):
+        if row[0] == last_lrid:
+            continue
+
+        result.append(row)
+        last_lrid = row[0]
+
+        if (limit is not None) and (len(result) >= limit):
+            break
+
+    return result
+
+
+def query_tiers(query: LGR_QUERY, hot_query_fn, archives: list, arc_query_fn) -> dict:
+    """ Run query on the hot db and the archives that could have matches, merge the results. Same result format as
+    SqliteLogGroup.query_lgrs().
+    hot_query_fn(query) and arc_query_fn(arc, query) run the query on the hot db / an archive.
+    Archives go in partition order, and we stop once limit records are in hand and the next partition starts after
+    the last of them. (ie the usual "latest 100 from this morning" touches no archives at all) """
+
+    lgrs = hot_query_fn(query)['lgrs']
+
+    for arc in archives:
+        if not arc.overlaps(get_query_srv_ts_min(query), query.srv_ts_max):
+            continue
+
+        if (query.limit is not None) and len(lgrs) >= query.limit and arc.p_start > lgrs[-1][1]:
+            break
+
+        lgrs = _merge_lgrs(lgrs, arc_query_fn(arc, query)['lgrs'], query.limit)
+
+    return {'fields': SQLITE_LGR_FIELDS, 'lgrs': lgrs}
+
+
+def iter_tiers(query: LGR_QUERY, hot_iter_fn, get_archives, arc_iter_fn, chunk_size: int):
+    """ query_tiers() a chunk (list of upto chunk_size rows) at a time, for exports. (see SqliteLogGroup.iter_lgrs())
+    hot_iter_fn() and arc_iter_fn(arc) return the iter_lgrs() generator of the hot db / an archive. get_archives() is
+    called once the hot db's read has started, ie its snapshot is taken. An archive made before that is in the list,
+    one made after it has records the snapshot still has too, those come out once. Every tier is read at the same
+    time (a statement each), rows are merged as they come. """
+
+    hot_chunks = hot_iter_fn()
+    first_chunk = next(hot_chunks, [])
+
+    archives = [arc for arc in get_archives() if arc.overlaps(get_query_srv_ts_min(query), query.srv_ts_max)]
+    tier_chunks = [hot_chunks] + [arc_iter_fn(arc) for arc in archives]
+    tier_rows = [itertools.chain(first_chunk, itertools.chain.from_iterable(hot_chunks))]
+    tier_rows += [itertools.chain.from_iterable(chunks) for chunks in tier_chunks[1:]]
+
+    try:
+        chunk = []
+        last_lrid = None
+        num_rows = 0
+
+        for row in heapq.merge(*tier_rows, key=lambda row: (row[1], row[0])):
+            if row[0] == last_lrid:
+                continue
+
+            chunk.append(row)
+            last_lrid = row[0]
+            num_rows += 1
+
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+
+            if (query.limit is not None) and (num_rows >= query.limit):
+                break
+
+        if chunk:
+            yield chunk
+    finally:
+        for chunks in tier_chunks:
+            chunks.close()
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_bench_tiering(num_days=10, records_per_day=40 * 1000, hot_days=2, num_queries=50):
+    """ num_days of records in a disk DAO log group, all hot vs everything but the last hot_days archived. Prints disk
+    size of each tier and query times for the latest records, a random hour of history, and a full history scan. """
+
+    import random  # pylint: disable=import-outside-toplevel
+    import shutil  # pylint: disable=import-outside-toplevel
+    import tempfile  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dbl_api import LOG_RECORD  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.dao_sqlite_disk import DAO_SQLITE  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.msg_codec import _dbg_mk_sample_msgs  # pylint: disable=import-outside-toplevel
+
+    num_records = num_days * records_per_day
+    print(f"Benchmarking hot/cold tiering w/ {num_days} days of {records_per_day:,} records ...")
+
+    rnd = random.Random(1655)
+    day_usec = 24 * 3600 * 1000000
+    base_ts = (int(time.time() * 1000000) // day_usec - num_days + 1) * day_usec
+    step = day_usec // records_per_day
+    msgs = _dbg_mk_sample_msgs(num_records)
+
+    lgrs = [
+        LOG_RECORD(srv_ts=base_ts + i * step, lvl=rnd.choice(['DBUG', 'INFO', 'WARN', 'ERRR']),
+                   session_id=f"sess_{i // 5000}", lineno=rnd.randint(1, 2000), filename='server_init.py',
+                   funcname='webapp_init', pid=4242, tid=140212345678912, msg=msgs[i]) for i in range(num_records)
+    ]
+
+    hour_starts = [base_ts + rnd.randrange(num_days * 24 - 1) * 3600 * 1000000 for _ in range(num_queries)]
+    queries = {
+        'latest 100': [LGR_QUERY(lgrp='bench', srv_ts_min=base_ts + (num_days - 1) * day_usec)] * num_queries,
+        'random hour, limit 100': [
+            LGR_QUERY(lgrp='bench', srv_ts_min=st, srv_ts_max=st + 3600 * 1000000) for st in hour_starts
+        ],
+        'full history': [LGR_QUERY(lgrp='bench', limit=num_records)],
+    }
+
+    def file_sizes(dirname):
+        hot = sum(os.path.getsize(os.path.join(dirname, f)) for f in os.listdir(dirname) if _ARC_INFIX not in f)
+        cold = sum(os.path.getsize(os.path.join(dirname, f)) for f in os.listdir(dirname) if _ARC_INFIX in f)
+        return hot, cold
+
+    results = {}
+    for tiered in (False, True):
+        tmp_dirname = tempfile.mkdtemp(prefix="l6sk_tier_bench_")
+        try:
+            dao = DAO_SQLITE(db_filename=os.path.join(tmp_dirname, 'l6sk.db'), num_readers=0,
+                             archive_after=hot_days * 24 * 3600.0 if tiered else None)
+            for batch_start in range(0, num_records, 1000):
+                dao.append_lgrs(LGR_APPEND_ARGS(lgrp='bench', lgrs=lgrs[batch_start:batch_start + 1000]))
+
+            archive_t = None
+            if tiered:
+                start_time = time.perf_counter()
+                dao.archive_lgrps()
+                archive_t = time.perf_counter() - start_time
+
+                # the hot db keeps its freed pages for new inserts, show what it would be after a vacuum.
+                dao._get_lgrp('bench').conn.execute("VACUUM;")  # pylint: disable=protected-access
+
+            dao._get_lgrp('bench').conn.execute("PRAGMA wal_checkpoint(TRUNCATE);")  # pylint: disable=protected-access
+
+            times = {}
+            for name, query_list in queries.items():
+                start_time = time.perf_counter()
+                for query in query_list:
+                    assert dao.query_lgrs(query)['lgrs']
+                times[name] = (time.perf_counter() - start_time) / len(query_list) * 1000
+
+            results[tiered] = (file_sizes(tmp_dirname), times, archive_t)
+        finally:
+            shutil.rmtree(tmp_dirname)
+
+    print(f"archived {num_days - hot_days} days in {results[True][2]:.1f} seconds")
+    print(f"{'':28}{'all hot':>14}{'tiered':>14}")
+    print(f"{'hot db MB':28}{results[False][0][0] / 2**20:>14.1f}{results[True][0][0] / 2**20:>14.1f}")
+    print(f"{'archive dbs MB':28}{results[False][0][1] / 2**20:>14.1f}{results[True][0][1] / 2**20:>14.1f}")
+    for name in queries:
+        print(f"{name + ' (ms)':28}{results[False][1][name]:>14.2f}{results[True][1][name]:>14.2f}")
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================================
+def main():
+    _dbg_bench_tiering()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,2376 @@
+""" sqlite_lgrp.py
+sqlite3 storage for a single log group. Both sqlite DAOs (memory and disk) hold one SqliteLogGroup per log group,
+and route the log record operations of DBL_API to it. The DAO owns the connection life cycle, this module owns
+the log_record schema and the SQL.
+"""
+
+import os
+import sys
+import time
+import random
+import sqlite3
+import threading
+import dataclasses
+import collections
+
+from l6sk.dbl.dbl_api import LOG_RECORD, LGR_QUERY, LGR_FIELDS, LGR_REPEAT_FIELDS, LGR_SAMPLE_FIELDS, LGR_LVL_CODES
+from l6sk.dbl.dbl_api import LGR_LVL_NAMES, LGR_HISTOGRAM, LGR_HISTOGRAM_FIELDS, LGR_SESSION_DIFF
+from l6sk.dbl.dbl_api import LGR_SESSION_DIFF_FIELDS, LGR_TEMPLATE_FIELDS, LGR_TEMPLATE_TOP, LGR_TEMPLATE_TOP_FIELDS
+from l6sk.dbl.dbl_api import LgrQueryError, get_srv_ts_usec, get_query_lvl_codes
+from l6sk.dbl.msg_codec import MsgZDictCodec, train_zdict
+from l6sk.dbl.lgr_regex import REGEX_MAX_LEN, PatternCache, register_regexp, regex_deadline, get_query_regexes
+from l6sk.dbl.lgr_regex import get_literal_regex
+from l6sk.dbl.heavy_hitters import space_saving_add, get_min_count
+from l6sk.dbl.lgr_templates import get_msg_template
+from l6sk.dbl.lgr_rollups import ensure_rollups, update_rollups, query_histogram
+
+from l6sk import log_util as log
+
+# ======================================================================================================================
+# ======================================================================================================================
+# =============================================================================================================== Schema
+# Timestamps are unix time in INTEGER micro seconds (srv_ts used to be TEXT w/ strftime('%s') i.e. second precision).
+# lvl is a small INTEGER code (see LGR_LVL_CODES), lineno, pid, tid are INTEGERs. sqlite stores small ints in 1-2 bytes
+# and 8 byte ints for timestamps which is about half of what the TEXT form of a float ts would take. Plus integer
+# comparisons on range scans instead of text collation.
+#
+# Caller metadata that repeats on almost every row (session id, filename, funcname, process/thread names) is
+# dictionary encoded. Each one gets a dimension table (lgr_dim_<name>) and log_record only keeps an integer
+# surrogate key (<name>_ref). SqliteLogGroup keeps these in memory so neither inserts nor reads have to look them up.
+#
+# msg can optionally be compressed (per log group) w/ a zlib preset dictionary trained on the group's own msgs.
+# Compressed msgs are BLOBs w/ msg_dver set to the lgr_msg_zdict version they need, plain msgs have msg_dver NULL.
+#
+# Schema version is kept in "PRAGMA user_version". Versions:
+#   0: the original TEXT schema (ndx/sqlite_table_design.ipynb), or an empty db
+#   1: INTEGER ts, lvl codes, INTEGER lineno/pid/tid
+#   2: dictionary encoded caller metadata
+#   3: msg compression (msg_dver, lgr_msg_zdict)
+#   4: (session_id_ref, srv_ts) index for session queries
+#   5: lgr_journal_seq, the last ingest journal entry applied to the group (see ingest_journal.py)
+#   6: repeat_count, last_srv_ts for repeated records collapsed at ingest (see SqliteLogGroup repeat_window)
+#   7: sample_rate of records kept by ingest sampling (see lgr_sampler.py)
+#   8: template_id of the msg's template (see lgr_templates.py), w/ a (template_id, srv_ts) index
+# The full text index (_FTS_SCHEMA_SCRIPT), the rollups (lgr_rollups.py), the session summaries (_SUMMARY_SCHEMA_SQL)
+# and the template counts (_TEMPLATE_SCHEMA_SCRIPT) arent versioned, they are only there for log groups that have them
+# on.
+LGRP_SCHEMA_VERSION = 8
+
+# dictionary encoded fields. value -> lgr_dim_<field>.id, stored in log_record.<field>_ref
+LGR_DIMS = ('session_id', 'filename', 'funcname', 'pname', 'tname')
+
+_LGR_DIM_SCHEMA_SCRIPT = "".join(
+    f"CREATE TABLE IF NOT EXISTS lgr_dim_{dim}(id INTEGER PRIMARY KEY NOT NULL, val TEXT NOT NULL UNIQUE);\n"
+    for dim in LGR_DIMS)
+
+# srv_ts default is here just as a back stop. DAO always sets srv_ts. julianday() has milli second precision.
+LOG_RECORD_SCHEMA_SCRIPT = _LGR_DIM_SCHEMA_SCRIPT + """
+CREATE TABLE IF NOT EXISTS log_record(
+
+    lrid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+
+    -- level code. 10 DBUG, 20 INFO, 30 WARN, 40 ERRR, 50 CRIT. NULL is allowed (ie fifo_2_l6sk)
+    lvl INTEGER,
+
+    subsys TEXT,
+
+    -- lgr_dim_session_id.id
+    session_id_ref INTEGER,
+
+    -- unix time in micro seconds
+    srv_ts INTEGER NOT NULL DEFAULT (CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER)),
+
+    -- client generated could be null. unix time in micro seconds
+    client_ts INTEGER,
+
+    -- caller info, mostly optional, depends on client info gathering abilities. *_ref are lgr_dim_*.id
+    lineno INTEGER,
+    filename_ref INTEGER,
+    funcname_ref INTEGER,
+    pid INTEGER,
+    pname_ref INTEGER,
+    tid INTEGER,
+    tname_ref INTEGER,
+
+    -- actual log msg. in case of fifo middleman, then this is a line of output.
+    -- TEXT, or a compressed BLOB if msg_dver is not NULL.
+    msg,
+
+    -- lgr_msg_zdict.dver msg was compressed with, NULL for plain msgs.
+    msg_dver INTEGER,
+
+    -- identical records that came right after this one (same session) and were collapsed into it at ingest.
+    -- repeat_count counts this one too, last_srv_ts is the srv_ts of the last repeat. NULL if it was never repeated.
+    repeat_count INTEGER,
+    last_srv_ts INTEGER,
+
+    -- the probability ingest sampling kept this record with. NULL if it wasnt sampled, ie 1.0
+    sample_rate REAL,
+
+    -- lgr_templates.get_template_id() of msg's template. NULL for records w/o a msg, or appended w/ templates off.
+    template_id INTEGER,
+
+    CHECK (lvl IS NULL OR lvl IN (10, 20, 30, 40, 50))
+);
+
+CREATE INDEX IF NOT EXISTS log_record_srv_ts_idx ON log_record(srv_ts);
+CREATE INDEX IF NOT EXISTS log_record_lvl_srv_ts_idx ON log_record(lvl, srv_ts);
+CREATE INDEX IF NOT EXISTS log_record_session_srv_ts_idx ON log_record(session_id_ref, srv_ts);
+CREATE INDEX IF NOT EXISTS log_record_template_srv_ts_idx ON log_record(template_id, srv_ts)
+    WHERE template_id IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS lgr_msg_zdict(
+    dver INTEGER PRIMARY KEY NOT NULL,
+    zdict BLOB NOT NULL,
+    -- the dict was trained on msgs upto (and including) this lrid.
+    trained_at_lrid INTEGER NOT NULL,
+    created_ts INTEGER NOT NULL
+);
+
+-- single row. seq of the last ingest journal entry appended to this group, updated in the same transaction as the
+-- rows. so a journal replay can skip what is already here.
+CREATE TABLE IF NOT EXISTS lgr_journal_seq(
+    id INTEGER PRIMARY KEY NOT NULL CHECK (id = 0),
+    seq INTEGER NOT NULL
+);
+"""
+
+# Full text index on msg (SqliteLogGroup fts). An FTS5 external content index, the content table is a view that
+# decodes msgs w/ lgr_msg() (see prepare_conn()), msgs might be compressed. sqlite only reads the view for 'rebuild'
+# and 'integrity-check', never on inserts or MATCH. Rows are put in the index by SqliteLogGroup (no triggers, the
+# decoding is in python anyway) and taken out by delete_lgrs(). Every record w/ lrid <= lgr_fts_seq.lrid is indexed,
+# the ones after it are not yet.
+_FTS_SCHEMA_SCRIPT = """
+CREATE VIEW IF NOT EXISTS lgr_fts_src AS SELECT lrid, lgr_msg(msg, msg_dver) AS msg FROM log_record;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS lgr_fts USING fts5(msg, content='lgr_fts_src', content_rowid='lrid');
+
+CREATE TABLE IF NOT EXISTS lgr_fts_seq(
+    id INTEGER PRIMARY KEY NOT NULL CHECK (id = 0),
+    lrid INTEGER NOT NULL
+);
+"""
+
+_FTS_MODES = (None, 'sync', 'deferred')
+
+# Per session summaries (SqliteLogGroup session_summaries). For every session: first/last srv_ts and record count,
+# counts by level and by file, and its most frequent msgs, kept up to date by append_lgrs() in the same transaction as
+# the records. Comparing two sessions (diff_sessions()) reads these, never log_record. Files are lgr_dim_filename ids,
+# 0 for records w/o a filename. Msgs are counted w/ Space-Saving (heavy_hitters.py), session_top_msgs counters per
+# session, a msg's true count is in [count - err, count]. Only the first _SESSION_MSG_LEN chars of a msg count, ie a
+# long msg that differs at the end counts as the same. Summaries stay in the hot db when records are archived.
+_SUMMARY_SCHEMA_SQL = [
+    """CREATE TABLE IF NOT EXISTS lgr_session_summary(
+    -- lgr_dim_session_id.id
+    session_id_ref INTEGER PRIMARY KEY NOT NULL,
+    first_srv_ts INTEGER NOT NULL,
+    last_srv_ts INTEGER NOT NULL,
+    -- records appended, repeats collapsed into another row each count.
+    count INTEGER NOT NULL
+);""",
+    """CREATE TABLE IF NOT EXISTS lgr_session_lvl(
+    session_id_ref INTEGER NOT NULL,
+    -- 0 for records w/o a level
+    lvl INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (session_id_ref, lvl)
+) WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS lgr_session_file(
+    session_id_ref INTEGER NOT NULL,
+    filename_ref INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    PRIMARY KEY (session_id_ref, filename_ref)
+) WITHOUT ROWID;""",
+    """CREATE TABLE IF NOT EXISTS lgr_session_msg(
+    session_id_ref INTEGER NOT NULL,
+    msg TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    err INTEGER NOT NULL,
+    PRIMARY KEY (session_id_ref, msg)
+) WITHOUT ROWID;""",
+]
+
+_SESSION_MSG_LEN = 200
+
+_UPSERT_SESSION_SQL = """
+INSERT INTO lgr_session_summary(session_id_ref, first_srv_ts, last_srv_ts, count) VALUES (?, ?, ?, ?)
+ON CONFLICT(session_id_ref) DO UPDATE SET first_srv_ts = min(first_srv_ts, excluded.first_srv_ts),
+                                          last_srv_ts = max(last_srv_ts, excluded.last_srv_ts),
+                                          count = count + excluded.count;
+"""
+
+_UPSERT_SESSION_LVL_SQL = """
+INSERT INTO lgr_session_lvl(session_id_ref, lvl, count) VALUES (?, ?, ?)
+ON CONFLICT(session_id_ref, lvl) DO UPDATE SET count = count + excluded.count;
+"""
+
+_UPSERT_SESSION_FILE_SQL = """
+INSERT INTO lgr_session_file(session_id_ref, filename_ref, count) VALUES (?, ?, ?)
+ON CONFLICT(session_id_ref, filename_ref) DO UPDATE SET count = count + excluded.count;
+"""
+
+# summaries for the records already there when a group gets them. Msg counts are exact then, the top
+# session_top_msgs of each session are kept w/ err 0. A repeat run counts repeat_count times.
+_BACKFILL_SUMMARY_SQL = [
+    """INSERT INTO lgr_session_summary(session_id_ref, first_srv_ts, last_srv_ts, count)
+       SELECT session_id_ref, min(srv_ts), max(coalesce(last_srv_ts, srv_ts)), sum(coalesce(repeat_count, 1))
+       FROM log_record WHERE session_id_ref IS NOT NULL GROUP BY 1;""",
+    """INSERT INTO lgr_session_lvl(session_id_ref, lvl, count)
+       SELECT session_id_ref, coalesce(lvl, 0), sum(coalesce(repeat_count, 1))
+       FROM log_record WHERE session_id_ref IS NOT NULL GROUP BY 1, 2;""",
+    """INSERT INTO lgr_session_file(session_id_ref, filename_ref, count)
+       SELECT session_id_ref, coalesce(filename_ref, 0), sum(coalesce(repeat_count, 1))
+       FROM log_record WHERE session_id_ref IS NOT NULL GROUP BY 1, 2;""",
+    f"""INSERT INTO lgr_session_msg(session_id_ref, msg, count, err)
+        SELECT session_id_ref, msg, count, 0 FROM (
+            SELECT session_id_ref, msg, count,
+                   row_number() OVER (PARTITION BY session_id_ref ORDER BY count DESC, msg) AS msg_rank
+            FROM (SELECT session_id_ref, substr(CAST(lgr_msg(msg, msg_dver) AS TEXT), 1, {_SESSION_MSG_LEN}) AS msg,
+                         sum(coalesce(repeat_count, 1)) AS count
+                  FROM log_record WHERE session_id_ref IS NOT NULL AND msg IS NOT NULL GROUP BY 1, 2))
+        WHERE msg_rank <= {{top_msgs}};""",
+]
+
+# Msg templates (SqliteLogGroup templates). Counts of the most frequent templates per hour, w/ Space-Saving
+# (heavy_hitters.py), template_top_k counters per hour. Kept up to date by append_lgrs() in the same transaction as the
+# records, and deleted after template_retention. lgr_template has the text of every template that got a counter. Only
+# records appended since the group got templates are counted. Both stay in the hot db when records are archived.
+_TEMPLATE_SCHEMA_SCRIPT = """
+CREATE TABLE IF NOT EXISTS lgr_template(
+    -- lgr_templates.get_template_id() of template
+    id INTEGER PRIMARY KEY NOT NULL,
+    template TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS lgr_template_top(
+    -- start of the hour, unix time in micro seconds
+    bucket_ts INTEGER NOT NULL,
+    template_id INTEGER NOT NULL,
+    -- records counted for it, its true count is in [count - err, count]
+    count INTEGER NOT NULL,
+    err INTEGER NOT NULL,
+    PRIMARY KEY (bucket_ts, template_id)
+) WITHOUT ROWID;
+"""
+
+_INSERT_FTS_SQL = "INSERT INTO lgr_fts(rowid, msg) VALUES (?, ?);"
+_UPDATE_FTS_SEQ_SQL = "INSERT OR REPLACE INTO lgr_fts_seq(id, lrid) VALUES (0, ?);"
+
+# schema version 1. caller metadata inline as TEXT. Only kept around for migration and benchmarks.
+_V1_LOG_RECORD_SCHEMA_SCRIPT = """
+CREATE TABLE IF NOT EXISTS log_record(
+    lrid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    lvl INTEGER,
+    subsys TEXT,
+    session_id TEXT,
+    srv_ts INTEGER NOT NULL DEFAULT (CAST((julianday('now') - 2440587.5) * 86400000000 AS INTEGER)),
+    client_ts INTEGER,
+    lineno INTEGER,
+    filename TEXT,
+    funcname TEXT,
+    pid INTEGER,
+    pname TEXT,
+    tid INTEGER,
+    tname TEXT,
+    msg TEXT,
+    CHECK (lvl IS NULL OR lvl IN (10, 20, 30, 40, 50))
+);
+
+CREATE INDEX IF NOT EXISTS log_record_srv_ts_idx ON log_record(srv_ts);
+CREATE INDEX IF NOT EXISTS log_record_lvl_srv_ts_idx ON log_record(lvl, srv_ts);
+"""
+
+# The old TEXT based schema (see ndx/sqlite_table_design.ipynb). Only kept around for migration and benchmarks.
+LEGACY_LOG_RECORD_SCHEMA_SCRIPT = """
+CREATE TABLE IF NOT EXISTS log_record(
+    lrid INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL,
+    lvl TEXT,
+    session_id TEXT,
+    srv_ts TEXT NOT NULL DEFAULT(strftime('%s','now')),
+    client_ts TEXT,
+    lineno TEXT,
+    filename TEXT,
+    funcname TEXT,
+    pid TEXT,
+    pname TEXT,
+    tid TEXT,
+    tname TEXT,
+    msg TEXT,
+    CHECK (lvl IS NULL OR lvl IN ('DBUG', 'INFO', 'WARN', 'ERRR', 'CRIT'))
+);
+"""
+
+# log_record columns backing LGR_FIELDS, same order.
+_LGR_COLUMNS = tuple(f"{field}_ref" if field in LGR_DIMS else field for field in LGR_FIELDS)
+
+# positions in LGR_FIELDS of the values that need decoding on the way out.
+_LVL_IDX = LGR_FIELDS.index('lvl')
+_MSG_IDX = LGR_FIELDS.index('msg')
+_DIM_IDXS = tuple((dim, LGR_FIELDS.index(dim)) for dim in LGR_DIMS)
+
+# what gets written and read back. msg_dver is only needed to decode msg, DBL users never see it.
+_INSERT_COLUMNS = _LGR_COLUMNS[1:] + LGR_REPEAT_FIELDS + LGR_SAMPLE_FIELDS + LGR_TEMPLATE_FIELDS + ('msg_dver', )
+_SELECT_COLUMNS = _LGR_COLUMNS + LGR_REPEAT_FIELDS + LGR_SAMPLE_FIELDS + LGR_TEMPLATE_FIELDS + ('msg_dver', )
+
+# what query results hold. the repeat, sample and template fields are after the usual ones, anything that zips rows w/
+# LGR_FIELDS still works.
+SQLITE_LGR_FIELDS = LGR_FIELDS + LGR_REPEAT_FIELDS + LGR_SAMPLE_FIELDS + LGR_TEMPLATE_FIELDS
+
+_SRV_TS_IDX = SQLITE_LGR_FIELDS.index('srv_ts')
+_REPEAT_COUNT_IDX = SQLITE_LGR_FIELDS.index('repeat_count')
+_LAST_SRV_TS_IDX = SQLITE_LGR_FIELDS.index('last_srv_ts')
+_SAMPLE_RATE_IDX = SQLITE_LGR_FIELDS.index('sample_rate')
+
+_INSERT_LGR_SQL = f"""
+INSERT INTO log_record({', '.join(_INSERT_COLUMNS)})
+VALUES ({', '.join('?' * len(_INSERT_COLUMNS))});
+"""
+
+# rows changed in place (repeat_count, last_srv_ts of a run that got more repeats) that are remembered for
+# get_changed_lrids(). A cached result older than that many changes is just thrown away.
+_ROW_CHANGES_KEPT = 4096
+
+# sqlite INTEGER is a signed 64 bit int.
+_INT64_MIN = -(2**63)
+_INT64_MAX = 2**63 - 1
+
+# text to int conversion for the legacy migration. Anything that doesnt round trip as an int (ie '', 'abc', '12.5')
+# is kept as is, sqlite will store it as TEXT in the INTEGER column rather than lose it.
+_LEGACY_INT_SQL = "CASE WHEN CAST(CAST({col} AS INTEGER) AS TEXT) = {col} THEN CAST({col} AS INTEGER) ELSE {col} END"
+_LEGACY_TS_SQL = "CAST(ROUND(CAST({col} AS REAL) * 1000000) AS INTEGER)"
+
+# version 0 (legacy TEXT) -> 1
+_MIGRATE_LEGACY_SQL = f"""
+INSERT INTO log_record(lrid, lvl, session_id, srv_ts, client_ts, lineno, filename, funcname, pid, pname, tid, tname,
+                       msg)
+SELECT lrid,
+       CASE lvl WHEN 'DBUG' THEN 10 WHEN 'INFO' THEN 20 WHEN 'WARN' THEN 30 WHEN 'ERRR' THEN 40 WHEN 'CRIT' THEN 50
+                ELSE NULL END,
+       session_id,
+       {_LEGACY_TS_SQL.format(col='srv_ts')},
+       CASE WHEN client_ts IS NULL OR client_ts = '' THEN NULL ELSE {_LEGACY_TS_SQL.format(col='client_ts')} END,
+       {_LEGACY_INT_SQL.format(col='lineno')},
+       filename,
+       funcname,
+       {_LEGACY_INT_SQL.format(col='pid')},
+       pname,
+       {_LEGACY_INT_SQL.format(col='tid')},
+       tname,
+       msg
+FROM log_record_prev;
+"""
+
+# version 1 -> 2. fill the dimension tables w/ the distinct values, then swap text for ids.
+_MIGRATE_V1_DIMS_SQL = [f"INSERT OR IGNORE INTO lgr_dim_{dim}(val) SELECT DISTINCT {dim} FROM log_record_prev "
+                        f"WHERE {dim} IS NOT NULL;" for dim in LGR_DIMS]
+
+_MIGRATE_V1_SELECT_COLS = [
+    f"(SELECT id FROM lgr_dim_{col} WHERE val = p.{col})" if col in LGR_DIMS else f"p.{col}" for col in LGR_FIELDS
+]
+
+_MIGRATE_V1_SQL = f"""
+INSERT INTO log_record({', '.join(_LGR_COLUMNS)})
+SELECT {', '.join(_MIGRATE_V1_SELECT_COLS)}
+FROM log_record_prev AS p;
+"""
+
+# Migrations that dont need a rebuild of log_record. version -> statements that take the db from version - 1 to it.
+# The rebuild migrations above land directly on the current schema, these only run for dbs that were already at 2+
+_ADDITIVE_MIGRATIONS = {
+    3: [
+        "ALTER TABLE log_record ADD COLUMN msg_dver INTEGER;",
+        LOG_RECORD_SCHEMA_SCRIPT[LOG_RECORD_SCHEMA_SCRIPT.index("CREATE TABLE IF NOT EXISTS lgr_msg_zdict"):],
+    ],
+    4: [
+        "CREATE INDEX IF NOT EXISTS log_record_session_srv_ts_idx ON log_record(session_id_ref, srv_ts);",
+    ],
+    5: [
+        LOG_RECORD_SCHEMA_SCRIPT[LOG_RECORD_SCHEMA_SCRIPT.index("CREATE TABLE IF NOT EXISTS lgr_journal_seq"):],
+    ],
+    6: [
+        "ALTER TABLE log_record ADD COLUMN repeat_count INTEGER;",
+        "ALTER TABLE log_record ADD COLUMN last_srv_ts INTEGER;",
+    ],
+    7: [
+        "ALTER TABLE log_record ADD COLUMN sample_rate REAL;",
+    ],
+    8: [
+        "ALTER TABLE log_record ADD COLUMN template_id INTEGER;",
+        "CREATE INDEX IF NOT EXISTS log_record_template_srv_ts_idx ON log_record(template_id, srv_ts) "
+        "WHERE template_id IS NOT NULL;",
+    ],
+}
+
+
+def _get_repeat_cols(run) -> tuple:
+    """ <repeat_count, last_srv_ts> to store for a run's row. NULLs for a record that wasnt repeated. """
+
+    if run.count == 1:
+        return None, None
+
+    return run.count, run.last_ts
+
+
+def _as_db_sample_rate(sample_rate):
+    """ Records that were kept for sure are stored w/ a NULL rate, it reads back as 1.0 """
+
+    if (sample_rate is None) or (sample_rate >= 1.0):
+        return None
+
+    return float(sample_rate)
+
+
+def _as_db_int(val):
+    """ Ints as ints, None as None. Values that can not be a sqlite INTEGER (non numeric or too big for int64, ie some
+    platform's thread ids) are kept as str rather than dropped. """
+
+    if val is None:
+        return None
+
+    try:
+        int_val = int(val)
+    except (TypeError, ValueError):
+        return str(val)
+
+    if (int_val < _INT64_MIN) or (int_val > _INT64_MAX):
+        return str(val)
+
+    return int_val
+
+
+class _RepeatRun:
+    """ The last record stored for a session, and how many identical ones were collapsed into it so far. """
+
+    __slots__ = ('key', 'first_ts', 'last_ts', 'count', 'lrid')
+
+    def __init__(self, key: tuple, first_ts: int, last_ts: int = None, count: int = 1, lrid: int = None):
+        self.key = key
+        self.first_ts = first_ts
+        self.last_ts = first_ts if last_ts is None else last_ts
+        self.count = count
+
+        # the row. None until its inserted.
+        self.lrid = lrid
+
+    def copy(self):
+        return _RepeatRun(self.key, self.first_ts, self.last_ts, self.count, self.lrid)
+
+
+class _SessionCounts:
+    """ One session's records in an append batch, counted up for its summary. """
+
+    __slots__ = ('first_ts', 'last_ts', 'count', 'lvls', 'files', 'msgs')
+
+    def __init__(self, srv_ts: int):
+        self.first_ts = srv_ts
+        self.last_ts = srv_ts
+        self.count = 0
+        self.lvls = collections.Counter()
+        self.files = collections.Counter()
+        self.msgs = collections.Counter()
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================= SqliteLogGroup
+class SqliteLogGroup:
+    """ One log group, stored in one sqlite database. Takes an open connection (autocommit i.e. isolation_level=None)
+    and makes sure the schema is there and up to date. The DAO that created the connection owns it.
+    read_only: the db is never written through this object (ie archive dbs on a mode=ro connection). The schema is
+    used as is, no migrations. Anything from version 4 on reads the same.
+    repeat_window: collapse repeated records at ingest. A record identical to the last one stored for its session
+    (lvl, filename, lineno, msg) and less than repeat_window seconds after it, is not stored, the stored one's
+    repeat_count and last_srv_ts are bumped instead. None means store everything. The last record of the
+    repeat_sessions most recently seen sessions is kept in memory for this. (a run that starts over after a restart
+    or an eviction only costs one more row)
+    fts: full text index on msg, for LGR_QUERY.msg_match. None means no index. 'sync': records are indexed in the same
+    transaction that appends them, a query sees them as soon as they are there. 'deferred': appends dont index,
+    index_fts() does (DBL_API.INDEX_FTS at LOW priority), fts_batch_size records at a time. Ingest doesnt pay for it,
+    msg_match misses records that arent indexed yet. Turning it on for a group that already has records indexes them
+    too, fts_batch_size at a time.
+    regex_max_len: longest LGR_QUERY msg_regex/filename_regex pattern accepted, in chars.
+    regex_timeout: seconds. Queries w/ a regex filter are interrupted (TimeoutError) after this long. None means no
+    limit.
+    rollups: keep per minute and per hour record counts by level, for histogram_lgrs(). Updated in the same transaction
+    as the records. Turning it on for a group that has records counts them too, records appended while it was off
+    (after it had been on) are left out. rollup_subsys: by subsystem too, histograms can filter and split on it.
+    Only counts records appended since it was on. rollup_minute_retention: seconds. Minute rollups older than this
+    are deleted, hour ones are kept. None means keep them all.
+    session_summaries: keep a summary of every session (first/last srv_ts, counts by level and file, top msgs) for
+    diff_sessions(). Updated in the same transaction as the records. Turning it on for a group that has records
+    summarizes them too, records appended while it was off (after it had been on) are left out. session_top_msgs:
+    msgs counted per session, the most frequent ones are kept.
+    templates: give every record the template id of its msg (see lgr_templates.py) for LGR_QUERY.template_id, and
+    count the most frequent templates per hour for top_templates(). Updated in the same transaction as the records.
+    Records appended before it was on have no template id, and arent counted. template_top_k: templates counted per
+    hour, the most frequent ones are kept. template_retention: seconds. Hour counts older than this are deleted. None
+    means keep them all. """
+
+    def __init__(self,
+                 lgrp: str,
+                 conn: sqlite3.Connection,
+                 msg_compression: bool = False,
+                 zdict_sample_size: int = 2000,
+                 zdict_retrain_every: int = 100 * 1000,
+                 repeat_window: float = None,
+                 repeat_sessions: int = 1024,
+                 fts: str = None,
+                 fts_batch_size: int = 5000,
+                 regex_max_len: int = REGEX_MAX_LEN,
+                 regex_timeout: float = 2.0,
+                 rollups: bool = True,
+                 rollup_subsys: bool = False,
+                 rollup_minute_retention: float = 7 * 24 * 3600.0,
+                 session_summaries: bool = True,
+                 session_top_msgs: int = 50,
+                 templates: bool = True,
+                 template_top_k: int = 100,
+                 template_retention: float = 30 * 24 * 3600.0,
+                 read_only: bool = False):
+        super().__init__()
+
+        if fts not in _FTS_MODES:
+            raise ValueError(f"Invalid fts mode: {fts} for log group: {lgrp}")
+
+        self._lgrp = lgrp
+        self._conn = conn
+
+        # msg compression. Once compression is on and there are zdict_sample_size msgs, a dictionary is trained from
+        # the most recent msgs. and then re-trained every zdict_retrain_every records, so the dict follows whatever the
+        # group is logging these days. Old dictionaries are kept, old rows still need them.
+        # Even w/ compression off, codec is needed to read back rows compressed while it was on.
+        self._msg_compression = msg_compression
+        self._zdict_sample_size = zdict_sample_size
+        self._zdict_retrain_every = zdict_retrain_every
+        self._codec = MsgZDictCodec()
+        self._cur_dver = None
+        self._lgrs_since_zdict = 0
+
+        # interning cache for the dictionary encoded fields. <dim: <val: id>> and the reverse <dim: <id: val>>.
+        # Its the whole dimension table. Dims are small (a few files, funcs, threads, ... and a session per client run)
+        # so holding all of it lets inserts resolve ids and reads decode them w/o ever doing a SELECT.
+        self._dim_ids = {dim: {} for dim in LGR_DIMS}
+        self._dim_vals = {dim: {} for dim in LGR_DIMS}
+
+        # seq of the last ingest journal entry in this group (lgr_journal_seq), None if it never got one.
+        self._journal_seq = None
+
+        # repeat collapsing. <session_id: _RepeatRun> in LRU order, upto repeat_sessions of them.
+        self._repeat_window_usec = None if repeat_window is None else int(repeat_window * 1000000)
+        self._repeat_sessions = repeat_sessions
+        self._repeat_runs = collections.OrderedDict()
+
+        # full text index. fts_lrid: every record upto (and including) it is indexed. Read only dbs (archives) are
+        # searchable if they have an index at all, they dont get new records.
+        self._fts = fts
+        self._fts_batch_size = fts_batch_size
+        self._fts_lrid = 0
+
+        self._regex_max_len = regex_max_len
+        self._regex_timeout = regex_timeout
+
+        # rollups. minute ones are pruned (rollup_minute_retention) whenever appends get to a new hour.
+        self._rollups = rollups and not read_only
+        self._rollup_subsys = rollup_subsys
+        self._rollup_minute_retention_usec = None
+        if rollup_minute_retention is not None:
+            self._rollup_minute_retention_usec = int(rollup_minute_retention * 1000000)
+        self._rollup_pruned_hour = None
+
+        self._session_summaries = session_summaries and not read_only
+        self._session_top_msgs = session_top_msgs
+
+        # templates. hour counts are pruned (template_retention) whenever appends get to a new hour. template_ids: the
+        # ones in lgr_template, set after a commit. Emptied when templates w/o counters are deleted, its a cache.
+        self._templates = templates and not read_only
+        self._template_top_k = template_top_k
+        self._template_retention_usec = None
+        if template_retention is not None:
+            self._template_retention_usec = int(template_retention * 1000000)
+        self._template_pruned_hour = None
+        self._template_ids = set()
+
+        # for result caches (see lgr_query_cache.py). max_lrid: every record upto it is committed. row_gen goes up by
+        # one for every batch that changed rows that were already there, _row_changes has <row_gen, lrid> of the most
+        # recent of those, all of them for the row_gens after _row_changes_floor. Set on the DBL worker after a
+        # commit, read on reader threads.
+        self._max_lrid = 0
+        self._row_gen = 0
+        self._row_changes = collections.deque()
+        self._row_changes_floor = 0
+        self._row_changes_lock = threading.Lock()
+
+        # lgr_msg() has to be there before the fts view is ever used.
+        self.prepare_conn(conn)
+
+        if not read_only:
+            self._ensure_schema()
+            self._journal_seq = self._load_journal_seq()
+            if fts is not None:
+                self._conn.executescript(_FTS_SCHEMA_SCRIPT)
+            if rollups:
+                ensure_rollups(self._conn, lgrp, rollup_subsys)
+            if session_summaries:
+                self._ensure_summaries()
+            if templates:
+                self._conn.executescript(_TEMPLATE_SCHEMA_SCRIPT)
+                self._template_ids = {row[0] for row in self._conn.execute("SELECT id FROM lgr_template;")}
+
+        self._fts_searchable = (fts is not None) if not read_only else has_fts_index(conn)
+        if self._fts_searchable:
+            self._fts_lrid = self._load_fts_lrid()
+
+        # archives made before version 6/7/8 dont have the repeat/sample/template columns. they read back as not
+        # repeated/sampled, and w/o a template.
+        table_cols = {row[1] for row in self._conn.execute("PRAGMA table_info(log_record);")}
+        self._has_template_ids = 'template_id' in table_cols
+        self._select_sql = "SELECT " + ", ".join(col if col in table_cols else "NULL" for col in _SELECT_COLUMNS)
+
+        self._load_dims()
+        self._load_zdicts()
+
+        # from sqlite_sequence, archiving can take every row out of the hot db. the mark shouldnt go back then.
+        self._max_lrid = self._conn.execute(
+            "SELECT max((SELECT coalesce(max(lrid), 0) FROM log_record), "
+            "(SELECT coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = 'log_record'));").fetchone()[0]
+
+    @property
+    def lgrp(self) -> str:
+        return self._lgrp
+
+    @property
+    def max_lrid(self) -> int:
+        """ Highest lrid committed. (0 for an empty group) """
+        return self._max_lrid
+
+    @property
+    def row_gen(self) -> int:
+        return self._row_gen
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return self._conn
+
+    def prepare_conn(self, conn: sqlite3.Connection):
+        """ Set up a connection to this log group's db for use w/ this object. The DAO calls this on any extra
+        (ie read-only) connections it opens to the same db. """
+
+        # SQL side access to msg text, for anything that needs to look inside msg in a query.
+        conn.create_function("lgr_msg", 2, self._decode_msg, deterministic=True)
+
+        # REGEXP, w/ a compiled pattern cache of its own. (connections are per thread)
+        register_regexp(conn)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # =========================================================================================== schema and migrations
+    def _ensure_schema(self):
+        """ Create the schema on a new db, or migrate an existing one in place, one version at a time. """
+
+        version = self._get_schema_version()
+
+        if version == 0:
+            self._migrate(_V1_LOG_RECORD_SCHEMA_SCRIPT, [_MIGRATE_LEGACY_SQL], to_version=1)
+            version = 1
+
+        if version == 1:
+            self._migrate(LOG_RECORD_SCHEMA_SCRIPT, _MIGRATE_V1_DIMS_SQL + [_MIGRATE_V1_SQL],
+                          to_version=LGRP_SCHEMA_VERSION)
+            version = LGRP_SCHEMA_VERSION
+
+        if version is None:
+            self._conn.executescript(LOG_RECORD_SCHEMA_SCRIPT + f"PRAGMA user_version = {LGRP_SCHEMA_VERSION};")
+            return
+
+        for to_version in range(version + 1, LGRP_SCHEMA_VERSION + 1):
+            self._migrate_additive(to_version)
+
+    def _get_schema_version(self):
+        """ Return the schema version of the db, None if there is no log_record table at all. """
+
+        # table_info rows: <cid, name, type, notnull, dflt_value, pk>
+        cols = {row[1]: row[2].upper() for row in self._conn.execute("PRAGMA table_info(log_record);")}
+
+        if not cols:
+            return None
+
+        version = self._conn.execute("PRAGMA user_version;").fetchone()[0]
+
+        # version 1 dbs were created before we started setting user_version.
+        if (version == 0) and (cols.get('srv_ts') == 'INTEGER'):
+            return 1
+
+        return version
+
+    def _migrate(self, new_schema_script: str, copy_stmts: list, to_version: int):
+        """ Rebuild log_record in the new layout. The old table is renamed to log_record_prev, the new schema created,
+        copy_stmts copy the data over (ts to micro seconds, lvl to codes, text to dim ids, ... whatever that version
+        needs), then the old table is dropped. Its all done in one transaction, inside sqlite, so its either all or
+        nothing and doesnt round trip millions of rows through python. lrids are preserved. """
+
+        log.info(f"Migrating log_record schema to version {to_version} for log group: {self._lgrp}")
+
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE;")
+
+        try:
+            cursor.execute("ALTER TABLE log_record RENAME TO log_record_prev;")
+
+            # indexes follow the renamed table, and would stop "CREATE INDEX IF NOT EXISTS" for the new one.
+            cursor.execute("DROP INDEX IF EXISTS log_record_srv_ts_idx;")
+            cursor.execute("DROP INDEX IF EXISTS log_record_lvl_srv_ts_idx;")
+            cursor.execute("DROP INDEX IF EXISTS log_record_session_srv_ts_idx;")
+            cursor.execute("DROP INDEX IF EXISTS log_record_template_srv_ts_idx;")
+
+            # executescript() would COMMIT first, do the statements one by one instead.
+            for stmt in new_schema_script.split(';'):
+                if stmt.strip():
+                    cursor.execute(stmt)
+
+            for stmt in copy_stmts:
+                cursor.execute(stmt)
+
+            cursor.execute("DROP TABLE log_record_prev;")
+            cursor.execute(f"PRAGMA user_version = {to_version};")
+            cursor.execute("COMMIT;")
+        except Exception:
+            cursor.execute("ROLLBACK;")
+            raise
+
+        log.info(f"Migrated log_record schema to version {to_version} for log group: {self._lgrp}")
+
+    def _migrate_additive(self, to_version: int):
+
+        log.info(f"Migrating log_record schema to version {to_version} for log group: {self._lgrp}")
+
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE;")
+
+        try:
+            for stmt in _ADDITIVE_MIGRATIONS[to_version]:
+                cursor.execute(stmt)
+
+            cursor.execute(f"PRAGMA user_version = {to_version};")
+            cursor.execute("COMMIT;")
+        except Exception:
+            cursor.execute("ROLLBACK;")
+            raise
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ========================================================================================= dictionary encoded dims
+    def _load_dims(self):
+
+        for dim in LGR_DIMS:
+            for dim_id, val in self._conn.execute(f"SELECT id, val FROM lgr_dim_{dim};"):
+                self._dim_ids[dim][val] = dim_id
+                self._dim_vals[dim][dim_id] = val
+
+    def _intern(self, cursor: sqlite3.Cursor, dim: str, val, new_entries: list):
+        """ Return the dim id for val, inserting it into the dim table if its new. Must be called inside the insert
+        transaction. New entries are put in the cache right away (later rows in the same batch need them) and
+        recorded in new_entries so they can be taken back out if the transaction rolls back. """
+
+        if val is None:
+            return None
+
+        dim_id = self._dim_ids[dim].get(val)
+
+        if dim_id is None:
+            val = str(val)
+            cursor.execute(f"INSERT INTO lgr_dim_{dim}(val) VALUES (?);", (val, ))
+            dim_id = cursor.lastrowid
+            self._dim_ids[dim][val] = dim_id
+            self._dim_vals[dim][dim_id] = val
+            new_entries.append((dim, val, dim_id))
+
+        return dim_id
+
+    def _forget_dim_entries(self, new_entries: list):
+
+        for dim, val, dim_id in new_entries:
+            self._dim_ids[dim].pop(val, None)
+            self._dim_vals[dim].pop(dim_id, None)
+
+    def _decode_dim(self, dim: str, dim_id, conn: sqlite3.Connection):
+
+        if dim_id is None:
+            return None
+
+        val = self._dim_vals[dim].get(dim_id)
+
+        # shouldnt happen, unless someone else wrote to this db. dont guess, go look.
+        if val is None:
+            row = conn.execute(f"SELECT val FROM lgr_dim_{dim} WHERE id = ?;", (dim_id, )).fetchone()
+            if row:
+                val = row[0]
+
+                # the cache belongs to the writer. readers dont get to change it.
+                if conn is self._conn:
+                    self._dim_ids[dim][val] = dim_id
+                    self._dim_vals[dim][dim_id] = val
+
+        return val
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ================================================================================================= msg compression
+    def _load_zdicts(self):
+
+        for dver, zdict, trained_at_lrid in self._conn.execute(
+                "SELECT dver, zdict, trained_at_lrid FROM lgr_msg_zdict ORDER BY dver;"):
+            self._codec.add_zdict(dver, zdict)
+            self._cur_dver = dver
+            self._lgrs_since_zdict = trained_at_lrid
+
+        max_lrid = self._conn.execute("SELECT max(lrid) FROM log_record;").fetchone()[0] or 0
+        self._lgrs_since_zdict = max_lrid - self._lgrs_since_zdict
+
+    def _maybe_train_zdict(self):
+        """ Train a new msg dictionary if its time. Called after an append batch commits. """
+
+        if not self._msg_compression:
+            return
+
+        if self._cur_dver is None:
+            if self._lgrs_since_zdict < self._zdict_sample_size:
+                return
+        elif self._lgrs_since_zdict < self._zdict_retrain_every:
+            return
+
+        self._train_zdict()
+
+    def _train_zdict(self):
+
+        # most recent msgs, decoded. (they might be compressed w/ the dict we are replacing)
+        rows = self._conn.execute("SELECT lrid, msg, msg_dver FROM log_record ORDER BY lrid DESC LIMIT ?;",
+                                  (self._zdict_sample_size, )).fetchall()
+
+        if not rows:
+            return
+
+        samples = [self._decode_msg(msg, msg_dver) for _, msg, msg_dver in rows]
+        zdict = train_zdict([sample for sample in samples if sample])
+
+        cursor = self._conn.execute(
+            "INSERT INTO lgr_msg_zdict(zdict, trained_at_lrid, created_ts) VALUES (?, ?, ?);",
+            (zdict, rows[0][0], get_srv_ts_usec()))
+
+        self._codec.add_zdict(cursor.lastrowid, zdict)
+        self._cur_dver = cursor.lastrowid
+        self._lgrs_since_zdict = 0
+
+        log.dbg(f"Trained msg zdict version {self._cur_dver} ({len(zdict)} bytes) for log group: {self._lgrp}")
+
+    def compress_msgs(self, batch_size: int = 5000) -> int:
+        """ Compress every plain msg in the log group w/ the current dictionary, training one first if there is none.
+        Regardless of msg_compression. Meant for log groups that are done being written to, ie archives.
+        Return the number of msgs compressed. """
+
+        if self._cur_dver is None:
+            self._train_zdict()
+
+        if self._cur_dver is None:
+            return 0
+
+        num_compressed = 0
+        last_lrid = None
+
+        while True:
+            rows = self._conn.execute(
+                "SELECT lrid, msg FROM log_record WHERE lrid > ? AND msg_dver IS NULL AND msg IS NOT NULL "
+                "ORDER BY lrid LIMIT ?;", (last_lrid if last_lrid is not None else _INT64_MIN, batch_size)).fetchall()
+
+            if not rows:
+                break
+
+            last_lrid = rows[-1][0]
+            updates = []
+
+            for lrid, msg in rows:
+                compressed = self._codec.compress(str(msg), self._cur_dver)
+                if compressed is not None:
+                    updates.append((compressed, self._cur_dver, lrid))
+
+            cursor = self._conn.cursor()
+            cursor.execute("BEGIN;")
+            try:
+                cursor.executemany("UPDATE log_record SET msg = ?, msg_dver = ? WHERE lrid = ?;", updates)
+                cursor.execute("COMMIT;")
+            except Exception:
+                cursor.execute("ROLLBACK;")
+                raise
+
+            num_compressed += len(updates)
+
+        return num_compressed
+
+    def _encode_msg(self, msg):
+        """ Return <msg, msg_dver> as they should be stored. """
+
+        if (msg is None) or (not self._msg_compression) or (self._cur_dver is None):
+            return msg, None
+
+        compressed = self._codec.compress(str(msg), self._cur_dver)
+
+        if compressed is None:
+            return msg, None
+
+        return compressed, self._cur_dver
+
+    def _decode_msg(self, msg, msg_dver):
+
+        if msg_dver is None:
+            return msg
+
+        return self._codec.decompress(msg, msg_dver)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # =========================================================================================================== append
+    def _load_journal_seq(self):
+
+        row = self._conn.execute("SELECT seq FROM lgr_journal_seq WHERE id = 0;").fetchone()
+
+        return None if row is None else row[0]
+
+    def append_lgrs(self, lgrs: list, journal_seq: int = None) -> int:
+        """ Insert the given LOG_RECORDs in one transaction. Set srv_ts on the ones that dont have one.
+        Return the number of records appended. (repeats collapsed into another row count too)
+        journal_seq: the batch is ingest journal entry journal_seq. Its recorded w/ the rows, and if the group already
+        has that entry (or a later one) nothing is inserted, 0 is returned. Entries come in seq order per group. """
+
+        if (journal_seq is not None) and (self._journal_seq is not None) and (journal_seq <= self._journal_seq):
+            return 0
+
+        srv_ts = get_srv_ts_usec()
+        for lgr in lgrs:
+            if lgr.srv_ts is None:
+                lgr.srv_ts = srv_ts
+
+        if self._repeat_window_usec is None:
+            stored_lgrs, stored_runs, touched_runs, updated_runs = lgrs, None, None, None
+        else:
+            stored_lgrs, stored_runs, touched_runs, updated_runs = self._collapse_repeats(lgrs)
+
+        new_entries = []
+
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN;")
+
+        try:
+            if stored_runs is None:
+                repeat_cols = [(None, None)] * len(stored_lgrs)
+            else:
+                repeat_cols = [_get_repeat_cols(run) for run in stored_runs]
+
+            rows = [self._lgr_to_row(cursor, lgr, cols, new_entries) for lgr, cols in zip(stored_lgrs, repeat_cols)]
+
+            cursor.executemany(_INSERT_LGR_SQL, rows)
+
+            # rows of this batch got consecutive lrids, single writer. (dim inserts were all before them)
+            first_lrid = None
+            if rows:
+                first_lrid = cursor.execute("SELECT last_insert_rowid();").fetchone()[0] - len(rows) + 1
+
+            fts_lrid = self._fts_lrid
+            if (self._fts == 'sync') and rows:
+                fts_lrid = self._index_fts_batch(cursor, stored_lgrs, first_lrid)
+
+            if touched_runs is not None:
+                for idx, run in enumerate(stored_runs):
+                    run.lrid = first_lrid + idx
+
+                cursor.executemany("UPDATE log_record SET repeat_count = ?, last_srv_ts = ? WHERE lrid = ?;",
+                                   [_get_repeat_cols(run) + (run.lrid, ) for run in updated_runs.values()])
+
+            rollup_pruned_hour = self._rollup_pruned_hour
+            if self._rollups and lgrs:
+                rollup_pruned_hour = update_rollups(cursor, lgrs, self._rollup_subsys,
+                                                    self._rollup_minute_retention_usec, rollup_pruned_hour)
+
+            if self._session_summaries and lgrs:
+                self._update_summaries(cursor, lgrs, new_entries)
+
+            template_pruned_hour, new_template_ids = self._template_pruned_hour, ()
+            if self._templates and lgrs:
+                template_pruned_hour, new_template_ids = self._update_templates(cursor, lgrs)
+
+            if journal_seq is not None:
+                cursor.execute("INSERT OR REPLACE INTO lgr_journal_seq(id, seq) VALUES (0, ?);", (journal_seq, ))
+
+            cursor.execute("COMMIT;")
+        except Exception:
+            cursor.execute("ROLLBACK;")
+            self._forget_dim_entries(new_entries)
+            raise
+
+        if journal_seq is not None:
+            self._journal_seq = journal_seq
+
+        self._rollup_pruned_hour = rollup_pruned_hour
+
+        if template_pruned_hour != self._template_pruned_hour:
+            self._template_ids.clear()
+        self._template_pruned_hour = template_pruned_hour
+        self._template_ids.update(new_template_ids)
+
+        self._fts_lrid = fts_lrid
+
+        if touched_runs is not None:
+            self._keep_repeat_runs(touched_runs)
+
+        # changed rows first, then max_lrid. A reader that sees the new max_lrid sees the changes too.
+        if updated_runs:
+            with self._row_changes_lock:
+                self._row_gen += 1
+                self._row_changes.extend((self._row_gen, lrid) for lrid in updated_runs)
+                while len(self._row_changes) > _ROW_CHANGES_KEPT:
+                    self._row_changes_floor = self._row_changes.popleft()[0]
+
+        if rows:
+            self._max_lrid = first_lrid + len(rows) - 1
+
+        self._lgrs_since_zdict += len(rows)
+        self._maybe_train_zdict()
+
+        return len(lgrs)
+
+    def get_changed_lrids(self, since_gen: int) -> set:
+        """ lrids of the rows changed in place after row_gen since_gen. None if that is too far back to tell. """
+
+        with self._row_changes_lock:
+            if since_gen < self._row_changes_floor:
+                return None
+
+            return {lrid for row_gen, lrid in self._row_changes if row_gen > since_gen}
+
+    def get_cache_mark(self, query: LGR_QUERY) -> tuple:
+        """ <max_lrid, row_gen> a result of query can be cached w/. None if its results upto max_lrid might still
+        change w/o a row changing, ie a msg_match while the full text index is behind. """
+
+        max_lrid = self._max_lrid
+
+        if (query.msg_match is not None) and (self._fts_lrid < max_lrid):
+            return None
+
+        return max_lrid, self._row_gen
+
+    def _collapse_repeats(self, lgrs: list) -> tuple:
+        """ Fold the records that repeat the last one of their session into it. Return <lgrs to store, their runs,
+        <session_id: the session's last run> for the sessions in the batch, <lrid: run> for already stored rows that
+        got more repeats>. The runs are copies, what is in _repeat_runs only changes once the batch is committed.
+        (_keep_repeat_runs()) """
+
+        stored_lgrs = []
+        stored_runs = []
+        touched_runs = {}
+        updated_runs = {}
+
+        for lgr in lgrs:
+            # rows keep one sample_rate, a change of rate starts a new one.
+            key = (lgr.lvl, lgr.filename, lgr.lineno, lgr.msg, lgr.sample_rate)
+
+            run = touched_runs.get(lgr.session_id)
+            if run is None:
+                run = self._repeat_runs.get(lgr.session_id)
+                if run is not None:
+                    run = run.copy()
+
+            if (run is not None) and (run.key == key) and (0 <= lgr.srv_ts - run.first_ts < self._repeat_window_usec):
+                run.count += 1
+                run.last_ts = max(run.last_ts, lgr.srv_ts)
+                if run.lrid is not None:
+                    updated_runs[run.lrid] = run
+            else:
+                run = _RepeatRun(key, lgr.srv_ts)
+                stored_lgrs.append(lgr)
+                stored_runs.append(run)
+
+            touched_runs[lgr.session_id] = run
+
+        return stored_lgrs, stored_runs, touched_runs, updated_runs
+
+    def _keep_repeat_runs(self, touched_runs: dict):
+
+        for session_id, run in touched_runs.items():
+            self._repeat_runs[session_id] = run
+            self._repeat_runs.move_to_end(session_id)
+
+        while len(self._repeat_runs) > self._repeat_sessions:
+            self._repeat_runs.popitem(last=False)
+
+    def _lgr_to_row(self, cursor: sqlite3.Cursor, lgr: LOG_RECORD, repeat_cols: tuple, new_entries: list) -> tuple:
+
+        lvl_code = None
+        if lgr.lvl is not None:
+            lvl_code = LGR_LVL_CODES[lgr.lvl]  # KeyError on unknown level, refuse the batch.
+
+        msg, msg_dver = self._encode_msg(lgr.msg)
+
+        template_id = None
+        if self._templates and (lgr.msg is not None):
+            template_id = get_msg_template(lgr.msg)[0]
+
+        return (
+            lgr.srv_ts,
+            lgr.client_ts,
+            lvl_code,
+            lgr.subsys,
+            self._intern(cursor, 'session_id', lgr.session_id, new_entries),
+            _as_db_int(lgr.lineno),
+            self._intern(cursor, 'filename', lgr.filename, new_entries),
+            self._intern(cursor, 'funcname', lgr.funcname, new_entries),
+            self._intern(cursor, 'pname', lgr.pname, new_entries),
+            _as_db_int(lgr.pid),
+            self._intern(cursor, 'tname', lgr.tname, new_entries),
+            _as_db_int(lgr.tid),
+            msg,
+        ) + repeat_cols + (_as_db_sample_rate(lgr.sample_rate), template_id, msg_dver)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ================================================================================================ full text index
+    def _load_fts_lrid(self) -> int:
+
+        row = self._conn.execute("SELECT lrid FROM lgr_fts_seq WHERE id = 0;").fetchone()
+
+        return 0 if row is None else row[0]
+
+    def _index_fts_batch(self, cursor: sqlite3.Cursor, lgrs: list, first_lrid: int) -> int:
+        """ fts 'sync'. Index the rows append_lgrs() just inserted (lgrs, from first_lrid on) inside its transaction.
+        Their msgs are right there, no need to read (and decompress) them back. Unless there is a backlog, then it goes
+        first. Return the new fts_lrid. """
+
+        if self._fts_lrid != first_lrid - 1:
+            return self._index_fts_backlog(cursor, len(lgrs) + self._fts_batch_size)[0]
+
+        cursor.executemany(_INSERT_FTS_SQL, [(first_lrid + idx, str(lgr.msg)) for idx, lgr in enumerate(lgrs)
+                                             if lgr.msg is not None])
+
+        fts_lrid = first_lrid + len(lgrs) - 1
+        cursor.execute(_UPDATE_FTS_SEQ_SQL, (fts_lrid, ))
+
+        return fts_lrid
+
+    def _index_fts_backlog(self, cursor: sqlite3.Cursor, max_rows: int) -> tuple:
+        """ Index upto max_rows of the records after fts_lrid, in lrid order. Must be called inside a transaction.
+        Return <the new fts_lrid, records indexed>. """
+
+        rows = cursor.execute("SELECT lrid, msg, msg_dver FROM log_record WHERE lrid > ? ORDER BY lrid LIMIT ?;",
+                              (self._fts_lrid, max_rows)).fetchall()
+
+        if not rows:
+            return self._fts_lrid, 0
+
+        cursor.executemany(_INSERT_FTS_SQL, [(lrid, str(self._decode_msg(msg, msg_dver)))
+                                             for lrid, msg, msg_dver in rows if msg is not None])
+        cursor.execute(_UPDATE_FTS_SEQ_SQL, (rows[-1][0], ))
+
+        return rows[-1][0], len(rows)
+
+    def index_fts(self, max_rows: int = None) -> dict:
+        """ Index the next max_rows (default fts_batch_size) records that arent in the full text index yet, in one
+        transaction. This is what DBL_API.INDEX_FTS runs. Return a dict w/ 'indexed', records indexed, and 'backlog',
+        records still to go. Both 0 for log groups w/o fts. """
+
+        if self._fts is None:
+            return {'indexed': 0, 'backlog': 0}
+
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN;")
+
+        try:
+            fts_lrid, num_indexed = self._index_fts_backlog(cursor, max_rows or self._fts_batch_size)
+            cursor.execute("COMMIT;")
+        except Exception:
+            cursor.execute("ROLLBACK;")
+            raise
+
+        self._fts_lrid = fts_lrid
+
+        # lrids are consecutive, but for the ones archiving deleted. (those are all indexed or gone)
+        max_lrid = self._conn.execute("SELECT max(lrid) FROM log_record;").fetchone()[0] or 0
+
+        return {'indexed': num_indexed, 'backlog': max(0, max_lrid - fts_lrid)}
+
+    def rebuild_fts(self):
+        """ Build the full text index from scratch, whatever fts is, off the msgs in the db (compressed or not). One
+        transaction. For archives, once their msgs are compressed. (see sqlite_archive.py) """
+
+        self._conn.executescript(_FTS_SCHEMA_SCRIPT)
+
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN;")
+
+        try:
+            cursor.execute("INSERT INTO lgr_fts(lgr_fts) VALUES ('rebuild');")
+            cursor.execute("INSERT INTO lgr_fts(lgr_fts) VALUES ('optimize');")
+            fts_lrid = cursor.execute("SELECT max(lrid) FROM log_record;").fetchone()[0] or 0
+            cursor.execute(_UPDATE_FTS_SEQ_SQL, (fts_lrid, ))
+            cursor.execute("COMMIT;")
+        except Exception:
+            cursor.execute("ROLLBACK;")
+            raise
+
+        self._fts_lrid = fts_lrid
+        self._fts_searchable = True
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ========================================================================================================== rollups
+    # upkeep is in append_lgrs(), see lgr_rollups.py.
+    def histogram_lgrs(self, hist: LGR_HISTOGRAM, conn: sqlite3.Connection = None) -> dict:
+        """ Record counts per bucket and level (and subsys) in hist's time range, off the rollups. See
+        lgr_rollups.query_histogram(). conn: same as query_lgrs()' """
+
+        if not self._rollups:
+            raise LgrQueryError(f"Log group: {self._lgrp} has no rollups. (lgrp_opts 'rollups')")
+
+        if ((hist.subsys is not None) or hist.by_subsys) and not self._rollup_subsys:
+            raise LgrQueryError(f"Log group: {self._lgrp} has no rollups by subsys. (lgrp_opts 'rollup_subsys')")
+
+        if (not isinstance(hist.bucket_sec, int)) or (hist.bucket_sec <= 0) or (hist.bucket_sec % 60):
+            raise LgrQueryError(f"Invalid bucket_sec: {hist.bucket_sec}, must be a multiple of 60")
+
+        return query_histogram(self._conn if conn is None else conn, hist)
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # =============================================================================================== session summaries
+    def _ensure_summaries(self):
+        """ Create the summary tables if the db doesnt have them yet, and summarize the records already there. One
+        transaction. """
+
+        if self._conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'lgr_session_summary';").fetchone() is not None:
+            return
+
+        cursor = self._conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE;")
+
+        try:
+            for stmt in _SUMMARY_SCHEMA_SQL:
+                cursor.execute(stmt)
+
+            for stmt in _BACKFILL_SUMMARY_SQL:
+                cursor.execute(stmt.format(top_msgs=int(self._session_top_msgs)))
+
+            num_sessions = cursor.execute("SELECT count(*) FROM lgr_session_summary;").fetchone()[0]
+            cursor.execute("COMMIT;")
+        except Exception:
+            cursor.execute("ROLLBACK;")
+            raise
+
+        if num_sessions:
+            log.info(f"Summarized the existing records of log group: {self._lgrp}, {num_sessions} sessions")
+
+    def _update_summaries(self, cursor: sqlite3.Cursor, lgrs: list, new_entries: list):
+        """ Count lgrs into their sessions' summaries, inside append_lgrs()' transaction. Counted up in python first, a
+        batch is one upsert per session, level and file it touches. Msgs are a read of the session's counters, Space-
+        Saving in python, and a write of the ones that changed. A batch is mostly one or a few sessions. """
+
+        sessions = {}
+        for lgr in lgrs:
+            if lgr.session_id is None:
+                continue
+
+            session_ref = self._intern(cursor, 'session_id', lgr.session_id, new_entries)
+            counts = sessions.get(session_ref)
+            if counts is None:
+                counts = sessions[session_ref] = _SessionCounts(lgr.srv_ts)
+
+            counts.first_ts = min(counts.first_ts, lgr.srv_ts)
+            counts.last_ts = max(counts.last_ts, lgr.srv_ts)
+            counts.count += 1
+            counts.lvls[0 if lgr.lvl is None else LGR_LVL_CODES[lgr.lvl]] += 1
+            counts.files[self._intern(cursor, 'filename', lgr.filename, new_entries) or 0] += 1
+            if lgr.msg is not None:
+                counts.msgs[str(lgr.msg)[:_SESSION_MSG_LEN]] += 1
+
+        if not sessions:
+            return
+
+        cursor.executemany(_UPSERT_SESSION_SQL, [(session_ref, counts.first_ts, counts.last_ts, counts.count)
+                                                 for session_ref, counts in sessions.items()])
+        cursor.executemany(_UPSERT_SESSION_LVL_SQL, [(session_ref, lvl, count)
+                                                     for session_ref, counts in sessions.items()
+                                                     for lvl, count in counts.lvls.items()])
+        cursor.executemany(_UPSERT_SESSION_FILE_SQL, [(session_ref, filename_ref, count)
+                                                      for session_ref, counts in sessions.items()
+                                                      for filename_ref, count in counts.files.items()])
+
+        deletes = []
+        upserts = []
+        for session_ref, counts in sessions.items():
+            if not counts.msgs:
+                continue
+
+            counters = {msg: [count, err] for msg, count, err in cursor.execute(
+                "SELECT msg, count, err FROM lgr_session_msg WHERE session_id_ref = ?;", (session_ref, ))}
+            evicted = space_saving_add(counters, counts.msgs, self._session_top_msgs)
+
+            deletes.extend((session_ref, msg) for msg in evicted)
+            upserts.extend((session_ref, msg, counters[msg][0], counters[msg][1])
+                           for msg in counts.msgs if msg in counters)
+
+        cursor.executemany("DELETE FROM lgr_session_msg WHERE session_id_ref = ? AND msg = ?;", deletes)
+        cursor.executemany("INSERT OR REPLACE INTO lgr_session_msg(session_id_ref, msg, count, err) "
+                           "VALUES (?, ?, ?, ?);", upserts)
+
+    def summarize_session(self, session_id: str, conn: sqlite3.Connection = None) -> dict:
+        """ The summary of session_id, None if the log group has none. A dict w/ 'session_id', 'first_srv_ts',
+        'last_srv_ts', 'count', 'lvls' (<lvl: count>, None for records w/o a level), 'files' (<filename: count>),
+        'msgs' (list of <msg, count, err>, most frequent first) and 'msg_min_count', the most a msg thats not in msgs
+        could have been counted. conn: same as query_lgrs()' """
+
+        if conn is None:
+            conn = self._conn
+
+        if not self._session_summaries:
+            raise LgrQueryError(f"Log group: {self._lgrp} has no session summaries. (lgrp_opts 'session_summaries')")
+
+        row = conn.execute("SELECT s.session_id_ref, s.first_srv_ts, s.last_srv_ts, s.count FROM lgr_session_summary s "
+                           "JOIN lgr_dim_session_id d ON d.id = s.session_id_ref WHERE d.val = ?;",
+                           (str(session_id), )).fetchone()
+        if row is None:
+            return None
+
+        session_ref, first_srv_ts, last_srv_ts, count = row
+
+        lvls = {LGR_LVL_NAMES.get(lvl): lvl_count for lvl, lvl_count in conn.execute(
+            "SELECT lvl, count FROM lgr_session_lvl WHERE session_id_ref = ? ORDER BY lvl;", (session_ref, ))}
+
+        files = {self._decode_dim('filename', filename_ref or None, conn): file_count
+                 for filename_ref, file_count in conn.execute(
+                     "SELECT filename_ref, count FROM lgr_session_file WHERE session_id_ref = ? ORDER BY count DESC;",
+                     (session_ref, ))}
+
+        msgs = conn.execute("SELECT msg, count, err FROM lgr_session_msg WHERE session_id_ref = ? "
+                            "ORDER BY count DESC, msg;", (session_ref, )).fetchall()
+        counters = {msg: [msg_count, err] for msg, msg_count, err in msgs}
+
+        return {'session_id': str(session_id), 'first_srv_ts': first_srv_ts, 'last_srv_ts': last_srv_ts, 'count': count,
+                'lvls': lvls, 'files': files, 'msgs': msgs,
+                'msg_min_count': get_min_count(counters, self._session_top_msgs)}
+
+    def diff_sessions(self, diff: LGR_SESSION_DIFF, conn: sqlite3.Connection = None) -> dict:
+        """ Compare two sessions, off their summaries. See DBL_API.DIFF_SESSIONS and LGR_SESSION_DIFF_FIELDS for what
+        it returns. Files and msgs whose counts are the same in both are left out, the rest is in order of how much
+        they differ, upto diff.top of each. conn: same as query_lgrs()' """
+
+        summary_a = self.summarize_session(diff.session_a, conn)
+        summary_b = self.summarize_session(diff.session_b, conn)
+
+        res = {'a': summary_a, 'b': summary_b, 'lvls': [], 'files': [], 'msgs': [], 'fields': LGR_SESSION_DIFF_FIELDS}
+        if (summary_a is None) or (summary_b is None):
+            return res
+
+        lvls = sorted(summary_a['lvls'].keys() | summary_b['lvls'].keys(), key=lambda lvl: LGR_LVL_CODES.get(lvl, 0))
+        res['lvls'] = [(lvl, summary_a['lvls'].get(lvl, 0), summary_b['lvls'].get(lvl, 0)) for lvl in lvls]
+
+        files = []
+        for filename in summary_a['files'].keys() | summary_b['files'].keys():
+            count_a = summary_a['files'].get(filename, 0)
+            count_b = summary_b['files'].get(filename, 0)
+            if count_a != count_b:
+                filename_regex = None if filename is None else get_literal_regex(filename, max_len=self._regex_max_len)
+                files.append((filename, count_a, count_b, filename_regex))
+
+        files.sort(key=lambda row: (-abs(row[2] - row[1]), row[0] or ''))
+        res['files'] = files[:diff.top]
+
+        counters_a = {msg: (count, err) for msg, count, err in summary_a['msgs']}
+        counters_b = {msg: (count, err) for msg, count, err in summary_b['msgs']}
+        absent_a = (summary_a['msg_min_count'], summary_a['msg_min_count'])
+        absent_b = (summary_b['msg_min_count'], summary_b['msg_min_count'])
+
+        msgs = []
+        for msg in counters_a.keys() | counters_b.keys():
+            count_a, err_a = counters_a.get(msg, absent_a)
+            count_b, err_b = counters_b.get(msg, absent_b)
+            if count_a != count_b:
+                # msgs were cut at _SESSION_MSG_LEN chars, one that long might have been longer.
+                msg_regex = get_literal_regex(msg, whole=len(msg) < _SESSION_MSG_LEN, max_len=self._regex_max_len)
+                msgs.append((msg, count_a, err_a, count_b, err_b, msg_regex))
+
+        msgs.sort(key=lambda row: (-abs(row[3] - row[1]), row[0]))
+        res['msgs'] = msgs[:diff.top]
+
+        return res
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ======================================================================================================== templates
+    def _update_templates(self, cursor: sqlite3.Cursor, lgrs: list) -> tuple:
+        """ Count lgrs' templates into their hours, inside append_lgrs()' transaction. Same as the session msgs, a read
+        of the hour's counters, Space-Saving in python, and a write of the ones that changed. Hour counts past
+        template_retention (and templates w/o a counter left) are deleted the first time a batch gets to a new hour.
+        Return <the hour they were last pruned at, ids of the templates added to lgr_template>. """
+
+        hours = {}
+        templates = {}
+        for lgr in lgrs:
+            if lgr.msg is None:
+                continue
+
+            template_id, template = get_msg_template(lgr.msg)
+            templates[template_id] = template
+
+            bucket_ts = lgr.srv_ts - lgr.srv_ts % _ROLLUP_HOUR_USEC
+            weights = hours.get(bucket_ts)
+            if weights is None:
+                weights = hours[bucket_ts] = collections.Counter()
+            weights[template_id] += 1
+
+        deletes = []
+        upserts = []
+        for bucket_ts, weights in hours.items():
+            counters = {template_id: [count, err] for template_id, count, err in cursor.execute(
+                "SELECT template_id, count, err FROM lgr_template_top WHERE bucket_ts = ?;", (bucket_ts, ))}
+            evicted = space_saving_add(counters, weights, self._template_top_k)
+
+            deletes.extend((bucket_ts, template_id) for template_id in evicted)
+            upserts.extend((bucket_ts, template_id, counters[template_id][0], counters[template_id][1])
+                           for template_id in weights if template_id in counters)
+
+        cursor.executemany("DELETE FROM lgr_template_top WHERE bucket_ts = ? AND template_id = ?;", deletes)
+        cursor.executemany("INSERT OR REPLACE INTO lgr_template_top(bucket_ts, template_id, count, err) "
+                           "VALUES (?, ?, ?, ?);", upserts)
+
+        new_template_ids = {template_id for _, template_id, _, _ in upserts} - self._template_ids
+        cursor.executemany("INSERT OR IGNORE INTO lgr_template(id, template) VALUES (?, ?);",
+                           [(template_id, templates[template_id]) for template_id in new_template_ids])
+
+        pruned_hour = self._template_pruned_hour
+        if self._template_retention_usec is None:
+            return pruned_hour, new_template_ids
+
+        hour = max(lgr.srv_ts for lgr in lgrs) // _ROLLUP_HOUR_USEC
+        if (pruned_hour is None) or (hour > pruned_hour):
+            cursor.execute("DELETE FROM lgr_template_top WHERE bucket_ts < ?;",
+                           (hour * _ROLLUP_HOUR_USEC - self._template_retention_usec, ))
+            cursor.execute("DELETE FROM lgr_template WHERE id NOT IN (SELECT template_id FROM lgr_template_top);")
+            pruned_hour = hour
+
+        return pruned_hour, new_template_ids
+
+    def top_templates(self, top: LGR_TEMPLATE_TOP, conn: sqlite3.Connection = None) -> dict:
+        """ The most frequent templates in top's hours, off the hour counts. Result is a dict w/ 'fields'
+        (LGR_TEMPLATE_TOP_FIELDS), 'templates', a list of tuples, highest count first, and 'total', the records w/ a
+        msg in those hours. A template an hour has no counter for was seen at most that hour's lowest count times
+        there, count_max adds that. conn: same as query_lgrs()' """
+
+        if conn is None:
+            conn = self._conn
+
+        if not self._templates:
+            raise LgrQueryError(f"Log group: {self._lgrp} has no templates. (lgrp_opts 'templates')")
+
+        where_clauses = []
+        params = []
+
+        if top.srv_ts_min is not None:
+            where_clauses.append("bucket_ts >= ?")
+            params.append(top.srv_ts_min - top.srv_ts_min % _ROLLUP_HOUR_USEC)
+
+        if top.srv_ts_max is not None:
+            where_clauses.append("bucket_ts <= ?")
+            params.append(top.srv_ts_max)
+
+        sql = "SELECT bucket_ts, template_id, count, err FROM lgr_template_top"
+        if where_clauses:
+            sql += " WHERE " + " AND ".join(where_clauses)
+
+        hours = collections.defaultdict(dict)
+        for bucket_ts, template_id, count, err in conn.execute(sql + ";", params):
+            hours[bucket_ts][template_id] = [count, err]
+
+        # <template_id: [count, count_min, lowest counts of the hours it was counted in]>
+        totals = {}
+        total = 0
+        min_counts = 0
+        for counters in hours.values():
+            min_count = get_min_count(counters, self._template_top_k)
+            min_counts += min_count
+            for template_id, (count, err) in counters.items():
+                counts = totals.get(template_id)
+                if counts is None:
+                    counts = totals[template_id] = [0, 0, 0]
+                counts[0] += count
+                counts[1] += count - err
+                counts[2] += min_count
+                total += count
+
+        top_ids = sorted(totals, key=lambda template_id: (-totals[template_id][0], template_id))[:top.limit]
+
+        texts = {}
+        if top_ids:
+            texts = dict(conn.execute(f"SELECT id, template FROM lgr_template WHERE id IN "
+                                      f"({', '.join('?' * len(top_ids))});", top_ids))
+
+        templates = [(template_id, texts.get(template_id), totals[template_id][0], totals[template_id][1],
+                      totals[template_id][0] + min_counts - totals[template_id][2]) for template_id in top_ids]
+
+        return {'fields': LGR_TEMPLATE_TOP_FIELDS, 'templates': templates, 'total': total}
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # ============================================================================================================ query
+    def query_lgrs(self, query: LGR_QUERY, conn: sqlite3.Connection = None, lrid_range: tuple = None) -> dict:
+        """ Return the log records matching query, in srv_ts order. Result is a dict w/ 'fields' and 'lgrs'
+        'lgrs' being a list of tuples w/ values in the order of 'fields'.
+
+        conn: run the query on this connection instead of the one this object owns, ie a read-only connection
+        on a reader thread. Must have gone through prepare_conn(). Decoding state (dims, dictionaries) is shared w/
+        the writer. Its only ever added to, and a reader can only see rows whose dims/dicts were added before
+        the rows were committed.
+
+        lrid_range: <lrid_min, lrid_max>, only records w/ lrid_min < lrid <= lrid_max. lrid_min None means from the
+        first. For result caches (see lgr_query_cache.py) """
+
+        if conn is None:
+            conn = self._conn
+
+        sql, params, regexes = self._get_query_sql(query, lrid_range)
+
+        with regex_deadline(conn, self._regex_timeout if regexes else None):
+            lgrs = [self._decode_row(row, conn) for row in conn.execute(sql, params)]
+
+        return {'fields': SQLITE_LGR_FIELDS, 'lgrs': lgrs}
+
+    def iter_lgrs(self, query: LGR_QUERY, conn: sqlite3.Connection = None, lrid_range: tuple = None,
+                  chunk_size: int = 1000):
+        """ query_lgrs() for results too big to have in memory at once, ie exports. Yields lists of upto chunk_size
+        rows (SQLITE_LGR_FIELDS order), fetchmany()ed off one statement. query.limit None means every match.
+        The statement is one read transaction, on a db in WAL mode thats one snapshot from the first chunk to the
+        last, appends that come in meanwhile arent seen (and dont wait on it). Close the generator to end it early.
+        The regex timeout is per chunk, and not on this object's own connection: a progress handler there would
+        interrupt the writer too. (ie the memory DAO's, see its export_lgrs()) """
+
+        if conn is None:
+            conn = self._conn
+
+        sql, params, regexes = self._get_query_sql(query, lrid_range)
+        regex_timeout = self._regex_timeout if (regexes and conn is not self._conn) else None
+
+        cursor = conn.cursor()
+        try:
+            with regex_deadline(conn, regex_timeout):
+                cursor.execute(sql, params)
+
+            while True:
+                with regex_deadline(conn, regex_timeout):
+                    rows = cursor.fetchmany(chunk_size)
+
+                if not rows:
+                    return
+
+                yield [self._decode_row(row, conn) for row in rows]
+        finally:
+            cursor.close()
+
+    def _get_query_sql(self, query: LGR_QUERY, lrid_range: tuple) -> tuple:
+        """ <sql, params, regexes> for query. (see query_lgrs()) """
+
+        where_clauses = []
+        params = []
+
+        if query.srv_ts_min is not None:
+            where_clauses.append("srv_ts >= ?")
+            params.append(query.srv_ts_min)
+
+        if query.srv_ts_max is not None:
+            where_clauses.append("srv_ts <= ?")
+            params.append(query.srv_ts_max)
+
+        if query.session_id is not None:
+            where_clauses.append("session_id_ref = (SELECT id FROM lgr_dim_session_id WHERE val = ?)")
+            params.append(query.session_id)
+
+        if query.subsys is not None:
+            where_clauses.append("subsys = ?")
+            params.append(query.subsys)
+
+        # walks the (template_id, srv_ts) index, like session_id does its own. Archives made before version 8 have no
+        # template ids, nothing in them matches.
+        if query.template_id is not None:
+            if self._has_template_ids:
+                where_clauses.append("template_id = ?")
+                params.append(query.template_id)
+            else:
+                where_clauses.append("0")
+
+        # always as IN, not as a lvl >= range. w/ IN sqlite walks the (lvl, srv_ts) index once per level and stops each
+        # walk at limit rows, then sorts those. A range on lvl cant give it srv_ts order, it scans the srv_ts index.
+        lvl_codes = get_query_lvl_codes(query)
+        if lvl_codes is not None:
+            where_clauses.append(f"lvl IN ({', '.join('?' * len(lvl_codes))})")
+            params.extend(lvl_codes)
+
+        # no index, client_ts is checked on the rows the srv_ts (or session, lvl) index walk brings up.
+        if query.client_ts_min is not None:
+            where_clauses.append("client_ts >= ?")
+            params.append(query.client_ts_min)
+
+        if query.client_ts_max is not None:
+            where_clauses.append("client_ts <= ?")
+            params.append(query.client_ts_max)
+
+        # keyset pagination. Every index on srv_ts ends in lrid (rowid), so this is where the index walk starts, page
+        # 1000 costs what page 1 does. (OFFSET would walk past all the pages before it)
+        if query.after is not None:
+            where_clauses.append("(srv_ts, lrid) > (?, ?)")
+            params.extend(query.after)
+
+        # a cached result's delta (lrid_min set) is the records appended since, a few at most. NOT INDEXED walks those
+        # by rowid, not the whole srv_ts range the query covers. W/o a lrid_min, the unary + keeps the bound from being
+        # used for the walk, the usual index does that.
+        not_indexed = False
+        if lrid_range is not None:
+            if lrid_range[0] is not None:
+                where_clauses.append("lrid > ?")
+                params.append(lrid_range[0])
+                not_indexed = True
+
+            where_clauses.append("+lrid <= ?")
+            params.append(lrid_range[1])
+
+        # the index hands over the lrids that match, they are looked up by rowid and sorted. Costs what the number of
+        # matches does, not what the log group's size does. msg LIKE '%...%' reads (and decodes) rows until it has a
+        # page, which only beats this for terms in a good part of all records.
+        if query.msg_match is not None:
+            if not self._fts_searchable:
+                raise LgrQueryError(f"Log group: {self._lgrp} has no full text index. (lgrp_opts 'fts')")
+
+            check_fts_query(query.msg_match)
+            where_clauses.append("lrid IN (SELECT rowid FROM lgr_fts WHERE lgr_fts MATCH ?)")
+            params.append(query.msg_match)
+
+        # regexes go last, no index can help them. sqlite checks the residual terms in the order given, so the cheap
+        # ones above weed a row out before its msg gets decoded and searched. filename is a dim, its regex runs once
+        # per distinct filename, rows are matched on the ids.
+        regexes = get_query_regexes(query, self._regex_max_len)
+
+        if 'filename' in regexes:
+            where_clauses.append("filename_ref IN (SELECT id FROM lgr_dim_filename WHERE val REGEXP ?)")
+            params.append(query.filename_regex)
+
+        if 'msg' in regexes:
+            where_clauses.append("lgr_msg(msg, msg_dver) REGEXP ?")
+            params.append(query.msg_regex)
+
+        sql = f"{self._select_sql} FROM log_record"
+        if not_indexed:
+            sql += " NOT INDEXED"
+        if where_clauses:
+            sql += " WHERE " + " AND ".join(where_clauses)
+
+        sql += " ORDER BY srv_ts, lrid"
+        if query.limit is not None:
+            sql += " LIMIT ?"
+            params.append(query.limit)
+
+        return sql + ";", params, regexes
+
+    def _decode_row(self, row: tuple, conn: sqlite3.Connection) -> tuple:
+        """ Turn a log_record row (columns in _SELECT_COLUMNS order) into what DBL users see (SQLITE_LGR_FIELDS order).
+        This is the only place msgs get decompressed, so only rows that are actually returned pay for it. """
+
+        msg_dver = row[-1]
+        row = list(row[:-1])
+        row[_LVL_IDX] = LGR_LVL_NAMES.get(row[_LVL_IDX])
+        row[_MSG_IDX] = self._decode_msg(row[_MSG_IDX], msg_dver)
+
+        for dim, idx in _DIM_IDXS:
+            row[idx] = self._decode_dim(dim, row[idx], conn)
+
+        if row[_REPEAT_COUNT_IDX] is None:
+            row[_REPEAT_COUNT_IDX] = 1
+            row[_LAST_SRV_TS_IDX] = row[_SRV_TS_IDX]
+
+        if row[_SAMPLE_RATE_IDX] is None:
+            row[_SAMPLE_RATE_IDX] = 1.0
+
+        return tuple(row)
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ================================================================================================ full text query check
+# fts5 only parses a MATCH when the statement runs, a malformed one ('"abc', 'foo AND') is an OperationalError by then,
+# same as a broken db would be. Each thread that checks gets a memory db w/ an empty index to have sqlite parse them.
+_fts_check = threading.local()
+
+
+def check_fts_query(msg_match: str):
+    """ LgrQueryError if msg_match isnt a query the full text index can run. (see LGR_QUERY.msg_match) """
+
+    conn = getattr(_fts_check, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(':memory:', isolation_level=None)
+        conn.execute("CREATE VIRTUAL TABLE lgr_fts USING fts5(msg);")
+        _fts_check.conn = conn
+
+    try:
+        conn.execute("SELECT rowid FROM lgr_fts WHERE lgr_fts MATCH ?;", (msg_match, )).fetchall()
+    except sqlite3.OperationalError as ex:
+        raise LgrQueryError(f"invalid msg query: {msg_match!r} ({ex})") from None
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# =================================================================================================== no such log group
+# DAOs only create a log group on an append. A read of one there is none of (ie a typo in a dashboard URL) gets what
+# an empty one would have returned, w/o leaving a db behind.
+def get_no_lgrp_result(args) -> dict:
+    """ The result of a read op w/ args (LGR_QUERY, LGR_HISTOGRAM, LGR_SESSION_DIFF or LGR_TEMPLATE_TOP) on a log
+    group that doesnt exist. """
+
+    if isinstance(args, LGR_HISTOGRAM):
+        return {'fields': LGR_HISTOGRAM_FIELDS, 'buckets': []}
+
+    if isinstance(args, LGR_SESSION_DIFF):
+        return {'a': None, 'b': None, 'lvls': [], 'files': [], 'msgs': [], 'fields': LGR_SESSION_DIFF_FIELDS}
+
+    if isinstance(args, LGR_TEMPLATE_TOP):
+        return {'fields': LGR_TEMPLATE_TOP_FIELDS, 'templates': [], 'total': 0}
+
+    return {'fields': SQLITE_LGR_FIELDS, 'lgrs': []}
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ========================================================================================================= bulk moves
+# These work on whatever connection they are given, not on a SqliteLogGroup's. Used to move old records out of a log
+# group's db into an archive db (see sqlite_archive.py) from a thread other than the DBL worker. Both dbs must be at
+# the current schema version.
+def copy_lgrs_to_attached(conn: sqlite3.Connection, attached: str, srv_ts_min: int, srv_ts_end: int):
+    """ Copy the records w/ srv_ts in [srv_ts_min, srv_ts_end) from conn's main db to the db ATTACHed to conn as
+    attached, as is. lrids, dim ids and compressed msgs are kept, so the dim tables and msg dictionaries are copied
+    whole. (they are small) One transaction. Return the highest lrid copied, None if there was nothing to copy. """
+
+    cursor = conn.cursor()
+    cursor.execute("BEGIN;")
+
+    try:
+        max_lrid = cursor.execute("SELECT max(lrid) FROM main.log_record WHERE srv_ts >= ? AND srv_ts < ?;",
+                                  (srv_ts_min, srv_ts_end)).fetchone()[0]
+
+        if max_lrid is None:
+            cursor.execute("ROLLBACK;")
+            return None
+
+        for dim in LGR_DIMS:
+            cursor.execute(f"INSERT OR IGNORE INTO {attached}.lgr_dim_{dim}(id, val) SELECT id, val FROM "
+                           f"main.lgr_dim_{dim};")
+
+        cursor.execute(f"INSERT OR IGNORE INTO {attached}.lgr_msg_zdict(dver, zdict, trained_at_lrid, created_ts) "
+                       f"SELECT dver, zdict, trained_at_lrid, created_ts FROM main.lgr_msg_zdict;")
+
+        cursor.execute(
+            f"INSERT INTO {attached}.log_record({', '.join(_SELECT_COLUMNS)}) SELECT {', '.join(_SELECT_COLUMNS)} "
+            f"FROM main.log_record WHERE srv_ts >= ? AND srv_ts < ? AND lrid <= ?;", (srv_ts_min, srv_ts_end, max_lrid))
+
+        cursor.execute("COMMIT;")
+    except Exception:
+        cursor.execute("ROLLBACK;")
+        raise
+
+    return max_lrid
+
+
+def has_fts_index(conn: sqlite3.Connection) -> bool:
+    """ Does conn's (main) db have a full text index? """
+
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'lgr_fts';").fetchone() is not None
+
+
+def _prepare_bulk_conn(conn: sqlite3.Connection):
+    """ lgr_msg() for a connection w/o a SqliteLogGroup, w/ the msg dictionaries in the db right now. """
+
+    codec = MsgZDictCodec()
+    for dver, zdict in conn.execute("SELECT dver, zdict FROM lgr_msg_zdict;"):
+        codec.add_zdict(dver, zdict)
+
+    def decode_msg(msg, msg_dver):
+        return msg if msg_dver is None else codec.decompress(msg, msg_dver)
+
+    conn.create_function("lgr_msg", 2, decode_msg, deterministic=True)
+
+
+def delete_lgrs(conn: sqlite3.Connection, srv_ts_min: int, srv_ts_end: int, max_lrid: int, batch_size: int = 5000):
+    """ Delete the records copy_lgrs_to_attached() copied (same srv_ts range, lrid <= max_lrid). batch_size records
+    per transaction, so a writer on another connection is never held up for long. Return how many were deleted.
+    If the db has a full text index, the records are taken out of it too, in the same transaction. """
+
+    batch_sql = "SELECT lrid FROM log_record WHERE srv_ts >= ? AND srv_ts < ? AND lrid <= ? ORDER BY lrid LIMIT ?"
+    batch_params = (srv_ts_min, srv_ts_end, max_lrid, batch_size)
+
+    fts = has_fts_index(conn)
+    if fts:
+        # the copied records are older than any dictionary trained after the copy.
+        _prepare_bulk_conn(conn)
+
+    num_deleted = 0
+
+    while True:
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE;")
+
+        try:
+            # FTS5 'delete' needs the text that was indexed. Only for indexed records, the writer might still be
+            # indexing (fts 'deferred'). IMMEDIATE so lgr_fts_seq cant move until the records are gone.
+            if fts:
+                cursor.execute(
+                    f"INSERT INTO lgr_fts(lgr_fts, rowid, msg) SELECT 'delete', lrid, lgr_msg(msg, msg_dver) "
+                    f"FROM log_record WHERE lrid IN ({batch_sql}) AND msg IS NOT NULL "
+                    f"AND lrid <= (SELECT coalesce(max(lrid), 0) FROM lgr_fts_seq);", batch_params)
+
+            cursor.execute(f"DELETE FROM log_record WHERE lrid IN ({batch_sql});", batch_params)
+            batch_deleted = cursor.rowcount
+            cursor.execute("COMMIT;")
+        except Exception:
+            cursor.execute("ROLLBACK;")
+            raise
+
+        num_deleted += batch_deleted
+        if batch_deleted < batch_size:
+            return num_deleted
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def get_db_size_bytes(conn: sqlite3.Connection) -> int:
+
+    page_count = conn.execute("PRAGMA page_count;").fetchone()[0]
+    page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+
+    return page_count * page_size
+
+
+def _dbg_bench_schema(num_records=200 * 1000, num_range_scans=200):
+    """ Legacy TEXT schema vs INTEGER schema. Same data, same indexes (srv_ts, (lvl, srv_ts)) on both sides so the
+    difference is only the column types. Prints bytes per row, insert rate, and range scan times. """
+
+    print(f"Benchmarking log_record schemas w/ {num_records:,} records ...")
+
+    rnd = random.Random(1655)
+    base_ts = time.time()
+    lvls = list(LGR_LVL_CODES)
+
+    # ~ 10k records per second of server time
+    recs = []
+    for i in range(num_records):
+        ts = base_ts + i / 10000
+        recs.append((ts, ts - rnd.random() / 100, rnd.choice(lvls), 'AZxV89HW_SvGbZsyFDkDP6q0', rnd.randint(1, 2000),
+                     'server_init.py', 'webapp_init', 4242, 'MainProcess', 140212345678912, 'MainThread',
+                     f"hello world {i}"))
+
+    legacy_rows = [(f"{r[0]:.0f}", f"{r[1]:.4f}", r[2], r[3], str(r[4]), r[5], r[6], str(r[7]), r[8], str(r[9]), r[10],
+                    r[11]) for r in recs]
+
+    legacy_conn = sqlite3.connect(":memory:", isolation_level=None)
+    legacy_conn.executescript(LEGACY_LOG_RECORD_SCHEMA_SCRIPT)
+    legacy_conn.executescript("CREATE INDEX l_ts ON log_record(srv_ts); CREATE INDEX l_lt ON log_record(lvl, srv_ts);")
+
+    # legacy stored seconds as text, for a fair comparison let it keep client_ts w/ 4 digits like the notebook did.
+    legacy_insert = """INSERT INTO log_record(srv_ts, client_ts, lvl, session_id, lineno, filename, funcname, pid,
+                       pname, tid, tname, msg) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);"""
+
+    start_time = time.perf_counter()
+    legacy_conn.execute("BEGIN;")
+    legacy_conn.executemany(legacy_insert, legacy_rows)
+    legacy_conn.execute("COMMIT;")
+    legacy_insert_t = time.perf_counter() - start_time
+
+    new_conn = sqlite3.connect(":memory:", isolation_level=None)
+    lgrp = SqliteLogGroup('bench', new_conn)
+    new_lgrs = [
+        LOG_RECORD(srv_ts=int(r[0] * 1000000), client_ts=int(r[1] * 1000000), lvl=r[2], session_id=r[3], lineno=r[4],
+                   filename=r[5], funcname=r[6], pid=r[7], pname=r[8], tid=r[9], tname=r[10], msg=r[11]) for r in recs
+    ]
+
+    start_time = time.perf_counter()
+    lgrp.append_lgrs(new_lgrs)
+    new_insert_t = time.perf_counter() - start_time
+
+    # range scans: 1 second worth of records (~10k), at random spots.
+    scan_starts = [base_ts + rnd.random() * (num_records / 10000 - 1) for _ in range(num_range_scans)]
+
+    start_time = time.perf_counter()
+    for st in scan_starts:
+        legacy_conn.execute("SELECT count(*), max(lineno) FROM log_record WHERE srv_ts >= ? AND srv_ts <= ?;",
+                            (f"{st:.0f}", f"{st + 1:.0f}")).fetchall()
+    legacy_scan_t = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for st in scan_starts:
+        new_conn.execute("SELECT count(*), max(lineno) FROM log_record WHERE srv_ts >= ? AND srv_ts <= ?;",
+                         (int(st * 1000000), int((st + 1) * 1000000))).fetchall()
+    new_scan_t = time.perf_counter() - start_time
+
+    # lvl + range scans. (ERRR in a 1 second window)
+    start_time = time.perf_counter()
+    for st in scan_starts:
+        legacy_conn.execute("SELECT count(*) FROM log_record WHERE lvl = 'ERRR' AND srv_ts >= ? AND srv_ts <= ?;",
+                            (f"{st:.0f}", f"{st + 1:.0f}")).fetchall()
+    legacy_lvl_scan_t = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for st in scan_starts:
+        new_conn.execute("SELECT count(*) FROM log_record WHERE lvl = 40 AND srv_ts >= ? AND srv_ts <= ?;",
+                         (int(st * 1000000), int((st + 1) * 1000000))).fetchall()
+    new_lvl_scan_t = time.perf_counter() - start_time
+
+    legacy_size = get_db_size_bytes(legacy_conn)
+    new_size = get_db_size_bytes(new_conn)
+
+    print(f"{'':24}{'legacy TEXT':>16}{'current':>16}")
+    print(f"{'db bytes per row':24}{legacy_size / num_records:>16.1f}{new_size / num_records:>16.1f}")
+    print(f"{'inserts per second':24}{num_records / legacy_insert_t:>16,.0f}{num_records / new_insert_t:>16,.0f}")
+    print(f"{'range scan (ms)':24}{legacy_scan_t * 1000 / num_range_scans:>16.3f}"
+          f"{new_scan_t * 1000 / num_range_scans:>16.3f}")
+    print(f"{'lvl + range scan (ms)':24}{legacy_lvl_scan_t * 1000 / num_range_scans:>16.3f}"
+          f"{new_lvl_scan_t * 1000 / num_range_scans:>16.3f}")
+
+
+def _dbg_bench_dims(num_records=200 * 1000, num_sessions=50):
+    """ Caller metadata inline as TEXT (schema v1) vs dictionary encoded (current). Prints bytes per row, insert rate
+    and the time to read back + decode 10k rows. """
+
+    print(f"Benchmarking dictionary encoded caller metadata w/ {num_records:,} records ...")
+
+    rnd = random.Random(1655)
+    base_ts = int(time.time() * 1000000)
+
+    sessions = [f"sess_{rnd.getrandbits(96):024x}" for _ in range(num_sessions)]
+    call_sites = [(f"/home/zu/x1ws/l6sk_python/l6sk/dbl/module_{i}.py", f"some_function_{i}") for i in range(40)]
+    threads = ['MainThread', 'dbl_worker_thread', 'ThreadPoolExecutor-0_0', 'ThreadPoolExecutor-0_1']
+
+    lgrs = []
+    for i in range(num_records):
+        filename, funcname = rnd.choice(call_sites)
+        lgrs.append(
+            LOG_RECORD(srv_ts=base_ts + i * 100, client_ts=base_ts + i * 100 - 50, lvl='INFO',
+                       session_id=sessions[i * num_sessions // num_records], lineno=rnd.randint(1, 2000),
+                       filename=filename, funcname=funcname, pid=4242, pname='MainProcess', tid=140212345678912,
+                       tname=rnd.choice(threads), msg=f"hello world {i}"))
+
+    v1_conn = sqlite3.connect(":memory:", isolation_level=None)
+    v1_conn.executescript(_V1_LOG_RECORD_SCHEMA_SCRIPT)
+    v1_rows = [(r.srv_ts, r.client_ts, 20, r.subsys, r.session_id, r.lineno, r.filename, r.funcname, r.pname, r.pid,
+                r.tname, r.tid, r.msg) for r in lgrs]
+
+    start_time = time.perf_counter()
+    v1_conn.execute("BEGIN;")
+    v1_conn.executemany(f"INSERT INTO log_record({', '.join(LGR_FIELDS[1:])}) VALUES ({', '.join('?' * 13)});",
+                        v1_rows)
+    v1_conn.execute("COMMIT;")
+    v1_insert_t = time.perf_counter() - start_time
+
+    new_conn = sqlite3.connect(":memory:", isolation_level=None)
+    lgrp = SqliteLogGroup('bench', new_conn)
+
+    start_time = time.perf_counter()
+    lgrp.append_lgrs(lgrs)
+    new_insert_t = time.perf_counter() - start_time
+
+    read_count = 10 * 1000
+
+    start_time = time.perf_counter()
+    v1_conn.execute(f"SELECT {', '.join(LGR_FIELDS)} FROM log_record ORDER BY srv_ts LIMIT ?;",
+                    (read_count, )).fetchall()
+    v1_read_t = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    lgrp.query_lgrs(LGR_QUERY(lgrp='bench', limit=read_count))
+    new_read_t = time.perf_counter() - start_time
+
+    print(f"{'':24}{'inline TEXT':>16}{'current':>16}")
+    print(f"{'db bytes per row':24}{get_db_size_bytes(v1_conn) / num_records:>16.1f}"
+          f"{get_db_size_bytes(new_conn) / num_records:>16.1f}")
+    print(f"{'inserts per second':24}{num_records / v1_insert_t:>16,.0f}{num_records / new_insert_t:>16,.0f}")
+    print(f"{'read 10k rows (ms)':24}{v1_read_t * 1000:>16.3f}{new_read_t * 1000:>16.3f}")
+
+
+def _dbg_bench_msg_compression(num_records=200 * 1000):
+    """ Same log group, msg compression off vs on. Prints bytes per row, insert rate, and the cost of reading back
+    rows, for a narrow (lvl filtered) and a wide read. """
+
+    from l6sk.dbl.msg_codec import _dbg_mk_sample_msgs  # pylint: disable=import-outside-toplevel
+
+    print(f"Benchmarking msg compression w/ {num_records:,} records ...")
+
+    rnd = random.Random(1655)
+    base_ts = int(time.time() * 1000000)
+    msgs = _dbg_mk_sample_msgs(num_records)
+    lvls = ['DBUG'] * 20 + ['INFO'] * 10 + ['ERRR']
+
+    results = {}
+    for msg_compression in (False, True):
+        lgrs = [
+            LOG_RECORD(srv_ts=base_ts + i * 100, lvl=rnd.choice(lvls), session_id='AZxV89HW_SvGbZsyFDkDP6q0',
+                       filename='dbl_dispatch.py', lineno=rnd.randint(1, 400), msg=msgs[i]) for i in range(num_records)
+        ]
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('bench', conn, msg_compression=msg_compression)
+
+        # batches of 500, so the dictionary gets trained along the way like it would in real life.
+        start_time = time.perf_counter()
+        for batch_start in range(0, num_records, 500):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + 500])
+        insert_t = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        for _ in range(50):
+            conn.execute("SELECT lrid FROM log_record WHERE lvl = 40 AND srv_ts >= ? AND srv_ts <= ?;",
+                         (base_ts, base_ts + num_records * 50)).fetchall()
+        filter_t = (time.perf_counter() - start_time) / 50
+
+        start_time = time.perf_counter()
+        lgrp.query_lgrs(LGR_QUERY(lgrp='bench', limit=10 * 1000))
+        read_t = time.perf_counter() - start_time
+
+        results[msg_compression] = (get_db_size_bytes(conn) / num_records, num_records / insert_t, filter_t * 1000,
+                                    read_t * 1000)
+
+    print(f"{'':28}{'plain':>16}{'compressed':>16}")
+    for idx, label, fmt in ((0, 'db bytes per row', '.1f'), (1, 'inserts per second', ',.0f'),
+                            (2, 'lvl filter, no msg (ms)', '.3f'), (3, 'read 10k rows (ms)', '.3f')):
+        print(f"{label:28}{results[False][idx]:>16{fmt}}{results[True][idx]:>16{fmt}}")
+
+
+def _dbg_bench_repeats(num_records=200 * 1000, storm_share=0.6, batch_size=500):
+    """ A retry storm: storm_share of the records are 3 sessions logging the same error over and over, the rest is
+    regular traffic from 50 sessions. repeat_window off vs on. Prints rows stored, bytes per record and insert rate. """
+
+    print(f"Benchmarking repeat collapsing w/ {num_records:,} records, {storm_share:.0%} of them a retry storm ...")
+
+    rnd = random.Random(1655)
+    base_ts = int(time.time() * 1000000)
+
+    lgrs = []
+    for i in range(num_records):
+        if rnd.random() < storm_share:
+            session_id = f"storm_{rnd.randrange(3)}"
+            lgrs.append(LOG_RECORD(srv_ts=base_ts + i * 100, lvl='ERRR', session_id=session_id, filename='upstream.py',
+                                   lineno=88, msg="connect() to 10.0.3.17:5432 failed: Connection refused, retrying"))
+        else:
+            lgrs.append(LOG_RECORD(srv_ts=base_ts + i * 100, lvl='INFO', session_id=f"sess_{rnd.randrange(50)}",
+                                   filename='handlers.py', lineno=rnd.randint(1, 400),
+                                   msg=f"GET /api/items/{i} 200 {rnd.randint(1, 900)} ms"))
+
+    results = {}
+    for repeat_window in (None, 60.0):
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('bench', conn, repeat_window=repeat_window)
+
+        start_time = time.perf_counter()
+        for batch_start in range(0, num_records, batch_size):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + batch_size])
+        insert_t = time.perf_counter() - start_time
+
+        num_rows = conn.execute("SELECT count(*) FROM log_record;").fetchone()[0]
+        num_lgrs = conn.execute("SELECT sum(coalesce(repeat_count, 1)) FROM log_record;").fetchone()[0]
+        assert num_lgrs == num_records
+
+        results[repeat_window] = (num_rows, get_db_size_bytes(conn) / num_records, num_records / insert_t)
+
+    print(f"{'':28}{'off':>16}{'repeat_window':>16}")
+    for idx, label, fmt in ((0, 'rows stored', ',.0f'), (1, 'db bytes per record', '.1f'),
+                            (2, 'records per second', ',.0f')):
+        print(f"{label:28}{results[None][idx]:>16{fmt}}{results[60.0][idx]:>16{fmt}}")
+
+
+def _dbg_bench_pages(num_records=400 * 1000, page_size=100, num_runs=20):
+    """ Cost of page 1 vs a deep page, keyset cursor vs OFFSET, for a plain query and a WARN+ (lvl IN) query.
+    OFFSET is what pagination would be w/o the cursor. """
+
+    print(f"Benchmarking query pages w/ {num_records:,} records, {page_size} per page ...")
+
+    rnd = random.Random(1655)
+    base_ts = int(time.time() * 1000000)
+    lvls = ['DBUG'] * 70 + ['INFO'] * 20 + ['WARN'] * 7 + ['ERRR'] * 3
+
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    lgrp = SqliteLogGroup('bench', conn)
+    lgrs = [LOG_RECORD(srv_ts=base_ts + i * 100, lvl=rnd.choice(lvls), session_id=f"sess_{rnd.randrange(50)}",
+                       msg=f"GET /api/items/{i} 200") for i in range(num_records)]
+    for batch_start in range(0, num_records, 5000):
+        lgrp.append_lgrs(lgrs[batch_start:batch_start + 5000])
+
+    print(f"{'':24}{'page':>8}{'keyset (ms)':>14}{'OFFSET (ms)':>14}")
+    for name, query in (('all', LGR_QUERY(lgrp='bench', limit=page_size)),
+                        ('lvl_min WARN', LGR_QUERY(lgrp='bench', lvl_min='WARN', limit=page_size))):
+        num_matches = sum(1 for lgr in lgrs if query.lvl_min is None or LGR_LVL_CODES[lgr.lvl] >= 30)
+
+        for page_idx in (0, num_matches // page_size // 2, num_matches // page_size - 1):
+            # the cursor for page_idx, and its OFFSET twin. (lvl codes inline, its a bench)
+            where = "" if query.lvl_min is None else "WHERE lvl IN (30, 40, 50)"
+            after = conn.execute(f"SELECT srv_ts, lrid FROM log_record {where} ORDER BY srv_ts, lrid "
+                                 f"LIMIT 1 OFFSET ?;", (page_idx * page_size - 1, )).fetchone() if page_idx else None
+            offset_sql = f"{lgrp._select_sql} FROM log_record {where} ORDER BY srv_ts, lrid LIMIT ? OFFSET ?;"
+
+            start_time = time.perf_counter()
+            for _ in range(num_runs):
+                keyset_lgrs = lgrp.query_lgrs(dataclasses.replace(query, after=after))['lgrs']
+            keyset_t = (time.perf_counter() - start_time) / num_runs
+
+            start_time = time.perf_counter()
+            for _ in range(num_runs):
+                offset_rows = [lgrp._decode_row(row, conn)
+                               for row in conn.execute(offset_sql, (page_size, page_idx * page_size))]
+            offset_t = (time.perf_counter() - start_time) / num_runs
+
+            assert [row[0] for row in keyset_lgrs] == [row[0] for row in offset_rows]
+            print(f"{name:24}{page_idx + 1:>8,}{keyset_t * 1000:>14.3f}{offset_t * 1000:>14.3f}")
+
+
+def _dbg_bench_fts(num_records=200 * 1000, batch_size=500, num_runs=20):
+    """ Ingest rate w/ the full text index off, 'sync' and 'deferred' (+ what catching up costs later). Then msg
+    searches, page 1 of 100, msg LIKE '%...%' (what it would be w/o the index) vs msg_match, for a rare, a less rare
+    and a common term. Compressed msgs, LIKE has to decode every row it looks at. """
+
+    from l6sk.dbl.msg_codec import _dbg_mk_sample_msgs  # pylint: disable=import-outside-toplevel
+
+    print(f"Benchmarking full text search w/ {num_records:,} records ...")
+
+    base_ts = int(time.time() * 1000000)
+    msgs = _dbg_mk_sample_msgs(num_records)
+
+    print(f"{'fts':12}{'records/s':>12}{'catch up (s)':>14}{'db bytes per row':>18}")
+    lgrps = {}
+    for fts in (None, 'sync', 'deferred'):
+        lgrs = [LOG_RECORD(srv_ts=base_ts + i * 100, lvl='INFO', msg=msgs[i]) for i in range(num_records)]
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('bench', conn, msg_compression=True, fts=fts, fts_batch_size=5000)
+
+        start_time = time.perf_counter()
+        for batch_start in range(0, num_records, batch_size):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + batch_size])
+        insert_t = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        while lgrp.index_fts()['backlog']:
+            pass
+        catch_up_t = time.perf_counter() - start_time
+
+        print(f"{str(fts):12}{num_records / insert_t:>12,.0f}{catch_up_t:>14.3f}"
+              f"{get_db_size_bytes(conn) / num_records:>18.1f}")
+        lgrps[fts] = lgrp
+
+    lgrp = lgrps['sync']
+    like_sql = f"{lgrp._select_sql} FROM log_record WHERE lgr_msg(msg, msg_dver) LIKE ? ORDER BY srv_ts, lrid LIMIT ?;"
+
+    print(f"{'term':28}{'matches':>10}{'LIKE (ms)':>12}{'MATCH (ms)':>12}")
+    for like, msg_match in (('%user:4242%', '"user 4242" *'), ('%from worker 16%', '"worker 16"'),
+                            ('%sqlite%', 'sqlite')):
+        num_matches = lgrp.conn.execute("SELECT count(*) FROM lgr_fts WHERE lgr_fts MATCH ?;",
+                                        (msg_match, )).fetchone()[0]
+
+        start_time = time.perf_counter()
+        for _ in range(num_runs):
+            like_rows = [lgrp._decode_row(row, lgrp.conn) for row in lgrp.conn.execute(like_sql, (like, 100))]
+        like_t = (time.perf_counter() - start_time) / num_runs
+
+        start_time = time.perf_counter()
+        for _ in range(num_runs):
+            match_rows = lgrp.query_lgrs(LGR_QUERY(lgrp='bench', msg_match=msg_match, limit=100))['lgrs']
+        match_t = (time.perf_counter() - start_time) / num_runs
+
+        assert [row[0] for row in like_rows] == [row[0] for row in match_rows]
+        print(f"{msg_match:28}{num_matches:>10,}{like_t * 1000:>12.3f}{match_t * 1000:>12.3f}")
+
+
+def _dbg_bench_regex(num_records=200 * 1000, num_runs=5):
+    """ msg_regex, all the matches (limit 10k) so the whole log group is looked at. REGEXP doing
+    re.search(pattern, value) per row vs the compiled pattern cache. Then the same regex narrowed down w/ a level and
+    a srv_ts range (the last 10%), how many rows the regex still runs on. Compressed msgs. """
+
+    import re  # pylint: disable=import-outside-toplevel
+    from l6sk.dbl.msg_codec import _dbg_mk_sample_msgs  # pylint: disable=import-outside-toplevel
+
+    print(f"Benchmarking msg regexes w/ {num_records:,} records ...")
+
+    base_ts = int(time.time() * 1000000)
+    msgs = _dbg_mk_sample_msgs(num_records)
+    lvls = ['DBUG', 'INFO', 'INFO', 'WARN', 'ERRR']
+    lgrs = [LOG_RECORD(srv_ts=base_ts + i * 100, lvl=lvls[i % 5], msg=msgs[i]) for i in range(num_records)]
+
+    conn = sqlite3.connect(":memory:", isolation_level=None)
+    lgrp = SqliteLogGroup('bench', conn, msg_compression=True, regex_timeout=None)
+    for batch_start in range(0, num_records, 500):
+        lgrp.append_lgrs(lgrs[batch_start:batch_start + 500])
+
+    pattern = r"took [1-9]\d\.\d+ ms client=10\.0\.0\.1\d\d$"
+    num_calls = [0]
+
+    def re_search_regexp(pattern, value):
+        num_calls[0] += 1
+        return value is not None and re.search(pattern, value) is not None
+
+    cache = PatternCache()
+
+    def cached_regexp(pattern, value):
+        num_calls[0] += 1
+        return value is not None and cache.get(pattern).search(value) is not None
+
+    whole_query = LGR_QUERY(lgrp='bench', msg_regex=pattern, limit=10000)
+    narrow_query = LGR_QUERY(lgrp='bench', msg_regex=pattern, lvls=frozenset({'ERRR'}),
+                             srv_ts_min=base_ts + num_records * 90, limit=10000)
+
+    print(f"{'regexp':16}{'query':28}{'matches':>10}{'regexp calls':>14}{'ms':>10}")
+    for name, regexp in (("re.search", re_search_regexp), ("PatternCache", cached_regexp)):
+        conn.create_function("regexp", 2, regexp, deterministic=True)
+
+        for query_name, query in (("whole group", whole_query), ("ERRR, last 10% of srv_ts", narrow_query)):
+            num_calls[0] = 0
+            start_time = time.perf_counter()
+            for _ in range(num_runs):
+                num_matches = len(lgrp.query_lgrs(query)['lgrs'])
+            query_t = (time.perf_counter() - start_time) / num_runs
+
+            print(f"{name:16}{query_name:28}{num_matches:>10,}{num_calls[0] // num_runs:>14,}{query_t * 1000:>10.1f}")
+
+    print(f"PatternCache compiled {cache.num_compiled} pattern(s)")
+
+
+def _dbg_bench_session_summaries(num_records=500 * 1000, num_sessions=20, batch_size=500, num_runs=10):
+    """ num_records from num_sessions sessions (a few msg shapes w/ ids in them, so lots of distinct msgs). Ingest
+    rate w/ session summaries off vs on, for batches of one session each (a client posts its own records) and for
+    batches w/ every session in them. Then comparing two of the sessions: the GROUP BYs over their records it would
+    take w/o summaries (counts by level, file and msg) vs diff_sessions(). """
+
+    print(f"Benchmarking session summaries w/ {num_records:,} records, {num_sessions} sessions ...")
+
+    rnd = random.Random(1748)
+    base_ts = int(time.time() * 1000000) - 24 * 3600 * 1000000
+    lvls = ['DBUG'] * 60 + ['INFO'] * 30 + ['WARN'] * 7 + ['ERRR'] * 3
+    msgs = ["GET /api/items/{} 200", "cache miss for key {}", "retrying upstream call, attempt {}", "worker idle"]
+
+    print(f"{'batches':16}{'summaries':>10}{'records/s':>12}{'db bytes per row':>18}")
+    lgrps = {}
+    for interleaved in (False, True):
+        lgrs = [LOG_RECORD(srv_ts=base_ts + i * 100, lvl=rnd.choice(lvls),
+                           session_id=f"sess_{(i if interleaved else i // batch_size) % num_sessions}",
+                           filename=f"mod_{rnd.randrange(30)}.py", msg=rnd.choice(msgs).format(rnd.randrange(1000)))
+                for i in range(num_records)]
+
+        for session_summaries in (False, True):
+            conn = sqlite3.connect(":memory:", isolation_level=None)
+            lgrp = SqliteLogGroup('bench', conn, session_summaries=session_summaries)
+
+            start_time = time.perf_counter()
+            for batch_start in range(0, num_records, batch_size):
+                lgrp.append_lgrs(lgrs[batch_start:batch_start + batch_size])
+            insert_t = time.perf_counter() - start_time
+
+            print(f"{'all sessions' if interleaved else 'one session':16}{str(session_summaries):>10}"
+                  f"{num_records / insert_t:>12,.0f}{get_db_size_bytes(conn) / num_records:>18.1f}")
+            lgrps[session_summaries] = lgrp
+
+    lgrp = lgrps[True]
+    group_by_sqls = [
+        "SELECT lvl, count(*) FROM log_record WHERE session_id_ref = ? GROUP BY 1;",
+        "SELECT filename_ref, count(*) FROM log_record WHERE session_id_ref = ? GROUP BY 1;",
+        "SELECT msg, count(*) FROM log_record WHERE session_id_ref = ? GROUP BY 1 ORDER BY 2 DESC LIMIT 50;",
+    ]
+    session_refs = [lgrp._dim_ids['session_id'][f"sess_{idx}"] for idx in range(2)]  # pylint: disable=protected-access
+
+    start_time = time.perf_counter()
+    for _ in range(num_runs):
+        for session_ref in session_refs:
+            for sql in group_by_sqls:
+                lgrp.conn.execute(sql, (session_ref, )).fetchall()
+    group_by_t = (time.perf_counter() - start_time) / num_runs
+
+    start_time = time.perf_counter()
+    for _ in range(num_runs):
+        diff = lgrp.diff_sessions(LGR_SESSION_DIFF(lgrp='bench', session_a='sess_0', session_b='sess_1'))
+    diff_t = (time.perf_counter() - start_time) / num_runs
+
+    print(f"diff of 2 sessions of {diff['a']['count']:,} records: GROUP BY {group_by_t * 1000:.2f} ms, "
+          f"summaries {diff_t * 1000:.2f} ms")
+
+
+def _dbg_bench_templates(num_records=500 * 1000, batch_size=500, num_runs=10):
+    """ num_records of a few msg shapes w/ values in them (numbers, hex, UUIDs, quoted keys), one of them rare. Ingest
+    rate w/ templates off vs on. Then the top templates of the day: templating every msg in a scan vs
+    top_templates(), and a page of the rare template's records: a msg_regex vs template_id. """
+
+    print(f"Benchmarking templates w/ {num_records:,} records ...")
+
+    rnd = random.Random(1749)
+    base_ts = int(time.time() * 1000000) - 12 * 3600 * 1000000
+    shapes = [("GET /api/items/{} 200 in {} ms", 40), ("cache miss for key '{}' ({} bytes)", 25),
+              ("session {} renewed, ttl {}", 20), ("worker {} idle, queue depth {}", 14),
+              ("checksum mismatch on block 0x{:x}, retry {}", 1)]
+    weights = [weight for _, weight in shapes]
+
+    def mk_msg():
+        shape = rnd.choices(shapes, weights)[0][0]
+        if "session" in shape:
+            return shape.format(f"{rnd.getrandbits(128):032x}"[:8] + "-1c2d-4e5f-8a9b-" + f"{rnd.getrandbits(48):012x}",
+                                rnd.randrange(3600))
+        return shape.format(rnd.randrange(1 << 20), rnd.randrange(1000))
+
+    lgrs = [LOG_RECORD(srv_ts=base_ts + i * 80000, lvl='INFO', session_id=f"sess_{i // batch_size % 20}",
+                       filename="app.py", msg=mk_msg()) for i in range(num_records)]
+
+    print(f"{'templates':>10}{'records/s':>12}{'db bytes per row':>18}")
+    for templates in (False, True):
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('bench', conn, templates=templates)
+
+        start_time = time.perf_counter()
+        for batch_start in range(0, num_records, batch_size):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + batch_size])
+        insert_t = time.perf_counter() - start_time
+
+        print(f"{str(templates):>10}{num_records / insert_t:>12,.0f}{get_db_size_bytes(conn) / num_records:>18.1f}")
+
+    start_time = time.perf_counter()
+    counts = collections.Counter(get_msg_template(msg)[1] for (msg, ) in conn.execute(
+        "SELECT msg FROM log_record WHERE msg IS NOT NULL;"))
+    scan_t = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    for _ in range(num_runs):
+        top = lgrp.top_templates(LGR_TEMPLATE_TOP(lgrp='bench', srv_ts_min=base_ts, limit=5))
+    top_t = (time.perf_counter() - start_time) / num_runs
+
+    same_top = [row[1] for row in top['templates']] == [template for template, _ in counts.most_common(5)]
+    print(f"top templates of {top['total']:,} records: scan {scan_t * 1000:.2f} ms, top_templates() "
+          f"{top_t * 1000:.2f} ms, same top 5: {same_top}")
+
+    template_id, template = get_msg_template(shapes[-1][0].format(1, 1))
+    queries = [("msg_regex", LGR_QUERY(lgrp='bench', msg_regex=r"^checksum mismatch on block 0x", limit=100)),
+               ("template_id", LGR_QUERY(lgrp='bench', template_id=template_id, limit=100))]
+    for name, query in queries:
+        start_time = time.perf_counter()
+        for _ in range(num_runs):
+            page = lgrp.query_lgrs(query)['lgrs']
+        query_t = (time.perf_counter() - start_time) / num_runs
+        print(f"page of {len(page)} records of {template!r} by {name}: {query_t * 1000:.2f} ms")
+
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================================
+def main():
+    _dbg_bench_schema()
+    _dbg_bench_dims()
+    _dbg_bench_msg_compression()
+    _dbg_bench_repeats()
+    _dbg_bench_pages()
+    _dbg_bench_fts()
+    _dbg_bench_regex()
+    _dbg_bench_session_summaries()
+    _dbg_bench_templates()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,235 @@
+""" sqlite_maint.py
+Housekeeping for the log group dbs of the disk sqlite DAO: WAL checkpoints and incremental vacuum.
+
+sqlite's automatic checkpoint runs on whichever connection commits the transaction that takes the WAL over
+wal_autocheckpoint pages. For us thats the DBL worker, in the middle of an insert, so every so often one append
+takes a whole checkpoint (db file writes + fsync) longer. And it is PASSIVE, w/ a long reader open it cant get past
+that reader's snapshot, the WAL just keeps growing. So the DAO turns it off on its writers and checkpoints them on a
+schedule instead, between requests and when the dispatch loop is idle: WalCheckpointer below.
+
+Deleting rows (ie moving partitions out to archives) leaves free pages in the db file. W/ auto_vacuum = INCREMENTAL
+(set on new log group dbs) incremental_vacuum_step() gives a few of them back to the OS at a time. Its a write, it
+runs on the DBL worker when the dispatch loop is idle. (both from DAO_SQLITE.run_maintenance())
+
+The timed reads and writes the sqlite DAOs serve health checks v2 and v3 with are here too. (hchk_read, hchk_write)
+"""
+
+import os
+import time
+import sqlite3
+import tempfile
+import threading
+
+# PRAGMA auto_vacuum values.
+_AUTO_VACUUM_INCREMENTAL = 2
+
+
+def get_wal_filename(db_filename: str) -> str:
+    return db_filename + "-wal"
+
+
+class WalCheckpointer:
+    """ Scheduled checkpoints for one db, on the writer's connection, between transactions. checkpoint() each time:
+    - PASSIVE, always. Copies whatever it can w/o waiting on readers. The writer is us, so unless a reader still
+      needs the old frames it gets all of it and the next write starts over at the beginning of the WAL.
+    - RESTART, if PASSIVE couldnt get it all and there is more than wal_max_bytes of it. Waits for the readers in the
+      way, so the WAL stops growing.
+    - TRUNCATE, if the WAL file itself is over wal_max_bytes. (it grew while a reader was in the way) Same as
+      RESTART, and truncates the file to 0 bytes.
+    RESTART/TRUNCATE waits are capped at escalate_timeout_ms, the DBL worker is what waits. If a long reader is still in
+    the way, escalating again on every call would just keep stalling it. Busy escalations back off, 1, 2, 4, ... upto
+    max_backoff calls w/ PASSIVE only. """
+
+    def __init__(self, conn: sqlite3.Connection, db_filename: str, wal_max_bytes: int, escalate_timeout_ms: int = 20,
+                 max_backoff: int = 16):
+
+        self._conn = conn
+        self._db_filename = db_filename
+        self._wal_max_bytes = wal_max_bytes
+        self._escalate_timeout_ms = escalate_timeout_ms
+        self._max_backoff = max_backoff
+
+        self._page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+        self._backoff = 0
+        self._skip = 0
+
+        # mode -> how many times it ran (and got all of the WAL for RESTART/TRUNCATE). "BUSY" are failed escalations.
+        self.counts = {"PASSIVE": 0, "RESTART": 0, "TRUNCATE": 0, "BUSY": 0}
+
+    def checkpoint(self) -> str:
+        """ Run the checkpoint(s) due, return the strongest mode that got all of the WAL, or PASSIVE. """
+
+        # (busy, frames in the WAL, frames copied to the db). -1, -1 if the db isnt in WAL mode.
+        _, log_frames, ckpt_frames = self._conn.execute("PRAGMA wal_checkpoint(PASSIVE);").fetchone()
+        self.counts["PASSIVE"] += 1
+
+        try:
+            wal_size = os.path.getsize(get_wal_filename(self._db_filename))
+        except FileNotFoundError:
+            wal_size = 0
+
+        escalate_to = None
+        if (ckpt_frames < log_frames) and (log_frames * self._page_size > self._wal_max_bytes):
+            escalate_to = "RESTART"
+        if wal_size > self._wal_max_bytes:
+            escalate_to = "TRUNCATE"
+
+        if escalate_to is None:
+            self._backoff = 0
+            return "PASSIVE"
+
+        if self._skip > 0:
+            self._skip -= 1
+            return "PASSIVE"
+
+        busy_timeout_ms = self._conn.execute("PRAGMA busy_timeout;").fetchone()[0]
+        self._conn.execute(f"PRAGMA busy_timeout = {int(self._escalate_timeout_ms)};")
+        try:
+            busy, _, _ = self._conn.execute(f"PRAGMA wal_checkpoint({escalate_to});").fetchone()
+        finally:
+            self._conn.execute(f"PRAGMA busy_timeout = {int(busy_timeout_ms)};")
+
+        # a reader was in the way.
+        if busy:
+            self.counts["BUSY"] += 1
+            self._backoff = min(max(1, self._backoff * 2), self._max_backoff)
+            self._skip = self._backoff
+            return "PASSIVE"
+
+        self.counts[escalate_to] += 1
+        self._backoff = 0
+        return escalate_to
+
+
+def incremental_vacuum_step(conn: sqlite3.Connection, max_pages: int) -> int:
+    """ Give up to max_pages free pages back to the OS. Return how many. 0 if there are none, or the db isnt
+    auto_vacuum = INCREMENTAL (dbs created before we set it, a VACUUM would convert them). """
+
+    if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] != _AUTO_VACUUM_INCREMENTAL:
+        return 0
+
+    num_free = conn.execute("PRAGMA freelist_count;").fetchone()[0]
+    if num_free == 0:
+        return 0
+
+    # incremental_vacuum frees one page per step of the statement, fetchall() to run it to the end.
+    conn.execute(f"PRAGMA incremental_vacuum({int(max_pages)});").fetchall()
+
+    return num_free - conn.execute("PRAGMA freelist_count;").fetchone()[0]
+
+
+# health check v3 writes and deletes a row in here. Its always empty in between.
+_HCHK_SENTINEL_SCHEMA = "CREATE TABLE IF NOT EXISTS hchk_sentinel(id INTEGER PRIMARY KEY NOT NULL, ts INTEGER NOT NULL)"
+
+
+def hchk_read(conn: sqlite3.Connection) -> float:
+    """ Read the schema table. Return how long it took in ms. """
+
+    start_time = time.perf_counter()
+    conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+
+    return (time.perf_counter() - start_time) * 1000
+
+
+def hchk_write(conn: sqlite3.Connection) -> float:
+    """ Insert a row in the sentinel table and delete it, two (autocommit) transactions. On a disk db each one has
+    to make it to disk, so this is about what a small write costs right now. Return how long it took in ms. """
+
+    start_time = time.perf_counter()
+    conn.execute(_HCHK_SENTINEL_SCHEMA)
+    cursor = conn.execute("INSERT INTO hchk_sentinel(ts) VALUES(?)", (time.time_ns() // 1000, ))
+    conn.execute("DELETE FROM hchk_sentinel WHERE id = ?", (cursor.lastrowid, ))
+
+    return (time.perf_counter() - start_time) * 1000
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ======================================================================================================================
+def _dbg_bench_checkpoints(duration: float = 20.0, batch_size: int = 200, burst: int = 50, idle_for: float = 0.05,
+                           long_read_at: float = 5.0, long_read_for: float = 5.0, checkpoint_interval: float = 1.0,
+                           wal_max_bytes: int = 64 * 1024 * 1024):
+    """ Bursty ingest: burst commits of batch_size records back to back, then idle_for seconds of nothing, for
+    duration seconds. A reader holds a snapshot for long_read_for seconds in the middle. Append latency and WAL size
+    w/ sqlite's automatic checkpoints vs. WalCheckpointer the way DAO_SQLITE.run_maintenance() runs it: in the idle
+    gaps, and every checkpoint_interval seconds between appends. """
+
+    from l6sk.dbl.sqlite_lgrp import SqliteLogGroup
+    from l6sk.dbl.dbl_api import LOG_RECORD
+
+    def run(scheduled: bool):
+        tmp_dirname = tempfile.mkdtemp(prefix="l6sk_bench_ckpt_")
+        db_filename = os.path.join(tmp_dirname, "lgrp_bench.db")
+
+        conn = sqlite3.connect(db_filename, isolation_level=None)
+        conn.execute("PRAGMA journal_mode = WAL;")
+        if scheduled:
+            conn.execute("PRAGMA wal_autocheckpoint = 0;")
+        lgrp = SqliteLogGroup('bench', conn)
+
+        def long_reader():
+            time.sleep(long_read_at)
+            read_conn = sqlite3.connect(db_filename, isolation_level=None)
+            read_conn.execute("BEGIN;")
+            read_conn.execute("SELECT count(*) FROM log_record;").fetchone()
+            time.sleep(long_read_for)
+            read_conn.execute("COMMIT;")
+            read_conn.close()
+
+        reader = threading.Thread(target=long_reader, daemon=True)
+        reader.start()
+
+        checkpointer = WalCheckpointer(conn, db_filename, wal_max_bytes) if scheduled else None
+        next_checkpoint = time.perf_counter() + checkpoint_interval
+        latencies = []
+        max_wal_size = 0
+        num_records = 0
+        end_time = time.perf_counter() + duration
+
+        while time.perf_counter() < end_time:
+            for _ in range(burst):
+                lgrs = [LOG_RECORD(lvl='INFO', session_id='bench_session', filename='bench.py', lineno=j,
+                                   msg=f"GET /api/items/{num_records + j} 200 {j % 1000} ms, user agent: client 1.2.3")
+                        for j in range(batch_size)]
+                num_records += batch_size
+
+                # a checkpoint between appends holds up the next one, same as it would the next DBL request.
+                start_time = time.perf_counter()
+                if checkpointer and (start_time >= next_checkpoint):
+                    checkpointer.checkpoint()
+                    next_checkpoint = time.perf_counter() + checkpoint_interval
+                lgrp.append_lgrs(lgrs)
+                latencies.append(time.perf_counter() - start_time)
+
+            max_wal_size = max(max_wal_size, os.path.getsize(get_wal_filename(db_filename)))
+
+            idle_end = time.perf_counter() + idle_for
+            if checkpointer:
+                checkpointer.checkpoint()
+                next_checkpoint = time.perf_counter() + checkpoint_interval
+            time.sleep(max(0.0, idle_end - time.perf_counter()))
+
+        reader.join()
+        final_wal_size = os.path.getsize(get_wal_filename(db_filename))
+        latencies.sort()
+
+        return (num_records / duration, latencies[len(latencies) // 2] * 1000,
+                latencies[len(latencies) * 999 // 1000] * 1000, latencies[-1] * 1000, max_wal_size / 2**20,
+                final_wal_size / 2**20, checkpointer.counts if checkpointer else None)
+
+    print(f"{duration:.0f}s of bursts of {burst} x {batch_size} record commits w/ {idle_for * 1000:.0f} ms gaps, "
+          f"a reader holds a snapshot from {long_read_at:.0f}s to {long_read_at + long_read_for:.0f}s:")
+    for name, scheduled in [("sqlite autocheckpoint", False), ("scheduled checkpoints", True)]:
+        rec_per_sec, p50, p999, max_lat, max_wal, final_wal, counts = run(scheduled)
+        print(f"  {name:<22} {rec_per_sec:>7.0f} rec/s  p50: {p50:5.2f} ms  p99.9: {p999:6.2f} ms  "
+              f"max: {max_lat:6.2f} ms  WAL max: {max_wal:6.1f} MB  WAL at end: {final_wal:6.1f} MB")
+        if counts:
+            print(f"  {'':<22} checkpoints: {counts}")
+
+
+def main():
+    _dbg_bench_checkpoints()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,94 @@
+""" sqlite_read_pool.py
+A small pool of reader threads, each w/ its own read-only sqlite connections. The disk DAO hands read requests to
+this pool so a slow query doesnt hold up the DBL worker (and every insert queued behind it).
+Only makes sense for db files in WAL mode: readers work off a snapshot and dont block the writer, or each other.
+"""
+
+import queue
+import sqlite3
+import threading
+import pathlib
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ
+from l6sk.dbl.dbl_api import DBL_FAIL_CAUSE, LgrQueryError
+
+# careful w/ log calls from here. reader threads are inf loops too.
+from l6sk import log_util as log
+
+
+def open_read_conn(db_filename: str) -> sqlite3.Connection:
+    """ Read-only connection to db_filename. mode=ro: it can never take a write lock. """
+
+    db_uri = pathlib.Path(db_filename).resolve().as_uri() + "?mode=ro"
+    return sqlite3.connect(db_uri, uri=True, isolation_level=None)
+
+
+class SqliteReadPool:
+    """ num_readers daemonic threads serving read work off one shared queue.
+
+    Work is submitted as <req, work> where work is a callable that takes one argument: a get_conn(db_filename,
+    on_open=None) function. get_conn returns the calling reader thread's read-only connection to db_filename,
+    opening it the first time (and calling on_open(conn) on it, ie to register SQL functions). Whatever work returns
+    is set as req.succ_data, if it raises, req.fail_cause is set instead. Just like the DBL worker does.
+    """
+
+    def __init__(self, num_readers: int, name_prefix: str = "dbl_reader_thread"):
+        super().__init__()
+
+        assert num_readers > 0
+
+        self._work_q = queue.Queue()
+        self._threads = []
+
+        for reader_idx in range(num_readers):
+            t = threading.Thread(target=self._reader_thread_entry, name=f"{name_prefix}_{reader_idx}")
+
+            # same as the DBL worker. if main thread is gone, there is nothing left to serve.
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+        log.dbg(f"SqliteReadPool started {num_readers} reader threads.")
+
+    def submit(self, req: DBL_REQ, work):
+        self._work_q.put_nowait((req, work))
+
+    def get_queue_depth(self) -> int:
+        return self._work_q.qsize()
+
+    # ==================================================================================================================
+    # ==================================================================================================================
+    # =============================================================================================== reader thread side
+    def _reader_thread_entry(self):
+
+        # db filename -> read-only connection. each reader thread has its own, sqlite conns dont like sharing threads.
+        conns = {}
+
+        def get_conn(db_filename: str, on_open=None) -> sqlite3.Connection:
+
+            conn = conns.get(db_filename)
+
+            if conn is None:
+                conn = open_read_conn(db_filename)
+
+                if on_open:
+                    on_open(conn)
+
+                conns[db_filename] = conn
+
+            return conn
+
+        while True:
+            req, work = self._work_q.get()
+
+            # same deal as DBL worker: nothing gets to break this loop.
+            try:
+                req.succ_data = work(get_conn)
+            except LgrQueryError as ex:
+                req.fail_cause = DBL_FAIL_CAUSE(http_err_code=400,
+                                                user_msg=str(ex),
+                                                dbg_info_string=str(ex))
+            except Exception as ex:
+                req.fail_cause = DBL_FAIL_CAUSE(http_err_code=500,
+                                                user_msg='Internal Server Error',
+                                                dbg_info_string=str(ex))
@@ -0,0 +1,243 @@
+""" ingest_quotas.py
+Per log group and per client ingest quotas. There is one DBL worker, one noisy service (or one broken client) sending
+as fast as it can would have every other log group wait behind it in the dispatch queues. API_NEW_LGR asks
+IngestQuotas before it queues anything, requests over quota get a 429 and never cost the DBL worker a thing.
+
+Quotas are token buckets, records and bytes (of request body) per second, each w/ its own burst. A request has to fit
+its log group's buckets and its client's (remote ip) buckets, and only takes from them if it fits all of them.
+Quota dicts look like:
+    {"records_per_sec": 2000, "records_burst": 10000, "bytes_per_sec": 4 * 1024 * 1024, "bytes_burst": None}
+None (or a missing key) rate means no limit of that kind, None burst means one second worth.
+
+Not thread safe. The web layer calls it from the ioloop thread.
+"""
+
+import time
+import math
+import collections
+
+from l6sk.dbl.dbl_api import get_lgrp_opts
+
+from l6sk import log_util as log
+
+# quota kinds. <name, rate key, burst key>
+_QUOTA_KINDS = (
+    ('records', 'records_per_sec', 'records_burst'),
+    ('bytes', 'bytes_per_sec', 'bytes_burst'),
+)
+
+
+class TokenBucket:
+    """ rate tokens per second, holds upto burst. Starts full. """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'last_ts')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_ts = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_ts) * self.rate)
+        self.last_ts = now
+
+    def get_wait(self, cost: float) -> float:
+        """ Seconds until cost tokens are there, 0 if they already are. Costs over burst are capped at burst, so
+        a big request only has to wait for a full bucket, not forever. """
+
+        cost = min(cost, self.burst)
+        if self.tokens >= cost:
+            return 0.0
+
+        return (cost - self.tokens) / self.rate
+
+    def take(self, cost: float):
+        self.tokens -= min(cost, self.burst)
+
+
+class _QuotaState:
+    """ The buckets and counters of one log group or client. """
+
+    __slots__ = ('buckets', 'counters')
+
+    def __init__(self, quota: dict, now: float):
+
+        # <kind: TokenBucket>, only for the kinds that have a limit.
+        self.buckets = {}
+        for kind, rate_key, burst_key in _QUOTA_KINDS:
+            rate = quota.get(rate_key)
+            if rate is not None:
+                burst = quota.get(burst_key)
+                self.buckets[kind] = TokenBucket(rate, rate if burst is None else burst, now)
+
+        # accepted_reqs, accepted_records, accepted_bytes, throttled_reqs, throttled_records, throttled_bytes
+        self.counters = collections.Counter()
+
+    def count(self, outcome: str, num_records: int, num_bytes: int):
+        self.counters[f"{outcome}_reqs"] += 1
+        self.counters[f"{outcome}_records"] += num_records
+        self.counters[f"{outcome}_bytes"] += num_bytes
+
+
+class IngestQuotas:
+    """ lgrp_quotas: per log group quota dicts, w/ "*" for the default and log group names for overrides, key by key.
+    The same format as lgrp_opts. (see dbl_api.get_lgrp_opts()) None means no log group quotas.
+    client_quota: the quota dict every client gets. None means no client quotas.
+    max_entries: buckets (and counters) are kept for this many of the most recent log groups, and as many clients. An
+    evicted one starts over w/ full buckets. """
+
+    def __init__(self, lgrp_quotas: dict = None, client_quota: dict = None, max_entries: int = 10000,
+                 clock=time.monotonic):
+        super().__init__()
+
+        self._lgrp_quotas = lgrp_quotas
+        self._client_quota = client_quota
+        self._max_entries = max_entries
+        self._clock = clock
+
+        # <name: _QuotaState> in LRU order.
+        self._lgrp_states = collections.OrderedDict()
+        self._client_states = collections.OrderedDict()
+
+    def _get_state(self, states: collections.OrderedDict, name: str, get_quota, now: float) -> _QuotaState:
+
+        state = states.get(name)
+
+        if state is None:
+            state = _QuotaState(get_quota(), now)
+            states[name] = state
+            if len(states) > self._max_entries:
+                states.popitem(last=False)
+        else:
+            states.move_to_end(name)
+
+        for bucket in state.buckets.values():
+            bucket.refill(now)
+
+        return state
+
+    def admit(self, lgrp: str, client: str, num_records: int, num_bytes: int) -> tuple:
+        """ Take num_records and num_bytes from lgrp's and client's buckets if they fit all of them.
+        Return <None, 0> if they did, <reason, seconds to wait before trying again> if they didnt.
+        reason is ie "lgrp_records", "client_bytes", ... """
+
+        now = self._clock()
+        costs = {'records': num_records, 'bytes': num_bytes}
+
+        states = [('lgrp', self._get_state(self._lgrp_states, lgrp, lambda: get_lgrp_opts(self._lgrp_quotas, lgrp),
+                                           now))]
+        if self._client_quota is not None:
+            states.append(('client', self._get_state(self._client_states, client, lambda: self._client_quota, now)))
+
+        reason = None
+        retry_after = 0.0
+        throttled_state = None
+        for scope, state in states:
+            for kind, bucket in state.buckets.items():
+                wait = bucket.get_wait(costs[kind])
+                if wait > retry_after:
+                    reason = f"{scope}_{kind}"
+                    retry_after = wait
+                    throttled_state = state
+
+        if reason is None:
+            for _, state in states:
+                state.count('accepted', num_records, num_bytes)
+                for kind, bucket in state.buckets.items():
+                    bucket.take(costs[kind])
+            return None, 0
+
+        # only the one whose quota it didnt fit counts it as throttled. a client over its quota doesnt make the log
+        # group it was sending to a throttled one.
+        throttled_state.count('throttled', num_records, num_bytes)
+        if throttled_state.counters['throttled_reqs'] == 1:
+            log.warn(f"Log group: {lgrp}, client: {client} is being throttled. ({reason})")
+
+        return reason, retry_after
+
+    def get_stats(self, max_clients: int = 10) -> dict:
+        """ Return the counters of every log group, and of the max_clients most throttled clients. """
+
+        top_clients = sorted(self._client_states.items(), key=lambda item: item[1].counters['throttled_reqs'],
+                             reverse=True)[:max_clients]
+
+        return {
+            'lgrps': {lgrp: dict(state.counters) for lgrp, state in self._lgrp_states.items()},
+            'throttled_lgrps': sorted(lgrp for lgrp, state in self._lgrp_states.items()
+                                      if state.counters['throttled_reqs']),
+            'top_throttled_clients': {client: dict(state.counters) for client, state in top_clients
+                                      if state.counters['throttled_reqs']},
+        }
+
+
+def get_retry_after_header(retry_after: float) -> str:
+    """ Retry-After is in whole seconds. """
+
+    return str(max(1, int(math.ceil(retry_after))))
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# ============================================================================================================ dbg/bench
+def _dbg_bench_noisy_neighbor(duration: float = 20.0, tick: float = 0.01, capacity: int = 500,
+                              noisy_rate: int = 1200, quiet_rate: int = 50, quiet_groups: int = 4):
+    """ Simulated time, tick seconds per step. One DBL worker that gets thru capacity records per tick, one noisy
+    log group sending noisy_rate records per tick, quiet_groups others sending quiet_rate each. The queue is FIFO like
+    the norm_q. W/o quotas the quiet groups wait behind the noisy one, w/ a quota on the noisy one they dont. """
+
+    def run(lgrp_quotas):
+        queue = collections.deque()
+        sent = collections.Counter()
+        throttled = collections.Counter()
+        waits = collections.defaultdict(list)
+        budget = 0
+        sim_time = [0.0]
+
+        quotas = None
+        if lgrp_quotas is not None:
+            quotas = IngestQuotas(lgrp_quotas=lgrp_quotas, clock=lambda: sim_time[0])
+
+        for step in range(int(duration / tick)):
+            sim_time[0] = step * tick
+
+            arrivals = [('noisy', noisy_rate // 10)] * 10
+            arrivals += [(f"quiet_{i}", quiet_rate // 10) for i in range(quiet_groups) for _ in range(10)]
+            for lgrp, num_records in arrivals:
+                sent[lgrp] += num_records
+                if quotas is not None:
+                    reason, _ = quotas.admit(lgrp, '10.0.0.1' if lgrp == 'noisy' else lgrp, num_records,
+                                             num_records * 200)
+                    if reason is not None:
+                        throttled[lgrp] += num_records
+                        continue
+                queue.append((sim_time[0], lgrp, num_records))
+
+            budget += capacity
+            while queue and budget > 0:
+                enqueue_ts, lgrp, num_records = queue.popleft()
+                budget -= num_records
+                waits[lgrp].append(sim_time[0] - enqueue_ts)
+            budget = min(budget, capacity)
+
+        quiet_waits = sorted(wait for lgrp, lgrp_waits in waits.items() if lgrp != 'noisy' for wait in lgrp_waits)
+        return quiet_waits[len(quiet_waits) * 99 // 100], quiet_waits[-1], throttled['noisy'] / sent['noisy'], \
+            sum(throttled[lgrp] for lgrp in sent if lgrp != 'noisy'), quotas
+
+    print(f"{duration:.0f}s simulated, DBL worker does {capacity / tick:.0f} records/s. One log group sends "
+          f"{noisy_rate / tick:.0f}/s, {quiet_groups} others {quiet_rate / tick:.0f}/s each:")
+
+    for name, lgrp_quotas in [("no quotas", None), ("20k records/s per log group", {"*": {"records_per_sec": 20000}})]:
+        p99_wait, max_wait, noisy_throttled, quiet_throttled, quotas = run(lgrp_quotas)
+        print(f"  {name:<28} quiet groups' queue wait p99: {p99_wait:6.2f} s  max: {max_wait:6.2f} s  "
+              f"noisy throttled: {noisy_throttled:5.1%}  quiet throttled: {quiet_throttled}")
+        if quotas is not None:
+            print(f"  {'':<28} throttled log groups: {quotas.get_stats()['throttled_lgrps']}")
+
+
+def main():
+    _dbg_bench_noisy_neighbor()
+
+
+if '__main__' == __name__:
+    main()
@@ -62,6 +62,53 @@ _knobs = {
     # but we found much better solutions than sleep waiting for DBL operations.
     # "L6SK_API__SLEEP_WAIT_TIMEOUT": 0.01,
 
+    # Ingest quotas (see ingest_quotas.py). Token buckets checked before a request is queued, over quota gets a 429.
+    # records_per_sec/bytes_per_sec (request body), None means no limit. *_burst None means one second worth.
+    # Per log group: "*" applies to all log groups, a log group's own entry overrides it key by key.
+    # i.e. {"*": {"records_per_sec": 20000}, "noisy_svc": {"records_per_sec": 2000, "bytes_per_sec": 1024 * 1024}}
+    "L6SK_API__LGRP_QUOTAS": {
+        "*": {
+            "records_per_sec": None,
+            "records_burst": None,
+            "bytes_per_sec": None,
+            "bytes_burst": None,
+        },
+    },
+
+    # Per client (remote ip). Every client gets the same quota, on top of its log group's. None means no client quota.
+    # i.e. {"records_per_sec": 5000, "bytes_per_sec": 8 * 1024 * 1024}
+    "L6SK_API__CLIENT_QUOTA": None,
+
+    # buckets are kept for this many log groups, and this many clients. (the most recent ones)
+    "L6SK_API__QUOTA_MAX_ENTRIES": 10000,
+
+    # most records a single /api/lgr/query page can ask for.
+    "L6SK_API__QUERY_MAX_LIMIT": 1000,
+
+    # most buckets a single /api/lgr/histogram can cover. (srv_ts range / bucket)
+    "L6SK_API__HISTOGRAM_MAX_BUCKETS": 10000,
+
+    # most /api/lgr/export at once, over that a new one gets a 503. Each is a thread and a read snapshot.
+    "L6SK_API__EXPORT_MAX_RUNNING": 4,
+
+    # /api/hchk?level=1|2|3 answers 503 if the DBL hasnt served the health check in this many seconds.
+    "L6SK_API__HCHK_TIMEOUT": 5.0,
+
+    # live tail, /api/lgr/tail (see dbl/lgr_hub.py). Off means a 503 for it, and the DBL worker publishes nothing.
+    "L6SK_API__TAIL": True,
+
+    # most tails at once, over that a new one gets a 503.
+    "L6SK_API__TAIL_MAX_TAILS": 1000,
+
+    # records a tail can fall behind by before its dropped. (a client that doesnt read fast enough)
+    "L6SK_API__TAIL_BUFFER": 5000,
+
+    # seconds. a tail w/ nothing to send sends a keepalive comment this often. (and finds out the client is gone)
+    "L6SK_API__TAIL_KEEPALIVE": 15.0,
+
+    # seconds. a tail sends at most one event this often, records that come in meanwhile go out together.
+    "L6SK_API__TAIL_FLUSH_INTERVAL": 0.1,
+
     # ------------------------------------------------------------------------------------------------------------------
     # ----------------------------------------------------------------------------------------- Crypt Util (system wide)
     # 18 bytes == 144 bits (2 to the -144 is as collision safe as any other space)
@@ -113,6 +160,99 @@ _knobs = {
     # it will start sleep waiting for the next request until there is a new request which will reset counter to 0.
     "DBL__IDLE_QUEUE_THRESHOLD": 10,
 
+    # Ingest journal for sync_level 2 appends. If set, durable appends are group committed (one fsync for everything
+    # that came in during the last one) to journal files in this directory, acked, and applied to the DAO afterwards.
+    # Whatever didnt get applied is replayed at start up. None means the DAO makes each one durable itself.
+    # i.e. str((Path(__file__) / '..' / '..' / 'ignored_data' / 'DBL' / 'journal').resolve())
+    "DBL__JOURNAL_DIRNAME": None,
+
+    # seconds the journal waits after the first request of a group for more to join it. 0 is usually best, the fsync
+    # itself is long enough for the next group to pile up.
+    "DBL__JOURNAL_GROUP_COMMIT_DELAY": 0.0,
+
+    # start a new journal file after this many bytes. Files are deleted once everything in them is durable in the DAO.
+    # (for the memory DAO, in a snapshot. W/o SQLITE_MEM_DAO__SNAPSHOT_DIRNAME the journal isnt used)
+    "DBL__JOURNAL_FILE_SIZE": 16 * 1024 * 1024,
+
+    # Ingest sampling (see lgr_sampler.py). When the dispatch queues hold more than TARGET_QUEUE_DELAY seconds worth of
+    # requests, DBUG, then INFO, then WARN records are sampled (upto MIN_KEEP_RATIO), ERRR and CRIT never are. And
+    # each session over SESSION_RATE records/s (w/ SESSION_BURST of slack) is sampled down to about that.
+    # sync_level 2 appends are never sampled. Stored rows keep their sample_rate for re-weighting counts.
+    "DBL__SAMPLING": False,
+    "DBL__SAMPLING_TARGET_QUEUE_DELAY": 0.5,
+    "DBL__SAMPLING_MIN_KEEP_RATIO": 0.01,
+    "DBL__SAMPLING_SESSION_RATE": 500.0,
+    "DBL__SAMPLING_SESSION_BURST": 2000.0,
+
+    # per log group options for the DAO's log group storage. "*" applies to all log groups, a log group's own entry
+    # overrides it key by key. i.e. {"*": {...}, "noisy_svc": {"msg_compression": True}}
+    # Options (sqlite DAOs):
+    #   msg_compression: compress log msgs w/ a zlib dictionary trained on the log group's own recent msgs.
+    #   zdict_sample_size: how many recent msgs to train the dictionary on.
+    #   zdict_retrain_every: train a new dictionary every this many records. (old rows keep using the old ones)
+    #   repeat_window: seconds. a record identical (lvl, filename, lineno, msg) to the last one of its session is
+    #     collapsed into it, if its within this many seconds of it. Queries return repeat_count and last_srv_ts w/ each
+    #     row. None means store every record. Keep it well under the tiering ARCHIVE_AFTER.
+    #   repeat_sessions: how many sessions' last records are kept in memory for repeat_window.
+    #   fts: full text index on msg, for msg searches (/api/lgr/query msg). None means no index. "sync": records are
+    #     indexed as they are appended, searches always see them, ingest pays for it. "deferred": a LOW priority
+    #     background op does the indexing (DBL__FTS_INDEX_INTERVAL), searches see records once its got to them.
+    #   fts_batch_size: how many records a "deferred" indexing op indexes per log group.
+    #   regex_max_len: longest msg/filename regex a query can have, in chars.
+    #   regex_timeout: seconds. a query w/ a regex filter is interrupted after this long. None means no limit.
+    #   rollups: keep per minute and per hour record counts by level, updated w/ every append, for /api/lgr/histogram.
+    #   rollup_subsys: roll up by subsystem too, so histograms can filter and split on it.
+    #   rollup_minute_retention: seconds. minute rollups are kept this long, hour ones for ever. None means for ever.
+    #   session_summaries: keep a summary of every session (first/last srv_ts, counts by level and file, top msgs),
+    #     updated w/ every append, for /api/lgr/session_diff.
+    #   session_top_msgs: how many msgs are counted per session, the most frequent ones are kept.
+    #   templates: mask the values (numbers, hex, UUIDs, quoted strings) in msgs at ingest, give every record the id of
+    #     its msg's template, for /api/lgr/query template, and count the most frequent templates per hour, for
+    #     /api/lgr/templates.
+    #   template_top_k: how many templates are counted per hour, the most frequent ones are kept.
+    #   template_retention: seconds. hour template counts are kept this long. None means for ever.
+    # Options (segment DAO): segment_size, sync_appends, index_every, bloom_bytes, archive_after. Default to the
+    # SEGMENT_DAO__ knobs.
+    "DBL__LGRP_OPTS": {
+        "*": {
+            "msg_compression": False,
+            "zdict_sample_size": 2000,
+            "zdict_retrain_every": 100 * 1000,
+            "repeat_window": None,
+            "repeat_sessions": 1024,
+            "fts": None,
+            "fts_batch_size": 5000,
+            "regex_max_len": 256,
+            "regex_timeout": 2.0,
+            "rollups": True,
+            "rollup_subsys": False,
+            "rollup_minute_retention": 7 * 24 * 3600.0,
+            "session_summaries": True,
+            "session_top_msgs": 50,
+            "templates": True,
+            "template_top_k": 100,
+            "template_retention": 30 * 24 * 3600.0,
+        },
+    },
+
+    # seconds. How often DBL_API.INDEX_FTS is queued (LOW priority) to index the records of "deferred" fts log groups.
+    # Its queued again right away while there is a backlog. None means never, ie no log group is "deferred".
+    "DBL__FTS_INDEX_INTERVAL": 1.0,
+
+    # Query result cache of the sqlite DAOs (see lgr_query_cache.py), upto this many bytes of rows. A repeated query
+    # over records that didnt change is served w/o any SQL, one that overlaps the head only queries the records
+    # appended since it was cached, if there are upto QUERY_CACHE_MAX_DELTA of them. None means no cache.
+    "DBL__QUERY_CACHE_BYTES": 64 * 1024 * 1024,
+    "DBL__QUERY_CACHE_MAX_DELTA": 10000,
+
+    # Exports (/api/lgr/export, see lgr_export.py) of the sqlite DAOs read this many records at a time, and upto
+    # MAX_PENDING encoded chunks of them wait for the client. An export's memory is about their product, for any size
+    # of result. A client that doesnt read for STALL_TIMEOUT seconds gets cut off. (it holds a read snapshot, and w/ it
+    # the WAL checkpoints) None means never.
+    "DBL__EXPORT_CHUNK_ROWS": 1000,
+    "DBL__EXPORT_MAX_PENDING": 4,
+    "DBL__EXPORT_STALL_TIMEOUT": 60.0,
+
     # ------------------------------------------------------------------------------------------------------------------
     # --------------------------------------------------------------------------------------------------- Service Limits
     # various subsystems may read these limits and refuse service beyond these.
@@ -148,14 +288,38 @@ _knobs = {
 # dict_a.update(dict_b) unions dicts. Duplicate keys will resolve in favor of the update argument.
 
 # ******************** On disk sqlite DAO
+_knobs.update({
+    # Sqlite db file. If set, the server runs the on disk sqlite DAO, each log group a db file (lgrp_<name>.db) in the
+    # same directory. None means use the memory sqlite DAO. (SEGMENT_DAO__DIRNAME goes before either)
+    # i.e. str((Path(__file__) / '..' / '..' / 'ignored_data' / 'DBL' / 'l6sk.db').resolve())
+    "SQLITE_FS_DAO__DB_FILENAME": None,
+
+    # drop the db file (not the log group files) on each run. (see init_knob_man())
+    "SQLITE_FS_DAO__START_CLEAN": False,
+
+    # log group dbs are in WAL mode. read ops are served by this many reader threads (own read-only connections)
+    # so they dont queue up behind inserts on the DBL worker. 0 means serve everything on the DBL worker.
+    # A query across log groups (/api/lgr/query w/ lgrps) runs upto this many of its log groups at the same time.
+    "SQLITE_FS_DAO__NUM_READERS": 2,
+
+    # hot/cold tiering. partitions (this many seconds of srv_ts, aligned to the epoch) older than ARCHIVE_AFTER
+    # seconds are moved out of a log group's db into read-only, compressed archive dbs. Queries still see them.
+    # None means keep everything in the log group's db.
+    "SQLITE_FS_DAO__ARCHIVE_AFTER": 7 * 24 * 3600.0,
+    "SQLITE_FS_DAO__ARCHIVE_PARTITION": 24 * 3600.0,
+    "SQLITE_FS_DAO__ARCHIVE_INTERVAL": 600.0,
+
+    # WAL maintenance, done by the DBL worker between requests (see sqlite_maint.py). No automatic checkpoints on
+    # the writers, a PASSIVE checkpoint every CHECKPOINT_INTERVAL seconds or when the worker is idle. A WAL over
+    # WAL_MAX_BYTES is reset/truncated. None means leave it to sqlite's automatic checkpoints.
+    # Idle time also goes to incremental_vacuum, VACUUM_STEP_PAGES at a time.
+    "SQLITE_FS_DAO__CHECKPOINT_INTERVAL": 1.0,
+    "SQLITE_FS_DAO__WAL_MAX_BYTES": 64 * 1024 * 1024,
+    "SQLITE_FS_DAO__VACUUM_STEP_PAGES": 128,
+})
+
+# not taken by DAO_SQLITE (yet)
 # _KNOBS.update({
-#     # drop old files/tables on each run
-#     "SQLITE_FS_DAO__START_CLEAN": True,
-
-#     # Sqlite db file. must be str. In general you better have good reason to put non-str objects in knobman
-#     # keep it in a dedicated parent folder, which will be dropped in case of clean start
-#     "SQLITE_FS_DAO__DB_FILENAME": str((Path(__file__) / '..' / '..' / 'ignored_data' / 'DBL' / 'l6sk.db').resolve()),
-
 #     # synchronous off means we are good with a write() once its passed to the OS.
 #     # unlike PG, this isnt just a dataloss risk, turning this off does carry some risk of data/db_file corruption.
 #     "SQLITE_FS_DAO__PRAGMAS": [
@@ -164,10 +328,43 @@ _knobs = {
 # })
 
 # ******************** MEMORY sqlite DAO
-# _knobs.update({
-#     # TODO fill in.
-#     "SQLITE_MEM_DAO__XXXX": "YYYYYYYYY",
-# })
+_knobs.update({
+    # Periodic snapshots of the memory log groups to this directory, and warm restore from there at start up.
+    # None means no snapshots, everything is lost on restart.
+    # i.e. str((Path(__file__) / '..' / '..' / 'ignored_data' / 'DBL' / 'mem_snapshots').resolve())
+    "SQLITE_MEM_DAO__SNAPSHOT_DIRNAME": None,
+
+    # seconds between snapshots. This is how much data a crash could lose.
+    "SQLITE_MEM_DAO__SNAPSHOT_INTERVAL": 60.0,
+})
+
+# ******************** Segment file DAO
+_knobs.update({
+    # Append-only segment files instead of sqlite. If set, the server runs the segment DAO w/ its log groups under
+    # this directory. None means use one of the sqlite DAOs. (see SQLITE_FS_DAO__DB_FILENAME)
+    # i.e. str((Path(__file__) / '..' / '..' / 'ignored_data' / 'DBL' / 'segments').resolve())
+    "SEGMENT_DAO__DIRNAME": None,
+
+    # segment file size in bytes. (each segment is mmap()ed) A log record must fit in one segment.
+    "SEGMENT_DAO__SEGMENT_SIZE": 64 * 1024 * 1024,
+
+    # msync() appends before acking them. False is like sqlite synchronous = OFF, an OS crash may lose recent appends.
+    "SEGMENT_DAO__SYNC_APPENDS": True,
+
+    # sparse index: one entry (offset, srv_ts range) per this many records. This is the unit queries skip by.
+    "SEGMENT_DAO__INDEX_EVERY": 128,
+
+    # per segment bloom filter over session ids and subsystems. ~10 bits per distinct value gives ~1% false positives.
+    "SEGMENT_DAO__BLOOM_BYTES": 4096,
+
+    # sealed segments whose records are all older than this many seconds are compacted into column oriented archive
+    # files. ~3-4x smaller, slower to query. None means keep everything in segments.
+    "SEGMENT_DAO__ARCHIVE_AFTER": 3 * 24 * 3600.0,
+
+    # seconds between archive runs, and rows per column chunk in an archive (the unit a query can skip by zone maps)
+    "SEGMENT_DAO__ARCHIVE_INTERVAL": 600.0,
+    "SEGMENT_DAO__ARCHIVE_CHUNK_ROWS": 8192,
+})
 
 # ======================================================================================================================
 # ======================================================================================================================
@@ -12,14 +12,169 @@
 
 import os
 import json
+import time
+import asyncio
+import dataclasses
 
 import tornado.escape
 import tornado.ioloop
+import tornado.iostream
 import tornado.locks
 import tornado.web
 
+from l6sk.dbl.dbl_api import DBL_API, LOG_RECORD, LGR_APPEND_ARGS, LGR_QUERY, LGR_LVL_CODES, ts_to_usec
+from l6sk.dbl.dbl_api import LGR_HISTOGRAM, LGR_EXPORT, LGR_EXPORT_FORMATS, get_next_page_after, get_srv_ts_usec
+from l6sk.dbl.dbl_api import LGR_SESSION_DIFF, LGR_TEMPLATE_TOP, LGR_MULTI_QUERY, get_next_multi_page_after
+from l6sk.dbl.dbl_api import is_valid_lgrp_name
+from l6sk.dbl.dbl_dispatch import DBL_REQ, DBL_REQ_PRIORITY
+from l6sk.dbl.lgr_regex import get_query_regexes
+from l6sk.dbl.sqlite_lgrp import check_fts_query
+from l6sk.dbl.lgr_hub import TAIL_FIELDS
+from l6sk.dbl.lgr_export import EXPORT_CONTENT_TYPES
+from l6sk.ingest_quotas import get_retry_after_header
 from l6sk import log_util as log
 
+# how often handlers check on their DBL request. (see DBL_REQUEST_DISPATCH on sleep waiting)
+_DBL_SLEEP_WAIT = 0.002
+
+# what a client can set on a log record. srv_ts and sample_rate are the server's.
+_LGR_CLIENT_FIELDS = frozenset(fld.name for fld in dataclasses.fields(LOG_RECORD)) - {'srv_ts', 'sample_rate'}
+
+
+def _lgr_from_json(lgr_json) -> LOG_RECORD:
+    """ LOG_RECORD from a client's JSON object. client_ts is unix time in (possibly fractional) seconds. """
+
+    if not isinstance(lgr_json, dict):
+        raise ValueError("log record must be a JSON object")
+
+    unknown_fields = set(lgr_json) - _LGR_CLIENT_FIELDS
+    if unknown_fields:
+        raise ValueError(f"unknown log record fields: {sorted(unknown_fields)}")
+
+    lgr = LOG_RECORD(**lgr_json)
+    lgr.client_ts = ts_to_usec(lgr.client_ts)
+
+    return lgr
+
+
+def _get_int_arg(handler: tornado.web.RequestHandler, name: str):
+    """ Optional int query arg. None if not there, ValueError if its not an int. """
+
+    val = handler.get_argument(name, default=None)
+    return int(val) if val is not None else None
+
+
+def _get_lvl_args(handler: tornado.web.RequestHandler) -> tuple:
+    """ <lvls, lvl_min> from the lvl and lvl_min args, None if not there. ValueError on unknown levels. """
+
+    lvls = handler.get_argument("lvl", default=None)
+    if lvls is not None:
+        lvls = frozenset(lvl for lvl in lvls.split(',') if lvl)
+
+    lvl_min = handler.get_argument("lvl_min", default=None)
+
+    unknown_lvls = ((lvls or set()) | ({lvl_min} if lvl_min is not None else set())) - set(LGR_LVL_CODES)
+    if unknown_lvls:
+        raise ValueError(f"unknown levels: {sorted(unknown_lvls)}")
+
+    return lvls, lvl_min
+
+
+def _query_from_args(handler: tornado.web.RequestHandler, max_limit: int, default_limit: int = 100,
+                     cursor: bool = True) -> LGR_QUERY:
+    """ LGR_QUERY from a query request's args. ValueError on anything malformed. max_limit None means no max,
+    default_limit None means no limit. cursor False leaves the cursor arg to the caller. """
+
+    lvls, lvl_min = _get_lvl_args(handler)
+
+    limit = _get_int_arg(handler, "limit")
+    if limit is None:
+        limit = default_limit
+    elif (limit < 1) or ((max_limit is not None) and (limit > max_limit)):
+        raise ValueError(f"limit must be between 1 and {max_limit}" if max_limit is not None else "limit must be 1+")
+
+    # the cursor is what the previous page's response said, <srv_ts>_<lrid>.
+    after = handler.get_argument("cursor", default=None) if cursor else None
+    if after is not None:
+        srv_ts, lrid = after.split('_')
+        after = (int(srv_ts), int(lrid))
+
+    query = LGR_QUERY(lgrp=handler.get_argument("lgrp", default='default'),
+                      srv_ts_min=_get_int_arg(handler, "srv_ts_min"),
+                      srv_ts_max=_get_int_arg(handler, "srv_ts_max"),
+                      session_id=handler.get_argument("session_id", default=None),
+                      subsys=handler.get_argument("subsys", default=None),
+                      lvl_min=lvl_min,
+                      limit=limit,
+                      lvls=lvls,
+                      client_ts_min=_get_int_arg(handler, "client_ts_min"),
+                      client_ts_max=_get_int_arg(handler, "client_ts_max"),
+                      after=after,
+                      msg_match=handler.get_argument("msg", default=None) or None,
+                      msg_regex=handler.get_argument("msg_re", default=None) or None,
+                      filename_regex=handler.get_argument("filename_re", default=None) or None,
+                      template_id=_get_int_arg(handler, "template"))
+
+    # bad patterns are the client's, a 400 here rather than a DAO failure.
+    get_query_regexes(query)
+    if query.msg_match is not None:
+        check_fts_query(query.msg_match)
+
+    return query
+
+
+def _multi_query_from_args(handler: tornado.web.RequestHandler, max_limit: int) -> LGR_MULTI_QUERY:
+    """ LGR_MULTI_QUERY from a query request w/ an lgrps arg: log group names, comma separated, or * for every log
+    group. ValueError on anything malformed. """
+
+    query = _query_from_args(handler, max_limit, cursor=False)
+
+    lgrps = handler.get_argument("lgrps")
+    if lgrps == '*':
+        lgrps = None
+    else:
+        lgrps = tuple(sorted(set(lgrp for lgrp in lgrps.split(',') if lgrp)))
+        bad_lgrps = [lgrp for lgrp in lgrps if not is_valid_lgrp_name(lgrp)]
+        if (not lgrps) or bad_lgrps:
+            raise ValueError(f"invalid log group names: {bad_lgrps}" if bad_lgrps else "lgrps is empty")
+
+    # here the cursor is <srv_ts>_<lgrp>_<lrid>. log group names can have '_' in them, srv_ts and lrid cant.
+    after = handler.get_argument("cursor", default=None)
+    if after is not None:
+        srv_ts, after = after.split('_', 1)
+        lgrp, lrid = after.rsplit('_', 1)
+        after = (int(srv_ts), lgrp, int(lrid))
+
+    return LGR_MULTI_QUERY(query=query, lgrps=lgrps, after=after)
+
+
+def _histogram_from_args(handler: tornado.web.RequestHandler, max_buckets: int) -> LGR_HISTOGRAM:
+    """ LGR_HISTOGRAM from a histogram request's args. The last 24 hours if there is no srv_ts_min. ValueError on
+    anything malformed. """
+
+    lvls, lvl_min = _get_lvl_args(handler)
+
+    bucket_sec = int(handler.get_argument("bucket", default='60'))
+    if (bucket_sec <= 0) or (bucket_sec % 60):
+        raise ValueError(f"bucket must be a multiple of 60 seconds: {bucket_sec}")
+
+    srv_ts_max = _get_int_arg(handler, "srv_ts_max")
+    srv_ts_min = _get_int_arg(handler, "srv_ts_min")
+    if srv_ts_min is None:
+        srv_ts_min = (srv_ts_max if srv_ts_max is not None else get_srv_ts_usec()) - 24 * 3600 * 1000000
+
+    if (srv_ts_max is not None) and ((srv_ts_max - srv_ts_min) // (bucket_sec * 1000000) >= max_buckets):
+        raise ValueError(f"over {max_buckets} buckets, use a bigger bucket or a shorter srv_ts range")
+
+    return LGR_HISTOGRAM(lgrp=handler.get_argument("lgrp", default='default'),
+                         srv_ts_min=srv_ts_min,
+                         srv_ts_max=srv_ts_max,
+                         bucket_sec=bucket_sec,
+                         lvl_min=lvl_min,
+                         lvls=lvls,
+                         subsys=handler.get_argument("subsys", default=None),
+                         by_subsys=handler.get_argument("by_subsys", default='0') == '1')
+
 
 
 # ======================================================================================================================
@@ -34,19 +189,422 @@ class Index(tornado.web.RequestHandler):
 
 # ----------------------------------------------------------------------------------------------------------------------
 class API_NEW_LGR(tornado.web.RequestHandler):
-    def post(self):
+
+    # log clients (SDKs, fifo_2_l6sk, curl) dont have an xsrf cookie. This endpoint doesnt use cookies at all.
+    def check_xsrf_cookie(self):
         pass
-        # message = {"id": str(uuid.uuid4()), "body": self.get_argument("body")}
-        # render_string() returns a "bytes", which is not supported in json. We need to get to a "str" + escaping
-        # because we might paste this back into a returned template, and we dont want to allow for html injection.
-        # message["html"] = tornado.escape.to_unicode(self.render_string("mytemplate.html", tpl_args=tpl_args))
+
+    async def post(self):
+        self.set_header("Content-Type", 'application/json')
+
+        try:
+            lgr_json = json.loads(self.get_argument("lgr"))
+            lgrs = [_lgr_from_json(item) for item in (lgr_json if isinstance(lgr_json, list) else [lgr_json])]
+            lgrp = self.get_argument("lgrp", default='default')
+            sync_level = int(self.get_argument("sync_level", default='0'))
+
+            if sync_level not in {0, 1, 2}:
+                raise ValueError(f"invalid sync_level: {sync_level}")
+        except (ValueError, TypeError) as ex:
+            self.set_status(400)
+            self.write(json.dumps({"err": "BAD_REQUEST", "msg": str(ex)}))
+            return
+
+        # over quota, the DBL worker never sees it.
+        ingest_quotas = self.settings.get('ingest_quotas')
+        if ingest_quotas is not None:
+            reason, retry_after = ingest_quotas.admit(lgrp, self.request.remote_ip, len(lgrs), len(self.request.body))
+            if reason is not None:
+                self.set_status(429)
+                self.set_header("Retry-After", get_retry_after_header(retry_after))
+                self.write(json.dumps({"err": "TOO_MANY_REQUESTS", "msg": f"over quota: {reason}"}))
+                return
+
+        # under load, some records dont make it to the queues. A client that asked for durability gets all of them in.
+        num_sampled_out = 0
+        lgr_sampler = self.settings.get('lgr_sampler')
+        if (lgr_sampler is not None) and (sync_level < 2):
+            kept_lgrs = lgr_sampler.sample(lgrs)
+            num_sampled_out = len(lgrs) - len(kept_lgrs)
+            lgrs = kept_lgrs
+
+        # nothing left to append.
+        if not lgrs:
+            if sync_level == 0:
+                self.write(json.dumps({"err": "SUCC"}))
+            else:
+                self.write(json.dumps({"err": "SUCC", "count": 0, "sampled_out": num_sampled_out}))
+            return
+
+        # sync_level 2 is APPEND_LGRS_DURABLE, the dispatcher sends it to the ingest journal if there is one.
+        op = DBL_API.APPEND_LGRS_DURABLE if sync_level == 2 else DBL_API.APPEND_LGRS
+        req = DBL_REQ(op=op, data=LGR_APPEND_ARGS(lgrp, lgrs))
+        self.settings['dbl_dispatch'].put_req(req)
+
+        if sync_level == 0:
+            self.write(json.dumps({"err": "SUCC"}))
+            return
+
+        while (req.succ_data is None) and (req.fail_cause is None):
+            await asyncio.sleep(_DBL_SLEEP_WAIT)
+
+        if req.fail_cause is not None:
+            log.dbg(f"Log record append failed: {req.fail_cause}")
+            self.set_status(req.fail_cause.http_err_code)
+            self.write(json.dumps({"err": req.fail_cause.user_msg}))
+            return
+
+        self.write(json.dumps({"err": "SUCC", "count": req.succ_data, "sampled_out": num_sampled_out}))
 
 
 # ----------------------------------------------------------------------------------------------------------------------
-class API_HCHK(tornado.web.RequestHandler):
+class API_LGR_QUERY(tornado.web.RequestHandler):
+
+    async def get(self):
+        self.set_header("Content-Type", 'application/json')
+
+        # w/ lgrps, the query runs on each of those log groups and the results are merged.
+        multi = self.get_argument("lgrps", default=None) is not None
+
+        try:
+            if multi:
+                query = _multi_query_from_args(self, self.settings.get('query_max_limit', 1000))
+            else:
+                query = _query_from_args(self, self.settings.get('query_max_limit', 1000))
+        except ValueError as ex:
+            self.set_status(400)
+            self.write(json.dumps({"err": "BAD_REQUEST", "msg": str(ex)}))
+            return
+
+        req = DBL_REQ(op=DBL_API.QUERY_MULTI_LGRS if multi else DBL_API.QUERY_LGRS, data=query)
+        self.settings['dbl_dispatch'].put_req(req)
+
+        while (req.succ_data is None) and (req.fail_cause is None):
+            await asyncio.sleep(_DBL_SLEEP_WAIT)
+
+        if req.fail_cause is not None:
+            log.dbg(f"Log record query failed: {req.fail_cause}")
+            self.set_status(req.fail_cause.http_err_code)
+            self.write(json.dumps({"err": req.fail_cause.user_msg}))
+            return
+
+        if multi:
+            after = get_next_multi_page_after(query, req.succ_data['lgrs'])
+            cursor = f"{after[0]}_{after[1]}_{after[2]}" if after is not None else None
+        else:
+            after = get_next_page_after(query, req.succ_data['lgrs'])
+            cursor = f"{after[0]}_{after[1]}" if after is not None else None
+
+        self.write(json.dumps({"err": "SUCC", "fields": req.succ_data['fields'], "lgrs": req.succ_data['lgrs'],
+                               "cursor": cursor}))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class API_LGR_HISTOGRAM(tornado.web.RequestHandler):
+    """ Record counts per time bucket and level. Off the log group's rollups, it costs what the number of buckets
+    does, not what the number of records does. """
+
+    async def get(self):
+        self.set_header("Content-Type", 'application/json')
+
+        try:
+            hist = _histogram_from_args(self, self.settings.get('histogram_max_buckets', 10000))
+        except ValueError as ex:
+            self.set_status(400)
+            self.write(json.dumps({"err": "BAD_REQUEST", "msg": str(ex)}))
+            return
+
+        req = DBL_REQ(op=DBL_API.HISTOGRAM_LGRS, data=hist)
+        self.settings['dbl_dispatch'].put_req(req)
+
+        while (req.succ_data is None) and (req.fail_cause is None):
+            await asyncio.sleep(_DBL_SLEEP_WAIT)
+
+        if req.fail_cause is not None:
+            log.dbg(f"Log record histogram failed: {req.fail_cause}")
+            self.set_status(req.fail_cause.http_err_code)
+            self.write(json.dumps({"err": req.fail_cause.user_msg}))
+            return
+
+        self.write(json.dumps({"err": "SUCC", "bucket": hist.bucket_sec, "fields": req.succ_data['fields'],
+                               "buckets": req.succ_data['buckets']}))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class API_LGR_SESSION_DIFF(tornado.web.RequestHandler):
+    """ Compare two sessions of a log group, ie the latest run w/ an earlier one. Off the per session summaries kept at
+    ingest, it costs the same for sessions of a hundred records or of millions. Rows behind a difference are a
+    /api/lgr/query w/ the session_id and the regex that comes w/ it, only for the ones the user wants to see. """
+
+    async def get(self):
+        self.set_header("Content-Type", 'application/json')
+
+        try:
+            diff = LGR_SESSION_DIFF(lgrp=self.get_argument("lgrp", default='default'),
+                                    session_a=self.get_argument("a"),
+                                    session_b=self.get_argument("b"),
+                                    top=int(self.get_argument("top", default='20')))
+            if not 0 < diff.top <= self.settings.get('query_max_limit', 1000):
+                raise ValueError(f"top out of range: {diff.top}")
+        except (ValueError, tornado.web.MissingArgumentError) as ex:
+            self.set_status(400)
+            self.write(json.dumps({"err": "BAD_REQUEST", "msg": str(ex)}))
+            return
+
+        req = DBL_REQ(op=DBL_API.DIFF_SESSIONS, data=diff)
+        self.settings['dbl_dispatch'].put_req(req)
+
+        while (req.succ_data is None) and (req.fail_cause is None):
+            await asyncio.sleep(_DBL_SLEEP_WAIT)
+
+        if req.fail_cause is not None:
+            log.dbg(f"Session diff failed: {req.fail_cause}")
+            self.set_status(req.fail_cause.http_err_code)
+            self.write(json.dumps({"err": req.fail_cause.user_msg}))
+            return
+
+        missing = [session_id for session_id, side in ((diff.session_a, 'a'), (diff.session_b, 'b'))
+                   if req.succ_data[side] is None]
+        if missing:
+            self.set_status(404)
+            self.write(json.dumps({"err": "NOT_FOUND", "msg": f"no summary for session(s): {', '.join(missing)}"}))
+            return
+
+        self.write(json.dumps(dict(req.succ_data, err="SUCC")))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class API_LGR_TEMPLATES(tornado.web.RequestHandler):
+    """ The most frequent msg templates of a log group, ie what it has mostly been logging lately. Off the per hour
+    counts kept at ingest, it costs what the number of hours does. The records of a template are a /api/lgr/query w/
+    its id. """
+
+    async def get(self):
+        self.set_header("Content-Type", 'application/json')
+
+        try:
+            srv_ts_max = _get_int_arg(self, "srv_ts_max")
+            srv_ts_min = _get_int_arg(self, "srv_ts_min")
+            if srv_ts_min is None:
+                srv_ts_min = (srv_ts_max if srv_ts_max is not None else get_srv_ts_usec()) - 24 * 3600 * 1000000
+
+            top = LGR_TEMPLATE_TOP(lgrp=self.get_argument("lgrp", default='default'),
+                                   srv_ts_min=srv_ts_min,
+                                   srv_ts_max=srv_ts_max,
+                                   limit=int(self.get_argument("limit", default='20')))
+            if not 0 < top.limit <= self.settings.get('query_max_limit', 1000):
+                raise ValueError(f"limit out of range: {top.limit}")
+        except ValueError as ex:
+            self.set_status(400)
+            self.write(json.dumps({"err": "BAD_REQUEST", "msg": str(ex)}))
+            return
+
+        req = DBL_REQ(op=DBL_API.TOP_TEMPLATES, data=top)
+        self.settings['dbl_dispatch'].put_req(req)
+
+        while (req.succ_data is None) and (req.fail_cause is None):
+            await asyncio.sleep(_DBL_SLEEP_WAIT)
+
+        if req.fail_cause is not None:
+            log.dbg(f"Top templates failed: {req.fail_cause}")
+            self.set_status(req.fail_cause.http_err_code)
+            self.write(json.dumps({"err": req.fail_cause.user_msg}))
+            return
+
+        self.write(json.dumps(dict(req.succ_data, err="SUCC")))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class API_LGR_EXPORT(tornado.web.RequestHandler):
+    """ Every record a query matches, NDJSON or CSV, optionally gzip. The DAO runs the export on a thread of its own
+    (see dbl/lgr_export.py), this writes and flush()es its chunks as they come. A client that reads slowly holds the
+    export back, not the other way around, memory stays at a few chunks. """
+
+    # exports running right now. IOLoop thread only.
+    _num_running = 0
+
+    def initialize(self):
+        self._export = None
+
+    async def get(self):
+
+        try:
+            query = _query_from_args(self, None, default_limit=None)
+            fmt = self.get_argument("format", default='ndjson')
+            if fmt not in LGR_EXPORT_FORMATS:
+                raise ValueError(f"format must be one of: {', '.join(LGR_EXPORT_FORMATS)}")
+            gzip = self.get_argument("gzip", default='0') == '1'
+        except ValueError as ex:
+            self.set_header("Content-Type", 'application/json')
+            self.set_status(400)
+            self.write(json.dumps({"err": "BAD_REQUEST", "msg": str(ex)}))
+            return
+
+        if API_LGR_EXPORT._num_running >= self.settings.get('export_max_running', 4):
+            self.set_header("Content-Type", 'application/json')
+            self.set_status(503)
+            self.write(json.dumps({"err": "UNAVAILABLE", "msg": "too many exports running, try again later"}))
+            return
+
+        API_LGR_EXPORT._num_running += 1
+        try:
+            await self._export_lgrs(LGR_EXPORT(query, fmt=fmt, gzip=gzip))
+        finally:
+            API_LGR_EXPORT._num_running -= 1
+
+    async def _export_lgrs(self, args: LGR_EXPORT):
+
+        req = DBL_REQ(op=DBL_API.EXPORT_LGRS, data=args)
+        self.settings['dbl_dispatch'].put_req(req)
+
+        while (req.succ_data is None) and (req.fail_cause is None):
+            await asyncio.sleep(_DBL_SLEEP_WAIT)
+
+        if req.fail_cause is not None:
+            log.dbg(f"Log record export failed: {req.fail_cause}")
+            self.set_header("Content-Type", 'application/json')
+            self.set_status(req.fail_cause.http_err_code)
+            self.write(json.dumps({"err": req.fail_cause.user_msg}))
+            return
+
+        export = self._export = req.succ_data
+        num_written = 0
+
+        try:
+            while True:
+                chunk = export.get_chunk()
+                if chunk is None:
+                    break
+
+                if not chunk:
+                    await asyncio.sleep(_DBL_SLEEP_WAIT)
+                    continue
+
+                # headers go out w/ the first chunk, a query that fails right away can still be a 500.
+                if not num_written:
+                    self.set_header("Content-Type", EXPORT_CONTENT_TYPES[args.fmt])
+                    self.set_header("Content-Disposition", f'attachment; filename="{args.query.lgrp}.{args.fmt}"')
+                    if args.gzip:
+                        self.set_header("Content-Encoding", 'gzip')
+
+                self.write(chunk)
+                num_written += len(chunk)
+                await self.flush()
+
+            if export.error is not None:
+                log.warn(f"Export of log group: {args.query.lgrp} failed after {num_written} bytes: {export.error}")
+
+                if not num_written:
+                    self.set_header("Content-Type", 'application/json')
+                    self.set_status(500)
+                    self.write(json.dumps({"err": 'Internal Server Error'}))
+                    return
 
+                # the status is long gone. cut the connection, so the client sees a truncated response, not a
+                # complete looking one.
+                self.request.connection.close()
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            export.cancel()
+
+    def on_connection_close(self):
+        if self._export is not None:
+            self._export.cancel()
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class API_LGR_TAIL(tornado.web.RequestHandler):
+    """ Live tail, as server-sent events. Records come from the LgrHub (self.settings['lgr_hub']) as the DBL worker
+    appends them, the DBL is never queried. """
+
+    def initialize(self):
+        self._sub = None
+
+    async def get(self):
+        lgr_hub = self.settings.get('lgr_hub')
+
+        try:
+            lvls, lvl_min = _get_lvl_args(self)
+        except ValueError as ex:
+            self.set_header("Content-Type", 'application/json')
+            self.set_status(400)
+            self.write(json.dumps({"err": "BAD_REQUEST", "msg": str(ex)}))
+            return
+
+        query = LGR_QUERY(lgrp=self.get_argument("lgrp", default='default'), lvls=lvls, lvl_min=lvl_min,
+                          session_id=self.get_argument("session_id", default=None),
+                          subsys=self.get_argument("subsys", default=None))
+
+        if lgr_hub is not None:
+            self._sub = lgr_hub.subscribe(query)
+
+        if self._sub is None:
+            self.set_header("Content-Type", 'application/json')
+            self.set_status(503)
+            self.write(json.dumps({"err": "UNAVAILABLE", "msg": "live tail is off, or at its max tails"}))
+            return
+
+        self.set_header("Content-Type", 'text/event-stream')
+        self.set_header("Cache-Control", 'no-cache')
+        self.set_header("X-Accel-Buffering", 'no')
+
+        sub = self._sub
+        keepalive = self.settings.get('tail_keepalive', 15.0)
+        flush_interval = self.settings.get('tail_flush_interval', 0.1)
+
+        try:
+            self.write(f"event: fields\ndata: {json.dumps(TAIL_FIELDS)}\n\n")
+            await self.flush()
+
+            while not sub.closed:
+                items = await lgr_hub.wait(sub, keepalive)
+
+                if items:
+                    # id is the last record's srv_ts. /api/lgr/query srv_ts_min=<id> picks up from there.
+                    self.write(f"id: {items[-1][0]}\ndata: [{','.join(item[1] for item in items)}]\n\n")
+                elif not sub.closed:
+                    self.write(": keepalive\n\n")
+
+                await self.flush()
+
+                # whatever comes in meanwhile goes out in one event. a busy log group doesnt mean a write per batch.
+                await asyncio.sleep(flush_interval)
+
+            # the hub dropped us, we didnt keep up. the client can reconnect and catch up w/ /api/lgr/query.
+            if sub.dropped:
+                self.write(f"event: dropped\ndata: {json.dumps({'msg': 'fell behind, reconnect'})}\n\n")
+                await self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            lgr_hub.unsubscribe(sub)
+
+    def on_connection_close(self):
+        if self._sub is not None:
+            self.settings['lgr_hub'].unsubscribe(self._sub)
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class API_LGR_QUOTAS(tornado.web.RequestHandler):
 
     def get(self):
+        self.set_header("Content-Type", 'application/json')
+
+        ingest_quotas = self.settings.get('ingest_quotas')
+        stats = ingest_quotas.get_stats() if ingest_quotas is not None else {}
+        self.write(json.dumps({"err": "SUCC", **stats}))
+
+
+# ----------------------------------------------------------------------------------------------------------------------
+class API_HCHK(tornado.web.RequestHandler):
+
+    # level 0 is just the web layer answering. 1, 2, 3 go thru the dispatcher to the DAO as HEALTH_CHK_1/2/3 (DAO ack,
+    # timed db read, timed db write) at HIGH priority. ie what a request would wait right now, w/ the queues as they
+    # are, so a load balancer can go by that instead of just liveness.
+    _HCHK_OPS = {1: DBL_API.HEALTH_CHK_1, 2: DBL_API.HEALTH_CHK_2, 3: DBL_API.HEALTH_CHK_3}
+
+    async def get(self):
         # you can implement a superclass for all APIHandlers that has a
         # self.set_default_headers() method where you could set headers for json response in there.
         # and then ensure that all /api/... handlers subclass APIHandler ...
@@ -57,5 +615,44 @@ class API_HCHK(tornado.web.RequestHandler):
 
         # TODO get this out of incoming get and echo it back to the user. we need to write JSON not html
         ping_id = self.get_argument("ping_id", default='ping0000')
-        res = {'ping_id': ping_id, "err": "SUCC"}
-        self.write(json.dumps(res))
+
+        try:
+            level = int(self.get_argument("level", default='0'))
+            if level not in {0, 1, 2, 3}:
+                raise ValueError(f"invalid level: {level}")
+        except ValueError as ex:
+            self.set_status(400)
+            self.write(json.dumps({'ping_id': ping_id, "err": "BAD_REQUEST", "msg": str(ex)}))
+            return
+
+        if level == 0:
+            res = {'ping_id': ping_id, "err": "SUCC"}
+            self.write(json.dumps(res))
+            return
+
+        dispatch = self.settings['dbl_dispatch']
+        req = DBL_REQ(op=self._HCHK_OPS[level], priority=DBL_REQ_PRIORITY.HIGH)
+        dispatch.put_req(req)
+
+        deadline = time.monotonic() + self.settings.get('hchk_timeout', 5.0)
+        while (req.succ_data is None) and (req.fail_cause is None):
+            if time.monotonic() > deadline:
+                self.set_status(503)
+                self.write(json.dumps({'ping_id': ping_id, "err": "TIMEOUT", "level": level,
+                                       "queue_depths": dispatch.get_queue_depths()}))
+                return
+            await asyncio.sleep(_DBL_SLEEP_WAIT)
+
+        res = {'ping_id': ping_id, "level": level,
+               "queue_wait_ms": (req.dequeue_ts - req.enqueue_ts) * 1000,
+               "queue_depths": dispatch.get_queue_depths()}
+
+        if req.fail_cause is not None:
+            log.warn(f"Health check v{level} failed: {req.fail_cause}")
+            self.set_status(503)
+            self.write(json.dumps({"err": "UNHEALTHY", **res}))
+            return
+
+        # v1 is just a string.
+        hchk = req.succ_data if isinstance(req.succ_data, dict) else {'hchk': req.succ_data}
+        self.write(json.dumps({"err": "SUCC", **res, 'hchk': hchk['hchk'], 'dao_exec_ms': hchk.get('dao_exec_ms')}))
@@ -21,6 +21,13 @@ from l6sk import l6sk_api
 L6SK_ROUTES = [
     (r"/", l6sk_api.Index),
     (r"/api/lgr/new", l6sk_api.API_NEW_LGR),
+    (r"/api/lgr/query", l6sk_api.API_LGR_QUERY),
+    (r"/api/lgr/histogram", l6sk_api.API_LGR_HISTOGRAM),
+    (r"/api/lgr/tail", l6sk_api.API_LGR_TAIL),
+    (r"/api/lgr/export", l6sk_api.API_LGR_EXPORT),
+    (r"/api/lgr/session_diff", l6sk_api.API_LGR_SESSION_DIFF),
+    (r"/api/lgr/templates", l6sk_api.API_LGR_TEMPLATES),
+    (r"/api/lgr/quotas", l6sk_api.API_LGR_QUOTAS),
     (r"/api/hchk", l6sk_api.API_HCHK),
 ]
 
@@ -34,7 +41,12 @@ API_DOCS = """
 - Post a new log record to this server.
 
 *** REQUIRED Arg: lgr
-    - The actual log record to be inserted as a JSON.
+    - The actual log record to be inserted as a JSON. (or a JSON list of them)
+    - fields: client_ts (unix time in seconds), lvl, subsys, session_id, lineno, filename, funcname, pname, pid,
+      tname, tid, msg. All optional.
+
+- OPTIONAL: lgrp
+    - log group name. default: "default"
 
 - OPTIONAL: sync_level
     - how long should this request wait before completion (ie client gets HTTP 200).
@@ -42,28 +54,169 @@ API_DOCS = """
     - 0: means this requests succeeds as soon as the server received a well formed the request.
     - 1: means wait till the record is fully processed by l6sk server and passed to the next layer (ie OS, DB, Disk)
     - 2: means wait till next layer confirms sync as well, ie fsync() or whatever else to assure durability.
+      w/ the ingest journal on (DBL__JOURNAL_DIRNAME) this is the journal's group fsync, the DB gets it right after.
+      The memory DAO w/o snapshots (SQLITE_MEM_DAO__SNAPSHOT_DIRNAME) cant make anything durable, 2 is the same as 1.
 
 ----
 #### JSON Response:
-- requst status
+- requst status: {"err": "SUCC", "count": <records appended>, "sampled_out": <records dropped by sampling>}
+  (no count for sync_level 0)
+- w/ sampling on (DBL__SAMPLING), sync_level 0 and 1 records may be sampled out when the server is behind. ERRR and
+  CRIT never are. Stored records keep the probability they were kept w/ (sample_rate).
+- HTTP 400 w/ {"err": "BAD_REQUEST", "msg": ...} for a malformed lgr or sync_level.
+- HTTP 429 w/ {"err": "TOO_MANY_REQUESTS", "msg": ...} and a Retry-After header (seconds) if the log group or the
+  client is over its ingest quota (L6SK_API__LGRP_QUOTAS, L6SK_API__CLIENT_QUOTA). Nothing was appended.
+
+======================================= ENDPOINT: /api/lgr/query
+- GET. Read back log records, in (srv_ts, lrid) order. All args optional, filters are ANDed.
+- lgrp: log group name. default: "default"
+- lgrps: search several log groups at once instead, comma separated names, or * for every log group. Each one is
+  queried w/ the same filters and the results merged, in (srv_ts, lgrp, lrid) order. Rows get the log group's name
+  as one more field, "lgrp", last. lgrp is ignored. W/ the on disk sqlite DAO (SQLITE_FS_DAO__DB_FILENAME set) upto
+  SQLITE_FS_DAO__NUM_READERS of the log groups are queried at the same time, the other DAOs go one after the other.
+- lvl: comma separated levels, ie "WARN,ERRR". lvl_min: a level, ie "WARN" means WARN, ERRR and CRIT.
+  Records w/o a level dont match either.
+- session_id, subsys: exact matches.
+- srv_ts_min, srv_ts_max, client_ts_min, client_ts_max: unix time in integer micro seconds, inclusive.
+- msg: full text search on msg, sqlite FTS5 syntax. ie: timeout upstream (both tokens), "connection refused" (phrase),
+  retr* (prefix), timeout OR refused, timeout NOT db. Only for log groups w/ a full text index (DBL__LGRP_OPTS "fts"),
+  w/ "deferred" indexing the most recent records may not be searchable yet.
+- msg_re, filename_re: python regex, matches anywhere in msg / filename. ie: timeout after [0-9]+ ms, ^src/net/.
+  Upto 256 chars. Quantified groups w/ a quantifier or | in them ie (a+)+ (a|aa)+ are refused. The more quantifiers
+  a pattern has, the less of a long msg it searches: all of it for none, the first 10k chars for one (.* [0-9]+ ...),
+  the first ~460 for two, ~100 for three, more are refused. Slow (no index), narrow the query down w/
+  srv_ts and lvl filters first. A query running over the log group's regex_timeout (DBL__LGRP_OPTS) fails.
+- template: a template id (see /api/lgr/templates), records whose msg has that template. Indexed. Records appended
+  before the log group had templates (DBL__LGRP_OPTS "templates") have none, they never match. (sqlite DAOs)
+- limit: records per page. default: 100, max: L6SK_API__QUERY_MAX_LIMIT
+- cursor: the "cursor" of the previous page's response, to get the next page. Keep the other args the same.
+- Returns: {"err": "SUCC", "fields": [<field name>, ...], "lgrs": [[<value>, ...], ...], "cursor": <str or null>}
+  rows are in "fields" order. cursor is null on the last page.
+- HTTP 400 w/ {"err": "BAD_REQUEST", "msg": ...} for malformed args (a msg FTS5 cant parse too), or invalid log group
+  names in lgrps. HTTP 400 w/ {"err": <why>} for a msg or template on a log group w/o a full text index / templates.
+
+======================================= ENDPOINT: /api/lgr/histogram
+- GET. Count of records per time bucket and level, ie for a "records per minute by level" chart. Reads the log
+  group's rollups (DBL__LGRP_OPTS "rollups"), never the records, so it takes about as long for a billion records as
+  for a thousand. All args optional.
+- lgrp: log group name. default: "default"
+- bucket: bucket size in seconds, a multiple of 60. default: 60. Buckets are aligned to the epoch. Minute rollups are
+  kept for the log group's rollup_minute_retention (7 days by default), use a multiple of 3600 for older ranges.
+- srv_ts_min, srv_ts_max: unix time in integer micro seconds. The buckets they are in are included.
+  default: the last 24 hours. Upto L6SK_API__HISTOGRAM_MAX_BUCKETS buckets.
+- lvl, lvl_min: same as /api/lgr/query. Records w/o a level are counted under a null lvl, unless filtered.
+- subsys: only this subsystem. by_subsys=1: a count per subsystem. Both need DBL__LGRP_OPTS "rollup_subsys".
+- Returns: {"err": "SUCC", "bucket": <bucket>, "fields": ["bucket_ts", "lvl", "subsys", "count", "est_count"],
+  "buckets": [[<value>, ...], ...]} in bucket_ts, lvl (, subsys) order. Buckets w/ no records are left out.
+  count: records appended (repeats collapsed at ingest each count). est_count: count w/ sampled records re-weighted,
+  ie about what it would have been w/o ingest sampling. subsys is null unless by_subsys=1.
+- HTTP 400 w/ {"err": "BAD_REQUEST", "msg": ...} for malformed args.
+
+======================================= ENDPOINT: /api/lgr/tail
+- GET. Live tail of a log group, as server-sent events (Content-Type: text/event-stream, ie EventSource in a browser)
+  Records are sent as they are appended, this doesnt query the DB.
+- lgrp: log group name. default: "default"
+- lvl, lvl_min, session_id, subsys: same filters as /api/lgr/query.
+- Events:
+  - "fields" (first): data is the JSON list of field names. /api/lgr/query's w/o lrid.
+  - message events (no event name): data is a JSON list of records (lists of values in "fields" order), id is the
+    srv_ts of the last one. Records appended in the same L6SK_API__TAIL_FLUSH_INTERVAL come in the same event.
+  - comment lines (": keepalive") every L6SK_API__TAIL_KEEPALIVE seconds w/ nothing to send.
+  - "dropped": the client fell behind by more than L6SK_API__TAIL_BUFFER records, the stream ends. Reconnect, and
+    /api/lgr/query w/ srv_ts_min=<last id> for what was missed.
+- Records collapsed as repeats (DBL__LGRP_OPTS "repeat_window") are sent one by one. Records sampled out
+  (DBL__SAMPLING) are not sent, they never got appended.
+- HTTP 400 w/ {"err": "BAD_REQUEST", "msg": ...} for malformed args.
+- HTTP 503 w/ {"err": "UNAVAILABLE", "msg": ...} if live tail is off (L6SK_API__TAIL) or there are
+  L6SK_API__TAIL_MAX_TAILS tails already.
+
+======================================= ENDPOINT: /api/lgr/export
+- GET. Every record a query matches, streamed as its read, ie for a download. (sqlite DAOs)
+- lgrp, lvl, lvl_min, session_id, subsys, srv_ts_min, srv_ts_max, client_ts_min, client_ts_max, msg, msg_re,
+  filename_re, template: same filters as /api/lgr/query.
+- limit: optional, the most records to export. default: all of them.
+- format: "ndjson" (default), one JSON object per record per line, or "csv", w/ a header row of the field names.
+- gzip: 1 to have the response gzip compressed (Content-Encoding: gzip, ie curl --compressed). default: 0
+- Records are in (srv_ts, lrid) order, the fields are /api/lgr/query's. The export is of the records there were when
+  it started, records appended while it runs arent in it. Ingest goes on meanwhile.
+- A failure mid way cuts the connection, the response is truncated. (a chunked response w/o its last chunk)
+- HTTP 400 w/ {"err": "BAD_REQUEST", "msg": ...} for malformed args.
+- HTTP 503 w/ {"err": "UNAVAILABLE", "msg": ...} if there are L6SK_API__EXPORT_MAX_RUNNING exports running already.
+
+======================================= ENDPOINT: /api/lgr/session_diff
+- GET. Compare two sessions of a log group, ie the latest run of a program w/ an earlier one. Reads the per session
+  summaries the log group keeps at ingest (DBL__LGRP_OPTS "session_summaries"), never the records. (sqlite DAOs)
+- a, b: the session_ids. a is the one compared against (ie the earlier run), b the other one. required.
+- lgrp: log group name. default: "default"
+- top: the most files and msgs returned, the ones whose counts differ the most. default: 20
+- Returns: {"err": "SUCC", "a": <summary of a>, "b": <summary of b>, "fields": {"lvls": [...], "files": [...],
+  "msgs": [...]}, "lvls": [[<value>, ...], ...], "files": [...], "msgs": [...]}
+  A summary is {"session_id", "first_srv_ts", "last_srv_ts", "count", "lvls": {<lvl>: <count>}, "files":
+  {<filename>: <count>}, "msgs": [[<msg>, <count>, <err>], ...], "msg_min_count"}. Records w/o a level or filename
+  are under "null". Repeats collapsed at ingest each count.
+  "lvls" rows: lvl, count_a, count_b, for every level either session has.
+  "files" rows: filename, count_a, count_b, filename_regex. Only files whose counts differ.
+  "msgs" rows: msg, count_a, err_a, count_b, err_b, msg_regex. Only msgs whose counts differ. Msgs are counted
+  approximately (the session_top_msgs most frequent per session, first 200 chars), a msg's true count is in
+  [count - err, count]. A msg a session has no count of was seen at most its "msg_min_count" times there, ie count
+  and err are that. (0 and 0 if nothing was left out)
+- To see the records behind a row, /api/lgr/query w/ session_id=<a or b> and filename_re=<filename_regex> or
+  msg_re=<msg_regex> (and lvl=<lvl> for a level).
+- HTTP 400 w/ {"err": "BAD_REQUEST", "msg": ...} for malformed or missing args.
+- HTTP 404 w/ {"err": "NOT_FOUND", "msg": ...} if a session has no summary, ie no records.
+
+======================================= ENDPOINT: /api/lgr/templates
+- GET. The most frequent msg templates of a log group, ie what its been logging the most. A template is a msg w/ its
+  values masked: quoted strings <str>, UUIDs <uuid>, hex <hex>, numbers <num>. ie "took 12 ms to reach 10.0.0.1" is
+  "took <num> ms to reach <num>". Reads the per hour template counts the log group keeps at ingest (DBL__LGRP_OPTS
+  "templates"), never the records. (sqlite DAOs) All args optional.
+- lgrp: log group name. default: "default"
+- srv_ts_min, srv_ts_max: unix time in integer micro seconds. The hours they are in are included.
+  default: the last 24 hours. Hour counts are kept for the log group's template_retention (30 days by default).
+- limit: the most templates returned. default: 20, max: L6SK_API__QUERY_MAX_LIMIT
+- Returns: {"err": "SUCC", "fields": ["template_id", "template", "count", "count_min", "count_max"],
+  "templates": [[<value>, ...], ...], "total": <records w/ a msg in the range>} highest count first.
+  Templates are counted approximately, the template_top_k most frequent per hour. count: records counted for it, its
+  true count is between count_min and count_max. Repeats collapsed at ingest each count.
+- To see the records of a template, /api/lgr/query w/ template=<template_id>.
+- HTTP 400 w/ {"err": "BAD_REQUEST", "msg": ...} for malformed args.
+
+======================================= ENDPOINT: /api/lgr/quotas
+- GET. No args
+- Returns: ingest quota counters as JSON.
+  {"err": "SUCC", "lgrps": {<lgrp>: {"accepted_reqs": ..., "accepted_records": ..., "accepted_bytes": ...,
+  "throttled_reqs": ..., "throttled_records": ..., "throttled_bytes": ...}}, "throttled_lgrps": [<lgrp>, ...],
+  "top_throttled_clients": {<remote ip>: {...same counters}}}
 
 ======================================= ENDPOINT: /api/hchk
 
 ----
 - Args:
 
-- ping_id: DAS
+- ping_id: echoed back.
+- level: optional, defaults to 0.
+  - 0: the web layer answers, nothing else is checked.
+  - 1: DAO ack. (DBL_API.HEALTH_CHK_1)
+  - 2: timed db read. (DBL_API.HEALTH_CHK_2)
+  - 3: timed db write + delete on a sentinel table. (DBL_API.HEALTH_CHK_3)
+  levels 1-3 go thru the DBL dispatch queues at HIGH priority.
 
 ----
 Returns: health status as JSON
+- queue_wait_ms: how long the health check waited in the dispatch queues.
+- dao_exec_ms: how long the db read/write took. (null for level 1)
+- queue_depths: requests waiting in each dispatch queue right now.
+- HTTP 503 w/ {"err": "UNHEALTHY", ...} if the DAO failed the check, {"err": "TIMEOUT", ...} if it wasnt served in
+  L6SK_API__HCHK_TIMEOUT seconds.
 
 ----
 #### Example:
 ```
-- GET /api/hchk
+- GET /api/hchk?level=3
 - Response:
 {
-    "health": ok
+    "err": "SUCC", "ping_id": "ping0000", "level": 3, "queue_wait_ms": 0.41, "dao_exec_ms": 3.2,
+    "queue_depths": {"hi": 0, "norm": 12, "lo": 0}, "hchk": "DBL health check v3: OK"
 }
 ```
 """
@@ -14,6 +14,7 @@ import json
 import shutil
 
 import tornado.web
+import tornado.ioloop
 import tornado.options as topts
 # topts.define >>> to define new options
 # topts.parse_command_line  >>> to parse argv
@@ -24,8 +25,16 @@ import l6sk.knobman as km
 import l6sk.log_util as log
 
 from l6sk.dbl.dao_sqlite_mem import MemSqliteDAO
-from l6sk.dbl.dbl_dispatch import DBL_REQUEST_DISPATCH, dbl_service_thread_entry
+from l6sk.dbl.dao_sqlite_disk import DAO_SQLITE
+from l6sk.dbl.dao_segment import SegmentDAO
+from l6sk.dbl.dbl_dispatch import DBL_REQUEST_DISPATCH, DBL_REQ, DBL_REQ_PRIORITY, dbl_service_thread_entry
+from l6sk.dbl.dbl_dispatch import dbl_ticker_thread_entry
+from l6sk.dbl.dbl_api import DBL_API
+from l6sk.dbl.ingest_journal import IngestJournal
+from l6sk.dbl.lgr_sampler import LgrSampler
+from l6sk.dbl.lgr_hub import LgrHub
 from l6sk.l6sk_contract import L6SK_ROUTES
+from l6sk.ingest_quotas import IngestQuotas
 from l6sk import crypt_util
 
 # ======================================================================================================================
@@ -44,17 +53,94 @@ def webapp_init():
     crypt_util.init_crypt_util()
 
     # ******************** Choose DAO
-    log.info("Starting DB Layer using the sqlite3 DAO")
 
     # TODO: decide if DBL can just retrieve a default DAO.
     # I think since we may have multiple DAO implementations, it makes sense to not have a default.
     # although we could do it, and then choose the default by setting something in knobman.
     # dao_kwargs = {"db_filename": km.get_knob("DBL_SQLITE_DB_FILENAME")}
     # dao_maker_callable = lambda: MemSqliteDAO(**dao_kwargs)
-    dao_maker_callable = lambda: MemSqliteDAO()
+    if km.get_knob("SEGMENT_DAO__DIRNAME"):
+        log.info("Starting DB Layer using the segment file DAO")
+        dao_kwargs = {
+            "dirname": km.get_knob("SEGMENT_DAO__DIRNAME"),
+            "lgrp_opts": km.get_knob("DBL__LGRP_OPTS"),
+            "segment_size": km.get_knob("SEGMENT_DAO__SEGMENT_SIZE"),
+            "sync_appends": km.get_knob("SEGMENT_DAO__SYNC_APPENDS"),
+            "index_every": km.get_knob("SEGMENT_DAO__INDEX_EVERY"),
+            "bloom_bytes": km.get_knob("SEGMENT_DAO__BLOOM_BYTES"),
+            "archive_after": km.get_knob("SEGMENT_DAO__ARCHIVE_AFTER"),
+            "archive_interval": km.get_knob("SEGMENT_DAO__ARCHIVE_INTERVAL"),
+            "archive_chunk_rows": km.get_knob("SEGMENT_DAO__ARCHIVE_CHUNK_ROWS"),
+            "export_chunk_rows": km.get_knob("DBL__EXPORT_CHUNK_ROWS"),
+            "export_max_pending": km.get_knob("DBL__EXPORT_MAX_PENDING"),
+            "export_stall_timeout": km.get_knob("DBL__EXPORT_STALL_TIMEOUT"),
+        }
+        dao_maker_callable = lambda: SegmentDAO(**dao_kwargs)
+    elif km.get_knob("SQLITE_FS_DAO__DB_FILENAME"):
+        log.info("Starting DB Layer using the on disk sqlite3 DAO")
+        dao_kwargs = {
+            "db_filename": km.get_knob("SQLITE_FS_DAO__DB_FILENAME"),
+            "lgrp_opts": km.get_knob("DBL__LGRP_OPTS"),
+            "num_readers": km.get_knob("SQLITE_FS_DAO__NUM_READERS"),
+            "archive_after": km.get_knob("SQLITE_FS_DAO__ARCHIVE_AFTER"),
+            "archive_partition": km.get_knob("SQLITE_FS_DAO__ARCHIVE_PARTITION"),
+            "archive_interval": km.get_knob("SQLITE_FS_DAO__ARCHIVE_INTERVAL"),
+            "checkpoint_interval": km.get_knob("SQLITE_FS_DAO__CHECKPOINT_INTERVAL"),
+            "wal_max_bytes": km.get_knob("SQLITE_FS_DAO__WAL_MAX_BYTES"),
+            "vacuum_step_pages": km.get_knob("SQLITE_FS_DAO__VACUUM_STEP_PAGES"),
+            "query_cache_bytes": km.get_knob("DBL__QUERY_CACHE_BYTES"),
+            "query_cache_max_delta": km.get_knob("DBL__QUERY_CACHE_MAX_DELTA"),
+            "export_chunk_rows": km.get_knob("DBL__EXPORT_CHUNK_ROWS"),
+            "export_max_pending": km.get_knob("DBL__EXPORT_MAX_PENDING"),
+            "export_stall_timeout": km.get_knob("DBL__EXPORT_STALL_TIMEOUT"),
+        }
+        dao_maker_callable = lambda: DAO_SQLITE(**dao_kwargs)
+    else:
+        log.info("Starting DB Layer using the memory sqlite3 DAO")
+        dao_kwargs = {
+            "lgrp_opts": km.get_knob("DBL__LGRP_OPTS"),
+            "snapshot_dirname": km.get_knob("SQLITE_MEM_DAO__SNAPSHOT_DIRNAME"),
+            "snapshot_interval": km.get_knob("SQLITE_MEM_DAO__SNAPSHOT_INTERVAL"),
+            # query result cache, bounded by bytes. (see lgr_query_cache.py)
+            "query_cache_bytes": km.get_knob("DBL__QUERY_CACHE_BYTES"),
+            "query_cache_max_delta": km.get_knob("DBL__QUERY_CACHE_MAX_DELTA"),
+            # streaming exports. (see lgr_export.py)
+            "export_chunk_rows": km.get_knob("DBL__EXPORT_CHUNK_ROWS"),
+            "export_max_pending": km.get_knob("DBL__EXPORT_MAX_PENDING"),
+            "export_stall_timeout": km.get_knob("DBL__EXPORT_STALL_TIMEOUT"),
+        }
+        dao_maker_callable = lambda: MemSqliteDAO(**dao_kwargs)
 
     # ******************** request dispatch
-    dispatch = DBL_REQUEST_DISPATCH()
+    # the journal keeps its files until the DAO has the entries durable. The memory DAO w/o snapshots never does.
+    journal = None
+    is_mem_dao = not (km.get_knob("SEGMENT_DAO__DIRNAME") or km.get_knob("SQLITE_FS_DAO__DB_FILENAME"))
+    if km.get_knob("DBL__JOURNAL_DIRNAME") and is_mem_dao and not km.get_knob("SQLITE_MEM_DAO__SNAPSHOT_DIRNAME"):
+        log.err("DBL__JOURNAL_DIRNAME is set, but the memory DAO has no snapshots (SQLITE_MEM_DAO__SNAPSHOT_DIRNAME) "
+                "to make anything durable. Not using the ingest journal, sync_level 2 is the same as 1.")
+    elif km.get_knob("DBL__JOURNAL_DIRNAME"):
+        log.info(f"sync_level 2 appends go through the ingest journal in: {km.get_knob('DBL__JOURNAL_DIRNAME')}")
+        journal = IngestJournal(km.get_knob("DBL__JOURNAL_DIRNAME"),
+                                group_commit_delay=km.get_knob("DBL__JOURNAL_GROUP_COMMIT_DELAY"),
+                                file_size=km.get_knob("DBL__JOURNAL_FILE_SIZE"))
+
+    # live tail. the DBL worker publishes appends to it, tails are fanned out on the IOLoop this thread is about to run.
+    lgr_hub = None
+    if km.get_knob("L6SK_API__TAIL"):
+        lgr_hub = LgrHub(tornado.ioloop.IOLoop.current().add_callback,
+                         max_buffer=km.get_knob("L6SK_API__TAIL_BUFFER"),
+                         max_subscribers=km.get_knob("L6SK_API__TAIL_MAX_TAILS"))
+
+    dispatch = DBL_REQUEST_DISPATCH(journal=journal, lgr_hub=lgr_hub)
+
+    lgr_sampler = None
+    if km.get_knob("DBL__SAMPLING"):
+        log.info("Log records are sampled under load")
+        lgr_sampler = LgrSampler(dispatch,
+                                 target_queue_delay=km.get_knob("DBL__SAMPLING_TARGET_QUEUE_DELAY"),
+                                 min_keep_ratio=km.get_knob("DBL__SAMPLING_MIN_KEEP_RATIO"),
+                                 session_rate=km.get_knob("DBL__SAMPLING_SESSION_RATE"),
+                                 session_burst=km.get_knob("DBL__SAMPLING_SESSION_BURST"))
 
     # Create DBL worker thread. This is the "DBL service". And give it pointers to the dispatch queues.
     t = threading.Thread(target=dbl_service_thread_entry,
@@ -69,6 +155,21 @@ def webapp_init():
     t.setDaemon(True)
     t.start()
 
+    # deferred full text indexing (lgrp_opts "fts": "deferred"), LOW priority so ingest and queries come first.
+    if km.get_knob("DBL__FTS_INDEX_INTERVAL") is not None:
+        t = threading.Thread(target=dbl_ticker_thread_entry,
+                             name="dbl_fts_index_thread",
+                             args=(dispatch,
+                                   lambda: DBL_REQ(op=DBL_API.INDEX_FTS, priority=DBL_REQ_PRIORITY.LOW),
+                                   km.get_knob("DBL__FTS_INDEX_INTERVAL"),
+                                   lambda req: req.succ_data['backlog'] > 0))
+        t.daemon = True
+        t.start()
+
+    ingest_quotas = IngestQuotas(lgrp_quotas=km.get_knob("L6SK_API__LGRP_QUOTAS"),
+                                 client_quota=km.get_knob("L6SK_API__CLIENT_QUOTA"),
+                                 max_entries=km.get_knob("L6SK_API__QUOTA_MAX_ENTRIES"))
+
     # ******************** Tornado web server
     # Tornado ppl normally put these on top of the file, but since we have knobman and it solves many problems ...
     topts.define("port", default=km.get_knob('TORNADO__SERVER_PORT'), help="l6sk server port", type=int)
@@ -88,12 +189,38 @@ def webapp_init():
         'template_path': km.get_knob('PATHNAME__TEMPLATES_DIR'),
         'xsrf_cookies': True,
 
+        # API handlers hand their DBL requests to this. (self.settings['dbl_dispatch'])
+        'dbl_dispatch': dispatch,
+
+        # None if sampling is off. (self.settings['lgr_sampler'])
+        'lgr_sampler': lgr_sampler,
+
+        # (self.settings['ingest_quotas'])
+        'ingest_quotas': ingest_quotas,
+
+        # (self.settings['query_max_limit'])
+        'query_max_limit': km.get_knob("L6SK_API__QUERY_MAX_LIMIT"),
+
+        # (self.settings['histogram_max_buckets'])
+        'histogram_max_buckets': km.get_knob("L6SK_API__HISTOGRAM_MAX_BUCKETS"),
+
+        # (self.settings['export_max_running'])
+        'export_max_running': km.get_knob("L6SK_API__EXPORT_MAX_RUNNING"),
+
+        # seconds. (self.settings['hchk_timeout'])
+        'hchk_timeout': km.get_knob("L6SK_API__HCHK_TIMEOUT"),
+
+        # None if live tail is off. (self.settings['lgr_hub'], 'tail_keepalive', 'tail_flush_interval')
+        'lgr_hub': lgr_hub,
+        'tail_keepalive': km.get_knob("L6SK_API__TAIL_KEEPALIVE"),
+        'tail_flush_interval': km.get_knob("L6SK_API__TAIL_FLUSH_INTERVAL"),
+
         # debug=True implies autoreload=True
         'debug': topts.options.debug
     }
 
     log.info(f"Starting log socket server on: {server_port}")
-    log.info(f"Options: \n{json.dumps(tor_app_settings, sort_keys=True, indent=4)}")
+    log.info(f"Options: \n{json.dumps(tor_app_settings, sort_keys=True, indent=4, default=str)}")
 
     app = tornado.web.Application(L6SK_ROUTES, **tor_app_settings)
     app.listen(server_port)
@@ -1,7 +1,9 @@
 import os
+import time
 import unittest
+import threading
 
-from l6sk.dbl.dbl_dispatch import DBL_REQ, DBL_REQUEST_DISPATCH, DBL_REQ_PRIORITY
+from l6sk.dbl.dbl_dispatch import DBL_REQ, DBL_REQUEST_DISPATCH, DBL_REQ_PRIORITY, dbl_ticker_thread_entry
 from l6sk.dbl.dbl_api import DBL_API
 
 # ======================================================================================================================
@@ -70,6 +72,50 @@ class TestDBLDispatch(unittest.TestCase):
 
         self.assertIsNone(actual_res)
 
+    def test_queue_timestamps(self):
+
+        dispatch = DBL_REQUEST_DISPATCH()
+
+        test_req = DBL_REQ(op=DBL_API.HEALTH_CHK_1, priority=DBL_REQ_PRIORITY.HIGH)
+        self.assertIsNone(test_req.enqueue_ts)
+
+        dispatch.put_req(test_req)
+        self.assertEqual(dispatch.get_queue_depths(), {'hi': 1, 'norm': 0, 'lo': 0})
+        self.assertIsNone(test_req.dequeue_ts)
+
+        self.assertIs(dispatch.get_next_req(), test_req)
+        self.assertGreaterEqual(test_req.dequeue_ts, test_req.enqueue_ts)
+        self.assertEqual(dispatch.get_queue_depths(), {'hi': 0, 'norm': 0, 'lo': 0})
+
+    def test_ticker(self):
+
+        dispatch = DBL_REQUEST_DISPATCH()
+        t = threading.Thread(target=dbl_ticker_thread_entry,
+                             args=(dispatch, lambda: DBL_REQ(op=DBL_API.INDEX_FTS, priority=DBL_REQ_PRIORITY.LOW),
+                                   3600.0, lambda req: req.succ_data['backlog'] > 0))
+        t.daemon = True
+        t.start()
+
+        def serve_next(backlog):
+            deadline = time.monotonic() + 5.0
+            while time.monotonic() < deadline:
+                req = dispatch.get_next_req()
+                if req is not None:
+                    self.assertEqual((req.op, req.priority), (DBL_API.INDEX_FTS, DBL_REQ_PRIORITY.LOW))
+                    req.succ_data = {'indexed': 10, 'backlog': backlog}
+                    return True
+                time.sleep(0.001)
+            return False
+
+        # one at a time, and right away while there is a backlog.
+        for backlog in (20, 10, 0):
+            self.assertTrue(serve_next(backlog))
+            self.assertLessEqual(dispatch.get_queue_depths()['lo'], 1)
+
+        # no backlog, the next one is an interval away.
+        time.sleep(0.05)
+        self.assertEqual(dispatch.get_queue_depths()['lo'], 0)
+
 
 # ======================================================================================================================
 # ======================================================================================================================
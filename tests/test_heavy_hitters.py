@@ -0,0 +1,58 @@
+import random
+import unittest
+import collections
+
+from l6sk.dbl.heavy_hitters import space_saving_add, get_min_count
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestHeavyHitters(unittest.TestCase):
+
+    def test_space_saving_bounds(self):
+
+        # zipf like, a few msgs are most of it, and a long tail of ones seen once or twice.
+        rnd = random.Random(48)
+        items = [f"msg {min(int(rnd.paretovariate(1.1)), 5000)}" for _ in range(20000)]
+        true_counts = collections.Counter(items)
+
+        capacity = 20
+        counters = {}
+        for batch_start in range(0, len(items), 500):
+            evicted = space_saving_add(counters, collections.Counter(items[batch_start:batch_start + 500]), capacity)
+            self.assertFalse(evicted & counters.keys())
+            self.assertEqual(len(counters), capacity)
+
+        # counts add up, every one is an upper bound and count - err a lower one.
+        self.assertEqual(sum(count for count, _ in counters.values()), len(items))
+        for item, (count, err) in counters.items():
+            self.assertLessEqual(count - err, true_counts[item])
+            self.assertLessEqual(true_counts[item], count)
+
+        # anything w/o a counter was seen at most min count times, so the heavy ones all have one.
+        min_count = get_min_count(counters, capacity)
+        for item, count in true_counts.items():
+            if item not in counters:
+                self.assertLessEqual(count, min_count)
+        for item, _ in true_counts.most_common(5):
+            self.assertIn(item, counters)
+
+    def test_space_saving_exact_under_capacity(self):
+
+        counters = {}
+        self.assertEqual(space_saving_add(counters, {'a': 3, 'b': 1}, 3), set())
+        self.assertEqual(space_saving_add(counters, {'a': 2, 'c': 1}, 3), set())
+        self.assertEqual(counters, {'a': [5, 0], 'b': [1, 0], 'c': [1, 0]})
+        self.assertEqual(get_min_count(counters, 3), 1)
+        self.assertEqual(get_min_count(counters, 4), 0)
+
+        # full. d takes over the lowest one (b, the smaller of the ties) and starts where it left off.
+        self.assertEqual(space_saving_add(counters, {'d': 2}, 3), {'b'})
+        self.assertEqual(counters, {'a': [5, 0], 'c': [1, 0], 'd': [3, 1]})
+
+        # an item thats evicted and comes back in the same batch isnt reported. (c goes for e, then takes e's)
+        self.assertEqual(space_saving_add(counters, {'e': 1, 'c': 9}, 3), {'e'})
+        self.assertEqual(counters, {'a': [5, 0], 'd': [3, 1], 'c': [11, 2]})
+
+if __name__ == '__main__':
+    unittest.main()
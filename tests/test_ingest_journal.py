@@ -0,0 +1,187 @@
+import os
+import time
+import unittest
+import tempfile
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ, DBL_REQUEST_DISPATCH
+from l6sk.dbl.dbl_api import DBL_API, LOG_RECORD, LGR_APPEND_ARGS, LGR_QUERY
+from l6sk.dbl.dao_sqlite_disk import DAO_SQLITE
+from l6sk.dbl.dao_sqlite_mem import MemSqliteDAO
+from l6sk.dbl.ingest_journal import IngestJournal
+
+
+def _mk_durable_req(i, lvl='INFO'):
+    return DBL_REQ(op=DBL_API.APPEND_LGRS_DURABLE,
+                   data=LGR_APPEND_ARGS(lgrp='default', lgrs=[LOG_RECORD(lvl=lvl, msg=f"hello {i}")]))
+
+
+def _wait_done(reqs, timeout=10.0):
+    deadline = time.time() + timeout
+    while any((req.succ_data is None) and (req.fail_cause is None) for req in reqs):
+        if time.time() > deadline:
+            raise TimeoutError("journal didnt get to the requests")
+        time.sleep(0.002)
+
+
+def _serve_queued(dispatch, dao, max_reqs=None) -> int:
+    """ Do what the DBL worker would. Return how many requests were served. """
+
+    num_served = 0
+    while (max_reqs is None) or (num_served < max_reqs):
+        req = dispatch.get_next_req()
+        if req is None:
+            break
+        dao.serve_req(req)
+        num_served += 1
+
+    return num_served
+
+
+def _query_msgs(dao) -> list:
+    req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=LGR_QUERY(lgrp='default'))
+    dao.serve_req(req)
+    msg_idx = req.succ_data['fields'].index('msg')
+    return [row[msg_idx] for row in req.succ_data['lgrs']]
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestIngestJournal(unittest.TestCase):
+
+    def test_ack_then_apply(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = DAO_SQLITE(os.path.join(tmp_dir, 'l6sk.db'), num_readers=0)
+            dispatch = DBL_REQUEST_DISPATCH(journal=IngestJournal(os.path.join(tmp_dir, 'jnl')))
+
+            reqs = [_mk_durable_req(i) for i in range(20)]
+            bad_req = _mk_durable_req(20, lvl='NOPE')
+            for req in reqs + [bad_req]:
+                dispatch.put_req(req)
+
+            # acked by the journal, nothing applied yet.
+            _wait_done(reqs + [bad_req])
+            self.assertTrue(all(req.succ_data == 1 for req in reqs))
+            self.assertEqual(bad_req.fail_cause.http_err_code, 400)
+            self.assertEqual(_query_msgs(dao), [])
+
+            self.assertEqual(_serve_queued(dispatch, dao), 20)
+            self.assertEqual(sorted(_query_msgs(dao)), sorted(f"hello {i}" for i in range(20)))
+
+    def test_applied_files_are_deleted(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            jnl_dirname = os.path.join(tmp_dir, 'jnl')
+            dao = DAO_SQLITE(os.path.join(tmp_dir, 'l6sk.db'), num_readers=0)
+
+            # tiny files, every group starts a new one.
+            dispatch = DBL_REQUEST_DISPATCH(journal=IngestJournal(jnl_dirname, file_size=1))
+
+            for i in range(5):
+                req = _mk_durable_req(i)
+                dispatch.put_req(req)
+                _wait_done([req])
+
+            self.assertEqual(len(os.listdir(jnl_dirname)), 6)
+
+            _serve_queued(dispatch, dao)
+
+            # the one being written to is always kept.
+            deadline = time.time() + 10.0
+            while (len(os.listdir(jnl_dirname)) > 1) and (time.time() < deadline):
+                time.sleep(0.01)
+
+            self.assertEqual(len(os.listdir(jnl_dirname)), 1)
+
+    def test_replay_after_crash(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_filename = os.path.join(tmp_dir, 'l6sk.db')
+            jnl_dirname = os.path.join(tmp_dir, 'jnl')
+
+            dao = DAO_SQLITE(db_filename, num_readers=0)
+            dispatch = DBL_REQUEST_DISPATCH(journal=IngestJournal(jnl_dirname))
+
+            reqs = [_mk_durable_req(i) for i in range(30)]
+            for req in reqs:
+                dispatch.put_req(req)
+            _wait_done(reqs)
+
+            # the DBL worker gets 10 of them in, then the process dies. and the last write() was cut short.
+            self.assertEqual(_serve_queued(dispatch, dao, max_reqs=10), 10)
+
+            jnl_filename = os.path.join(jnl_dirname, os.listdir(jnl_dirname)[0])
+            with open(jnl_filename, 'ab') as f:
+                f.write(b'\x40\x00\x00\x00half an entry')
+
+            # restart. all 30 are there, once.
+            dao = DAO_SQLITE(db_filename, num_readers=0)
+            journal = IngestJournal(jnl_dirname)
+            journal.replay(dao)
+            self.assertEqual(sorted(_query_msgs(dao)), sorted(f"hello {i}" for i in range(30)))
+            self.assertFalse(os.path.exists(jnl_filename))
+
+            # new entries keep going after the old ones, the DAO doesnt take them for replays.
+            dispatch = DBL_REQUEST_DISPATCH(journal=journal)
+            req = _mk_durable_req(30)
+            dispatch.put_req(req)
+            _wait_done([req])
+            _serve_queued(dispatch, dao)
+            self.assertEqual(len(_query_msgs(dao)), 31)
+
+    def test_memory_dao_files_kept_until_snapshot(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            snap_dirname = os.path.join(tmp_dir, 'snap')
+            jnl_dirname = os.path.join(tmp_dir, 'jnl')
+
+            def wait_num_files(num_files):
+                deadline = time.time() + 10.0
+                while (len(os.listdir(jnl_dirname)) != num_files) and (time.time() < deadline):
+                    time.sleep(0.01)
+                return len(os.listdir(jnl_dirname))
+
+            # snapshots are taken by hand here.
+            dao = MemSqliteDAO(snapshot_dirname=snap_dirname, snapshot_interval=3600.0)
+            journal = IngestJournal(jnl_dirname, file_size=1)
+            dispatch = DBL_REQUEST_DISPATCH(journal=journal)
+            journal.replay(dao)
+
+            for i in range(5):
+                req = _mk_durable_req(i)
+                dispatch.put_req(req)
+                _wait_done([req])
+            _serve_queued(dispatch, dao)
+
+            # applied, but only in memory.
+            time.sleep(0.2)
+            self.assertEqual(len(os.listdir(jnl_dirname)), 6)
+
+            dao.snapshot_lgrps()
+            self.assertEqual(wait_num_files(1), 1)
+
+            # 3 more, applied, then the process dies before the next snapshot.
+            for i in range(5, 8):
+                req = _mk_durable_req(i)
+                dispatch.put_req(req)
+                _wait_done([req])
+            _serve_queued(dispatch, dao)
+            time.sleep(0.2)
+            self.assertEqual(len(os.listdir(jnl_dirname)), 4)
+
+            # restart. the replayed files stay until a snapshot has them.
+            dao = MemSqliteDAO(snapshot_dirname=snap_dirname, snapshot_interval=3600.0)
+            journal = IngestJournal(jnl_dirname)
+            dispatch = DBL_REQUEST_DISPATCH(journal=journal)
+            journal.replay(dao)
+            self.assertEqual(sorted(_query_msgs(dao)), sorted(f"hello {i}" for i in range(8)))
+
+            time.sleep(0.2)
+            self.assertEqual(len(os.listdir(jnl_dirname)), 5)
+
+            dao.snapshot_lgrps()
+            self.assertEqual(wait_num_files(1), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+
+from l6sk.ingest_quotas import IngestQuotas, get_retry_after_header
+
+
+class _FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestIngestQuotas(unittest.TestCase):
+
+    def test_lgrp_quotas_and_overrides(self):
+
+        clock = _FakeClock()
+        quotas = IngestQuotas(lgrp_quotas={"*": {"records_per_sec": 100, "records_burst": 200},
+                                           "noisy": {"records_per_sec": 10, "records_burst": None,
+                                                     "bytes_per_sec": 1000}},
+                              clock=clock)
+
+        # noisy gets 10 records of burst (one second worth), then has to wait.
+        self.assertEqual(quotas.admit('noisy', '10.0.0.1', 10, 100), (None, 0))
+        reason, retry_after = quotas.admit('noisy', '10.0.0.1', 5, 100)
+        self.assertEqual(reason, 'lgrp_records')
+        self.assertAlmostEqual(retry_after, 0.5)
+        self.assertEqual(get_retry_after_header(retry_after), '1')
+
+        # a throttled request takes nothing, half a second later it fits.
+        clock.now += 0.5
+        self.assertEqual(quotas.admit('noisy', '10.0.0.1', 5, 100), (None, 0))
+
+        # bytes too. (records_per_sec 10 refilled by now)
+        clock.now += 10
+        self.assertEqual(quotas.admit('noisy', '10.0.0.1', 1, 600), (None, 0))
+        self.assertEqual(quotas.admit('noisy', '10.0.0.1', 1, 600)[0], 'lgrp_bytes')
+
+        # others get the "*" quota, noisy doesnt get in their way.
+        for _ in range(20):
+            self.assertEqual(quotas.admit('quiet', '10.0.0.2', 10, 100), (None, 0))
+        self.assertEqual(quotas.admit('quiet', '10.0.0.2', 10, 100)[0], 'lgrp_records')
+
+        stats = quotas.get_stats()
+        self.assertEqual(stats['throttled_lgrps'], ['noisy', 'quiet'])
+        self.assertEqual(stats['lgrps']['noisy']['throttled_reqs'], 2)
+        self.assertEqual(stats['lgrps']['noisy']['accepted_records'], 16)
+        self.assertEqual(stats['lgrps']['quiet']['accepted_reqs'], 20)
+        self.assertEqual(stats['top_throttled_clients'], {})
+
+    def test_client_quota(self):
+
+        clock = _FakeClock()
+        quotas = IngestQuotas(lgrp_quotas=None, client_quota={"records_per_sec": 100}, clock=clock)
+
+        # a client's quota spans log groups.
+        self.assertEqual(quotas.admit('lgrp_a', '10.0.0.1', 60, 0), (None, 0))
+        self.assertEqual(quotas.admit('lgrp_b', '10.0.0.1', 60, 0)[0], 'client_records')
+        self.assertEqual(quotas.admit('lgrp_b', '10.0.0.2', 60, 0), (None, 0))
+
+        # a request bigger than the burst gets in once the bucket is full.
+        clock.now += 1
+        self.assertEqual(quotas.admit('lgrp_a', '10.0.0.1', 500, 0), (None, 0))
+        self.assertEqual(quotas.admit('lgrp_a', '10.0.0.1', 1, 0)[0], 'client_records')
+
+        stats = quotas.get_stats()
+        self.assertEqual(list(stats['top_throttled_clients']), ['10.0.0.1'])
+        self.assertEqual(stats['top_throttled_clients']['10.0.0.1']['throttled_reqs'], 2)
+        self.assertEqual(stats['throttled_lgrps'], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
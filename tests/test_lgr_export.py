@@ -0,0 +1,200 @@
+import os
+import io
+import csv
+import gzip
+import json
+import time
+import sqlite3
+import unittest
+import tempfile
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ
+from l6sk.dbl.dbl_api import DBL_API, LOG_RECORD, LGR_APPEND_ARGS, LGR_QUERY, LGR_EXPORT
+from l6sk.dbl.dao_sqlite_mem import MemSqliteDAO
+from l6sk.dbl.dao_sqlite_disk import DAO_SQLITE
+from l6sk.dbl.sqlite_lgrp import SQLITE_LGR_FIELDS
+
+
+def _mk_lgrs(count, base_ts=1604851200000000, step=1000):
+    return [LOG_RECORD(srv_ts=base_ts + i * step, lvl=['DBUG', 'INFO', 'ERRR'][i % 3], session_id=f"sess_{i % 4}",
+                       lineno=i, filename='test_lgr_export.py', msg=f"request {i} said \"hi\", took {i % 7} ms")
+            for i in range(count)]
+
+
+def _serve(dao, req):
+    dao.serve_req(req)
+
+    deadline = time.monotonic() + 5.0
+    while (req.succ_data is None) and (req.fail_cause is None) and (time.monotonic() < deadline):
+        time.sleep(0.001)
+
+    return req
+
+
+def _append(dao, lgrs):
+    return _serve(dao, DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS('default', lgrs))).succ_data
+
+
+def _read_export(export, timeout=10.0):
+    """ Everything an export hands out, like the export handler takes it. """
+
+    data = b''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        chunk = export.get_chunk()
+        if chunk is None:
+            return data
+        if not chunk:
+            time.sleep(0.001)
+        data += chunk
+
+    raise TimeoutError("export didnt finish")
+
+
+def _read_first_chunk(export):
+    """ Wait for an export's first chunk, the export thread is blocked on the next one then. (max_pending=1) """
+
+    chunk = b''
+    while not chunk:
+        chunk = export.get_chunk()
+        time.sleep(0.001)
+
+    return chunk
+
+
+def _decode(data, fmt, is_gzip):
+
+    text = (gzip.decompress(data) if is_gzip else data).decode()
+
+    if fmt == 'ndjson':
+        return [tuple(json.loads(line).values()) for line in text.splitlines()]
+
+    rows = list(csv.reader(io.StringIO(text)))
+    assert tuple(rows[0]) == SQLITE_LGR_FIELDS
+    return [tuple(row) for row in rows[1:]]
+
+
+def _as_csv(rows):
+    """ rows as they read back from csv, all strs. """
+    return [tuple('' if val is None else str(val) for val in row) for row in rows]
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestLgrExport(unittest.TestCase):
+
+    def _export(self, dao, query, fmt='ndjson', is_gzip=False):
+        req = _serve(dao, DBL_REQ(op=DBL_API.EXPORT_LGRS, data=LGR_EXPORT(query, fmt=fmt, gzip=is_gzip)))
+        self.assertIsNone(req.fail_cause)
+        return req.succ_data
+
+    def test_exports_match_queries(self):
+
+        # 6 one hour partitions of old records, the disk DAO archives the first 3.
+        hour_usec = 3600 * 1000000
+        base_ts = 1604851200 * 1000000
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            archive_after = (time.time() * 1000000 - (base_ts + 3 * hour_usec)) / 1000000
+            daos = [MemSqliteDAO(export_chunk_rows=70, export_max_pending=2),
+                    DAO_SQLITE(os.path.join(tmp_dir, 'l6sk.db'), num_readers=0, archive_after=archive_after,
+                               archive_partition=3600.0, archive_interval=3600.0, export_chunk_rows=70,
+                               export_max_pending=2)]
+
+            for dao in daos:
+                for p_idx in range(6):
+                    _append(dao, _mk_lgrs(100, base_ts=base_ts + p_idx * hour_usec))
+
+                # out of order records, the tiers have to be merged.
+                _append(dao, _mk_lgrs(50, base_ts=base_ts + 5000, step=hour_usec // 50))
+
+                if isinstance(dao, DAO_SQLITE):
+                    self.assertEqual(dao.archive_lgrps(), 3)
+
+                queries = [LGR_QUERY(lgrp='default', limit=None),
+                           LGR_QUERY(lgrp='default', lvl_min='ERRR', session_id='sess_2', limit=None),
+                           LGR_QUERY(lgrp='default', srv_ts_min=base_ts + 2 * hour_usec, limit=150),
+                           LGR_QUERY(lgrp='default', msg_regex='took [56] ms', limit=None)]
+
+                for query in queries:
+                    expected = dao.query_lgrs(query)['lgrs']
+                    self.assertTrue(expected)
+
+                    for fmt in ['ndjson', 'csv']:
+                        for is_gzip in [False, True]:
+                            export = self._export(dao, query, fmt, is_gzip)
+                            rows = _decode(_read_export(export), fmt, is_gzip)
+                            self.assertEqual(rows, expected if fmt == 'ndjson' else _as_csv(expected))
+                            self.assertEqual(export.num_rows, len(expected))
+                            self.assertIsNone(export.error)
+
+                self.assertEqual(len(dao.query_lgrs(queries[0])['lgrs']), 650)
+
+                # nothing matches, csv is just the header.
+                export = self._export(dao, LGR_QUERY(lgrp='default', session_id='nope', limit=None), 'csv')
+                self.assertEqual(_decode(_read_export(export), 'csv', False), [])
+
+    def test_ingest_goes_on_during_export(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for dao in [MemSqliteDAO(export_chunk_rows=100, export_max_pending=1),
+                        DAO_SQLITE(os.path.join(tmp_dir, 'l6sk.db'), num_readers=2, export_chunk_rows=100,
+                                   export_max_pending=1)]:
+
+                _append(dao, _mk_lgrs(2000))
+                export = self._export(dao, LGR_QUERY(lgrp='default', limit=None))
+
+                # the export is waiting on us, w/ a statement open.
+                data = _read_first_chunk(export)
+
+                # appends dont wait on it, and arent in it.
+                start_time = time.monotonic()
+                for batch_idx in range(10):
+                    self.assertEqual(_append(dao, _mk_lgrs(100, base_ts=1604851300000000 + batch_idx * 100000)), 100)
+                self.assertLess(time.monotonic() - start_time, 2.0)
+
+                rows = _decode(data + _read_export(export), 'ndjson', False)
+                self.assertEqual(len(rows), 2000)
+                self.assertEqual([row[SQLITE_LGR_FIELDS.index('lineno')] for row in rows], list(range(2000)))
+
+                req = _serve(dao, DBL_REQ(op=DBL_API.QUERY_LGRS, data=LGR_QUERY(lgrp='default', limit=5000)))
+                self.assertEqual(len(req.succ_data['lgrs']), 3000)
+
+    def test_stalled_and_cancelled_exports_let_go(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = DAO_SQLITE(os.path.join(tmp_dir, 'l6sk.db'), num_readers=0, checkpoint_interval=None,
+                             export_chunk_rows=100, export_max_pending=1, export_stall_timeout=0.3)
+            _append(dao, _mk_lgrs(1000))
+
+            def wal_is_reset():
+                # timeout=0: a checkpoint that has to wait on a reader says so, it doesnt wait.
+                conn = sqlite3.connect(os.path.join(tmp_dir, 'lgrp_default.db'), isolation_level=None, timeout=0)
+                try:
+                    _append(dao, _mk_lgrs(10, base_ts=1604851300000000))
+                    return conn.execute("PRAGMA wal_checkpoint(TRUNCATE);").fetchone()[0] == 0
+                finally:
+                    conn.close()
+
+            # nobody reads. its snapshot keeps the WAL from being reset, until its given up on.
+            export = self._export(dao, LGR_QUERY(lgrp='default', limit=None))
+            time.sleep(0.05)
+            self.assertFalse(wal_is_reset())
+            time.sleep(0.6)
+            self.assertTrue(wal_is_reset())
+
+            # what was queued before is still handed out, then its over.
+            self.assertTrue(export.get_chunk())
+            self.assertIsNone(export.get_chunk())
+            self.assertIn("stalled", export.error)
+
+            # the client goes away.
+            export = self._export(dao, LGR_QUERY(lgrp='default', limit=None))
+            self.assertTrue(_read_first_chunk(export))
+            export.cancel()
+            time.sleep(0.3)
+            self.assertTrue(wal_is_reset())
+
+
+if __name__ == '__main__':
+    unittest.main()
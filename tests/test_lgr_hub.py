@@ -0,0 +1,116 @@
+import json
+import asyncio
+import unittest
+import threading
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ, process_dbl_req
+from l6sk.dbl.dbl_api import DBL_API, LOG_RECORD, LGR_APPEND_ARGS, LGR_QUERY
+from l6sk.dbl.dao_sqlite_mem import MemSqliteDAO
+from l6sk.dbl.lgr_hub import LgrHub, TAIL_FIELDS
+
+
+def _mk_lgrs(count, base_ts=1604852083000000):
+    return [LOG_RECORD(srv_ts=base_ts + i * 1000, lvl=['DBUG', 'INFO', 'ERRR'][i % 3], session_id=f"sess_{i % 2}",
+                       lineno=i, msg=f"msg {i}") for i in range(count)]
+
+
+def _linenos(items):
+    return [json.loads(item[1])[TAIL_FIELDS.index('lineno')] for item in items]
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestLgrHub(unittest.TestCase):
+
+    def test_fan_out_from_dbl_worker(self):
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            hub = LgrHub(loop.call_soon_threadsafe)
+            dao = MemSqliteDAO()
+
+            def append(lgrp, lgrs):
+                # same as the DBL worker does it, on a thread of its own.
+                req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp, lgrs))
+                worker = threading.Thread(target=process_dbl_req, args=(dao, req, hub))
+                worker.start()
+                worker.join()
+                return req
+
+            # nobody tails, nothing is scheduled on the loop.
+            self.assertFalse(hub.has_subscribers('default'))
+            append('default', _mk_lgrs(3))
+            self.assertEqual(hub.num_published, 0)
+
+            everything = hub.subscribe(LGR_QUERY(lgrp='default'))
+            errors = hub.subscribe(LGR_QUERY(lgrp='default', lvl_min='ERRR'))
+            sess_1 = hub.subscribe(LGR_QUERY(lgrp='default', session_id='sess_1', lvls=frozenset({'DBUG', 'INFO'})))
+            other = hub.subscribe(LGR_QUERY(lgrp='other'))
+            self.assertEqual(hub.get_stats()['lgrps'], {'default': 3, 'other': 1})
+
+            append('default', _mk_lgrs(6))
+            append('default', _mk_lgrs(2, base_ts=1604852084000000))
+
+            items = await hub.wait(everything, 1.0)
+            self.assertEqual(_linenos(items), [0, 1, 2, 3, 4, 5, 0, 1])
+            self.assertEqual(items[-1][0], 1604852084001000)
+            error_items = await hub.wait(errors, 1.0)
+            self.assertEqual(_linenos(error_items), [2, 5])
+            self.assertEqual(_linenos(await hub.wait(sess_1, 1.0)), [1, 3, 1])
+
+            # records are encoded once, every subscriber gets the same string.
+            self.assertIs(error_items[0][1], items[2][1])
+
+            # nothing for other, or anymore for the rest. wait times out.
+            self.assertEqual(await hub.wait(other, 0.01), [])
+            self.assertEqual(await hub.wait(everything, 0.01), [])
+
+            # a failed append isnt published.
+            req = append('bad name', _mk_lgrs(2))
+            self.assertIsNotNone(req.fail_cause)
+            self.assertEqual(hub.num_published, 8)
+
+            # unsubscribing wakes up the waiter.
+            waiter = asyncio.ensure_future(hub.wait(everything, 10.0))
+            await asyncio.sleep(0)
+            hub.unsubscribe(everything)
+            self.assertEqual(await asyncio.wait_for(waiter, 1.0), [])
+            self.assertTrue(everything.closed)
+            self.assertEqual(hub.get_stats()['subscribers'], 3)
+
+        asyncio.run(run())
+
+    def test_slow_subscriber_is_dropped(self):
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            hub = LgrHub(loop.call_soon_threadsafe, max_buffer=10, max_subscribers=2)
+
+            slow = hub.subscribe(LGR_QUERY(lgrp='default'))
+            fast = hub.subscribe(LGR_QUERY(lgrp='default'))
+            self.assertIsNone(hub.subscribe(LGR_QUERY(lgrp='default')))
+
+            # fast keeps up, slow never reads. the batch that would take slow over 10 records drops it.
+            num_received = 0
+            for batch_idx in range(4):
+                hub.publish('default', _mk_lgrs(4, base_ts=1604852083000000 + batch_idx * 1000000))
+                await asyncio.sleep(0)
+                num_received += len(await hub.wait(fast, 1.0))
+
+            self.assertEqual(num_received, 16)
+            self.assertTrue(slow.dropped and slow.closed)
+            self.assertFalse(fast.dropped)
+            self.assertEqual(hub.get_stats()['dropped'], 1)
+
+            # what it got before it was dropped is still there, once.
+            self.assertEqual(len(await hub.wait(slow, 1.0)), 8)
+            self.assertEqual(await hub.wait(slow, 1.0), [])
+
+            # and its slot is free again.
+            self.assertIsNotNone(hub.subscribe(LGR_QUERY(lgrp='default')))
+
+        asyncio.run(run())
+
+
+if __name__ == '__main__':
+    unittest.main()
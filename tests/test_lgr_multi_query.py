@@ -0,0 +1,64 @@
+import unittest
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ
+from l6sk.dbl.dbl_api import DBL_API, LGR_QUERY, LGR_MULTI_QUERY, get_next_multi_page_after
+from l6sk.dbl.lgr_multi_query import LgrpQueryMerge
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestLgrMultiQuery(unittest.TestCase):
+
+    def test_merge_order(self):
+
+        mquery = LGR_MULTI_QUERY(query=LGR_QUERY(lgrp=None, limit=4))
+        merge = LgrpQueryMerge(mquery, ['b', 'a'], ('lrid', 'srv_ts'))
+
+        # rows are (lrid, srv_ts). ties on srv_ts go by log group, then lrid.
+        self.assertFalse(merge.run_lgrp('b', lambda query: {'lgrs': [(1, 10), (2, 20), (3, 20)]}))
+        self.assertTrue(merge.run_lgrp('a', lambda query: {'lgrs': [(7, 20), (8, 30)]}))
+
+        res = merge.get_result()
+        self.assertEqual(res['fields'], ('lrid', 'srv_ts', 'lgrp'))
+        self.assertEqual(res['lgrs'], [(1, 10, 'b'), (7, 20, 'a'), (2, 20, 'b'), (3, 20, 'b')])
+        self.assertEqual(get_next_multi_page_after(mquery, res['lgrs']), (20, 'b', 3))
+
+    def test_lgrp_queries(self):
+
+        mquery = LGR_MULTI_QUERY(query=LGR_QUERY(lgrp=None, limit=2, srv_ts_max=100), after=(20, 'b', 3))
+        merge = LgrpQueryMerge(mquery, ['a', 'b', 'c'], ('lrid', 'srv_ts'))
+
+        # the cursor, for each log group.
+        self.assertEqual(merge.get_lgrp_query('a').after, (20, 2**63 - 1))
+        self.assertEqual(merge.get_lgrp_query('b').after, (20, 3))
+        self.assertEqual(merge.get_lgrp_query('c').after, (20, 0))
+        self.assertEqual(merge.get_lgrp_query('c').lgrp, 'c')
+
+        # a full page bounds what the log groups after it look at, a short one doesnt.
+        merge.run_lgrp('a', lambda query: {'lgrs': [(1, 30)]})
+        self.assertEqual(merge.get_lgrp_query('c').srv_ts_max, 100)
+        merge.run_lgrp('b', lambda query: {'lgrs': [(4, 40), (5, 50)]})
+        self.assertEqual(merge.get_lgrp_query('c').srv_ts_max, 50)
+
+    def test_failure(self):
+
+        def fail(query):
+            raise ValueError("no such table")
+
+        mquery = LGR_MULTI_QUERY(query=LGR_QUERY(lgrp=None))
+        merge = LgrpQueryMerge(mquery, ['a', 'b'], ('lrid', 'srv_ts'))
+        self.assertFalse(merge.run_lgrp('a', fail))
+
+        # the log groups after a failure arent run at all.
+        self.assertIsNone(merge.get_lgrp_query('b'))
+        self.assertTrue(merge.run_lgrp('b', lambda query: self.fail("ran after a failure")))
+
+        req = DBL_REQ(op=DBL_API.QUERY_MULTI_LGRS, data=mquery)
+        merge.set_result(req)
+        self.assertIsNone(req.succ_data)
+        self.assertEqual(req.fail_cause.http_err_code, 500)
+        self.assertIn("no such table", req.fail_cause.dbg_info_string)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+import os
+import time
+import unittest
+import tempfile
+import sqlite3
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ
+from l6sk.dbl.dbl_api import DBL_API, LOG_RECORD, LGR_APPEND_ARGS, LGR_QUERY
+from l6sk.dbl.dao_sqlite_mem import MemSqliteDAO
+from l6sk.dbl.dao_sqlite_disk import DAO_SQLITE
+from l6sk.dbl.sqlite_lgrp import SqliteLogGroup
+from l6sk.dbl.lgr_query_cache import LgrQueryCache
+
+
+def _mk_lgrs(count, base_ts=1604852083000000, msg='msg'):
+    return [LOG_RECORD(srv_ts=base_ts + i * 1000, lvl=['DBUG', 'INFO', 'WARN', 'ERRR'][i % 4],
+                       session_id=f"sess_{i % 3}", lineno=i, msg=f"{msg} {i}") for i in range(count)]
+
+
+def _cached_query(cache, lgrp, query):
+    return cache.query_lgrs(query, lgrp.get_cache_mark(query),
+                            lambda lrid_range: lgrp.query_lgrs(query, lrid_range=lrid_range), lgrp.get_changed_lrids)
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestLgrQueryCache(unittest.TestCase):
+
+    def test_hits_deltas_and_misses(self):
+
+        lgrp = SqliteLogGroup('default', sqlite3.connect(":memory:", isolation_level=None))
+        cache = LgrQueryCache(max_delta=50)
+        lgrp.append_lgrs(_mk_lgrs(100))
+
+        queries = [LGR_QUERY(lgrp='default'),
+                   LGR_QUERY(lgrp='default', lvl_min='WARN', limit=1000),
+                   LGR_QUERY(lgrp='default', session_id='sess_1', srv_ts_min=1604852083050000, limit=10),
+                   LGR_QUERY(lgrp='default', srv_ts_max=1604852083020000)]
+
+        def check_all():
+            for query in queries:
+                self.assertEqual(_cached_query(cache, lgrp, query), lgrp.query_lgrs(query))
+
+        check_all()
+        self.assertEqual(cache.get_stats()['misses'], 4)
+
+        # nothing appended, no SQL.
+        check_all()
+        self.assertEqual(cache.get_stats()['hits'], 4)
+
+        # a few appended, only those are queried and merged in. (the limit 10 one stays as it was)
+        lgrp.append_lgrs(_mk_lgrs(30, base_ts=1604852084000000))
+        check_all()
+        self.assertEqual(cache.get_stats()['delta_hits'], 4)
+
+        # more than max_delta appended, queries run again.
+        lgrp.append_lgrs(_mk_lgrs(60, base_ts=1604852085000000))
+        check_all()
+        self.assertEqual(cache.get_stats()['misses'], 8)
+
+        # appends in the past (srv_ts before the cached rows) are merged in order.
+        lgrp.append_lgrs(_mk_lgrs(5, base_ts=1604852083000500))
+        check_all()
+        self.assertEqual(cache.get_stats()['delta_hits'], 8)
+
+        # lvl_min=WARN and lvls=WARN,ERRR,CRIT are the same query.
+        query = LGR_QUERY(lgrp='default', lvls=frozenset({'WARN', 'ERRR', 'CRIT'}), limit=1000)
+        self.assertEqual(_cached_query(cache, lgrp, query), lgrp.query_lgrs(query))
+        self.assertEqual(cache.get_stats()['hits'], 5)
+
+    def test_repeat_rows_invalidate(self):
+
+        lgrp = SqliteLogGroup('default', sqlite3.connect(":memory:", isolation_level=None), repeat_window=60.0)
+        cache = LgrQueryCache()
+
+        def repeat(srv_ts, session_id):
+            return LOG_RECORD(srv_ts=srv_ts, lvl='INFO', session_id=session_id, msg='retrying')
+
+        lgrp.append_lgrs([repeat(1604852083000000, 'sess_a'), repeat(1604852083000000, 'sess_b')])
+        sess_a = LGR_QUERY(lgrp='default', session_id='sess_a')
+        sess_b = LGR_QUERY(lgrp='default', session_id='sess_b')
+        _cached_query(cache, lgrp, sess_a)
+        _cached_query(cache, lgrp, sess_b)
+
+        # sess_a's row gets another repeat. sess_a's entry is dropped, sess_b's doesnt have the row and is still good.
+        lgrp.append_lgrs([repeat(1604852084000000, 'sess_a')])
+        res = _cached_query(cache, lgrp, sess_a)
+        self.assertEqual(res, lgrp.query_lgrs(sess_a))
+        self.assertEqual(dict(zip(res['fields'], res['lgrs'][0]))['repeat_count'], 2)
+        self.assertEqual(_cached_query(cache, lgrp, sess_b), lgrp.query_lgrs(sess_b))
+        self.assertEqual(cache.get_stats()['misses'], 3)
+        self.assertEqual(cache.get_stats()['hits'], 1)
+
+    def test_eviction_by_bytes(self):
+
+        lgrp = SqliteLogGroup('default', sqlite3.connect(":memory:", isolation_level=None))
+        lgrp.append_lgrs(_mk_lgrs(1000, msg='x' * 200))
+        cache = LgrQueryCache(max_bytes=1000 * 1000)
+        _cached_query(cache, lgrp, LGR_QUERY(lgrp='default', limit=20))
+        page_bytes = cache.get_stats()['bytes']
+
+        # room for 8 pages. the least recently used ones go.
+        cache = LgrQueryCache(max_bytes=page_bytes * 8 + page_bytes // 2)
+        pages = [LGR_QUERY(lgrp='default', srv_ts_min=1604852083000000 + idx * 100000, limit=20) for idx in range(9)]
+        for query in pages[:8] + [pages[0], pages[8], pages[0]]:
+            _cached_query(cache, lgrp, query)
+
+        stats = cache.get_stats()
+        self.assertEqual((stats['entries'], stats['evicted'], stats['hits']), (8, 1, 2))
+        self.assertLessEqual(stats['bytes'], page_bytes * 8 + page_bytes // 2)
+        _cached_query(cache, lgrp, pages[1])
+        self.assertEqual(cache.get_stats()['misses'], 10)
+
+        # results over a share of the cache arent cached at all.
+        _cached_query(cache, lgrp, LGR_QUERY(lgrp='default', limit=1000))
+        self.assertEqual(cache.get_stats()['entries'], 8)
+
+    def test_dao_queries_are_cached(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            daos = [MemSqliteDAO(query_cache_bytes=1024 * 1024),
+                    DAO_SQLITE(os.path.join(tmp_dir, 'l6sk.db'), num_readers=2, query_cache_bytes=1024 * 1024)]
+
+            for dao in daos:
+                query = LGR_QUERY(lgrp='default', lvl_min='WARN', limit=1000)
+                for batch_idx in range(3):
+                    req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(
+                        'default', _mk_lgrs(40, base_ts=1604852083000000 + batch_idx * 1000000)))
+                    dao.serve_req(req)
+                    self.assertEqual(req.succ_data, 40)
+
+                    for _ in range(2):
+                        req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=query)
+                        dao.serve_req(req)
+                        deadline = time.monotonic() + 5.0
+                        while (req.succ_data is None) and (req.fail_cause is None) and (time.monotonic() < deadline):
+                            time.sleep(0.001)
+                        self.assertEqual(len(req.succ_data['lgrs']), 20 * (batch_idx + 1))
+
+                stats = dao._query_cache.get_stats()  # pylint: disable=protected-access
+                self.assertEqual((stats['misses'], stats['delta_hits'], stats['hits']), (1, 2, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import random
+import sqlite3
+import unittest
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ, DBL_REQUEST_DISPATCH
+from l6sk.dbl.dbl_api import DBL_API, LOG_RECORD, LGR_APPEND_ARGS, LGR_QUERY
+from l6sk.dbl.lgr_sampler import LgrSampler
+from l6sk.dbl.sqlite_lgrp import SqliteLogGroup
+
+
+class _FakeClock:
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _mk_lgrs(count, lvl, session_id=None):
+    return [LOG_RECORD(lvl=lvl, session_id=session_id, msg=f"msg {i}") for i in range(count)]
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestLgrSampler(unittest.TestCase):
+
+    def test_ratios_follow_queue_delay(self):
+
+        clock = _FakeClock()
+        dispatch = DBL_REQUEST_DISPATCH()
+        sampler = LgrSampler(dispatch, target_queue_delay=0.5, adjust_interval=0.25, session_rate=None,
+                             rnd=random.Random(1655), clock=clock)
+
+        # nothing queued, everything is kept as is.
+        kept = sampler.sample(_mk_lgrs(100, 'DBUG'))
+        self.assertEqual(len(kept), 100)
+        self.assertTrue(all(lgr.sample_rate is None for lgr in kept))
+
+        # the DBL worker does 4 req/s and there are 100 queued, 25 s worth. DBUG goes first, down to the floor.
+        for _ in range(100):
+            dispatch.put_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS('default', [])))
+
+        for _ in range(20):
+            clock.now += 0.25
+            dispatch.get_next_req()
+            sampler.sample([])
+
+        ratios = sampler.get_keep_ratios()
+        self.assertEqual(ratios['DBUG'], 0.01)
+        self.assertLess(ratios['INFO'], 1.0)
+        self.assertLess(ratios['INFO'], ratios['WARN'])
+
+        # ERRR and CRIT always make it. the rest w/ the ratio they were kept with.
+        kept = sampler.sample(_mk_lgrs(1000, 'ERRR') + _mk_lgrs(1000, 'CRIT') + _mk_lgrs(1000, 'DBUG'))
+        self.assertEqual(sum(lgr.lvl in ('ERRR', 'CRIT') for lgr in kept), 2000)
+        self.assertLess(sum(lgr.lvl == 'DBUG' for lgr in kept), 50)
+        self.assertTrue(all(lgr.sample_rate == 0.01 for lgr in kept if lgr.lvl == 'DBUG'))
+
+        # drained. ratios come back up, WARN first.
+        while dispatch.get_next_req() is not None:
+            pass
+
+        clock.now += 0.25
+        sampler.sample([])
+        self.assertEqual(sampler.get_keep_ratios()['DBUG'], 0.01)
+        self.assertGreater(sampler.get_keep_ratios()['WARN'], ratios['WARN'])
+
+        for _ in range(200):
+            clock.now += 0.25
+            sampler.sample([])
+        self.assertEqual(set(sampler.get_keep_ratios().values()), {1.0})
+
+    def test_session_buckets(self):
+
+        clock = _FakeClock()
+        dispatch = DBL_REQUEST_DISPATCH()
+        sampler = LgrSampler(dispatch, session_rate=100.0, session_burst=200.0, rnd=random.Random(1655), clock=clock)
+
+        # nothing queued, a session way over its rate still keeps everything.
+        for _ in range(500):
+            clock.now += 0.01
+            kept = sampler.sample(_mk_lgrs(100, 'INFO', 'chatty'))
+            self.assertEqual(len(kept), 100)
+            self.assertTrue(all(lgr.sample_rate is None for lgr in kept))
+
+        # the DBL worker is stuck, INFO goes down to the floor.
+        dispatch.put_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS('default', [])))
+        while sampler.get_keep_ratios()['INFO'] > 0.01:
+            clock.now += 0.25
+            sampler.sample([])
+
+        chatty_sent = chatty_kept = chatty_weighted = quiet_kept = 0
+        for _ in range(500):
+            clock.now += 0.01
+
+            kept = sampler.sample(_mk_lgrs(20, 'INFO', 'chatty') + _mk_lgrs(1, 'INFO', 'quiet'))
+            chatty_sent += 20
+            chatty_kept += sum(lgr.session_id == 'chatty' for lgr in kept)
+            chatty_weighted += sum(1 / (lgr.sample_rate or 1.0) for lgr in kept if lgr.session_id == 'chatty')
+            quiet_kept += sum(lgr.session_id == 'quiet' for lgr in kept)
+
+        # 5 s, 2000 records/s from chatty. it keeps what the ratio lets thru, and about its rate on top of that.
+        # quiet is at its rate and keeps everything.
+        self.assertGreater(chatty_kept, 0.01 * chatty_sent + 100 * 5)
+        self.assertLess(chatty_kept, 0.01 * chatty_sent + 200 + 2 * 100 * 5)
+        self.assertEqual(quiet_kept, 500)
+
+        # weighted, the kept records still add up to what was sent.
+        self.assertAlmostEqual(chatty_weighted / chatty_sent, 1.0, delta=0.1)
+
+    def test_sample_rate_is_stored(self):
+
+        lgrp = SqliteLogGroup('default', sqlite3.connect(":memory:", isolation_level=None), repeat_window=60.0)
+
+        lgrs = _mk_lgrs(3, 'DBUG', 'sess_a')
+        lgrs[0].sample_rate = 0.25
+        lgrs.append(LOG_RECORD(lvl='DBUG', session_id='sess_a', msg='msg 2', sample_rate=0.5))
+        lgrp.append_lgrs(lgrs)
+
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default'))
+        rows = [dict(zip(res['fields'], row)) for row in res['lgrs']]
+
+        # a change of rate isnt collapsed into the same row.
+        self.assertEqual([(row['msg'], row['sample_rate'], row['repeat_count']) for row in rows],
+                         [('msg 0', 0.25, 1), ('msg 1', 1.0, 1), ('msg 2', 1.0, 1), ('msg 2', 0.5, 1)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from l6sk.dbl.lgr_templates import get_template, get_template_id, get_msg_template, TEMPLATE_MSG_LEN
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestLgrTemplates(unittest.TestCase):
+
+    def test_masks(self):
+
+        self.assertEqual(get_template("took 12 ms"), "took <num> ms")
+        self.assertEqual(get_template("conn to 10.0.0.1:5432 failed after 3.5s"), "conn to <num> failed after <num>s")
+        self.assertEqual(get_template("req 550e8400-e29b-41d4-a716-446655440000 done"), "req <uuid> done")
+        self.assertEqual(get_template("ptr 0x7ffd12 sha deadbeef1234 accepted 12345678"),
+                         "ptr <hex> sha <hex> accepted <num>")
+
+        # quoted strings go first, whatever is in them. apostrophes inside words arent quotes.
+        self.assertEqual(get_template("key \"a b 12\" missing"), "key <str> missing")
+        self.assertEqual(get_template("user 'bob 2' isn't there, can't retry"), "user <str> isn't there, can't retry")
+        self.assertEqual(get_template("no values here"), "no values here")
+
+    def test_ids(self):
+
+        template_id, template = get_msg_template("took 12 ms")
+        self.assertEqual(template, "took <num> ms")
+        self.assertEqual(template_id, get_template_id("took <num> ms"))
+        self.assertEqual(get_msg_template("took 340 ms")[0], template_id)
+        self.assertNotEqual(get_msg_template("took 340 s")[0], template_id)
+
+        # positive sqlite INTEGERs.
+        self.assertTrue(0 <= template_id < 2**63)
+
+        # non str msgs are templated as str, long ones by their start.
+        self.assertEqual(get_msg_template(42)[1], "<num>")
+        self.assertEqual(get_msg_template("x" * TEMPLATE_MSG_LEN + " 12")[1], "x" * TEMPLATE_MSG_LEN)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,499 @@
+import os
+import json
+import time
+import unittest
+import dataclasses
+import tempfile
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ
+from l6sk.dbl.dbl_api import DBL_API, LOG_RECORD, LGR_APPEND_ARGS, LGR_QUERY, LGR_FIELDS, get_next_page_after
+from l6sk.dbl.dbl_api import LGR_MULTI_QUERY, LGR_EXPORT, LGR_HISTOGRAM, LGR_SESSION_DIFF, LGR_TEMPLATE_TOP
+from l6sk.dbl.dao_segment import SegmentDAO
+from l6sk.dbl.segment_lgrp import SegmentLogGroup
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# test data ...
+def _mk_test_lgrs(count, base_ts=1604852083000000):
+
+    lgrs = []
+    for i in range(count):
+        lgrs.append(
+            LOG_RECORD(srv_ts=base_ts + i * 1000, client_ts=base_ts + i * 1000 - 7, lvl=['DBUG', 'INFO', 'ERRR'][i % 3],
+                       session_id='AZxV89HW_SvGbZsyFDkDP6q0', lineno=i, filename='test_segment_dao.py', pid=4242,
+                       tid=140212345678912, msg=f"hello {i}"))
+
+    return lgrs
+
+
+def _query_pages(query_fn, query):
+    """ All records query matches, a page (query.limit records) at a time, w/ the keyset cursor. """
+
+    lgrs = []
+    while True:
+        page = query_fn(query)['lgrs']
+        lgrs += page
+
+        after = get_next_page_after(query, page)
+        if after is None:
+            return lgrs
+
+        query = dataclasses.replace(query, after=after)
+
+
+# small segments, so tests roll over plenty of them.
+_SEGMENT_SIZE = 4096 * 2
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+class TestSegmentDAO(unittest.TestCase):
+
+    def test_append_and_query(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = SegmentDAO(dirname=tmp_dir)
+
+            req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=_mk_test_lgrs(30)))
+            dao.serve_req(req)
+            self.assertIsNone(req.fail_cause)
+            self.assertEqual(req.succ_data, 30)
+
+            query = LGR_QUERY(lgrp='default', srv_ts_min=1604852083000000 + 10 * 1000, limit=5)
+            req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=query)
+            dao.serve_req(req)
+            self.assertIsNone(req.fail_cause)
+
+            lgrs = [dict(zip(req.succ_data['fields'], row)) for row in req.succ_data['lgrs']]
+            self.assertEqual(len(lgrs), 5)
+            self.assertEqual(lgrs[0]['msg'], 'hello 10')
+            self.assertEqual(lgrs[0]['lvl'], 'INFO')
+            self.assertEqual(lgrs[0]['lineno'], 10)
+            self.assertEqual(lgrs[0]['tid'], 140212345678912)
+            self.assertEqual(lgrs[0]['srv_ts'], 1604852083000000 + 10 * 1000)
+            self.assertEqual(lgrs[0]['lrid'], 11)
+            self.assertIsNone(lgrs[0]['funcname'])
+
+            dao.close()
+            self.assertTrue(os.path.isdir(os.path.join(tmp_dir, 'lgrp_default')))
+
+    def test_bad_lgrp_name_fails_req(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='../etc', lgrs=_mk_test_lgrs(1)))
+            SegmentDAO(dirname=tmp_dir).serve_req(req)
+            self.assertIsNone(req.succ_data)
+            self.assertIsNotNone(req.fail_cause)
+
+    def test_segments_roll_over_and_reopen(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE)
+            for batch_idx in range(10):
+                lgrp.append_lgrs(_mk_test_lgrs(50, base_ts=1604852083000000 + batch_idx * 50 * 1000))
+
+            self.assertGreater(lgrp.get_num_segments(), 3)
+            lgrp.close()
+
+            # sealed segments from their footers, the active one by walking its frames.
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE)
+            lgrs = lgrp.query_lgrs(LGR_QUERY(lgrp='default', limit=1000))['lgrs']
+            self.assertEqual([row[0] for row in lgrs], list(range(1, 501)))
+
+            # lrids keep going after a reopen.
+            lgrp.append_lgrs(_mk_test_lgrs(1, base_ts=1704852083000000))
+            lgrs = lgrp.query_lgrs(LGR_QUERY(lgrp='default', srv_ts_min=1704852083000000))['lgrs']
+            self.assertEqual(lgrs[0][0], 501)
+
+            # range in the middle, spanning segments.
+            lgrs = lgrp.query_lgrs(
+                LGR_QUERY(lgrp='default', srv_ts_min=1604852083000000 + 100 * 1000,
+                          srv_ts_max=1604852083000000 + 299 * 1000, limit=1000))['lgrs']
+            self.assertEqual([row[LGR_FIELDS.index('lineno')] for row in lgrs[:2]], [0, 1])
+            self.assertEqual(len(lgrs), 200)
+            lgrp.close()
+
+    def test_torn_write_is_dropped(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE)
+            lgrp.append_lgrs(_mk_test_lgrs(5))
+            lgrp.close()
+
+            # half a frame after the last good one, like a crash in the middle of an append.
+            seg_fname = os.path.join(tmp_dir, sorted(os.listdir(tmp_dir))[-1])
+            with open(seg_fname, 'r+b') as seg_file:
+                data = seg_file.read()
+                end_of_data = data.index(b'hello 4') + len(b'hello 4')
+                seg_file.seek(end_of_data)
+                seg_file.write(b'\x40\x00\x00\x00\x12\x34')
+
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE)
+            self.assertEqual(len(lgrp.query_lgrs(LGR_QUERY(lgrp='default'))['lgrs']), 5)
+
+            lgrp.append_lgrs(_mk_test_lgrs(1))
+            lgrs = lgrp.query_lgrs(LGR_QUERY(lgrp='default'))['lgrs']
+            self.assertEqual([row[0] for row in lgrs], [1, 6, 2, 3, 4, 5])
+            lgrp.close()
+
+    def test_out_of_order_srv_ts(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE)
+
+            # newer records first, then older ones (client provided srv_ts). results still come back in srv_ts order.
+            lgrp.append_lgrs(_mk_test_lgrs(100, base_ts=1604852083000000 + 1000 * 1000))
+            lgrp.append_lgrs(_mk_test_lgrs(100, base_ts=1604852083000000))
+
+            lgrs = lgrp.query_lgrs(LGR_QUERY(lgrp='default', limit=10))['lgrs']
+            self.assertEqual([row[0] for row in lgrs], list(range(101, 111)))
+
+            srv_ts_list = [row[1] for row in lgrp.query_lgrs(LGR_QUERY(lgrp='default', limit=1000))['lgrs']]
+            self.assertEqual(srv_ts_list, sorted(srv_ts_list))
+            self.assertEqual(len(srv_ts_list), 200)
+            lgrp.close()
+
+    def test_odd_values_round_trip(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE)
+            lgrp.append_lgrs([
+                LOG_RECORD(srv_ts=1, tid=2**70, pid='pid_abc', msg='héllo wörld', session_id='s'),
+                LOG_RECORD(srv_ts=2),
+            ])
+
+            lgrs = [dict(zip(LGR_FIELDS, row)) for row in lgrp.query_lgrs(LGR_QUERY(lgrp='default'))['lgrs']]
+            self.assertEqual(lgrs[0]['tid'], str(2**70))
+            self.assertEqual(lgrs[0]['pid'], 'pid_abc')
+            self.assertEqual(lgrs[0]['msg'], 'héllo wörld')
+            self.assertEqual(lgrs[0]['session_id'], 's')
+            self.assertEqual(lgrs[1], dict(zip(LGR_FIELDS, (2, 2) + (None, ) * (len(LGR_FIELDS) - 2))))
+
+            # bad level refuses the whole batch
+            with self.assertRaises(KeyError):
+                lgrp.append_lgrs([LOG_RECORD(msg='ok'), LOG_RECORD(lvl='NOPE')])
+            self.assertEqual(len(lgrp.query_lgrs(LGR_QUERY(lgrp='default'))['lgrs']), 2)
+            lgrp.close()
+
+    def test_session_query_skips_segments(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE, index_every=8, bloom_bytes=256)
+
+            # every batch is a different session, and fills about a segment.
+            for batch_idx in range(8):
+                lgrs = _mk_test_lgrs(80, base_ts=1604852083000000 + batch_idx * 80 * 1000)
+                for lgr in lgrs:
+                    lgr.session_id = f"sess_{batch_idx}"
+                    lgr.subsys = 'net' if batch_idx == 3 else None
+                lgrp.append_lgrs(lgrs)
+
+            for reopen in (False, True):
+                if reopen:
+                    lgrp.close()
+                    lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE, index_every=8,
+                                           bloom_bytes=256)
+
+                res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', session_id='sess_5', limit=1000))
+                self.assertEqual(len(res['lgrs']), 80)
+                self.assertTrue(all(row[LGR_FIELDS.index('session_id')] == 'sess_5' for row in res['lgrs']))
+                self.assertGreater(res['stats']['segments_skipped_bloom'], 0)
+                self.assertGreater(res['stats']['blocks_skipped'], res['stats']['blocks_scanned'])
+
+                res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', subsys='net', limit=1000))
+                self.assertEqual(len(res['lgrs']), 80)
+                self.assertEqual(res['lgrs'][0][LGR_FIELDS.index('session_id')], 'sess_3')
+
+                res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', session_id='sess_5', subsys='net'))
+                self.assertEqual(res['lgrs'], [])
+
+            self.assertGreater(lgrp.get_scan_stats()['segments_skipped_bloom'], 0)
+            lgrp.close()
+
+    def test_time_range_skips_blocks(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE, index_every=8)
+            lgrp.append_lgrs(_mk_test_lgrs(400))
+
+            res = lgrp.query_lgrs(
+                LGR_QUERY(lgrp='default', srv_ts_min=1604852083000000 + 200 * 1000,
+                          srv_ts_max=1604852083000000 + 209 * 1000))
+            self.assertEqual([row[LGR_FIELDS.index('lineno')] for row in res['lgrs']], list(range(200, 210)))
+            self.assertLessEqual(res['stats']['blocks_scanned'], 3)
+            self.assertGreaterEqual(res['stats']['blocks'], 400 // 8)
+            self.assertEqual(res['stats']['blocks_skipped'], res['stats']['blocks'] - res['stats']['blocks_scanned'])
+            self.assertGreater(res['stats']['segments_skipped_ts'], 0)
+            lgrp.close()
+
+    def test_archive_segments(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE, index_every=8, archive_chunk_rows=16)
+            for batch_idx in range(8):
+                lgrs = _mk_test_lgrs(80, base_ts=1604852083000000 + batch_idx * 80 * 1000)
+                for lgr in lgrs:
+                    lgr.session_id = f"sess_{batch_idx}"
+                lgrs[0].tid = 2**70
+                lgrs[1].pid = None
+                lgrp.append_lgrs(lgrs)
+
+            queries = [
+                LGR_QUERY(lgrp='default', limit=1000),
+                LGR_QUERY(lgrp='default', srv_ts_min=1604852083000000 + 100 * 1000,
+                          srv_ts_max=1604852083000000 + 299 * 1000, limit=1000),
+                LGR_QUERY(lgrp='default', session_id='sess_2', lvl_min='INFO', limit=1000),
+                LGR_QUERY(lgrp='default', lvl_min='ERRR', limit=20),
+            ]
+            expected = [lgrp.query_lgrs(query)['lgrs'] for query in queries]
+
+            # everything older than batch 4 is archived, the rest (and the active segment) stays.
+            num_segments = lgrp.get_num_segments()
+            num_archived = lgrp.archive_segments(1604852083000000 + 4 * 80 * 1000)
+            self.assertGreater(num_archived, 2)
+            self.assertEqual(lgrp.get_num_archives(), num_archived)
+            self.assertEqual(lgrp.get_num_segments(), num_segments - num_archived)
+            self.assertEqual(lgrp.archive_segments(1604852083000000 + 4 * 80 * 1000), 0)
+
+            for reopen in (False, True):
+                if reopen:
+                    lgrp.close()
+                    lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE, index_every=8)
+                    self.assertEqual(lgrp.get_num_archives(), num_archived)
+
+                for query, lgrs in zip(queries, expected):
+                    self.assertEqual(lgrp.query_lgrs(query)['lgrs'], lgrs)
+
+                # pages across archives and segments.
+                self.assertEqual(_query_pages(lgrp.query_lgrs, dataclasses.replace(queries[0], limit=37)), expected[0])
+                self.assertEqual(_query_pages(lgrp.query_lgrs, dataclasses.replace(queries[2], limit=5)), expected[2])
+
+                res = lgrp.query_lgrs(queries[0])
+                self.assertEqual(res['stats']['archives'], num_archived)
+                self.assertEqual(res['lgrs'][0][LGR_FIELDS.index('tid')], str(2**70))
+                self.assertIsNone(res['lgrs'][1][LGR_FIELDS.index('pid')])
+
+            # session in an archive, the other archives are skipped by their bloom filters.
+            res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', session_id='sess_1', limit=1000))
+            self.assertEqual(len(res['lgrs']), 80)
+            self.assertGreaterEqual(res['stats']['segments_skipped_bloom'], num_archived - 2)
+
+            # archived chunks skipped by their zone maps. (whole chunk of lvl < CRIT, all of them)
+            res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', lvl_min='CRIT', srv_ts_max=1604852083000000 + 99 * 1000))
+            self.assertEqual(res['lgrs'], [])
+            self.assertEqual(res['stats']['blocks_scanned'], 0)
+
+            # new appends keep the lrids going.
+            lgrp.append_lgrs(_mk_test_lgrs(1, base_ts=1704852083000000))
+            self.assertEqual(lgrp.query_lgrs(LGR_QUERY(lgrp='default', srv_ts_min=1704852083000000))['lgrs'][0][0], 641)
+            lgrp.close()
+
+    def test_query_filters_and_pages(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE, index_every=8, archive_chunk_rows=16)
+            lgrs = _mk_test_lgrs(300)
+            for idx, lgr in enumerate(lgrs):
+                # runs of 7 records w/ the same srv_ts, pages have to split them by lrid.
+                lgr.srv_ts = 1604852083000000 + (idx // 7) * 1000
+                lgr.lvl = ['DBUG', 'INFO', 'WARN', 'ERRR', None][idx % 5]
+                lgr.client_ts = None if idx % 10 == 9 else 1604852083000000 - idx
+                lgr.filename = 'net.py' if idx % 4 == 0 else 'db.py'
+            lgrp.append_lgrs(lgrs[:150])
+            lgrp.append_lgrs(lgrs[150:])
+
+            queries = [
+                LGR_QUERY(lgrp='default', limit=1000),
+                LGR_QUERY(lgrp='default', lvls=frozenset({'DBUG', 'ERRR'}), limit=1000),
+                LGR_QUERY(lgrp='default', lvls=frozenset({'DBUG', 'ERRR'}), lvl_min='INFO', limit=1000),
+                LGR_QUERY(lgrp='default', client_ts_min=1604852083000000 - 20, client_ts_max=1604852083000000 - 10,
+                          limit=1000),
+                LGR_QUERY(lgrp='default', msg_regex=r"^hello \d*7$", lvl_min='WARN', limit=1000),
+                LGR_QUERY(lgrp='default', filename_regex=r"^net", msg_regex=r"1", limit=1000),
+            ]
+            xpct_linenos = [
+                list(range(300)),
+                [idx for idx in range(300) if idx % 5 in (0, 3)],
+                [idx for idx in range(300) if idx % 5 == 3],
+                [10, 11, 12, 13, 14, 15, 16, 17, 18, 20],
+                list(range(7, 300, 10)),
+                [idx for idx in range(0, 300, 4) if '1' in str(idx)],
+            ]
+
+            for archived in (False, True):
+                if archived:
+                    self.assertGreater(lgrp.archive_segments(1604852083000000 + 30 * 1000), 0)
+
+                for query, linenos in zip(queries, xpct_linenos):
+                    lgrs = lgrp.query_lgrs(query)['lgrs']
+                    self.assertEqual([row[LGR_FIELDS.index('lineno')] for row in lgrs], linenos)
+
+                    for page_size in (1, 7, 10):
+                        self.assertEqual(_query_pages(lgrp.query_lgrs, dataclasses.replace(query, limit=page_size)),
+                                         lgrs)
+
+            # no full text index in segments.
+            with self.assertRaises(ValueError):
+                lgrp.query_lgrs(LGR_QUERY(lgrp='default', msg_match='hello'))
+            with self.assertRaises(ValueError):
+                lgrp.query_lgrs(LGR_QUERY(lgrp='default', msg_regex='(a+)+'))
+            lgrp.close()
+
+    def test_archive_crash_leftovers(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE)
+            lgrp.append_lgrs(_mk_test_lgrs(200))
+            seg_fnames = sorted(fname for fname in os.listdir(tmp_dir) if fname.endswith('.l6seg'))
+            with open(os.path.join(tmp_dir, seg_fnames[0]), 'rb') as seg_file:
+                first_seg = seg_file.read()
+
+            self.assertGreater(lgrp.archive_segments(1704852083000000), 0)
+            lgrp.close()
+
+            # crashed after the archive was in place but before the segment was deleted, and in the middle of
+            # writing another archive.
+            with open(os.path.join(tmp_dir, seg_fnames[0]), 'wb') as seg_file:
+                seg_file.write(first_seg)
+            with open(os.path.join(tmp_dir, 'arc_00000000000000009999.l6arc.tmp'), 'wb') as arc_file:
+                arc_file.write(b'half an archive')
+
+            lgrp = SegmentLogGroup('default', tmp_dir, segment_size=_SEGMENT_SIZE)
+            lgrs = lgrp.query_lgrs(LGR_QUERY(lgrp='default', limit=1000))['lgrs']
+            self.assertEqual([row[0] for row in lgrs], list(range(1, 201)))
+            self.assertNotIn(seg_fnames[0], os.listdir(tmp_dir))
+            self.assertNotIn('arc_00000000000000009999.l6arc.tmp', os.listdir(tmp_dir))
+            lgrp.close()
+
+    def test_dao_archives_per_lgrp_opts(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = SegmentDAO(dirname=tmp_dir, segment_size=_SEGMENT_SIZE, archive_interval=3600.0,
+                             lgrp_opts={'old': {'archive_after': 0.0}})
+
+            for lgrp in ('old', 'new'):
+                req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp=lgrp, lgrs=_mk_test_lgrs(200)))
+                dao.serve_req(req)
+                self.assertIsNone(req.fail_cause)
+
+            self.assertGreater(dao.archive_lgrps(), 0)
+            self.assertTrue(any(fname.endswith('.l6arc') for fname in os.listdir(os.path.join(tmp_dir, 'lgrp_old'))))
+            self.assertFalse(any(fname.endswith('.l6arc') for fname in os.listdir(os.path.join(tmp_dir, 'lgrp_new'))))
+
+            req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=LGR_QUERY(lgrp='old', lvl_min='ERRR', limit=1000))
+            dao.serve_req(req)
+            self.assertEqual(len(req.succ_data['lgrs']), len(range(2, 200, 3)))
+            dao.close()
+
+    def test_multi_query_and_export(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = SegmentDAO(dirname=tmp_dir, segment_size=_SEGMENT_SIZE, export_chunk_rows=7)
+
+            # b's records interleave w/ a's, and a has a segment thats out of srv_ts order.
+            lgrs_b = _mk_test_lgrs(100, base_ts=1604852083000500)
+            lgrs_a = _mk_test_lgrs(200)
+            lgrs_a[150].srv_ts = 1604852083000000 + 3
+            for lgrp, lgrs in [('a', lgrs_a), ('b', lgrs_b)]:
+                dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp=lgrp, lgrs=lgrs)))
+            dao.close()
+
+            # reopened, every log group on disk is in a multi query w/o lgrps.
+            dao = SegmentDAO(dirname=tmp_dir, segment_size=_SEGMENT_SIZE, export_chunk_rows=7)
+            query = LGR_QUERY(lgrp=None, lvl_min='INFO', limit=1000)
+
+            req = DBL_REQ(op=DBL_API.QUERY_MULTI_LGRS, data=LGR_MULTI_QUERY(query=query))
+            dao.serve_req(req)
+            self.assertIsNone(req.fail_cause)
+            rows = req.succ_data['lgrs']
+            self.assertEqual(len(rows), sum(i % 3 != 0 for i in range(200)) + sum(i % 3 != 0 for i in range(100)))
+            self.assertEqual(rows, sorted(rows, key=lambda row: (row[1], row[-1], row[0])))
+            self.assertEqual({row[-1] for row in rows}, {'a', 'b'})
+
+            # an export is the same records as a query, in the same order. later appends arent in it.
+            query = LGR_QUERY(lgrp='a', lvl_min='INFO', limit=None)
+            expected = dao.query_lgrs(dataclasses.replace(query, limit=1000))['lgrs']
+
+            req = DBL_REQ(op=DBL_API.EXPORT_LGRS, data=LGR_EXPORT(query))
+            dao.serve_req(req)
+            self.assertIsNone(req.fail_cause)
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='a', lgrs=_mk_test_lgrs(30))))
+
+            export, data = req.succ_data, b''
+            deadline = time.monotonic() + 10.0
+            while time.monotonic() < deadline:
+                chunk = export.get_chunk()
+                if chunk is None:
+                    break
+                data += chunk
+                time.sleep(0.001)
+
+            self.assertIsNone(export.error)
+            self.assertEqual([tuple(json.loads(line).values()) for line in data.decode().splitlines()], expected)
+            dao.close()
+
+    def test_unsupported_ops(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = SegmentDAO(dirname=tmp_dir)
+
+            for op, data in [(DBL_API.HISTOGRAM_LGRS, LGR_HISTOGRAM(lgrp='default')),
+                             (DBL_API.DIFF_SESSIONS, LGR_SESSION_DIFF(lgrp='default', session_a='a', session_b='b')),
+                             (DBL_API.TOP_TEMPLATES, LGR_TEMPLATE_TOP(lgrp='default'))]:
+                req = DBL_REQ(op=op, data=data)
+                dao.serve_req(req)
+                self.assertIsNone(req.succ_data)
+                self.assertEqual(req.fail_cause.http_err_code, 501)
+
+            # no full text index here, a msg_match is the client's mistake.
+            req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=LGR_QUERY(lgrp='default', msg_match='timeout'))
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=_mk_test_lgrs(3))))
+            dao.serve_req(req)
+            self.assertEqual(req.fail_cause.http_err_code, 400)
+
+    def test_reads_dont_create_lgrps(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = SegmentDAO(dirname=tmp_dir)
+
+            for op, data in [(DBL_API.QUERY_LGRS, LGR_QUERY(lgrp='nope')),
+                             (DBL_API.QUERY_MULTI_LGRS, LGR_MULTI_QUERY(query=LGR_QUERY(lgrp=None), lgrps=('nope', ))),
+                             (DBL_API.EXPORT_LGRS, LGR_EXPORT(LGR_QUERY(lgrp='nope')))]:
+                req = DBL_REQ(op=op, data=data)
+                dao.serve_req(req)
+                self.assertIsNone(req.fail_cause)
+
+                if op == DBL_API.EXPORT_LGRS:
+                    deadline = time.monotonic() + 5.0
+                    while (req.succ_data.get_chunk() is not None) and (time.monotonic() < deadline):
+                        time.sleep(0.001)
+                    self.assertEqual(req.succ_data.num_rows, 0)
+                else:
+                    self.assertEqual(req.succ_data['lgrs'], [])
+
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+            # an append still does.
+            req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='nope', lgrs=_mk_test_lgrs(3)))
+            dao.serve_req(req)
+            self.assertEqual(len(dao.query_lgrs(LGR_QUERY(lgrp='nope'))['lgrs']), 3)
+
+    def test_health_checks(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = SegmentDAO(dirname=tmp_dir)
+
+            for op in [DBL_API.HEALTH_CHK_2, DBL_API.HEALTH_CHK_3]:
+                req = DBL_REQ(op=op)
+                dao.serve_req(req)
+                self.assertIsNone(req.fail_cause)
+                self.assertTrue(req.succ_data['hchk'].endswith(": OK"))
+                self.assertGreaterEqual(req.succ_data['dao_exec_ms'], 0.0)
+
+            # no sentinel file left behind.
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
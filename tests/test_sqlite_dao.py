@@ -1,6 +1,63 @@
 
 import os
+import time
+import dataclasses
 import unittest
+import tempfile
+import sqlite3
+import threading
+
+from l6sk.dbl.dbl_dispatch import DBL_REQ
+from l6sk.dbl.dbl_api import DBL_API, LOG_RECORD, LGR_APPEND_ARGS, LGR_QUERY, LGR_HISTOGRAM, get_lgrp_opts
+from l6sk.dbl.dbl_api import LGR_LVL_CODES, LGR_SESSION_DIFF, LGR_TEMPLATE_TOP, get_next_page_after
+from l6sk.dbl.dbl_api import LGR_MULTI_QUERY, LGR_EXPORT, LgrQueryError, get_next_multi_page_after
+from l6sk.dbl.dao_sqlite_mem import MemSqliteDAO
+from l6sk.dbl.dao_sqlite_disk import DAO_SQLITE
+from l6sk.dbl.sqlite_lgrp import SqliteLogGroup, LEGACY_LOG_RECORD_SCHEMA_SCRIPT, LGR_FIELDS
+from l6sk.dbl.lgr_templates import get_msg_template
+from l6sk.dbl.lgr_regex import check_regex
+from l6sk.dbl import sqlite_lgrp
+
+
+# ======================================================================================================================
+# ======================================================================================================================
+# test data ...
+def _mk_test_lgrs(count, base_ts=1604852083000000):
+
+    lgrs = []
+    for i in range(count):
+        lgrs.append(
+            LOG_RECORD(srv_ts=base_ts + i * 1000, client_ts=base_ts + i * 1000 - 7, lvl=['DBUG', 'INFO', 'ERRR'][i % 3],
+                       session_id='AZxV89HW_SvGbZsyFDkDP6q0', lineno=i, filename='test_sqlite_dao.py', pid=4242,
+                       tid=140212345678912, msg=f"hello {i}"))
+
+    return lgrs
+
+
+def _wait_req(req, timeout=5.0):
+    """ sleep wait for a DBL_REQ to be done, like a DBL user would. (some DAOs finish reads on other threads) """
+
+    deadline = time.monotonic() + timeout
+    while (req.succ_data is None) and (req.fail_cause is None) and (time.monotonic() < deadline):
+        time.sleep(0.001)
+
+    return req
+
+
+def _query_pages(query_fn, query):
+    """ All records query matches, a page (query.limit records) at a time, w/ the keyset cursor. """
+
+    lgrs = []
+    while True:
+        page = query_fn(query)['lgrs']
+        lgrs += page
+
+        after = get_next_page_after(query, page)
+        if after is None:
+            return lgrs
+
+        query = dataclasses.replace(query, after=after)
+
 
 # ======================================================================================================================
 # ======================================================================================================================
@@ -33,6 +90,1087 @@ class TestSQLiteDAO(unittest.TestCase):
 
         self.assertEqual(2, 1 + 1)
 
+    def _append_and_query_back(self, dao):
+
+        req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=_mk_test_lgrs(30)))
+        dao.serve_req(req)
+        self.assertIsNone(req.fail_cause)
+        self.assertEqual(req.succ_data, 30)
+
+        query = LGR_QUERY(lgrp='default', srv_ts_min=1604852083000000 + 10 * 1000, limit=5)
+        req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=query)
+        dao.serve_req(req)
+        _wait_req(req)
+        self.assertIsNone(req.fail_cause)
+
+        lgrs = [dict(zip(req.succ_data['fields'], row)) for row in req.succ_data['lgrs']]
+        self.assertEqual(len(lgrs), 5)
+        self.assertEqual(lgrs[0]['msg'], 'hello 10')
+        self.assertEqual(lgrs[0]['lvl'], 'INFO')
+        self.assertEqual(lgrs[0]['lineno'], 10)
+        self.assertEqual(lgrs[0]['tid'], 140212345678912)
+        self.assertEqual(lgrs[0]['srv_ts'], 1604852083000000 + 10 * 1000)
+
+    def test_mem_dao_append_and_query(self):
+
+        self._append_and_query_back(MemSqliteDAO())
+
+    def test_disk_dao_append_and_query(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'))
+            self._append_and_query_back(dao)
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'lgrp_default.db')))
+
+    def test_disk_dao_without_readers(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self._append_and_query_back(DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=0))
+
+    def test_disk_dao_reads_dont_wait_on_writer(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=2)
+
+            req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=_mk_test_lgrs(10)))
+            dao.serve_req(req)
+            self.assertEqual(req.succ_data, 10)
+
+            # writer is in the middle of a write transaction. (ie a big batch, or a checkpoint)
+            writer_conn = sqlite3.connect(os.path.join(tmp_dir, 'lgrp_default.db'), isolation_level=None)
+            writer_conn.execute("BEGIN IMMEDIATE;")
+            writer_conn.execute("INSERT INTO log_record(srv_ts, msg) VALUES (1, 'not committed');")
+
+            req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=LGR_QUERY(lgrp='default', limit=100))
+            dao.serve_req(req)
+            _wait_req(req, timeout=2.0)
+
+            # reader got the last committed snapshot, w/o waiting for the writer.
+            self.assertIsNone(req.fail_cause)
+            self.assertEqual(len(req.succ_data['lgrs']), 10)
+
+            writer_conn.execute("ROLLBACK;")
+            writer_conn.close()
+
+    def test_mem_dao_snapshot_and_restore(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # long interval, snapshot by hand.
+            dao = MemSqliteDAO(snapshot_dirname=tmp_dir, snapshot_interval=3600)
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='lg_a', lgrs=_mk_test_lgrs(500))))
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='lg_b', lgrs=_mk_test_lgrs(3))))
+            dao.snapshot_lgrps()
+
+            self.assertTrue(os.path.exists(os.path.join(tmp_dir, 'lgrp_lg_a.snap.db')))
+            self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'lgrp_lg_a.snap.db.tmp')))
+
+            # anything after the last snapshot is lost.
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='lg_b', lgrs=_mk_test_lgrs(3))))
+
+            restored_dao = MemSqliteDAO(snapshot_dirname=tmp_dir, snapshot_interval=3600)
+
+            for lgrp, xpct_count in (('lg_a', 500), ('lg_b', 3)):
+                req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=LGR_QUERY(lgrp=lgrp, limit=1000))
+                restored_dao.serve_req(req)
+                self.assertEqual(len(req.succ_data['lgrs']), xpct_count)
+                self.assertEqual(req.succ_data['lgrs'][0][LGR_FIELDS.index('session_id')], 'AZxV89HW_SvGbZsyFDkDP6q0')
+
+    def test_mem_dao_snapshot_during_ingest(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = MemSqliteDAO(snapshot_dirname=tmp_dir, snapshot_interval=0.05)
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='lg_a', lgrs=_mk_test_lgrs(20000))))
+            snap_filename = os.path.join(tmp_dir, 'lgrp_lg_a.snap.db')
+            stop = threading.Event()
+
+            # the DBL worker, w/ a batch of 7 appended every few ms.
+            def dbl_worker():
+                while not stop.is_set():
+                    dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS,
+                                          data=LGR_APPEND_ARGS(lgrp='lg_a', lgrs=_mk_test_lgrs(7))))
+                    dao.run_maintenance(False)
+                    time.sleep(0.002)
+
+            worker = threading.Thread(target=dbl_worker)
+            worker.start()
+            try:
+                deadline = time.monotonic() + 10.0
+                while (not os.path.exists(snap_filename)) and (time.monotonic() < deadline):
+                    time.sleep(0.01)
+            finally:
+                stop.set()
+                worker.join()
+
+            # a snapshot got done, and its of whole appends.
+            self.assertTrue(os.path.exists(snap_filename))
+            restored_dao = MemSqliteDAO(snapshot_dirname=tmp_dir, snapshot_interval=3600)
+            req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=LGR_QUERY(lgrp='lg_a', limit=None))
+            restored_dao.serve_req(req)
+            self.assertGreaterEqual(len(req.succ_data['lgrs']), 20000)
+            self.assertEqual((len(req.succ_data['lgrs']) - 20000) % 7, 0)
+
+    def test_session_and_subsys_filters(self):
+
+        lgrp = SqliteLogGroup('default', sqlite3.connect(":memory:", isolation_level=None))
+        lgrs = _mk_test_lgrs(30)
+        for idx, lgr in enumerate(lgrs):
+            lgr.session_id = f"sess_{idx % 3}"
+            lgr.subsys = 'net' if idx % 2 else None
+        lgrp.append_lgrs(lgrs)
+
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', session_id='sess_1'))
+        self.assertEqual([row[LGR_FIELDS.index('lineno')] for row in res['lgrs']], list(range(1, 30, 3)))
+
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', session_id='sess_1', subsys='net'))
+        self.assertEqual([row[LGR_FIELDS.index('lineno')] for row in res['lgrs']], [1, 7, 13, 19, 25])
+
+        self.assertEqual(lgrp.query_lgrs(LGR_QUERY(lgrp='default', session_id='nope'))['lgrs'], [])
+
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', lvl_min='INFO', subsys='net'))
+        self.assertEqual([row[LGR_FIELDS.index('lineno')] for row in res['lgrs']],
+                         [idx for idx in range(1, 30, 2) if idx % 3])
+
+    def test_query_filters_and_pages(self):
+
+        lgrp = SqliteLogGroup('default', sqlite3.connect(":memory:", isolation_level=None))
+        lgrs = _mk_test_lgrs(100)
+        for idx, lgr in enumerate(lgrs):
+            # runs of 7 records w/ the same srv_ts, pages have to split them by lrid.
+            lgr.srv_ts = 1604852083000000 + (idx // 7) * 1000
+            lgr.lvl = ['DBUG', 'INFO', 'WARN', 'ERRR', None][idx % 5]
+            lgr.client_ts = None if idx % 10 == 9 else 1604852083000000 - idx
+        lgrp.append_lgrs(lgrs)
+
+        def linenos(rows):
+            return [row[LGR_FIELDS.index('lineno')] for row in rows]
+
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', lvls=frozenset({'DBUG', 'ERRR'}), limit=1000))
+        self.assertEqual(linenos(res['lgrs']), [idx for idx in range(100) if idx % 5 in (0, 3)])
+
+        # both level filters apply.
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', lvls=frozenset({'DBUG', 'ERRR'}), lvl_min='INFO', limit=1000))
+        self.assertEqual(linenos(res['lgrs']), [idx for idx in range(100) if idx % 5 == 3])
+
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', client_ts_min=1604852083000000 - 20,
+                                        client_ts_max=1604852083000000 - 10, limit=1000))
+        self.assertEqual(linenos(res['lgrs']), [10, 11, 12, 13, 14, 15, 16, 17, 18, 20])
+
+        for query in [LGR_QUERY(lgrp='default', limit=1000),
+                      LGR_QUERY(lgrp='default', lvl_min='WARN', limit=1000),
+                      LGR_QUERY(lgrp='default', srv_ts_min=1604852083000000 + 3000, client_ts_min=0, limit=1000)]:
+            expected = lgrp.query_lgrs(query)['lgrs']
+            self.assertGreater(len(expected), 10)
+
+            for page_size in (1, 3, 7, 10):
+                self.assertEqual(_query_pages(lgrp.query_lgrs, dataclasses.replace(query, limit=page_size)), expected)
+
+    def test_bad_lgrp_name_fails_req(self):
+
+        req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='../etc', lgrs=_mk_test_lgrs(1)))
+        MemSqliteDAO().serve_req(req)
+        self.assertIsNone(req.succ_data)
+        self.assertIsNotNone(req.fail_cause)
+
+    def test_reads_dont_create_lgrps(self):
+
+        reads = [(DBL_API.QUERY_LGRS, LGR_QUERY(lgrp='nope')),
+                 (DBL_API.QUERY_MULTI_LGRS, LGR_MULTI_QUERY(query=LGR_QUERY(lgrp=None), lgrps=('nope', 'nope_2'))),
+                 (DBL_API.HISTOGRAM_LGRS, LGR_HISTOGRAM(lgrp='nope')),
+                 (DBL_API.DIFF_SESSIONS, LGR_SESSION_DIFF(lgrp='nope', session_a='a', session_b='b')),
+                 (DBL_API.TOP_TEMPLATES, LGR_TEMPLATE_TOP(lgrp='nope')),
+                 (DBL_API.EXPORT_LGRS, LGR_EXPORT(LGR_QUERY(lgrp='nope')))]
+
+        def check(dao, tmp_dir=None):
+            for op, data in reads:
+                req = DBL_REQ(op=op, data=data)
+                dao.serve_req(req)
+                _wait_req(req)
+                self.assertIsNone(req.fail_cause, op)
+
+                if op == DBL_API.EXPORT_LGRS:
+                    deadline = time.monotonic() + 5.0
+                    while (req.succ_data.get_chunk() is not None) and (time.monotonic() < deadline):
+                        time.sleep(0.001)
+                    self.assertEqual(req.succ_data.num_rows, 0)
+                else:
+                    self.assertFalse(req.succ_data.get('lgrs') or req.succ_data.get('buckets') or
+                                     req.succ_data.get('templates') or req.succ_data.get('msgs'), op)
+
+            self.assertNotIn('nope', dao._lgrps)
+            if tmp_dir is not None:
+                self.assertFalse(os.path.exists(os.path.join(tmp_dir, 'lgrp_nope.db')))
+
+            # an append still does.
+            req = DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='nope', lgrs=_mk_test_lgrs(3)))
+            dao.serve_req(req)
+            self.assertEqual(req.succ_data, 3)
+            req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=LGR_QUERY(lgrp='nope'))
+            dao.serve_req(req)
+            self.assertEqual(len(_wait_req(req).succ_data['lgrs']), 3)
+
+        check(MemSqliteDAO())
+
+        for num_readers in (0, 2):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                check(DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=num_readers), tmp_dir)
+
+    def test_health_checks(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_filename = os.path.join(tmp_dir, 'l6sk.db')
+
+            for dao in [MemSqliteDAO(), DAO_SQLITE(db_filename=db_filename)]:
+                for op in [DBL_API.HEALTH_CHK_2, DBL_API.HEALTH_CHK_3, DBL_API.HEALTH_CHK_3]:
+                    req = DBL_REQ(op=op)
+                    dao.serve_req(req)
+                    self.assertIsNone(req.fail_cause)
+                    self.assertTrue(req.succ_data['hchk'].endswith(": OK"))
+                    self.assertGreaterEqual(req.succ_data['dao_exec_ms'], 0.0)
+
+            # the sentinel row is gone after each v3.
+            with sqlite3.connect(db_filename) as conn:
+                self.assertEqual(conn.execute("SELECT count(*) FROM hchk_sentinel").fetchone()[0], 0)
+
+    def test_disk_dao_maintenance(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=0, wal_max_bytes=64 * 1024,
+                             vacuum_step_pages=8)
+            lgrp_filename = os.path.join(tmp_dir, 'lgrp_default.db')
+
+            for i in range(10):
+                dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS,
+                                      data=LGR_APPEND_ARGS(lgrp='default', lgrs=_mk_test_lgrs(200, base_ts=i * 10**9))))
+
+            # no automatic checkpoints, the WAL has it all.
+            self.assertGreater(os.path.getsize(lgrp_filename + '-wal'), 64 * 1024)
+
+            # not due yet, and not idle.
+            self.assertFalse(dao.run_maintenance(idle=False))
+            self.assertEqual(dao.get_maint_stats()['default']['PASSIVE'], 0)
+
+            dao.run_maintenance(idle=True)
+            self.assertEqual(dao.get_maint_stats()['default']['TRUNCATE'], 1)
+            self.assertEqual(os.path.getsize(lgrp_filename + '-wal'), 0)
+
+            # free pages go back to the OS a step at a time, while idle.
+            conn = sqlite3.connect(lgrp_filename, isolation_level=None)
+            conn.execute("DELETE FROM log_record WHERE lrid <= 1500;")
+            self.assertGreater(conn.execute("PRAGMA freelist_count;").fetchone()[0], 8)
+
+            for _ in range(1000):
+                if not dao.run_maintenance(idle=True) and conn.execute("PRAGMA freelist_count;").fetchone()[0] == 0:
+                    break
+
+            self.assertEqual(conn.execute("PRAGMA freelist_count;").fetchone()[0], 0)
+            conn.close()
+
+    def test_disk_dao_archives_old_partitions(self):
+
+        # 5 one hour partitions of old records, and some current ones.
+        hour_usec = 3600 * 1000000
+        base_ts = 1604851200 * 1000000
+        lgrs = []
+        for p_idx in range(5):
+            lgrs += _mk_test_lgrs(20, base_ts=base_ts + p_idx * hour_usec)
+        lgrs += _mk_test_lgrs(20, base_ts=int(time.time() * 1000000))
+        for idx, lgr in enumerate(lgrs):
+            lgr.msg = f"request {idx} served in {idx % 7} ms, user: usr_{idx % 3}"
+
+        queries = [
+            LGR_QUERY(lgrp='default', limit=1000),
+            LGR_QUERY(lgrp='default', limit=30),
+            LGR_QUERY(lgrp='default', srv_ts_min=base_ts + hour_usec + 5000, srv_ts_max=base_ts + 3 * hour_usec + 3000),
+            LGR_QUERY(lgrp='default', lvl_min='ERRR', srv_ts_max=base_ts + 4 * hour_usec),
+        ]
+
+        for num_readers in (0, 2):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                # partitions that end 3 hours after base_ts or earlier are archived.
+                archive_after = (time.time() * 1000000 - (base_ts + 3 * hour_usec)) / 1000000
+                dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=num_readers,
+                                 archive_after=archive_after, archive_partition=3600.0, archive_interval=3600.0)
+                dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=lgrs)))
+
+                def run_queries():
+                    reqs = [DBL_REQ(op=DBL_API.QUERY_LGRS, data=query) for query in queries]
+                    for req in reqs:
+                        dao.serve_req(req)
+                    return [_wait_req(req).succ_data['lgrs'] for req in reqs]
+
+                expected = run_queries()
+                self.assertEqual(len(expected[0]), 120)
+
+                # partition 1 as it was in the hot db, for the crash below.
+                hot_conn = sqlite3.connect(os.path.join(tmp_dir, 'lgrp_default.db'), isolation_level=None)
+                hot_conn.execute("CREATE TABLE saved AS SELECT * FROM log_record WHERE srv_ts >= ? AND srv_ts < ?;",
+                                 (base_ts + hour_usec, base_ts + 2 * hour_usec))
+
+                self.assertEqual(dao.archive_lgrps(), 3)
+                self.assertEqual(dao.archive_lgrps(), 0)
+
+                arc_fnames = sorted(fname for fname in os.listdir(tmp_dir) if '.arc_' in fname)
+                self.assertEqual(len(arc_fnames), 3)
+
+                self.assertEqual(hot_conn.execute("SELECT count(*) FROM log_record;").fetchone()[0], 60)
+
+                # archive msgs are all compressed.
+                arc_conn = sqlite3.connect(os.path.join(tmp_dir, arc_fnames[0]))
+                self.assertEqual(arc_conn.execute("SELECT count(*) FROM log_record WHERE msg_dver IS NULL;").fetchone(),
+                                 (0, ))
+                arc_conn.close()
+
+                self.assertEqual(run_queries(), expected)
+
+                # pages across the hot db and the archives.
+                def query_fn(query):
+                    req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=query)
+                    dao.serve_req(req)
+                    return _wait_req(req).succ_data
+
+                self.assertEqual(_query_pages(query_fn, dataclasses.replace(queries[0], limit=7)), expected[0])
+                self.assertEqual(_query_pages(query_fn, dataclasses.replace(queries[3], limit=2)), expected[3])
+
+                # crash after an archive was in place, before its records were deleted from the hot db. They come
+                # back once, and the next run deletes them.
+                hot_conn.execute("INSERT INTO log_record SELECT * FROM saved;")
+                hot_conn.execute("DROP TABLE saved;")
+
+                self.assertEqual(run_queries(), expected)
+                self.assertEqual(dao.archive_lgrps(), 0)
+                self.assertEqual(hot_conn.execute("SELECT count(*) FROM log_record;").fetchone()[0], 60)
+                hot_conn.close()
+
+                # archives are found again by a new DAO.
+                dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=num_readers)
+                self.assertEqual(run_queries(), expected)
+
+    def test_legacy_schema_migration(self):
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        conn.executescript(LEGACY_LOG_RECORD_SCHEMA_SCRIPT)
+        conn.execute("INSERT INTO log_record(lrid, lvl, session_id, srv_ts, client_ts, lineno, tid, msg) "
+                     "VALUES (100, 'DBUG', '_sess_', '1605002109', '1604852083.2660', '17', 'tid_abc', 'Hi');")
+        conn.execute("INSERT INTO log_record(lrid, lvl, session_id, srv_ts, client_ts, msg) "
+                     "VALUES (110, NULL, '_sess_', '1605002110', NULL, 'Hi2');")
+
+        lgrp = SqliteLogGroup('default', conn)
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default'))
+        lgrs = [dict(zip(LGR_FIELDS, row)) for row in res['lgrs']]
+
+        self.assertEqual(len(lgrs), 2)
+        self.assertEqual(lgrs[0]['lrid'], 100)
+        self.assertEqual(lgrs[0]['lvl'], 'DBUG')
+        self.assertEqual(lgrs[0]['srv_ts'], 1605002109000000)
+        self.assertEqual(lgrs[0]['client_ts'], 1604852083266000)
+        self.assertEqual(lgrs[0]['lineno'], 17)
+        self.assertEqual(lgrs[0]['tid'], 'tid_abc')
+        self.assertIsNone(lgrs[1]['lvl'])
+        self.assertIsNone(lgrs[1]['client_ts'])
+
+        # new rows keep going after the migrated lrids
+        lgrp.append_lgrs(_mk_test_lgrs(1, base_ts=1605002111000000))
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default'))
+        self.assertGreater(res['lgrs'][-1][0], 110)
+
+    def test_v1_schema_migration_to_dims(self):
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        conn.executescript(sqlite_lgrp._V1_LOG_RECORD_SCHEMA_SCRIPT)  # pylint: disable=protected-access
+        conn.execute("INSERT INTO log_record(lrid, lvl, session_id, srv_ts, filename, tname, msg) "
+                     "VALUES (7, 20, 'sess_a', 1605002109000000, 'a.py', 'MainThread', 'Hi');")
+
+        lgrp = SqliteLogGroup('default', conn)
+        self.assertEqual(conn.execute("PRAGMA user_version;").fetchone()[0], sqlite_lgrp.LGRP_SCHEMA_VERSION)
+
+        lgrs = [dict(zip(LGR_FIELDS, row)) for row in lgrp.query_lgrs(LGR_QUERY(lgrp='default'))['lgrs']]
+        self.assertEqual(lgrs[0]['lrid'], 7)
+        self.assertEqual(lgrs[0]['session_id'], 'sess_a')
+        self.assertEqual(lgrs[0]['filename'], 'a.py')
+        self.assertEqual(lgrs[0]['tname'], 'MainThread')
+        self.assertIsNone(lgrs[0]['funcname'])
+
+    def test_dims_are_interned(self):
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn)
+        lgrp.append_lgrs(_mk_test_lgrs(10))
+        lgrp.append_lgrs(_mk_test_lgrs(10))
+
+        # 20 rows, one session, one file.
+        self.assertEqual(conn.execute("SELECT count(*) FROM lgr_dim_session_id;").fetchone()[0], 1)
+        self.assertEqual(conn.execute("SELECT count(*) FROM lgr_dim_filename;").fetchone()[0], 1)
+        self.assertEqual(conn.execute("SELECT count(DISTINCT session_id_ref) FROM log_record;").fetchone()[0], 1)
+
+        # a reopened log group picks the dims back up from the db.
+        lgrp = SqliteLogGroup('default', conn)
+        lgrs = [dict(zip(LGR_FIELDS, row)) for row in lgrp.query_lgrs(LGR_QUERY(lgrp='default'))['lgrs']]
+        self.assertEqual(lgrs[-1]['session_id'], 'AZxV89HW_SvGbZsyFDkDP6q0')
+
+        # a failed batch doesnt leave ids in the cache that the db doesnt have.
+        bad_lgrs = [LOG_RECORD(session_id='sess_new', msg='ok'), LOG_RECORD(lvl='NOPE', msg='bad')]
+        with self.assertRaises(KeyError):
+            lgrp.append_lgrs(bad_lgrs)
+
+        lgrp.append_lgrs([LOG_RECORD(session_id='sess_new', msg='ok')])
+        lgrs = [dict(zip(LGR_FIELDS, row)) for row in lgrp.query_lgrs(LGR_QUERY(lgrp='default'))['lgrs']]
+        self.assertEqual(lgrs[-1]['session_id'], 'sess_new')
+
+    def test_msg_compression_and_zdict_rotation(self):
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, msg_compression=True, zdict_sample_size=50, zdict_retrain_every=100)
+
+        all_lgrs = []
+        for batch_idx in range(6):
+            lgrs = _mk_test_lgrs(40, base_ts=1604852083000000 + batch_idx * 1000 * 1000)
+            for lgr in lgrs:
+                lgr.msg = f"DBL request served op=APPEND_LGRS lgrp=default batch_size={lgr.lineno} queue=norm_q"
+            lgrp.append_lgrs(lgrs)
+            all_lgrs += lgrs
+
+        # first dict after 50 records, then a new one every 100.
+        dvers = [row[0] for row in conn.execute("SELECT DISTINCT msg_dver FROM log_record ORDER BY msg_dver;")]
+        self.assertEqual(dvers, [None, 1, 2])
+        self.assertEqual(conn.execute("SELECT typeof(msg) FROM log_record WHERE msg_dver = 1 LIMIT 1;").fetchone()[0],
+                         'blob')
+
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', limit=1000))
+        self.assertEqual([row[LGR_FIELDS.index('msg')] for row in res['lgrs']], [lgr.msg for lgr in all_lgrs])
+
+        # SQL side decoding
+        sql_msgs = [row[0] for row in conn.execute("SELECT lgr_msg(msg, msg_dver) FROM log_record ORDER BY lrid;")]
+        self.assertEqual(sql_msgs, [lgr.msg for lgr in all_lgrs])
+
+        # reopen w/ compression turned off. old dictionaries still decode old rows.
+        lgrp = SqliteLogGroup('default', conn, msg_compression=False)
+        lgrp.append_lgrs([LOG_RECORD(msg='plain again')])
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', limit=1000))
+        self.assertEqual(res['lgrs'][0][LGR_FIELDS.index('msg')], all_lgrs[0].msg)
+        self.assertEqual(res['lgrs'][-1][LGR_FIELDS.index('msg')], 'plain again')
+
+    def test_repeat_collapsing(self):
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, repeat_window=10.0)
+        base_ts = 1604852083000000
+
+        def mk_lgr(session_id, msg, sec, lineno=42):
+            return LOG_RECORD(srv_ts=base_ts + int(sec * 1000000), lvl='ERRR', session_id=session_id,
+                              filename='worker.py', lineno=lineno, msg=msg)
+
+        def query():
+            res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', limit=100))
+            return [(row['session_id'], row['msg'], row['repeat_count'], row['last_srv_ts'] - row['srv_ts'])
+                    for row in (dict(zip(res['fields'], row)) for row in res['lgrs'])]
+
+        # a crash loop in sess_a, interleaved w/ sess_b. other sessions dont break a run.
+        lgrs = [mk_lgr('sess_a', 'conn refused', i * 0.1) for i in range(5)]
+        lgrs.insert(2, mk_lgr('sess_b', 'conn refused', 0.15))
+        self.assertEqual(lgrp.append_lgrs(lgrs), 6)
+
+        # next batch keeps the run going, then something else, then the same msg again starts a new row.
+        lgrp.append_lgrs([mk_lgr('sess_a', 'conn refused', 1.0), mk_lgr('sess_a', 'conn refused', 2.0),
+                          mk_lgr('sess_a', 'conn refused', 2.5, lineno=43), mk_lgr('sess_a', 'conn refused', 3.0)])
+
+        self.assertEqual(query(), [('sess_a', 'conn refused', 7, 2000000), ('sess_b', 'conn refused', 1, 0),
+                                   ('sess_a', 'conn refused', 1, 0), ('sess_a', 'conn refused', 1, 0)])
+
+        # the window counts from the first record of the run.
+        lgrp.append_lgrs([mk_lgr('sess_b', 'conn refused', 5.0), mk_lgr('sess_b', 'conn refused', 10.2)])
+        self.assertEqual(query()[1], ('sess_b', 'conn refused', 2, 4850000))
+        self.assertEqual(query()[-1], ('sess_b', 'conn refused', 1, 0))
+
+        # a failed batch doesnt count its repeats.
+        with self.assertRaises(KeyError):
+            lgrp.append_lgrs([mk_lgr('sess_b', 'conn refused', 10.3), LOG_RECORD(lvl='NOPE', msg='bad')])
+        lgrp.append_lgrs([mk_lgr('sess_b', 'conn refused', 10.4)])
+        self.assertEqual(query()[-1], ('sess_b', 'conn refused', 2, 200000))
+        self.assertEqual(conn.execute("SELECT count(*) FROM log_record;").fetchone()[0], 5)
+
+        # version 5 dbs (ie old archives) read back as not repeated, and get the columns when opened for writing.
+        conn.execute("ALTER TABLE log_record DROP COLUMN repeat_count;")
+        conn.execute("ALTER TABLE log_record DROP COLUMN last_srv_ts;")
+        conn.execute("ALTER TABLE log_record DROP COLUMN sample_rate;")
+        conn.execute("DROP INDEX log_record_template_srv_ts_idx;")
+        conn.execute("ALTER TABLE log_record DROP COLUMN template_id;")
+        conn.execute("PRAGMA user_version = 5;")
+        res = SqliteLogGroup('default', conn, read_only=True).query_lgrs(LGR_QUERY(lgrp='default'))
+        self.assertEqual({row[res['fields'].index('repeat_count')] for row in res['lgrs']}, {1})
+
+        lgrp = SqliteLogGroup('default', conn, repeat_window=10.0)
+        self.assertEqual(conn.execute("PRAGMA user_version;").fetchone()[0], sqlite_lgrp.LGRP_SCHEMA_VERSION)
+        lgrp.append_lgrs([mk_lgr('sess_c', 'hi', 20.0), mk_lgr('sess_c', 'hi', 20.5)])
+        self.assertEqual(query()[-1], ('sess_c', 'hi', 2, 500000))
+
+    def test_full_text_search(self):
+
+        msgs = ["connect to db-3 failed: connection refused", "request served in 12 ms", "retrying upstream timeout",
+                "connection reset by peer", "upstream timeout after 30 s"]
+
+        def mk_lgrs(count, base_ts):
+            lgrs = _mk_test_lgrs(count, base_ts=base_ts)
+            for idx, lgr in enumerate(lgrs):
+                lgr.msg = msgs[idx % len(msgs)]
+            return lgrs
+
+        def search(lgrp, msg_match, **kwargs):
+            query = LGR_QUERY(lgrp='default', msg_match=msg_match, limit=3, **kwargs)
+            return [row[LGR_FIELDS.index('lineno')] for row in _query_pages(lgrp.query_lgrs, query)]
+
+        # sync, compressed msgs. searchable as soon as they are appended.
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, msg_compression=True, zdict_sample_size=20, fts='sync')
+        for batch_idx in range(4):
+            lgrp.append_lgrs(mk_lgrs(25, 1604852083000000 + batch_idx * 1000 * 1000))
+
+        self.assertGreater(conn.execute("SELECT count(*) FROM log_record WHERE msg_dver IS NOT NULL;").fetchone()[0], 0)
+        self.assertEqual(search(lgrp, 'timeout upstream'), [2, 4, 7, 9, 12, 14, 17, 19, 22, 24] * 4)
+        self.assertEqual(search(lgrp, '"connection refused"'), [0, 5, 10, 15, 20] * 4)
+        self.assertEqual(search(lgrp, 'conn*', lvl_min='ERRR'), [5, 8, 20, 23] * 4)
+        self.assertEqual(search(lgrp, 'refused OR reset', srv_ts_max=1604852083000000 + 10 * 1000),
+                         [0, 3, 5, 8, 10])
+        self.assertEqual(search(lgrp, 'nothing'), [])
+        self.assertEqual(lgrp.index_fts(), {'indexed': 0, 'backlog': 0})
+        conn.execute("INSERT INTO lgr_fts(lgr_fts, rank) VALUES ('integrity-check', 1);")
+
+        for msg_match in ('timeout AND', '"timeout', 'NOT', 'x:timeout'):
+            with self.assertRaises(LgrQueryError):
+                search(lgrp, msg_match)
+
+        # no index, no msg searches.
+        with self.assertRaises(LgrQueryError):
+            search(SqliteLogGroup('default', sqlite3.connect(":memory:", isolation_level=None)), 'timeout')
+
+        # deferred. appends dont index, index_fts() catches up a batch at a time.
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, fts='deferred', fts_batch_size=40)
+        lgrp.append_lgrs(mk_lgrs(100, 1604852083000000))
+        self.assertEqual(search(lgrp, 'refused'), [])
+
+        self.assertEqual(lgrp.index_fts(), {'indexed': 40, 'backlog': 60})
+        self.assertEqual(search(lgrp, 'refused'), list(range(0, 40, 5)))
+        self.assertEqual(lgrp.index_fts(), {'indexed': 40, 'backlog': 20})
+        self.assertEqual(lgrp.index_fts(), {'indexed': 20, 'backlog': 0})
+        self.assertEqual(search(lgrp, 'refused'), list(range(0, 100, 5)))
+
+        # switched to sync w/ a backlog. the backlog goes first, then the batch.
+        lgrp.append_lgrs(mk_lgrs(10, 1604852090000000))
+        lgrp = SqliteLogGroup('default', conn, fts='sync', fts_batch_size=40)
+        lgrp.append_lgrs(mk_lgrs(10, 1604852095000000))
+        self.assertEqual(search(lgrp, 'refused'), list(range(0, 100, 5)) + [0, 5, 0, 5])
+        conn.execute("INSERT INTO lgr_fts(lgr_fts, rank) VALUES ('integrity-check', 1);")
+
+        # thru the DAO
+        dao = MemSqliteDAO(lgrp_opts={"*": {"fts": 'deferred'}})
+        dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=mk_lgrs(30, 0))))
+        req = DBL_REQ(op=DBL_API.INDEX_FTS)
+        dao.serve_req(req)
+        self.assertEqual(req.succ_data, {'indexed': 30, 'backlog': 0})
+
+        req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=LGR_QUERY(lgrp='default', msg_match='"reset by peer"'))
+        dao.serve_req(req)
+        self.assertEqual(len(req.succ_data['lgrs']), 6)
+
+        # a malformed msg_match, or one on a log group w/o the index, is the client's. a 400, not a 500.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            no_fts_daos = [MemSqliteDAO(), DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=2)]
+            for no_fts_dao in no_fts_daos:
+                no_fts_dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS,
+                                             data=LGR_APPEND_ARGS(lgrp='default', lgrs=mk_lgrs(3, 0))))
+
+            for bad_dao, query in [(dao, LGR_QUERY(lgrp='default', msg_match='timeout AND')),
+                                   (no_fts_daos[0], LGR_QUERY(lgrp='default', msg_match='timeout')),
+                                   (no_fts_daos[1], LGR_QUERY(lgrp='default', msg_match='timeout')),
+                                   (no_fts_daos[1], LGR_QUERY(lgrp='default', msg_match='"timeout'))]:
+                for req in [DBL_REQ(op=DBL_API.QUERY_LGRS, data=query),
+                            DBL_REQ(op=DBL_API.QUERY_MULTI_LGRS, data=LGR_MULTI_QUERY(query=query))]:
+                    bad_dao.serve_req(req)
+                    _wait_req(req)
+                    self.assertIsNone(req.succ_data)
+                    self.assertEqual(req.fail_cause.http_err_code, 400)
+                    self.assertNotEqual(req.fail_cause.user_msg, 'Internal Server Error')
+
+    def test_disk_dao_full_text_search_across_archives(self):
+
+        hour_usec = 3600 * 1000000
+        base_ts = 1604851200 * 1000000
+        lgrs = []
+        for p_idx in range(4):
+            lgrs += _mk_test_lgrs(30, base_ts=base_ts + p_idx * hour_usec)
+        lgrs += _mk_test_lgrs(30, base_ts=int(time.time() * 1000000))
+        for idx, lgr in enumerate(lgrs):
+            lgr.msg = f"request {idx} served in {idx % 7} ms, user: usr_{idx % 3}"
+
+        queries = [LGR_QUERY(lgrp='default', msg_match='usr_1', limit=1000),
+                   LGR_QUERY(lgrp='default', msg_match='"in 3 ms"', limit=1000),
+                   LGR_QUERY(lgrp='default', msg_match='usr_2 NOT "in 0 ms"', lvl_min='INFO', limit=4)]
+
+        for fts in ('sync', 'deferred'):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                archive_after = (time.time() * 1000000 - (base_ts + 3 * hour_usec)) / 1000000
+                dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=2,
+                                 lgrp_opts={"*": {"fts": fts, "fts_batch_size": 100}}, archive_after=archive_after,
+                                 archive_partition=3600.0, archive_interval=3600.0)
+                dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=lgrs)))
+
+                def query_fn(query):
+                    req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=query)
+                    dao.serve_req(req)
+                    return _wait_req(req).succ_data
+
+                # deferred: index half of it, then archive. Archives are indexed whole, the hot db catches up later.
+                if fts == 'deferred':
+                    req = DBL_REQ(op=DBL_API.INDEX_FTS)
+                    dao.serve_req(req)
+                    self.assertEqual(req.succ_data, {'indexed': 100, 'backlog': 50})
+
+                self.assertEqual(dao.archive_lgrps(), 3)
+
+                if fts == 'deferred':
+                    req = DBL_REQ(op=DBL_API.INDEX_FTS, data='default')
+                    dao.serve_req(req)
+                    self.assertEqual(req.succ_data, {'indexed': 50, 'backlog': 0})
+
+                lrids = [[row[0] for row in _query_pages(query_fn, query)] for query in queries]
+                self.assertEqual(lrids[0], [idx + 1 for idx in range(150) if idx % 3 == 1])
+                self.assertEqual(lrids[1], [idx + 1 for idx in range(150) if idx % 7 == 3])
+                self.assertEqual(lrids[2], [idx + 1 for idx in range(150) if idx % 3 == 2 and idx % 7])
+
+                # the archived records are out of the hot db's index too.
+                hot_conn = sqlite3.connect(os.path.join(tmp_dir, 'lgrp_default.db'), isolation_level=None)
+                self.assertEqual(hot_conn.execute("SELECT count(*) FROM log_record;").fetchone()[0], 60)
+                dao._get_lgrp('default').prepare_conn(hot_conn)
+                hot_conn.execute("INSERT INTO lgr_fts(lgr_fts, rank) VALUES ('integrity-check', 1);")
+                self.assertEqual(hot_conn.execute("SELECT count(*) FROM lgr_fts WHERE lgr_fts MATCH 'request';")
+                                 .fetchone()[0], 60)
+                hot_conn.close()
+
+    def test_regex_filters(self):
+
+        lgrs = _mk_test_lgrs(60)
+        for idx, lgr in enumerate(lgrs):
+            lgr.filename = f"src/{['net', 'db', 'ui'][idx % 4 % 3]}/mod_{idx % 4}.py"
+            lgr.msg = f"request {idx} served in {idx % 7} ms"
+
+        def search(query_fn, **kwargs):
+            query = LGR_QUERY(lgrp='default', limit=4, **kwargs)
+            return [row[LGR_FIELDS.index('lineno')] for row in _query_pages(query_fn, query)]
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, msg_compression=True, zdict_sample_size=20, regex_max_len=40)
+        lgrp.append_lgrs(lgrs[:30])
+        lgrp.append_lgrs(lgrs[30:])
+        self.assertGreater(conn.execute("SELECT count(*) FROM log_record WHERE msg_dver IS NOT NULL;").fetchone()[0], 0)
+
+        self.assertEqual(search(lgrp.query_lgrs, msg_regex=r"in [34] ms$"), [i for i in range(60) if i % 7 in (3, 4)])
+        self.assertEqual(search(lgrp.query_lgrs, filename_regex=r"^src/(net|ui)/"),
+                         [i for i in range(60) if i % 4 != 1])
+        self.assertEqual(search(lgrp.query_lgrs, filename_regex=r"mod_3", msg_regex=r"in 0 ms", lvl_min='ERRR'), [35])
+        self.assertEqual(search(lgrp.query_lgrs, msg_regex=r"request 1\d ", srv_ts_max=1604852083000000 + 14 * 1000),
+                         list(range(10, 15)))
+        self.assertEqual(search(lgrp.query_lgrs, filename_regex=r"nothing"), [])
+
+        # pathological, too long or broken patterns never get to run.
+        for pattern in (r"(a+)+$", r"(\w+\s+)*x", r"(x{2,}){3}", "x" * 41, r"(unclosed", r"(a+b?)+$", r"(a|aa)+$",
+                        r"(\w+\s?)+$", r"(.*a){12}", r"(a?)+", r".*.*.*.*x"):
+            with self.assertRaises(ValueError):
+                lgrp.query_lgrs(LGR_QUERY(lgrp='default', msg_regex=pattern))
+        self.assertEqual(search(lgrp.query_lgrs, msg_regex=r"\(a\+\)+"), [])
+
+        # the rest is polynomial, patterns only search as much of a value as they can in REGEX_STEP_BUDGET steps.
+        self.assertEqual(check_regex(r"timeout").max_value_len, 10**8)
+        self.assertEqual(check_regex(r"timeout after \d+ ms").max_value_len, 9999)
+        self.assertEqual(check_regex(r".*.*x").search("a" * 400 + "x").start(), 0)
+        self.assertIsNone(check_regex(r".*.*x").search("a" * 1000 + "x"))
+
+        # over regex_timeout, the query is interrupted. the connection is fine after. (deadline checks are every 10k
+        # sqlite instructions, it takes a few thousand rows to get to one)
+        lgrp = SqliteLogGroup('default', sqlite3.connect(":memory:", isolation_level=None), regex_timeout=0.0)
+        lgrp.append_lgrs(_mk_test_lgrs(5000))
+        with self.assertRaises(TimeoutError):
+            lgrp.query_lgrs(LGR_QUERY(lgrp='default', msg_regex=r"nothing"))
+        self.assertEqual(len(lgrp.query_lgrs(LGR_QUERY(lgrp='default', limit=10000))['lgrs']), 5000)
+
+        # disk DAO, on the reader threads' connections.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=2)
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=lgrs)))
+
+            def query_fn(query):
+                req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=query)
+                dao.serve_req(req)
+                return _wait_req(req).succ_data
+
+            self.assertEqual(search(query_fn, msg_regex=r"in 6 ms", filename_regex=r"/db/"), [13, 41])
+
+    def test_histogram_rollups(self):
+
+        hour = 3600 * 1000000
+        base_ts = 1604851200000000  # on the hour
+
+        # 3 hours of records, one every 20 seconds. some w/o a level, some sampled, some repeats.
+        lgrs = []
+        for i in range(540):
+            lgrs.append(LOG_RECORD(srv_ts=base_ts + i * 20 * 1000000, lvl=[None, 'INFO', 'INFO', 'ERRR'][i % 4],
+                                   subsys=['net', 'db', None][i % 3], session_id=f"sess_{i % 4}",
+                                   sample_rate=0.25 if i % 4 == 1 else None, msg="hello"))
+
+        def expected(bucket_usec, lvls=None, subsys=None):
+            counts = {}
+            for lgr in lgrs:
+                if ((lvls is None) or (lgr.lvl in lvls)) and ((subsys is None) or (lgr.subsys == subsys)):
+                    key = (lgr.srv_ts - lgr.srv_ts % bucket_usec, lgr.lvl)
+                    counts[key] = counts.get(key, 0) + 1
+            # in lvl code order, no level first.
+            keys = sorted(counts, key=lambda key: (key[0], LGR_LVL_CODES.get(key[1], 0)))
+            return [key + (None, counts[key]) for key in keys]
+
+        def hist(lgrp, **kwargs):
+            return [row[:4] for row in lgrp.histogram_lgrs(LGR_HISTOGRAM(lgrp='default', **kwargs))['buckets']]
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, repeat_window=120.0, rollup_subsys=True, rollup_minute_retention=None)
+        for batch_start in range(0, len(lgrs), 100):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + 100])
+
+        # repeats were collapsed, they still count.
+        self.assertLess(conn.execute("SELECT count(*) FROM log_record;").fetchone()[0], len(lgrs))
+        self.assertEqual(hist(lgrp), expected(60 * 1000000))
+        self.assertEqual(hist(lgrp, bucket_sec=3600), expected(hour))
+        self.assertEqual(hist(lgrp, bucket_sec=600, lvls=frozenset({'INFO'})),
+                         expected(600 * 1000000, lvls={'INFO'}))
+        self.assertEqual(hist(lgrp, bucket_sec=7200, lvl_min='WARN', subsys='db'),
+                         expected(2 * hour, lvls={'ERRR'}, subsys='db'))
+
+        # bucket of srv_ts_min upto the one of srv_ts_max.
+        self.assertEqual(hist(lgrp, bucket_sec=3600, srv_ts_min=base_ts + hour + 1, srv_ts_max=base_ts + 2 * hour),
+                         [row for row in expected(hour) if row[0] in (base_ts + hour, base_ts + 2 * hour)])
+
+        # est_count re-weighs the sampled ones. every INFO record w/ an odd i is 4 records.
+        res = lgrp.histogram_lgrs(LGR_HISTOGRAM(lgrp='default', bucket_sec=3600 * 24, lvls=frozenset({'INFO'})))
+        self.assertEqual(res['fields'], ('bucket_ts', 'lvl', 'subsys', 'count', 'est_count'))
+        self.assertEqual(res['buckets'], [(base_ts - base_ts % (24 * hour), 'INFO', None, 270, 135 * 4 + 135.0)])
+
+        res = lgrp.histogram_lgrs(LGR_HISTOGRAM(lgrp='default', bucket_sec=3600 * 24, lvls=frozenset({'ERRR'}),
+                                                by_subsys=True))
+        self.assertEqual([row[2:4] for row in res['buckets']], [(None, 45), ('db', 45), ('net', 45)])
+
+        # a failed batch doesnt count.
+        with self.assertRaises(KeyError):
+            lgrp.append_lgrs([LOG_RECORD(srv_ts=base_ts, lvl='INFO'), LOG_RECORD(srv_ts=base_ts, lvl='NOPE')])
+        self.assertEqual(hist(lgrp, bucket_sec=3600), expected(hour))
+
+        # a group that didnt have rollups gets the records already there counted when it does. (as is, repeats count
+        # in the bucket their run started in)
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, rollups=False)
+        lgrp.append_lgrs(lgrs)
+        with self.assertRaises(ValueError):
+            hist(lgrp)
+
+        lgrp = SqliteLogGroup('default', conn)
+        self.assertEqual(hist(lgrp), expected(60 * 1000000))
+        with self.assertRaises(ValueError):
+            hist(lgrp, subsys='db')
+        with self.assertRaises(ValueError):
+            hist(lgrp, bucket_sec=90)
+
+        # minute rollups past rollup_minute_retention go once appends get to a new hour, hour ones stay.
+        lgrp = SqliteLogGroup('default', conn, rollup_minute_retention=3600.0)
+        lgrp.append_lgrs([LOG_RECORD(srv_ts=base_ts + 3 * hour + 1, lvl='INFO')])
+        self.assertEqual({row[0] for row in hist(lgrp)}, {base_ts + 2 * hour + i * 60 * 1000000 for i in range(60)} |
+                         {base_ts + 3 * hour})
+        self.assertEqual(len(hist(lgrp, bucket_sec=3600, lvls=frozenset({'ERRR'}))), 3)
+
+        # disk DAO, on the reader threads' connections.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=2)
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=lgrs)))
+
+            req = DBL_REQ(op=DBL_API.HISTOGRAM_LGRS, data=LGR_HISTOGRAM(lgrp='default', bucket_sec=3600))
+            dao.serve_req(req)
+            self.assertEqual([row[:4] for row in _wait_req(req).succ_data['buckets']], expected(hour))
+
+    def test_session_summaries(self):
+
+        base_ts = 1604851200000000
+
+        # two runs of the same program. run_2 also fails to connect, over and over, and logs fewer requests.
+        lgrs = []
+        for i in range(600):
+            lgrs.append(LOG_RECORD(srv_ts=base_ts + i * 1000000, lvl=['INFO', 'DBUG', None][i % 3], session_id='run_1',
+                                   filename=['app.py', 'http.py'][i % 2], msg=f"request {i % 40} served"))
+        for i in range(500):
+            if i % 5 == 0:
+                lgr = LOG_RECORD(srv_ts=base_ts + 3600000000 + i * 1000000, lvl='ERRR', session_id='run_2',
+                                 filename='db.py', msg="connection refused")
+            else:
+                lgr = LOG_RECORD(srv_ts=base_ts + 3600000000 + i * 1000000, lvl=['INFO', 'DBUG', None][i % 3],
+                                 session_id='run_2', filename=['app.py', 'http.py'][i % 2],
+                                 msg=f"request {i % 40} served")
+            lgrs.append(lgr)
+        lgrs.append(LOG_RECORD(srv_ts=base_ts, lvl='INFO', msg="no session"))
+
+        def expected(session_id):
+            session_lgrs = [lgr for lgr in lgrs if lgr.session_id == session_id]
+            lvls = {}
+            files = {}
+            msgs = {}
+            for lgr in session_lgrs:
+                lvls[lgr.lvl] = lvls.get(lgr.lvl, 0) + 1
+                files[lgr.filename] = files.get(lgr.filename, 0) + 1
+                msgs[lgr.msg] = msgs.get(lgr.msg, 0) + 1
+            return (min(lgr.srv_ts for lgr in session_lgrs), max(lgr.srv_ts for lgr in session_lgrs),
+                    len(session_lgrs), lvls, files), msgs
+
+        def check_summary(summary, session_id, exact_msgs=False):
+            expected_summary, msgs = expected(session_id)
+            self.assertEqual((summary['first_srv_ts'], summary['last_srv_ts'], summary['count'], summary['lvls'],
+                              summary['files']), expected_summary)
+
+            # Space-Saving: every count is an upper bound, count - err a lower one. whatever is left out was seen at
+            # most msg_min_count times, so anything seen more than that is in.
+            for msg, count, err in summary['msgs']:
+                self.assertLessEqual(count - err, msgs[msg])
+                self.assertLessEqual(msgs[msg], count)
+                if exact_msgs:
+                    self.assertEqual(err, 0)
+            self.assertLessEqual(len(summary['msgs']), 10)
+            counted = {row[0] for row in summary['msgs']}
+            for msg, count in msgs.items():
+                if msg not in counted:
+                    self.assertLessEqual(count, summary['msg_min_count'])
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, repeat_window=60.0, session_top_msgs=10)
+        for batch_start in range(0, len(lgrs), 70):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + 70])
+
+        check_summary(lgrp.summarize_session('run_1'), 'run_1')
+        check_summary(lgrp.summarize_session('run_2'), 'run_2')
+        self.assertIsNone(lgrp.summarize_session('run_3'))
+
+        # the refused connections are the biggest difference, and the regex that comes w/ them gets just those.
+        diff = lgrp.diff_sessions(LGR_SESSION_DIFF(lgrp='default', session_a='run_1', session_b='run_2', top=5))
+        self.assertEqual(diff['lvls'], [(None, 200, 133), ('DBUG', 200, 134), ('INFO', 200, 133), ('ERRR', 0, 100)])
+        self.assertEqual(diff['files'][0], ('app.py', 300, 200, '^app\\.py$'))
+        self.assertIn(('db.py', 0, 100, '^db\\.py$'), diff['files'])
+        self.assertEqual(len(diff['msgs']), 5)
+
+        msg, count_a, err_a, count_b, err_b, msg_regex = diff['msgs'][0]
+        self.assertEqual((msg, count_b, err_b), ("connection refused", 100, 0))
+        self.assertLessEqual(count_a - err_a, 0)
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', session_id='run_2', msg_regex=msg_regex, limit=1000))
+        self.assertEqual(sum(row[res['fields'].index('repeat_count')] or 1 for row in res['lgrs']), 100)
+        self.assertEqual(diff['fields']['msgs'], ('msg', 'count_a', 'err_a', 'count_b', 'err_b', 'msg_regex'))
+
+        diff = lgrp.diff_sessions(LGR_SESSION_DIFF(lgrp='default', session_a='run_1', session_b='run_3'))
+        self.assertIsNone(diff['b'])
+        self.assertEqual(diff['msgs'], [])
+
+        # a failed batch doesnt count.
+        with self.assertRaises(KeyError):
+            lgrp.append_lgrs([LOG_RECORD(srv_ts=base_ts, lvl='INFO', session_id='run_1'),
+                              LOG_RECORD(srv_ts=base_ts, lvl='NOPE', session_id='run_1')])
+        check_summary(lgrp.summarize_session('run_1'), 'run_1')
+
+        # a group that didnt have summaries gets the records already there summarized when it does. msg counts are
+        # exact then.
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, session_summaries=False)
+        lgrp.append_lgrs(lgrs)
+        with self.assertRaises(ValueError):
+            lgrp.summarize_session('run_1')
+
+        lgrp = SqliteLogGroup('default', conn, session_top_msgs=10)
+        check_summary(lgrp.summarize_session('run_1'), 'run_1', exact_msgs=True)
+        check_summary(lgrp.summarize_session('run_2'), 'run_2', exact_msgs=True)
+
+        # disk DAO, on the reader threads' connections.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=2,
+                             lgrp_opts={"*": {"session_top_msgs": 10}})
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=lgrs)))
+
+            req = DBL_REQ(op=DBL_API.DIFF_SESSIONS, data=LGR_SESSION_DIFF(lgrp='default', session_a='run_1',
+                                                                          session_b='run_2'))
+            dao.serve_req(req)
+            check_summary(_wait_req(req).succ_data['b'], 'run_2')
+            self.assertEqual(req.succ_data['lvls'][-1], ('ERRR', 0, 100))
+
+    def test_templates(self):
+
+        base_ts = 1604851200000000
+        hour = 3600 * 1000000
+
+        # 3 hours. a couple of busy templates, a timeout that shows up in the 2nd hour, and a tail of one offs.
+        lgrs = []
+        for i in range(3000):
+            srv_ts = base_ts + (i // 1000) * hour + i * 1000
+            if i % 3 == 0:
+                msg = f"request {i} served in {i % 97} ms"
+            elif i % 3 == 1:
+                msg = f"cache miss for key '{i:x}'"
+            elif (i // 1000 == 1) and (i % 2 == 0):
+                msg = f"upstream 10.0.0.{i % 7} timed out after 0x{i:x}"
+            else:
+                msg = f"one off {i} {chr(ord('a') + i % 26) * (i % 50 + 1)}"
+            lgrs.append(LOG_RECORD(srv_ts=srv_ts, lvl='INFO', session_id='run_1', msg=msg))
+        lgrs.append(LOG_RECORD(srv_ts=base_ts, lvl='INFO', session_id='run_1'))
+
+        true_counts = {}
+        for lgr in lgrs:
+            if lgr.msg is not None:
+                template_id = get_msg_template(lgr.msg)[0]
+                true_counts[template_id] = true_counts.get(template_id, 0) + 1
+
+        def check_top(res, limit):
+            self.assertEqual(res['total'], len(lgrs) - 1)
+            self.assertLessEqual(len(res['templates']), limit)
+            for template_id, template, count, count_min, count_max in res['templates']:
+                self.assertEqual(get_msg_template(template)[0], template_id)
+                self.assertLessEqual(count_min, true_counts[template_id])
+                self.assertLessEqual(true_counts[template_id], count_max)
+            self.assertEqual([row[2] for row in res['templates']],
+                             sorted((row[2] for row in res['templates']), reverse=True))
+
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, template_top_k=20, template_retention=None)
+        for batch_start in range(0, len(lgrs), 100):
+            lgrp.append_lgrs(lgrs[batch_start:batch_start + 100])
+
+        res = lgrp.top_templates(LGR_TEMPLATE_TOP(lgrp='default', limit=5))
+        check_top(res, 5)
+        self.assertEqual(res['fields'], ('template_id', 'template', 'count', 'count_min', 'count_max'))
+        self.assertEqual({row[1] for row in res['templates'][:2]},
+                         {"request <num> served in <num> ms", "cache miss for key <str>"})
+        self.assertEqual(res['templates'][0][2], 1000)
+
+        # the timeout is in the 2nd hour only.
+        res = lgrp.top_templates(LGR_TEMPLATE_TOP(lgrp='default', srv_ts_min=base_ts + hour + 1,
+                                                  srv_ts_max=base_ts + hour + 2))
+        self.assertEqual(res['total'], 1000)
+        template_id = get_msg_template("upstream 10.0.0.1 timed out after 0x1")[0]
+        self.assertIn((template_id, "upstream <num> timed out after <hex>", true_counts[template_id]),
+                      [row[:3] for row in res['templates']])
+
+        # every record has its template id, and a query by it gets exactly the template's records, off the index.
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', limit=None))
+        msg_idx, template_idx = res['fields'].index('msg'), res['fields'].index('template_id')
+        self.assertEqual([row[template_idx] for row in res['lgrs']],
+                         [None if row[msg_idx] is None else get_msg_template(row[msg_idx])[0] for row in res['lgrs']])
+        self.assertEqual(sum(row[template_idx] is None for row in res['lgrs']), 1)
+        res = lgrp.query_lgrs(LGR_QUERY(lgrp='default', template_id=template_id, limit=None))
+        self.assertEqual(len(res['lgrs']), true_counts[template_id])
+        self.assertTrue(all(row[res['fields'].index('msg')].startswith("upstream ") for row in res['lgrs']))
+        sql, params, _ = lgrp._get_query_sql(LGR_QUERY(lgrp='default', template_id=template_id), None)
+        plan = " ".join(row[-1] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params))
+        self.assertIn("log_record_template_srv_ts_idx", plan)
+
+        # hour counts past retention go, and so do the templates only they had.
+        lgrp = SqliteLogGroup('default', conn, template_top_k=20, template_retention=3600.0)
+        lgrp.append_lgrs([LOG_RECORD(srv_ts=base_ts + 5 * hour, lvl='INFO', msg="took 5 ms")])
+        res = lgrp.top_templates(LGR_TEMPLATE_TOP(lgrp='default'))
+        self.assertEqual([row[1:3] for row in res['templates']], [("took <num> ms", 1)])
+        self.assertEqual(conn.execute("SELECT count(*) FROM lgr_template;").fetchone()[0], 1)
+        lgrp.append_lgrs([LOG_RECORD(srv_ts=base_ts + 6 * hour, lvl='INFO', msg="request 1 served in 2 ms")])
+        self.assertEqual(conn.execute("SELECT count(*) FROM lgr_template;").fetchone()[0], 2)
+
+        # w/o templates, records get no template id and there are no counts.
+        conn = sqlite3.connect(":memory:", isolation_level=None)
+        lgrp = SqliteLogGroup('default', conn, templates=False)
+        lgrp.append_lgrs(lgrs[:10])
+        self.assertEqual(lgrp.query_lgrs(LGR_QUERY(lgrp='default', template_id=template_id))['lgrs'], [])
+        with self.assertRaises(ValueError):
+            lgrp.top_templates(LGR_TEMPLATE_TOP(lgrp='default'))
+
+        # disk DAO, on the reader threads' connections.
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=2,
+                             lgrp_opts={"*": {"template_top_k": 20, "template_retention": None}})
+            dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp='default', lgrs=lgrs)))
+
+            req = DBL_REQ(op=DBL_API.TOP_TEMPLATES, data=LGR_TEMPLATE_TOP(lgrp='default', limit=3))
+            dao.serve_req(req)
+            check_top(_wait_req(req).succ_data, 3)
+
+    def test_multi_query(self):
+
+        base_ts = 1604852083000000
+
+        # 3 log groups, interleaved in time, w/ records at the same srv_ts in more than one group.
+        lgrs_by_lgrp = {}
+        for lgrp_idx, lgrp in enumerate(['alpha', 'beta_1', 'gamma']):
+            lgrs_by_lgrp[lgrp] = [LOG_RECORD(srv_ts=base_ts + (i * 3 + lgrp_idx) // 2 * 1000,
+                                             lvl=['DBUG', 'INFO', 'ERRR'][(i + lgrp_idx) % 3], lineno=i,
+                                             msg=f"{lgrp} {i}") for i in range(40 + lgrp_idx * 10)]
+
+        def expected(lgrp_query_fn, query, lgrps):
+            rows = []
+            for lgrp in lgrps:
+                rows += [row + (lgrp, ) for row in lgrp_query_fn(dataclasses.replace(query, lgrp=lgrp, limit=None))]
+            return sorted(rows, key=lambda row: (row[1], row[-1], row[0]))
+
+        def check(dao, query_fn):
+            for lgrp, lgrs in lgrs_by_lgrp.items():
+                dao.serve_req(DBL_REQ(op=DBL_API.APPEND_LGRS, data=LGR_APPEND_ARGS(lgrp=lgrp, lgrs=lgrs)))
+
+            def lgrp_query_fn(query):
+                req = DBL_REQ(op=DBL_API.QUERY_LGRS, data=query)
+                dao.serve_req(req)
+                return _wait_req(req).succ_data['lgrs']
+
+            for query, lgrps in [(LGR_QUERY(lgrp=None, limit=7), None),
+                                 (LGR_QUERY(lgrp=None, limit=5, lvl_min='INFO'), ('alpha', 'gamma')),
+                                 (LGR_QUERY(lgrp=None, limit=1000, srv_ts_min=base_ts + 20000), ('beta_1', )),
+                                 (LGR_QUERY(lgrp=None, limit=3, msg_regex=" 1[0-9]$"), None)]:
+                mquery = LGR_MULTI_QUERY(query=query, lgrps=lgrps)
+                res = query_fn(mquery)
+                self.assertEqual(res['fields'][-1], 'lgrp')
+
+                # a page at a time, w/ the cursor, is the same as a merge of everything.
+                rows = []
+                while True:
+                    page = query_fn(mquery)['lgrs']
+                    self.assertLessEqual(len(page), query.limit)
+                    rows += page
+                    after = get_next_multi_page_after(mquery, page)
+                    if after is None:
+                        break
+                    mquery = dataclasses.replace(mquery, after=after)
+
+                self.assertEqual(rows, expected(lgrp_query_fn, query, lgrps or sorted(lgrs_by_lgrp)))
+                self.assertTrue(rows)
+
+            # a log group that cant be queried fails the whole thing.
+            with self.assertRaises(RuntimeError):
+                query_fn(LGR_MULTI_QUERY(query=LGR_QUERY(lgrp=None), lgrps=('alpha', 'bad-name')))
+
+        def mk_query_fn(dao):
+            def query_fn(mquery):
+                req = DBL_REQ(op=DBL_API.QUERY_MULTI_LGRS, data=mquery)
+                dao.serve_req(req)
+                if _wait_req(req).fail_cause is not None:
+                    raise RuntimeError(req.fail_cause.dbg_info_string)
+                return req.succ_data
+            return query_fn
+
+        dao = MemSqliteDAO()
+        check(dao, mk_query_fn(dao))
+
+        for num_readers in (0, 2):
+            with tempfile.TemporaryDirectory() as tmp_dir:
+                dao = DAO_SQLITE(db_filename=os.path.join(tmp_dir, 'l6sk.db'), num_readers=num_readers)
+                check(dao, mk_query_fn(dao))
+
+    def test_lgrp_opts(self):
+
+        lgrp_opts = {"*": {"msg_compression": False, "zdict_sample_size": 10}, "noisy": {"msg_compression": True}}
+
+        self.assertEqual(get_lgrp_opts(lgrp_opts, "quiet"), {"msg_compression": False, "zdict_sample_size": 10})
+        self.assertEqual(get_lgrp_opts(lgrp_opts, "noisy"), {"msg_compression": True, "zdict_sample_size": 10})
+        self.assertEqual(get_lgrp_opts(None, "noisy"), {})
 
 
 if __name__ == '__main__':